@@ -42,6 +42,10 @@ class CacheTestCase(unittest.TestCase):
         def my_fast_cache_func(arg):
             return arg
 
+        @cache(max_size = 100)
+        def my_bounded_cache_func(arg):
+            return arg
+
         def func_cache_hasheable():
             my_cache_func(5)
 
@@ -64,6 +68,11 @@ class CacheTestCase(unittest.TestCase):
 
         self.runner_fast  = stress_util.MainRunner(func_fast_cache, "cache_fast")
 
+        def func_bounded_cache():
+            my_bounded_cache_func(5)
+
+        self.runner_bounded  = stress_util.MainRunner(func_bounded_cache, "cache_bounded")
+
     def _show_results(self, l):
         return "max: %s; avg: %s; next max: %s" % (max(l), avg(l), next_max(l,4))
 
@@ -111,6 +120,17 @@ class CacheTestCase(unittest.TestCase):
         max_time   =   2 # And this is far too much
         print "con_fast",self._show_results(self.runner_fast.run_threaded(threads, iterations, max_time))
 
+    def test_sequential_bounded(self):
+        iterations = 10000
+        max_time   = 0.3
+        print "seq_bounded",self._show_results(self.runner_bounded.run_sequential(iterations, max_time))
+
+    def test_concurrent_bounded(self):
+        threads    = 200
+        iterations =  50
+        max_time   =   2 # And this is far too much
+        print "con_bounded",self._show_results(self.runner_bounded.run_threaded(threads, iterations, max_time))
+
 def suite():
     return unittest.makeSuite(CacheTestCase)
 
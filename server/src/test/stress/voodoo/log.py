@@ -1,6 +1,8 @@
+import time
 import unittest
 
 import test.util.stress as stress_util
+import voodoo.log as log
 from voodoo.log import logged
 
 def avg(l):
@@ -33,6 +35,9 @@ class TestingLog(object):
         except ZeroDivisionError:
             pass
 
+    def not_logged_method(self, a, b):
+        return a + b
+
 class LogTestCase(unittest.TestCase):
     def setUp(self):
         testing_log = TestingLog()
@@ -58,6 +63,28 @@ class LogTestCase(unittest.TestCase):
         max_time   = 0.3
         print "seq_wrong",self._show_results(self.runner_wrong.run_sequential(iterations, max_time))
 
+    def test_sequential_disabled(self):
+        # The logger of TestingLog is not enabled for debug, so this is the
+        # overhead of @logged in every call in production
+        testing_log = TestingLog()
+        iterations  = 200000
+        results = []
+        for name, method in (('not logged', testing_log.not_logged_method), ('logged', testing_log.normal_method)):
+            t0 = time.time()
+            for _ in xrange(iterations):
+                method(1, 2)
+            results.append("%s: %.2f us/call" % (name, (time.time() - t0) * 1000000 / iterations))
+
+        log.enable_tracing()
+        try:
+            t0 = time.time()
+            for _ in xrange(iterations):
+                testing_log.normal_method(1, 2)
+            results.append("logged and traced: %.2f us/call" % ((time.time() - t0) * 1000000 / iterations))
+        finally:
+            log.disable_tracing()
+        print "seq_disabled", "; ".join(results)
+
     def test_concurrent_wrong(self):
         threads    = 200
         iterations =  50
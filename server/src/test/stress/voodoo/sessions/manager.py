@@ -13,8 +13,17 @@
 # Author: Pablo Orduña <pablo@ordunya.com>
 #
 
+import sys
+import time
 import unittest
 
+try:
+    import redis
+except ImportError:
+    redis = None
+
+REDIS_AVAILABLE = redis is not None
+
 import test.util.stress as stress_util
 
 import test.unit.configuration as configuration_module
@@ -50,8 +59,52 @@ class SessionManagerTestCase(unittest.TestCase):
         max_time   =  0.7 # And this is far too much
         print "con",max(self.runner.run_threaded(threads, iterations, max_time))
 
+class BulkSessionsTestCase(unittest.TestCase):
+    """
+    Compares retrieving the sessions one by one and in a single call to
+    get_sessions, as AliveUsersCollection does in every check.
+    """
+
+    SESSIONS = 2000
+
+    def _measure(self, session_type, pool_id):
+        cfg_manager = ConfigurationManager.ConfigurationManager()
+        cfg_manager.append_module(configuration_module)
+        session_manager = SessionManager.SessionManager(cfg_manager, session_type, pool_id)
+        session_manager.clear()
+        try:
+            session_ids = []
+            for _ in xrange(self.SESSIONS):
+                session_id = session_manager.create_session()
+                session_manager.modify_session(session_id, { 'session_polling' : (time.time(), -1234) })
+                session_ids.append(session_id)
+
+            t0 = time.time()
+            for session_id in session_ids:
+                session_manager.get_session(session_id)
+            one_by_one = time.time() - t0
+
+            t0 = time.time()
+            self.assertEquals(self.SESSIONS, len(session_manager.get_sessions(session_ids)))
+            bulk = time.time() - t0
+        finally:
+            session_manager.clear()
+
+        print >> sys.stderr
+        print >> sys.stderr, "%s sessions in %s: one by one %.3f s; get_sessions %.3f s" % (self.SESSIONS, session_type, one_by_one, bulk)
+
+    def test_memory(self):
+        self._measure(SessionType.Memory, "foo")
+
+    if REDIS_AVAILABLE:
+        def test_redis(self):
+            self._measure(SessionType.redis, "0")
+
 def suite():
-    return unittest.makeSuite(SessionManagerTestCase)
+    return unittest.TestSuite((
+                unittest.makeSuite(SessionManagerTestCase),
+                unittest.makeSuite(BulkSessionsTestCase),
+            ))
 
 if __name__ == '__main__':
     unittest.main()
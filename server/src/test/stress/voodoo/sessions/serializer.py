@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import sys
+import time
+import unittest
+
+import voodoo.sessions.serializer as SessionSerializer
+
+from test.unit.voodoo.sessions.test_serializer import create_reservation_session
+
+class SessionSerializerTestCase(unittest.TestCase):
+    """
+    Compares the cost of encoding and decoding a reservation session of
+    the core server, and the size of the result, with each codec.
+    """
+
+    ITERATIONS = 10000
+
+    def _measure(self, codec, session):
+        serializer = SessionSerializer.SessionSerializer(codec)
+
+        t0 = time.time()
+        for _ in xrange(self.ITERATIONS):
+            serialized = serializer.serialize(session)
+        encoding = (time.time() - t0) * 1e6 / self.ITERATIONS
+
+        t0 = time.time()
+        for _ in xrange(self.ITERATIONS):
+            serializer.deserialize(serialized)
+        decoding = (time.time() - t0) * 1e6 / self.ITERATIONS
+
+        print >> sys.stderr, "%-8s encode %6.1f us; decode %6.1f us; %5s bytes" % (codec, encoding, decoding, len(serialized))
+
+    def test_codecs(self):
+        session = create_reservation_session()
+        # Sessions grow with the commands sent
+        for n in xrange(50):
+            session['async_commands_ids']['request%s' % n] = (n, 'command %s' % n)
+
+        print >> sys.stderr
+        for codec in sorted(SessionSerializer.CODECS):
+            self._measure(codec, session)
+
+def suite():
+    return unittest.makeSuite(SessionSerializerTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
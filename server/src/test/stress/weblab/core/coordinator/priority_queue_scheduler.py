@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import sys
+import json
+import time
+import unittest
+
+import weblab.core.coordinator.redis.coordinator as redis_coordinator
+import weblab.core.coordinator.sql.coordinator as sql_coordinator
+import weblab.core.coordinator.memory.coordinator as memory_coordinator
+from weblab.core.coordinator.sql.priority_queue_scheduler_model import WaitingReservation
+import weblab.core.coordinator.status as WSS
+from weblab.core.coordinator.config_parser import COORDINATOR_LABORATORY_SERVERS
+from weblab.core.coordinator.resource import Resource
+from weblab.core.coordinator.redis.constants import WEBLAB_RESOURCE_PQUEUE_RESERVATIONS, WEBLAB_RESOURCE_RESERVATION_PQUEUE, ACTIVE_STATUS
+from weblab.data.experiments import ExperimentId, ExperimentInstanceId
+
+import test.unit.configuration as configuration_module
+import voodoo.configuration as ConfigurationManager
+
+from test.unit.weblab.core.coordinator.test_coordinator import ConfirmerMock, DEFAULT_REQUEST_INFO, DEFAULT_CONSUMER_DATA
+
+RESOURCE_TYPE = 'res_type'
+INSTANCES     = 50
+ROUNDS        = 5
+
+class RedisPromotionTestCase(unittest.TestCase):
+    """
+    Compares how many waiting reservations per second are promoted by
+    the Lua script running in the redis server and by the former loop
+    performing one redis command at a time.
+    """
+    def setUp(self):
+        self.cfg_manager = ConfigurationManager.ConfigurationManager()
+        self.cfg_manager.append_module(configuration_module)
+        self.cfg_manager._set_value(COORDINATOR_LABORATORY_SERVERS, {
+            'lab1:inst@machine' : dict([ ('inst%s|exp1|cat1' % i, 'res_inst%s@%s' % (i, RESOURCE_TYPE)) for i in xrange(INSTANCES) ])
+        })
+        self.cfg_manager._set_value('core_scheduling_systems', { RESOURCE_TYPE : ("PRIORITY_QUEUE", {}) })
+
+        self.coordinator = redis_coordinator.Coordinator(None, self.cfg_manager, ConfirmerClass = ConfirmerMock)
+        self.coordinator._clean()
+
+        self.resources = []
+        for i in xrange(INSTANCES):
+            resource = Resource(RESOURCE_TYPE, 'res_inst%s' % i)
+            self.coordinator.add_experiment_instance_id("lab1:inst@machine", ExperimentInstanceId('inst%s' % i, 'exp1', 'cat1'), resource)
+            self.resources.append(resource)
+
+        self.scheduler = self.coordinator.schedulers[RESOURCE_TYPE]
+
+    def tearDown(self):
+        self.coordinator._clean()
+        self.coordinator.stop()
+
+    def _promote(self, server_side_promotion):
+        self.scheduler.server_side_promotion = server_side_promotion
+
+        # Fill the queue while every slot is busy, then release all the
+        # slots and measure a single update of the queue
+        for resource in self.resources:
+            self.coordinator.resources_manager.acquire_resource(resource)
+
+        reservation_ids = []
+        for _ in xrange(INSTANCES):
+            _, reservation_id = self.coordinator.reserve_experiment(ExperimentId('exp1', 'cat1'), 30, 5, True, 'initial data', DEFAULT_REQUEST_INFO, DEFAULT_CONSUMER_DATA)
+            reservation_ids.append(reservation_id)
+
+        for resource in self.resources:
+            self.coordinator.resources_manager.release_resource(resource)
+
+        t0 = time.time()
+        self.scheduler._update_queues()
+        elapsed = time.time() - t0
+
+        self.assertEquals(INSTANCES, len(self.coordinator.confirmer.uses_confirm))
+        self.coordinator.confirmer.uses_confirm = []
+
+        for reservation_id in reservation_ids:
+            self.coordinator.finish_reservation(reservation_id)
+
+        return elapsed
+
+    def _run(self, server_side_promotion):
+        times = [ self._promote(server_side_promotion) for _ in xrange(ROUNDS) ]
+        return INSTANCES * ROUNDS / sum(times)
+
+    def test_promotions_per_second(self):
+        client_side = self._run(server_side_promotion = False)
+        server_side = self._run(server_side_promotion = True)
+        print >> sys.stderr
+        print >> sys.stderr, "Promotions per second (client side): %.2f" % client_side
+        print >> sys.stderr, "Promotions per second (server side): %.2f" % server_side
+
+class RedisExpirationTestCase(unittest.TestCase):
+    """
+    Compares the time required to look for expired reservations when
+    there are 10, 100 and 1000 active reservations, using the sorted set
+    of deadlines and retrieving every reservation as it was done before.
+    """
+
+    SIZES      = (10, 100, 1000)
+    ITERATIONS = 100
+
+    def _create_coordinator(self, instances):
+        cfg_manager = ConfigurationManager.ConfigurationManager()
+        cfg_manager.append_module(configuration_module)
+        cfg_manager._set_value(COORDINATOR_LABORATORY_SERVERS, {
+            'lab1:inst@machine' : dict([ ('inst%s|exp1|cat1' % i, 'res_inst%s@%s' % (i, RESOURCE_TYPE)) for i in xrange(instances) ])
+        })
+        cfg_manager._set_value('core_scheduling_systems', { RESOURCE_TYPE : ("PRIORITY_QUEUE", {'expiration_check_period' : 0}) })
+
+        coordinator = redis_coordinator.Coordinator(None, cfg_manager, ConfirmerClass = ConfirmerMock)
+        coordinator._clean()
+        for i in xrange(instances):
+            coordinator.add_experiment_instance_id("lab1:inst@machine", ExperimentInstanceId('inst%s' % i, 'exp1', 'cat1'), Resource(RESOURCE_TYPE, 'res_inst%s' % i))
+
+        # Every reservation gets a slot, so all of them are active
+        for _ in xrange(instances):
+            coordinator.reserve_experiment(ExperimentId('exp1', 'cat1'), 3600, 5, True, 'initial data', DEFAULT_REQUEST_INFO, DEFAULT_CONSUMER_DATA)
+        return coordinator
+
+    def _full_scan(self, scheduler):
+        # How _remove_expired_reservations looked for the expired slots
+        client = scheduler.redis_maker()
+        reservations = list(client.smembers(WEBLAB_RESOURCE_PQUEUE_RESERVATIONS % RESOURCE_TYPE))
+        pipeline = client.pipeline()
+        for reservation_id in reservations:
+            pipeline.get(WEBLAB_RESOURCE_RESERVATION_PQUEUE % (RESOURCE_TYPE, reservation_id))
+        now = scheduler.time_provider.get_time()
+        expired = []
+        for reservation_id, reservation_data in zip(reservations, pipeline.execute()):
+            if reservation_data is not None:
+                data = json.loads(reservation_data)
+                if ACTIVE_STATUS in data and scheduler._get_slot_deadline(data) <= now:
+                    expired.append(reservation_id)
+        return expired
+
+    def _measure(self, func):
+        t0 = time.time()
+        for _ in xrange(self.ITERATIONS):
+            func()
+        return (time.time() - t0) * 1000.0 / self.ITERATIONS
+
+    def test_expiration_check(self):
+        print >> sys.stderr
+        for size in self.SIZES:
+            coordinator = self._create_coordinator(size)
+            try:
+                scheduler = coordinator.schedulers[RESOURCE_TYPE]
+                self.assertEquals(size, len(coordinator.confirmer.uses_confirm))
+
+                full_scan = self._measure(lambda : self._full_scan(scheduler))
+                deadlines = self._measure(scheduler._remove_expired_reservations)
+                print >> sys.stderr, "%5s active reservations: full scan %.3f ms; deadlines %.3f ms" % (size, full_scan, deadlines)
+            finally:
+                coordinator._clean()
+                coordinator.stop()
+
+class SqlQueuePositionTestCase(unittest.TestCase):
+    """
+    Compares how many queue positions per second are calculated when there
+    are 500 reservations waiting in the queue of a resource type, by
+    retrieving the whole queue (as get_reservation_status used to do) and by
+    counting the reservations ahead. It runs against the database engine
+    selected in the test configuration.
+    """
+
+    QUEUED  = 500
+    SAMPLES = 100
+
+    def setUp(self):
+        self.cfg_manager = ConfigurationManager.ConfigurationManager()
+        self.cfg_manager.append_module(configuration_module)
+        self.cfg_manager._set_value(COORDINATOR_LABORATORY_SERVERS, {
+            'lab1:inst@machine' : { 'inst1|exp1|cat1' : 'res_inst1@%s' % RESOURCE_TYPE }
+        })
+        self.cfg_manager._set_value('core_scheduling_systems', { RESOURCE_TYPE : ("PRIORITY_QUEUE", {}) })
+
+        self.coordinator = sql_coordinator.Coordinator(None, self.cfg_manager, ConfirmerClass = ConfirmerMock)
+        self.coordinator._clean()
+        self.coordinator.add_experiment_instance_id("lab1:inst@machine", ExperimentInstanceId('inst1', 'exp1', 'cat1'), Resource(RESOURCE_TYPE, 'res_inst1'))
+
+        # The first one takes the only slot, and the rest wait in the queue
+        self.coordinator.reserve_experiment(ExperimentId('exp1', 'cat1'), 3600, 5, True, 'initial data', DEFAULT_REQUEST_INFO, DEFAULT_CONSUMER_DATA)
+        self.reservation_ids = []
+        for _ in xrange(self.QUEUED):
+            _, reservation_id = self.coordinator.reserve_experiment(ExperimentId('exp1', 'cat1'), 3600, 5, True, 'initial data', DEFAULT_REQUEST_INFO, DEFAULT_CONSUMER_DATA)
+            self.reservation_ids.append(reservation_id)
+
+        self.scheduler = self.coordinator.schedulers[RESOURCE_TYPE]
+
+    def tearDown(self):
+        self.coordinator._clean()
+        self.coordinator.stop()
+
+    def _full_queue_position(self, session, waiting_reservation):
+        # How get_reservation_status calculated the position
+        waiting_reservations = session.query(WaitingReservation)\
+                .filter(WaitingReservation.resource_type == waiting_reservation.resource_type).order_by(WaitingReservation.priority, WaitingReservation.id).all()
+        return waiting_reservations.index(waiting_reservation)
+
+    def _measure(self, func):
+        samples = self.reservation_ids[::self.QUEUED / self.SAMPLES]
+        session = self.scheduler.session_maker()
+        try:
+            waiting_reservations = [ session.query(WaitingReservation).filter_by(reservation_id = reservation_id).one() for reservation_id in samples ]
+            t0 = time.time()
+            positions = [ func(session, waiting_reservation) for waiting_reservation in waiting_reservations ]
+            return len(samples) / (time.time() - t0), positions
+        finally:
+            session.close()
+
+    def test_positions_per_second(self):
+        full_queue, full_queue_positions = self._measure(self._full_queue_position)
+        counted,    counted_positions    = self._measure(self.scheduler._get_queue_position)
+        self.assertEquals(full_queue_positions, counted_positions)
+        self.assertEquals(range(0, self.QUEUED, self.QUEUED / self.SAMPLES), counted_positions)
+
+        samples = self.reservation_ids[::self.QUEUED / self.SAMPLES]
+        t0 = time.time()
+        for reservation_id in samples:
+            self.assertTrue(isinstance(self.scheduler.get_reservation_status(reservation_id), WSS.WaitingQueueStatus))
+        statuses = len(samples) / (time.time() - t0)
+
+        print >> sys.stderr
+        print >> sys.stderr, "%s queued reservations; positions per second (retrieving the queue): %.2f" % (self.QUEUED, full_queue)
+        print >> sys.stderr, "%s queued reservations; positions per second (counting):             %.2f" % (self.QUEUED, counted)
+        print >> sys.stderr, "%s queued reservations; get_reservation_status per second:           %.2f" % (self.QUEUED, statuses)
+
+class CoordinatorLatencyTestCase(unittest.TestCase):
+    """
+    Compares the latency of reserve_experiment, get_reservation_status and
+    finish_reservation in the in-process (memory) coordinator and in the
+    redis one, with 500 reservations, half of them waiting in the queue.
+    """
+
+    RESERVATIONS = 500
+
+    def _create_coordinator(self, Coordinator):
+        cfg_manager = ConfigurationManager.ConfigurationManager()
+        cfg_manager.append_module(configuration_module)
+        cfg_manager._set_value(COORDINATOR_LABORATORY_SERVERS, {
+            'lab1:inst@machine' : dict([ ('inst%s|exp1|cat1' % i, 'res_inst%s@%s' % (i, RESOURCE_TYPE)) for i in xrange(self.RESERVATIONS / 2) ])
+        })
+        cfg_manager._set_value('core_scheduling_systems', { RESOURCE_TYPE : ("PRIORITY_QUEUE", {'expiration_check_period' : 0}) })
+
+        coordinator = Coordinator(None, cfg_manager, ConfirmerClass = ConfirmerMock)
+        coordinator._clean()
+        for i in xrange(self.RESERVATIONS / 2):
+            coordinator.add_experiment_instance_id("lab1:inst@machine", ExperimentInstanceId('inst%s' % i, 'exp1', 'cat1'), Resource(RESOURCE_TYPE, 'res_inst%s' % i))
+        return coordinator
+
+    def _latencies(self, func, arguments):
+        latencies = []
+        results = []
+        for argument in arguments:
+            t0 = time.time()
+            results.append(func(argument))
+            latencies.append((time.time() - t0) * 1000.0)
+        latencies.sort()
+        return results, (sum(latencies) / len(latencies), latencies[len(latencies) * 99 / 100])
+
+    def _measure(self, Coordinator):
+        coordinator = self._create_coordinator(Coordinator)
+        try:
+            reserve = lambda _ : coordinator.reserve_experiment(ExperimentId('exp1', 'cat1'), 3600, 5, True, 'initial data', DEFAULT_REQUEST_INFO, DEFAULT_CONSUMER_DATA)[1]
+            reservation_ids, reserve_latency = self._latencies(reserve, xrange(self.RESERVATIONS))
+            statuses, status_latency = self._latencies(coordinator.get_reservation_status, reservation_ids)
+            self.assertEquals(self.RESERVATIONS / 2, len([ status for status in statuses if isinstance(status, WSS.WaitingQueueStatus) ]))
+            _, finish_latency = self._latencies(coordinator.finish_reservation, reservation_ids)
+            return reserve_latency, status_latency, finish_latency
+        finally:
+            coordinator._clean()
+            coordinator.stop()
+
+    def test_latency(self):
+        results = [ ('memory', self._measure(memory_coordinator.Coordinator)) ]
+        if redis_coordinator.REDIS_AVAILABLE:
+            results.append(('redis', self._measure(redis_coordinator.Coordinator)))
+
+        print >> sys.stderr
+        for name, latencies in results:
+            print >> sys.stderr, "%-6s (ms, mean / p99): reserve %.3f / %.3f; status %.3f / %.3f; finish %.3f / %.3f" % ((name,) + sum(latencies, ()))
+
+def suite():
+    suites = [ unittest.makeSuite(SqlQueuePositionTestCase), unittest.makeSuite(CoordinatorLatencyTestCase) ]
+    if redis_coordinator.REDIS_AVAILABLE:
+        suites.append(unittest.makeSuite(RedisPromotionTestCase))
+        suites.append(unittest.makeSuite(RedisExpirationTestCase))
+    return unittest.TestSuite(suites)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import sys
+import time
+import datetime
+import unittest
+
+import voodoo.gen.coordinator.CoordAddress as CoordAddress
+import voodoo.configuration as ConfigurationManager
+
+from weblab.data.experiments import ExperimentId
+from weblab.data.command import Command
+
+import weblab.core.data_retriever as TemporalInformationRetriever
+import weblab.core.coordinator.store as TemporalInformationStore
+from weblab.core.db import DatabaseGateway
+
+import test.unit.configuration as configuration
+
+class TemporalInformationRetrieverTestCase(unittest.TestCase):
+    """
+    Simulates the beginning of a class: many students start an
+    experiment at once and send some commands, and the experiments
+    finish. Measures how long it takes to have everything stored.
+    """
+
+    STUDENTS = 200
+    COMMANDS = 5
+
+    def setUp(self):
+        self.cfg_manager = ConfigurationManager.ConfigurationManager()
+        self.cfg_manager.append_module(configuration)
+        self.dbmanager = DatabaseGateway(self.cfg_manager)
+        self.dbmanager._delete_all_uses()
+        session = self.dbmanager.Session()
+        try:
+            self.student1 = self.dbmanager._get_user(session, 'student1')
+        finally:
+            session.close()
+
+    def tearDown(self):
+        self.dbmanager._delete_all_uses()
+
+    def _measure(self, writers):
+        self.dbmanager._delete_all_uses()
+        self.cfg_manager._set_value(TemporalInformationRetriever.USAGE_WRITERS, writers)
+
+        initial_store   = TemporalInformationStore.InitialTemporalInformationStore()
+        finished_store  = TemporalInformationStore.FinishTemporalInformationStore()
+        commands_store  = TemporalInformationStore.CommandsTemporalInformationStore()
+        completed_store = TemporalInformationStore.CompletedInformationStore()
+        retriever = TemporalInformationRetriever.TemporalInformationRetriever(self.cfg_manager, initial_store, finished_store, commands_store, completed_store, self.dbmanager)
+
+        now = datetime.datetime.now()
+        exp_id = ExperimentId('ud-dummy','Dummy experiments')
+        coord_address = CoordAddress.CoordAddress.translate_address('ser:inst@mach')
+
+        retriever.start()
+        try:
+            t0 = time.time()
+            for student in xrange(self.STUDENTS):
+                reservation_id = 'reservation%s' % student
+                request_info = {'username':'student1','role':'student','permission_scope' : 'user', 'permission_id' : self.student1.id}
+                initial_store.put(TemporalInformationStore.InitialInformationEntry(
+                            reservation_id, exp_id, coord_address,
+                            "{}", now, now, request_info, "{}"))
+                for command in xrange(self.COMMANDS):
+                    entry_id = student * self.COMMANDS + command
+                    commands_store.put(TemporalInformationStore.CommandOrFileInformationEntry(reservation_id, True, True, entry_id, Command('request'), time.time()))
+                    commands_store.put(TemporalInformationStore.CommandOrFileInformationEntry(reservation_id, False, True, entry_id, Command('response'), time.time()))
+                finished_store.put(reservation_id, "{}", now, now)
+
+            while True:
+                stats = retriever.get_stats()
+                if stats['backlog'] == 0 and stats['pending'] == 0:
+                    break
+                time.sleep(0.01)
+            elapsed = time.time() - t0
+        finally:
+            retriever.stop()
+            retriever.join(5)
+
+        print >> sys.stderr, "%s writers: %s students stored in %.2f seconds; %s flushes; max latency %.2f seconds" % (writers, self.STUDENTS, elapsed, stats['flushes'], stats['max_latency'])
+
+        self.assertEquals(self.STUDENTS, len(self.dbmanager.list_usages_per_user('student1', limit = self.STUDENTS)))
+
+    def test_class_start(self):
+        print >> sys.stderr
+        for writers in (1, 4):
+            self._measure(writers)
+
+def suite():
+    return unittest.makeSuite(TemporalInformationRetrieverTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
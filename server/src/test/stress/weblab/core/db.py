@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import sys
+import time
+import unittest
+
+import voodoo.configuration as ConfigurationManager
+
+import weblab.core.db as DatabaseGateway
+from weblab.data.experiments import CommandSent, FileSent
+from weblab.data.command import Command
+
+import test.unit.configuration as configuration
+from test.unit.weblab.core.test_db import create_usage
+
+class StoreCommandsTestCase(unittest.TestCase):
+    """
+    Compares how many commands per second are stored by looking up the
+    experiment use of each entry (as store_commands used to do) and by
+    the bulk statements of store_commands. It runs against the database engine
+    selected in the test configuration (MySQL if available, SQLite
+    otherwise).
+    """
+
+    RESERVATIONS = 50
+    ENTRIES      = 1000
+
+    def setUp(self):
+        cfg_manager = ConfigurationManager.ConfigurationManager()
+        cfg_manager.append_module(configuration)
+        self.gateway = DatabaseGateway.create_gateway(cfg_manager)
+        self.gateway._delete_all_uses()
+        self.reservation_ids = [ 'reservation%s' % n for n in xrange(self.RESERVATIONS) ]
+        for reservation_id in self.reservation_ids:
+            create_usage(self.gateway, reservation_id)
+
+    def tearDown(self):
+        self.gateway._delete_all_uses()
+
+    def _entries(self):
+        for n in xrange(self.ENTRIES):
+            yield n, self.reservation_ids[n % self.RESERVATIONS]
+
+    def _per_entry(self):
+        # What store_commands used to do: one lookup of the experiment
+        # use per entry (and of the command per response), in a single
+        # transaction
+        session = self.gateway.Session()
+        try:
+            db_commands = []
+            for n, reservation_id in self._entries():
+                if n % 2:
+                    self.gateway._append_file(session, reservation_id, FileSent('path/to/file', '{sha}%s' % n, time.time(), Command('response'), time.time()))
+                elif n % 4:
+                    self.gateway._append_command(session, reservation_id, CommandSent(Command('command'), time.time(), Command('response'), time.time()))
+                else:
+                    db_commands.append(self.gateway._append_command(session, reservation_id, CommandSent(Command('command'), time.time())))
+            session.commit()
+            command_ids = [ db_command.id for db_command in db_commands ]
+
+            for command_id in command_ids:
+                self.gateway._update_command(session, command_id, Command('response'), time.time())
+            session.commit()
+        finally:
+            session.close()
+
+    def _batch(self):
+        complete_commands = []
+        complete_files    = []
+        command_requests  = {}
+        for n, reservation_id in self._entries():
+            if n % 2:
+                complete_files.append((reservation_id, n, FileSent('path/to/file', '{sha}%s' % n, time.time(), Command('response'), time.time())))
+            elif n % 4:
+                complete_commands.append((reservation_id, n, CommandSent(Command('command'), time.time(), Command('response'), time.time())))
+            else:
+                command_requests[n] = (reservation_id, CommandSent(Command('command'), time.time()))
+
+        mappings = self.gateway.store_commands(complete_commands, command_requests, [], complete_files, {}, [])
+        command_responses = [ (n, mappings[n], Command('response'), time.time()) for n in command_requests ]
+        self.gateway.store_commands([], {}, command_responses, [], {}, [])
+
+    def _measure(self, name, func):
+        t0 = time.time()
+        func()
+        elapsed = time.time() - t0
+        print >> sys.stderr, "%-12s %s entries in %.2f seconds (%.1f entries/second)" % (name, self.ENTRIES, elapsed, self.ENTRIES / elapsed)
+
+    def test_store_commands(self):
+        print >> sys.stderr
+        print >> sys.stderr, "Database engine: %s" % self.gateway.engine.name
+        self._measure("per entry", self._per_entry)
+        self._measure("batch", self._batch)
+
+def suite():
+    return unittest.makeSuite(StoreCommandsTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
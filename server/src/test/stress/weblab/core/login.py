@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import sys
+import time
+import unittest
+import threading
+
+import voodoo.configuration as ConfigurationManager
+
+import weblab.core.db as DatabaseGateway
+import weblab.core.login.manager as login_manager
+import weblab.core.login.simple.ldap_auth as ldap_auth
+
+import test.unit.configuration as configuration
+import test.unit.weblab.login.fake_ldap as FakeLdap
+
+DB_USERS   = [ 'student1', 'student2', 'student3', 'student4', 'student5', 'student6' ]
+LDAP_USERS = [ 'studentLDAP1', 'studentLDAP2' ]
+
+class LoginTestCase(unittest.TestCase):
+    """
+    Many students log in at the beginning of an exam, some of them several
+    times (e.g. in different tabs), with users authenticated by the database
+    and by a LDAP server (a stub which takes the time of a TLS connection to
+    open a connection, and some time to check each password). Measures the
+    logins per second with the different caches and the pool of LDAP
+    connections, against the database engine selected in the test
+    configuration.
+    """
+
+    STUDENTS           = 40
+    LOGINS             = 3
+    LDAP_CONNECT_TIME  = 0.05 # seconds to open a connection to the LDAP server
+    LDAP_BIND_TIME     = 0.01 # seconds to check a password in the LDAP server
+
+    def setUp(self):
+        self.fake_ldap = FakeLdap.install(ldap_auth)
+        self.cfg_manager = ConfigurationManager.ConfigurationManager()
+        self.cfg_manager.append_module(configuration)
+        self.gateway = DatabaseGateway.create_gateway(self.cfg_manager)
+
+    def tearDown(self):
+        self.fake_ldap.uninstall()
+
+    def _measure(self, name, ldap_pool_size, user_auths_cache_time, credentials_cache_time):
+        FakeLdap.reset()
+        FakeLdap.initialize_latency = self.LDAP_CONNECT_TIME
+        FakeLdap.bind_latency       = self.LDAP_BIND_TIME
+        ldap_auth.close_all()
+
+        self.cfg_manager._set_value(ldap_auth.LDAP_POOL_SIZE, ldap_pool_size)
+        self.cfg_manager._set_value(login_manager.USER_AUTHS_CACHE_TIME, user_auths_cache_time)
+        self.cfg_manager._set_value(login_manager.CREDENTIALS_CACHE_TIME, credentials_cache_time)
+        manager = login_manager.LoginManager(self.gateway, None, self.cfg_manager)
+
+        users = DB_USERS + LDAP_USERS
+        errors = []
+        def student(n):
+            try:
+                for _ in xrange(self.LOGINS):
+                    manager._validate_simple_authn(users[n % len(users)], FakeLdap.PASSWORD)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [ threading.Thread(target = student, args = (n,)) for n in xrange(self.STUDENTS) ]
+        t0 = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - t0
+
+        self.assertEquals([], errors)
+        logins = self.STUDENTS * self.LOGINS
+        print >> sys.stderr, "%-45s %s logins in %.2f seconds (%.1f logins/second); %s LDAP connections opened" % (name + ':', logins, elapsed, logins / elapsed, len(FakeLdap.connections))
+
+    def test_login(self):
+        print >> sys.stderr
+        self._measure("no LDAP pool, no caches",               ldap_pool_size = 0,  user_auths_cache_time = 0,  credentials_cache_time = 0)
+        self._measure("LDAP pool",                             ldap_pool_size = 10, user_auths_cache_time = 0,  credentials_cache_time = 0)
+        self._measure("LDAP pool, user auths cache",           ldap_pool_size = 10, user_auths_cache_time = 10, credentials_cache_time = 0)
+        self._measure("LDAP pool, user auths and credentials caches", ldap_pool_size = 10, user_auths_cache_time = 10, credentials_cache_time = 10)
+
+def suite():
+    return unittest.makeSuite(LoginTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import sys
+import json
+import time
+import types
+import datetime
+import unittest
+
+import weblab.core.new_server as new_server
+import weblab.core.reservations as Reservation
+from weblab.data.command import Command
+from weblab.data.dto.experiments import ExperimentAllowed, Experiment, ExperimentCategory, ExperimentClient
+
+def reflective_simplify_response(response, limit = 15, counter = 0):
+    """ simplify_response as it was before the encoders were cached per class """
+    if counter == limit:
+        return None
+    if isinstance(response, (basestring, int, long, float, bool)):
+        return response
+    if isinstance(response, (list, tuple)):
+        return [ reflective_simplify_response(i, limit, counter + 1) for i in response ]
+    if isinstance(response, dict):
+        new_response = {}
+        for i in response:
+            new_response[i] = reflective_simplify_response(response[i], limit, counter + 1)
+        return new_response
+    if isinstance(response, (datetime.datetime, datetime.date, datetime.time)):
+        return response.isoformat()
+    ret = {}
+    for attr in [ a for a in dir(response) if not a.startswith('_') ]:
+        if not hasattr(response.__class__, attr):
+            attr_value = getattr(response, attr)
+            if not isinstance(attr_value, types.FunctionType) and not isinstance(attr_value, types.MethodType):
+                ret[attr] = reflective_simplify_response(attr_value, limit, counter + 1)
+    return ret
+
+class SimplifyResponseTestCase(unittest.TestCase):
+    """
+    Measures how many responses per second are serialized (simplified and
+    dumped as JSON, as in WebLabAPI.jsonify) for the most common requests,
+    inspecting each object as before and with the encoders cached per class.
+    """
+
+    ITERATIONS  = 5000
+    EXPERIMENTS = 30
+
+    def setUp(self):
+        now = datetime.datetime.now()
+        experiments = []
+        for n in xrange(self.EXPERIMENTS):
+            client = ExperimentClient('js', { 'html.file' : 'experiment%s.html' % n, 'experiment.reserve.button.shown' : True })
+            experiment = Experiment('experiment%s' % n, ExperimentCategory('Category'), now, now, client, n)
+            experiments.append(ExperimentAllowed(experiment, 200, 5, True, 'permanent%s' % n, n, 'group'))
+
+        self.responses = [
+            ('get_reservation_status', Reservation.WaitingReservation('reservation;route', 5)),
+            ('send_command',           Command('ChangeSwitch on 0')),
+            ('list_experiments',       experiments),
+        ]
+
+    def _measure(self, name, simplify, dumps):
+        print >> sys.stderr, name
+        for method, response in self.responses:
+            iterations = self.ITERATIONS if method != 'list_experiments' else self.ITERATIONS / 10
+            t0 = time.time()
+            for _ in xrange(iterations):
+                dumps({ 'result' : simplify(response), 'is_exception' : False })
+            elapsed = time.time() - t0
+            print >> sys.stderr, "    %-25s %8.1f responses/second" % (method + ':', iterations / elapsed)
+
+    def test_simplify_response(self):
+        # test/unit/weblab/comm/test_server.py checks that both return the same
+        print >> sys.stderr
+        self._measure("reflective, json",  reflective_simplify_response, json.dumps)
+        self._measure("cached encoders, json", new_server.simplify_response, json.dumps)
+
+def suite():
+    return unittest.makeSuite(SimplifyResponseTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
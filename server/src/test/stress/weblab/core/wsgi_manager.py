@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import sys
+import json
+import time
+import httplib
+import unittest
+import threading
+
+from flask import Flask, Blueprint, request, Response
+
+import voodoo.configuration as ConfigurationManager
+
+import weblab.configuration_doc as configuration_doc
+import weblab.core.wsgi_manager as wsgi_manager
+
+import test.unit.configuration as configuration_module
+from test.util.ports import new as new_port
+
+def create_app():
+    app = Flask('weblab.stress')
+    json_api = Blueprint('json', __name__)
+
+    @json_api.route('/', methods = ['POST'])
+    def service():
+        method = json.loads(request.data)['method']
+        result = { 'is_exception' : False, 'result' : { 'status' : 'Reservation::waiting', 'position' : 5, 'method' : method } }
+        return Response(json.dumps(result), mimetype = 'application/json')
+
+    app.register_blueprint(json_api, url_prefix = '/weblab/json')
+    return app
+
+class WsgiServerTestCase(unittest.TestCase):
+    """
+    Many students poll the status of their reservations through /weblab/json/
+    at the same time. Each student uses a single HTTP connection (as browsers
+    do), which is reused only if the server keeps it alive. Compares the
+    server creating a thread per connection with the pool of workers.
+    """
+
+    STUDENTS = 300
+    POLLS    = 10
+
+    def setUp(self):
+        self.cfg_manager = ConfigurationManager.ConfigurationManager()
+        self.cfg_manager.append_module(configuration_module)
+        self.cfg_manager._set_value(configuration_doc.CORE_FACADE_ACCESS_LOG, False)
+        self.app = create_app()
+
+    def _measure(self, server_mode):
+        port = new_port()
+        self.cfg_manager._set_value(configuration_doc.CORE_FACADE_PORT, port)
+        self.cfg_manager._set_value(configuration_doc.CORE_FACADE_SERVER_MODE, server_mode)
+        server = wsgi_manager.WebLabWsgiServer(self.cfg_manager, self.app)
+        server.start()
+
+        body = json.dumps({ 'method' : 'get_reservation_status', 'params' : { 'reservation_id' : { 'id' : 'reservation' } } })
+        headers = { 'Content-Type' : 'application/json' }
+
+        latencies = []
+        errors    = []
+        start_event = threading.Event()
+        def student():
+            connection = httplib.HTTPConnection('127.0.0.1', port, timeout = 30)
+            start_event.wait()
+            for _ in xrange(self.POLLS):
+                t0 = time.time()
+                try:
+                    connection.request('POST', '/weblab/json/', body, headers)
+                    response = connection.getresponse()
+                    response.read()
+                    if response.status != 200:
+                        errors.append(response.status)
+                        continue
+                except Exception as e:
+                    errors.append(e.__class__.__name__)
+                    connection.close()
+                    continue
+                latencies.append(time.time() - t0)
+            connection.close()
+
+        try:
+            threads = [ threading.Thread(target = student) for _ in xrange(self.STUDENTS) ]
+            for thread in threads:
+                thread.start()
+            t0 = time.time()
+            start_event.set()
+            for thread in threads:
+                thread.join()
+            elapsed = time.time() - t0
+            stats = server.get_stats()[0]
+        finally:
+            server.stop()
+
+        latencies.sort()
+        mean = sum(latencies) / len(latencies) if latencies else 0.0
+        p99  = latencies[int(len(latencies) * 0.99)] if latencies else 0.0
+        print >> sys.stderr, "%-10s %5s polls in %.2f seconds (%.1f polls/second); latency mean %.1f ms, p99 %.1f ms; %s errors" % (server_mode + ':', len(latencies), elapsed, len(latencies) / elapsed, mean * 1000, p99 * 1000, len(errors))
+        if errors:
+            print >> sys.stderr, "%-10s errors: %s" % ('', ', '.join(sorted(set(map(str, errors)))))
+        print >> sys.stderr, "%-10s server: %s" % ('', stats)
+
+    def test_polls(self):
+        print >> sys.stderr
+        self._measure(wsgi_manager.THREADED_MODE)
+        self._measure(wsgi_manager.POOL_MODE)
+
+def suite():
+    return unittest.makeSuite(WsgiServerTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
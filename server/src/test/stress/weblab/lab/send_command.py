@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import sys
+import time
+import unittest
+import threading
+
+from test.util.ports import new as new_port
+
+import voodoo.gen.protocols.protocols as Protocols
+import voodoo.gen.protocols.ConnectionPool as ConnectionPool
+import voodoo.gen.generators.ServerSkel as ServerSkel
+import voodoo.gen.generators.ClientSkel as ClientSkel
+
+import voodoo.configuration as ConfigurationManager
+import test.unit.configuration as configuration_module
+
+PORT = new_port()
+
+# The subset of weblab.methods.Laboratory used by the benchmark
+METHODS = ['send_command']
+
+class SendCommandTestCase(unittest.TestCase):
+    """
+    Many students of a class send commands to the experiments of a single
+    laboratory server through XML-RPC, as the core server does. Measures
+    the commands per second with different sizes of the pool of connections
+    (a pool of a single connection serializes the calls).
+    """
+
+    STUDENTS            = 20
+    COMMANDS            = 10
+    EXPERIMENT_LATENCY  = 0.02 # seconds that each experiment takes to reply
+
+    def setUp(self):
+        cfg_manager = ConfigurationManager.ConfigurationManager()
+        cfg_manager.append_module(configuration_module)
+
+        latency = self.EXPERIMENT_LATENCY
+        class FakeLaboratoryServer(ServerSkel.factory(cfg_manager, Protocols.XMLRPC, METHODS)):
+            def do_send_command(self, lab_session_id, command):
+                time.sleep(latency)
+                return 'response to %s' % command
+
+        self.server = FakeLaboratoryServer(XMLRPC = ('', PORT))
+        self.server.start()
+        self.Client = ClientSkel.factory(Protocols.XMLRPC, METHODS)
+
+    def tearDown(self):
+        self.server.stop()
+        ConnectionPool.close_all()
+
+    def _measure(self, pool_size):
+        ConnectionPool.close_all()
+        ConnectionPool._pools[('localhost', PORT)] = ConnectionPool.HTTPConnectionPool('localhost', PORT, size = pool_size)
+        client = self.Client('localhost', PORT)
+
+        errors = []
+        def student(n):
+            try:
+                for command in xrange(self.COMMANDS):
+                    client.send_command('session%s' % n, 'command%s' % command)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [ threading.Thread(target = student, args = (n,)) for n in xrange(self.STUDENTS) ]
+        t0 = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - t0
+
+        self.assertEquals([], errors)
+        commands = self.STUDENTS * self.COMMANDS
+        stats = ConnectionPool.get_pool('localhost', PORT).get_stats()
+        print >> sys.stderr, "pool of %s connections: %s commands in %.2f seconds (%.1f commands/second); %s connections created" % (pool_size, commands, elapsed, commands / elapsed, stats['created'])
+
+    def test_send_command(self):
+        print >> sys.stderr
+        for pool_size in (1, 5, self.STUDENTS):
+            self._measure(pool_size)
+
+def suite():
+    return unittest.makeSuite(SendCommandTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
+
@@ -13,6 +13,7 @@
 # Author: Pablo Orduña <pablo@ordunya.com>
 #
 import unittest
+import threading
 
 from test.util.ports import new as new_port
 from test.util.module_disposer import uses_module
@@ -21,12 +22,14 @@ import voodoo.gen.protocols.XMLRPC.ServerXMLRPC as ServerXMLRPC
 import voodoo.gen.protocols.XMLRPC.Errors as Exceptions
 
 import voodoo.gen.protocols.protocols as Protocols
+import voodoo.gen.protocols.ConnectionPool as ConnectionPool
 import voodoo.gen.generators as gens
 
 import test.unit.configuration as configuration_module
 import voodoo.configuration as ConfigurationManager
 
 PORT = new_port()
+CONCURRENT_PORT = new_port()
 
 class GeneralXMLRPCTestCase(unittest.TestCase):
 
@@ -62,6 +65,46 @@ class GeneralXMLRPCTestCase(unittest.TestCase):
                 client.method2
             )
 
+    @uses_module(ServerXMLRPC)
+    def test_concurrent_calls(self):
+        methods = ["method1", "method2"]
+        first_call_running = threading.Event()
+        second_call_finished = threading.Event()
+
+        cfg_manager= ConfigurationManager.ConfigurationManager()
+        cfg_manager.append_module(configuration_module)
+
+        class Ser(gens.ServerSkel.factory(cfg_manager,Protocols.XMLRPC,methods)):
+            def do_method1(self):
+                first_call_running.set()
+                # It only finishes if the other call is not serialized behind this one
+                return second_call_finished.wait(5)
+            def do_method2(self):
+                second_call_finished.set()
+                return True
+
+        server = Ser(XMLRPC = ('',CONCURRENT_PORT))
+        server.start()
+
+        client = gens.ClientSkel.factory(Protocols.XMLRPC,methods)(
+                    'localhost',
+                    CONCURRENT_PORT
+                )
+
+        results = []
+        thread = threading.Thread(target = lambda : results.append(client.method1()))
+        thread.setDaemon(True)
+        thread.start()
+        self.assertTrue(first_call_running.wait(5))
+
+        self.assertTrue(client.method2())
+        thread.join(5)
+        self.assertEquals([True], results)
+
+        # The connections are kept alive
+        self.assertTrue(client.method2())
+        self.assertTrue(ConnectionPool.get_pool('localhost', CONCURRENT_PORT).get_stats()['reused'] > 0)
+
 def suite():
     return unittest.makeSuite(GeneralXMLRPCTestCase)
 
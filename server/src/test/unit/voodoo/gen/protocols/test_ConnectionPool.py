@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import errno
+import socket
+import httplib
+import unittest
+import threading
+
+import test.unit.configuration as configuration_module
+import voodoo.configuration as ConfigurationManager
+
+import voodoo.gen.protocols.ConnectionPool as ConnectionPool
+
+class FakeConnection(object):
+    def __init__(self, host, port, timeout = None):
+        self.host    = host
+        self.port    = port
+        self.timeout = timeout
+        self.closed  = False
+        self.error   = None
+
+    def request(self, method, url, body, headers):
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.closed = True
+
+class FakeTime(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+class HTTPConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fake_time = FakeTime()
+        self.pool = ConnectionPool.HTTPConnectionPool('localhost', 10000, size = 2, timeout = 5,
+                            max_idle = 10, connection_class = FakeConnection, time_func = self.fake_time.time)
+
+    def test_reuse(self):
+        connection, reused = self.pool.acquire()
+        self.assertFalse(reused)
+        self.assertEquals(5, connection.timeout)
+        self.pool.release(connection)
+
+        connection2, reused = self.pool.acquire()
+        self.assertTrue(reused)
+        self.assertTrue(connection is connection2)
+
+        # Unless they are not reusable
+        self.pool.release(connection2, reusable = False)
+        self.assertTrue(connection2.closed)
+        connection3, reused = self.pool.acquire()
+        self.assertFalse(reused)
+        self.assertFalse(connection3 is connection2)
+
+    def test_no_reuse(self):
+        connection, _ = self.pool.acquire()
+        self.pool.release(connection)
+        connection2, reused = self.pool.acquire(reuse = False)
+        self.assertFalse(reused)
+        self.assertFalse(connection is connection2)
+
+    def test_max_idle(self):
+        connection, _ = self.pool.acquire()
+        self.pool.release(connection)
+        self.fake_time.now += 11
+
+        connection2, reused = self.pool.acquire()
+        self.assertFalse(reused)
+        self.assertTrue(connection.closed)
+        self.assertEquals(0, self.pool.get_stats()['idle'])
+
+    def test_bounded(self):
+        connection1, _ = self.pool.acquire()
+        connection2, _ = self.pool.acquire()
+        self.assertEquals(2, self.pool.get_stats()['in_use'])
+
+        acquired = []
+        def acquire():
+            acquired.append(self.pool.acquire())
+        thread = threading.Thread(target = acquire)
+        thread.setDaemon(True)
+        thread.start()
+        thread.join(0.2)
+        # It waits until any other is released
+        self.assertEquals([], acquired)
+
+        self.pool.release(connection1)
+        thread.join(5)
+        self.assertEquals([(connection1, True)], acquired)
+
+    def test_acquire_timeout(self):
+        self.pool.acquire_timeout = 0.2
+        connection1, _ = self.pool.acquire()
+        self.pool.acquire()
+
+        self.assertRaises(ConnectionPool.PoolTimeoutError, self.pool.acquire)
+        self.assertEquals(1, self.pool.get_stats()['timeouts'])
+        self.assertEquals(2, self.pool.get_stats()['in_use'])
+
+        # It is a connection error, but the call can not be retried
+        self.assertTrue(issubclass(ConnectionPool.PoolTimeoutError, socket.error))
+        self.assertFalse(ConnectionPool.is_stale_connection_error(ConnectionPool.PoolTimeoutError("timed out")))
+
+        self.pool.release(connection1)
+        self.assertEquals((connection1, True), self.pool.acquire())
+
+    def test_closed_by_server(self):
+        connection, _ = self.pool.acquire()
+        connection.sock, server_sock = socket.socketpair()
+        self.pool.release(connection)
+
+        # Still open
+        connection2, reused = self.pool.acquire()
+        self.assertTrue(reused)
+        self.pool.release(connection2)
+
+        server_sock.close()
+        connection3, reused = self.pool.acquire()
+        self.assertFalse(reused)
+        self.assertTrue(connection.closed)
+        connection.sock.close()
+
+    def test_stale_connection_errors(self):
+        # Raised while reading the response: the server might have processed the request
+        self.assertFalse(ConnectionPool.is_stale_connection_error(httplib.BadStatusLine("''")))
+        self.assertTrue(ConnectionPool.is_stale_connection_error(socket.error(errno.ECONNRESET, "reset")))
+        self.assertFalse(ConnectionPool.is_stale_connection_error(socket.timeout("timed out")))
+        self.assertFalse(ConnectionPool.is_stale_connection_error(socket.error(errno.ECONNREFUSED, "refused")))
+        self.assertFalse(ConnectionPool.is_stale_connection_error(ValueError("whatever")))
+
+    def test_send_request(self):
+        connection = FakeConnection('localhost', 10000)
+        ConnectionPool.send_request(connection, True, "POST", "/", "body", {})
+
+        # Only retried if the connection was reused
+        connection.error = socket.error(errno.EPIPE, "broken pipe")
+        self.assertRaises(ConnectionPool.StaleConnectionError, ConnectionPool.send_request, connection, True, "POST", "/", "body", {})
+        self.assertRaises(socket.error, ConnectionPool.send_request, connection, False, "POST", "/", "body", {})
+
+        connection.error = socket.timeout("timed out")
+        self.assertRaises(socket.timeout, ConnectionPool.send_request, connection, True, "POST", "/", "body", {})
+
+class GetPoolTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        cfg_manager = ConfigurationManager.ConfigurationManager()
+        cfg_manager.append_module(configuration_module)
+        ConnectionPool.configure(cfg_manager)
+        ConnectionPool.close_all()
+
+    def test_get_pool(self):
+        cfg_manager = ConfigurationManager.ConfigurationManager()
+        cfg_manager.append_module(configuration_module)
+        cfg_manager._set_value(ConnectionPool.RPC_CLIENT_POOL_SIZE, 3)
+        cfg_manager._set_value(ConnectionPool.RPC_CLIENT_POOL_SIZES, { 'otherhost:10001' : 7 })
+        cfg_manager._set_value(ConnectionPool.RPC_CLIENT_TIMEOUT, 20)
+        cfg_manager._set_value(ConnectionPool.RPC_CLIENT_POOL_TIMEOUT, 40)
+        ConnectionPool.close_all()
+        ConnectionPool.configure(cfg_manager)
+
+        pool = ConnectionPool.get_pool('somehost', '10000')
+        self.assertTrue(pool is ConnectionPool.get_pool('somehost', 10000))
+        self.assertEquals(3, pool.size)
+        self.assertEquals(20, pool.timeout)
+        self.assertEquals(40, pool.acquire_timeout)
+        self.assertEquals(7, ConnectionPool.get_pool('otherhost', 10001).size)
+
+def suite():
+    return unittest.TestSuite((
+            unittest.makeSuite(HTTPConnectionPoolTestCase),
+            unittest.makeSuite(GetPoolTestCase),
+        ))
+
+if __name__ == '__main__':
+    unittest.main()
+
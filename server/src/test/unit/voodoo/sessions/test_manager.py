@@ -23,6 +23,7 @@ except ImportError:
     ERROR_MESSAGE_SHOWN = False
 else:
     REDIS_AVAILABLE = True
+    import voodoo.sessions.redis_gateway as RedisGateway
 
 import threading
 import time
@@ -53,6 +54,8 @@ class SessionManagerTestCase(unittest.TestCase):
         if REDIS_AVAILABLE:
             self.redis_server1 = SessionManager.SessionManager( cfg_manager, SessionType.redis, "0" )
             self.redis_server2 = SessionManager.SessionManager( cfg_manager, SessionType.redis, "1" )
+            cfg_manager._set_value(RedisGateway.SESSION_REDIS_HASH_LAYOUT, True)
+            self.redis_hash_server = SessionManager.SessionManager( cfg_manager, SessionType.redis, "2" )
         else:
             global ERROR_MESSAGE_SHOWN
             if not ERROR_MESSAGE_SHOWN:
@@ -66,11 +69,13 @@ class SessionManagerTestCase(unittest.TestCase):
         if REDIS_AVAILABLE:
             self.redis_server1.clear()
             self.redis_server2.clear()
+            self.redis_hash_server.clear()
     
     def tearDown(self):
         if REDIS_AVAILABLE:
             self.redis_server1.clear()
             self.redis_server2.clear()
+            self.redis_hash_server.clear()
 
     if REDIS_AVAILABLE:
         def test_redis_zombies(self):
@@ -101,6 +106,29 @@ class SessionManagerTestCase(unittest.TestCase):
             finally:
                 server.clear()
 
+        def test_redis_lock_tokens_per_thread(self):
+            cfg_manager= ConfigurationManager.ConfigurationManager()
+            cfg_manager.append_module(configuration_module)
+            cfg_manager._set_value(RedisGateway.SESSION_REDIS_LOCK_TTL, 0.2)
+            server = SessionManager.SessionManager( cfg_manager, SessionType.redis, "0" )
+            try:
+                sess_id = server.create_session()
+                server.get_session_locking(sess_id)
+                time.sleep(0.3)
+
+                # The lock of this thread expired, and another thread acquires it
+                def other_thread():
+                    server.get_session_locking(sess_id)
+                thread = threading.Thread(target = other_thread)
+                thread.start()
+                thread.join()
+
+                # Unlocking here does not release the lock of the other thread
+                server.unlock_without_modifying(sess_id)
+                lock = server.gateway._session_lock(sess_id.id)
+                self.assertEquals(None, lock.acquire(timeout = 0))
+            finally:
+                server.clear()
 
     def test_checking_parameter(self):
         self.assertRaises(
@@ -233,6 +261,41 @@ class SessionManagerTestCase(unittest.TestCase):
         self.assertTrue(sess_id2 in sessions)
         self.assertTrue(sess_id3 in sessions)
 
+    def session_tester_get_sessions(self, server):
+        sess_id1 = server.create_session()
+        sess_id2 = server.create_session()
+        server.modify_session(sess_id1, { 'test' : 'mytest1' })
+        server.modify_session(sess_id2, { 'test' : 'mytest2' })
+
+        missing_sess_id = SessionId.SessionId('does.not.exist')
+
+        sessions = server.get_sessions([ sess_id1, sess_id2, missing_sess_id ])
+        self.assertEquals({ sess_id1 : { 'test' : 'mytest1' }, sess_id2 : { 'test' : 'mytest2' } }, sessions)
+
+        self.assertEquals({}, server.get_sessions([]))
+
+    def session_tester_fields(self, server):
+        sess_id = server.create_session()
+        server.modify_session(sess_id, { 'a' : 1, 'b' : (1, 2), 'c' : 'foo' })
+
+        self.assertEquals({ 'a' : 1, 'b' : (1, 2) }, server.get_session_fields(sess_id, ('a', 'b', 'missing')))
+
+        # Fields not in the session are not created
+        server.update_session_fields(sess_id, { 'a' : 2, 'd' : 'bar' })
+        self.assertEquals({ 'a' : 2, 'b' : (1, 2), 'c' : 'foo' }, server.get_session(sess_id))
+
+        server.delete_session(sess_id)
+        self.assertRaises(
+                SessionErrors.SessionNotFoundError,
+                server.get_session_fields,
+                sess_id, ('a',)
+            )
+        self.assertRaises(
+                SessionErrors.SessionNotFoundError,
+                server.update_session_fields,
+                sess_id, { 'a' : 3 }
+            )
+
     def session_tester_pool_ids(self, server1, server2):
         sess_id1 = server1.create_session()
         sess_id2 = server2.create_session()
@@ -269,6 +332,21 @@ class SessionManagerTestCase(unittest.TestCase):
     def test_memory_session_list_sessions(self):
         self.session_tester_list_sessions(self.memory_server1)
 
+    def test_memory_get_sessions(self):
+        self.session_tester_get_sessions(self.memory_server1)
+
+    def test_memory_session_fields(self):
+        self.session_tester_fields(self.memory_server1)
+
+    def test_memory_atomic_field_updates(self):
+        self.assertFalse(self.memory_server1.atomic_field_updates)
+
+        cfg_manager= ConfigurationManager.ConfigurationManager()
+        cfg_manager.append_module(configuration_module)
+        cfg_manager._set_value(configuration_doc.SESSION_MEMORY_GATEWAY_SERIALIZE, False)
+        server = SessionManager.SessionManager( cfg_manager, SessionType.Memory, "foo" )
+        self.assertTrue(server.atomic_field_updates)
+
     def test_memory_pool_ids(self):
         self.session_tester_pool_ids(self.memory_server1, self.memory_server2)
 
@@ -287,6 +365,12 @@ class SessionManagerTestCase(unittest.TestCase):
     def test_sqlalchemy_session_list_sessions(self):
         self.session_tester_list_sessions(self.sqlalchemy_server1)
 
+    def test_sqlalchemy_get_sessions(self):
+        self.session_tester_get_sessions(self.sqlalchemy_server1)
+
+    def test_sqlalchemy_session_fields(self):
+        self.session_tester_fields(self.sqlalchemy_server1)
+
     def test_sqlalchemy_pool_ids(self):
         self.session_tester_pool_ids(self.sqlalchemy_server1, self.sqlalchemy_server2)
 
@@ -306,12 +390,55 @@ class SessionManagerTestCase(unittest.TestCase):
         def test_redis_session_list_sessions(self):
             self.session_tester_list_sessions(self.redis_server1)
 
+        def test_redis_get_sessions(self):
+            self.session_tester_get_sessions(self.redis_server1)
+
         def test_redis_pool_ids(self):
             self.session_tester_pool_ids(self.redis_server1, self.redis_server2)
 
         def test_redis_create_session_given_a_sess_id(self):
             self.session_create_session_given_a_sess_id(self.redis_server1)
 
+        def test_redis_session_fields(self):
+            self.session_tester_fields(self.redis_server1)
+
+        def test_redis_hash_session(self):
+            self.session_tester(self.redis_hash_server)
+
+        def test_redis_hash_session_locking(self):
+            self.session_tester_locking(self.redis_hash_server)
+
+        def test_redis_hash_session_locking_2steps(self):
+            self.session_tester_locking_2steps(self.redis_hash_server)
+
+        def test_redis_hash_session_list_sessions(self):
+            self.session_tester_list_sessions(self.redis_hash_server)
+
+        def test_redis_hash_get_sessions(self):
+            self.session_tester_get_sessions(self.redis_hash_server)
+
+        def test_redis_hash_create_session_given_a_sess_id(self):
+            self.session_create_session_given_a_sess_id(self.redis_hash_server)
+
+        def test_redis_hash_session_fields(self):
+            self.session_tester_fields(self.redis_hash_server)
+
+        def test_redis_hash_session_stores_changed_fields(self):
+            server = self.redis_hash_server
+            sess_id = server.create_session()
+            server.modify_session(sess_id, { 'polling' : 1, 'data' : 'foo', 'removed' : True })
+
+            session = server.get_session_locking(sess_id)
+            # Meanwhile, another request polls without locking
+            server.update_session_fields(sess_id, { 'polling' : 2 })
+            session['data'] = 'bar'
+            session.pop('removed')
+            server.modify_session_unlocking(sess_id, session)
+
+            self.assertEquals({ 'polling' : 2, 'data' : 'bar' }, server.get_session(sess_id))
+            self.assertTrue(server.atomic_field_updates)
+            self.assertFalse(self.redis_server1.atomic_field_updates)
+
 
 def suite():
     return unittest.makeSuite(SessionManagerTestCase)
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import unittest
+import datetime
+
+import voodoo.sessions.serializer as SessionSerializer
+import voodoo.sessions.exc as SessionErrors
+from voodoo.sessions.session_id import SessionId
+from voodoo.gen.coordinator.CoordAddress import CoordAddress
+
+from weblab.data.experiments import ExperimentId
+
+def create_reservation_session():
+    return {
+        'session_polling'    : (1400000000.123456, -1234),
+        'latest_timestamp'   : 1400000000123L,
+        'experiment_id'      : ExperimentId('ud-dummy', 'Dummy experiments'),
+        'creator_session_id' : SessionId('creator'),
+        'reservation_id'     : SessionId('reservation'),
+        'federated'          : False,
+        'lab_session_id'     : SessionId('lab'),
+        'lab_coordaddr'      : CoordAddress.translate_address('laboratory1:main_instance@main_machine'),
+        'async_commands_ids' : { 'request1' : (5, 'command') },
+        'name'               : u'Pablo Orduña',
+        'login'              : u'porduna',
+        'nothing'            : None,
+    }
+
+class SessionSerializerTestCase(unittest.TestCase):
+
+    def _test_codec(self, codec):
+        serializer = SessionSerializer.SessionSerializer(codec)
+        session = create_reservation_session()
+
+        serialized = serializer.serialize(session)
+        self.assertTrue(serialized.startswith('{%s}' % codec))
+
+        deserialized = serializer.deserialize(serialized)
+        self.assertEquals(session, deserialized)
+        self.assertEquals(tuple, type(deserialized['session_polling']))
+        self.assertEquals(str,   type(deserialized['async_commands_ids'].keys()[0]))
+        self.assertEquals(str,   type(deserialized['async_commands_ids']['request1'][1]))
+        self.assertEquals(unicode, type(deserialized['login']))
+        self.assertEquals(unicode, type(deserialized['name']))
+
+    def test_pickle(self):
+        self._test_codec(SessionSerializer.PICKLE)
+
+    def test_json(self):
+        self._test_codec(SessionSerializer.JSON)
+
+    if SessionSerializer.MSGPACK_AVAILABLE:
+        def test_msgpack(self):
+            self._test_codec(SessionSerializer.MSGPACK)
+
+    def test_fallback_to_pickle(self):
+        serializer = SessionSerializer.SessionSerializer(SessionSerializer.JSON)
+        for session in ({ 'date' : datetime.datetime(2014, 1, 1) }, { 5 : 'five' }, { 'str' : 'Ordu\xc3\xb1a' }, { '__type__' : 'tuple' }, { u'login' : 'porduna' }):
+            serialized = serializer.serialize(session)
+            self.assertTrue(serialized.startswith('{pickle}'))
+            self.assertEquals(session, serializer.deserialize(serialized))
+
+    def test_deserialize_any_format(self):
+        session = create_reservation_session()
+        serialized = SessionSerializer.SessionSerializer(SessionSerializer.JSON).serialize(session)
+        self.assertEquals(session, SessionSerializer.SessionSerializer().deserialize(serialized))
+
+        # Sessions stored by previous versions
+        old_serialized = '{pickle}' + SessionSerializer.pickle.dumps(session)
+        self.assertEquals(session, SessionSerializer.SessionSerializer(SessionSerializer.JSON).deserialize(old_serialized))
+
+    def test_errors(self):
+        self.assertRaises(SessionErrors.SessionSerializationNotImplementedError, SessionSerializer.SessionSerializer, 'foo')
+        serializer = SessionSerializer.SessionSerializer()
+        self.assertRaises(SessionErrors.SessionSerializationNotImplementedError, serializer.deserialize, 'foo')
+        self.assertRaises(SessionErrors.SessionNotDeserializableError, serializer.deserialize, '{json}foo')
+
+def suite():
+    return unittest.makeSuite(SessionSerializerTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
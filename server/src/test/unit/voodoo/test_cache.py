@@ -14,7 +14,8 @@
 #
 
 import unittest
-#import time
+import threading
+import time
 
 import voodoo.cache as cache
 
@@ -304,6 +305,185 @@ class CacheTestCase(unittest.TestCase):
         self.assertEquals(21, fibonacci(8))
         self.assertEquals(8 + 1 + before_calls, self._calls)
 
+    def test_bounded_cache_generator(self):
+        wait_time  = 0.4
+
+        @cache.cache(wait_time, max_size = 100)
+        def fibonacci(n):
+            self._calls += 1
+            if n in (0,1):
+                return n
+            return fibonacci(n-1) + fibonacci(n-2)
+
+        self._real_test_fib(fibonacci, wait_time)
+        self.assertEquals(9, fibonacci.stats()['size'])
+
+    def test_bounded_cache_generator_with_object(self):
+        wait_time  = 0.4
+
+        class FibonacciClass(object):
+            def __init__(self, test_case):
+                super(FibonacciClass, self).__init__()
+                self._test_case = test_case
+            @cache.cache(wait_time, max_size = 100)
+            def fibonacci(self,n):
+                self._test_case._calls += 1
+                if n in (0,1):
+                    return n
+                return self.fibonacci(n-1) + self.fibonacci(n-2)
+
+        fibonacci_instance = FibonacciClass(self)
+        self._real_test_fib(fibonacci_instance.fibonacci,wait_time)
+
+    def test_bounded_cache_evicts(self):
+        self._call_times = 0
+
+        @cache.cache(max_size = 2)
+        def whatever(arg):
+            self._call_times += 1
+            return arg
+
+        whatever(1)
+        whatever(2)
+        whatever(1)
+        whatever(3) # 2 is evicted
+        self.assertEquals(3, self._call_times)
+        whatever(1)
+        self.assertEquals(3, self._call_times)
+        whatever(2)
+        self.assertEquals(4, self._call_times)
+
+        stats = whatever.stats()
+        self.assertEquals(2, stats['size'])
+        self.assertEquals(2, stats['evictions'])
+        self.assertEquals(2, stats['hits'])
+
+    def test_invalidate(self):
+        for max_size in (None, 10):
+            self._call_times = 0
+
+            @cache.cache(max_size = max_size)
+            def whatever(arg):
+                self._call_times += 1
+                return arg
+
+            whatever({'foo' : 'bar'})
+            whatever(5)
+            whatever.invalidate(5)
+            whatever(5)
+            whatever({'foo' : 'bar'})
+            self.assertEquals(3, self._call_times)
+
+            whatever.clear()
+            whatever({'foo' : 'bar'})
+            self.assertEquals(4, self._call_times)
+
+    def test_cleaner(self):
+        self._call_times = 0
+
+        @cache.cache(0.1)
+        def whatever(arg):
+            self._call_times += 1
+            return arg
+
+        read_file = open(__file__)
+        whatever(5)
+        whatever(arg = read_file)
+
+        cleaner = cache._CacheCleaner()
+        # Entries which have not expired yet are kept
+        cleaner.clean_cache_obj(whatever)
+        whatever(5)
+        whatever(arg = read_file)
+        self.assertEquals(2, self._call_times)
+
+        time.sleep(0.2)
+        cleaner.clean_cache_obj(whatever)
+        dictionaries = whatever._get_dictionaries(None)
+        self.assertEquals({}, dictionaries['dict'])
+        self.assertEquals([], dictionaries['list'])
+
+class CacheEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.current_time = 10
+        self.engine = cache.CacheEngine(max_size = 3, ttl = 5, time_func = lambda : self.current_time)
+
+    def test_lru(self):
+        for n in range(3):
+            self.engine.set(n, str(n))
+        self.assertEquals('0', self.engine.get(0))
+
+        # 1 is the least recently used
+        self.engine.set(3, '3')
+        self.assertEquals(None, self.engine.get(1))
+        self.assertEquals('0', self.engine.get(0))
+        self.assertEquals(3, len(self.engine))
+
+    def test_ttl(self):
+        self.engine.set('foo', 'bar')
+        self.current_time += 4
+        self.engine.set('bar', 'foo')
+        self.assertEquals('bar', self.engine.get('foo'))
+
+        self.current_time += 1
+        self.assertEquals(None, self.engine.get('foo'))
+        self.assertEquals('foo', self.engine.get('bar'))
+
+        self.current_time += 4
+        self.assertEquals(1, self.engine.purge_expired())
+        self.assertEquals(0, len(self.engine))
+        self.assertEquals(2, self.engine.stats()['expirations'])
+
+    def test_single_flight(self):
+        calls     = []
+        results   = []
+        computing = threading.Event()
+        release   = threading.Event()
+
+        def compute():
+            calls.append(None)
+            computing.set()
+            release.wait(5)
+            return 'result'
+
+        def call():
+            results.append(self.engine.get_or_compute('key', compute))
+
+        threads = [ threading.Thread(target = call) for _ in range(5) ]
+        threads[0].start()
+        computing.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while self.engine.stats()['coalesced'] < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEquals(1, len(calls))
+        self.assertEquals(['result'] * 5, results)
+        self.assertEquals('result', self.engine.get_or_compute('key', compute))
+        self.assertEquals(1, len(calls))
+
+        stats = self.engine.stats()
+        self.assertEquals(1, stats['hits'])
+        self.assertEquals(5, stats['misses'])
+
+    def test_errors_are_not_cached(self):
+        def fail():
+            raise ValueError("error")
+
+        self.assertRaises(ValueError, self.engine.get_or_compute, 'key', fail)
+        self.assertEquals('value', self.engine.get_or_compute('key', lambda : 'value'))
+
+    def test_invalidate_while_computing(self):
+        def compute():
+            self.engine.invalidate('key')
+            return 'old'
+
+        self.assertEquals('old', self.engine.get_or_compute('key', compute))
+        self.assertEquals(None, self.engine.get('key'))
+
 class FastCacheTestCase(unittest.TestCase):
     def testFoo(self):
 
@@ -325,10 +505,36 @@ class FastCacheTestCase(unittest.TestCase):
         b.method(5)
         self.assertEquals(2, self._calls)
 
+        # The instances are not kept by the cache
+        del a
+        cache._CacheCleaner().clean_fast_cache_obj(A.method)
+        self.assertEquals(1, len(A.method.cache))
+
+    def test_bounded(self):
+        self._calls = 0
+
+        @cache.fast_cache.bounded(2)
+        def whatever(arg):
+            self._calls += 1
+            return arg
+
+        whatever(1)
+        whatever(2)
+        whatever(3)
+        whatever(3)
+        self.assertEquals(3, self._calls)
+        whatever(1)
+        self.assertEquals(4, self._calls)
+
+        whatever.invalidate(1)
+        whatever(1)
+        self.assertEquals(5, self._calls)
+
 
 def suite():
     return unittest.TestSuite((
                     unittest.makeSuite(CacheTestCase),
+                    unittest.makeSuite(CacheEngineTestCase),
                     unittest.makeSuite(FastCacheTestCase)
                 ))
 
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import json
+import logging
+import unittest
+
+import voodoo.log as log
+from voodoo.log import logged
+from voodoo.sessions.session_id import SessionId
+
+class RecordsHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+class LoggedClass(object):
+    @logged(except_for = 'password')
+    def login(self, username, password):
+        return username
+
+    @logged()
+    def get_status(self, reservation_id):
+        return 'waiting'
+
+    @logged()
+    def fail(self):
+        raise ValueError("failed")
+
+class LoggedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.logger  = logging.getLogger(LoggedClass.__module__ + '.' + LoggedClass.__name__)
+        self.handler = RecordsHandler()
+        self.logger.addHandler(self.handler)
+        self.original_level = self.logger.level
+        self.obj = LoggedClass()
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.original_level)
+        log.refresh_levels()
+        log.disable_tracing()
+
+    def test_disabled(self):
+        self.logger.setLevel(logging.INFO)
+        log.refresh_levels()
+        self.assertEquals('user', self.obj.login('user', 'secret'))
+        self.assertEquals([], self.handler.records)
+
+    def test_enabled(self):
+        self.logger.setLevel(logging.INFO)
+        log.refresh_levels()
+        self.obj.login('user', 'secret')
+
+        # The level is checked again after refresh_levels
+        self.logger.setLevel(logging.DEBUG)
+        log.refresh_levels()
+        self.obj.login('user', 'secret')
+
+        self.assertEquals(2, len(self.handler.records))
+        self.assertTrue('Calling login' in self.handler.records[0])
+        self.assertTrue("'<hidden>'" in self.handler.records[0])
+        self.assertFalse('secret' in self.handler.records[0])
+        self.assertTrue("finished with value <'user'>" in self.handler.records[1])
+
+    def test_log_exc(self):
+        self.logger.setLevel(logging.INFO)
+        try:
+            raise ValueError("the error")
+        except ValueError:
+            log.log_exc(LoggedClass, log.level.Debug)
+            self.assertEquals([], self.handler.records)
+            log.log_exc(LoggedClass, log.level.Info)
+        self.assertTrue(any('the error' in record for record in self.handler.records))
+
+    def test_tracing(self):
+        self.logger.setLevel(logging.INFO)
+        log.refresh_levels()
+        log.enable_tracing(size = 3)
+
+        log.set_trace_context('context reservation')
+        self.obj.get_status(SessionId('reservation1'))
+        self.obj.get_status(reservation_id = 'reservation2')
+        self.assertRaises(ValueError, self.obj.fail)
+        log.set_trace_context(None)
+
+        traces = log.get_traces()
+        self.assertEquals(3, len(traces))
+        self.assertEquals(['reservation1', 'reservation2', 'context reservation'], [ trace['reservation_id'] for trace in traces ])
+        self.assertEquals(LoggedClass.__module__ + '.LoggedClass.get_status', traces[0]['method'])
+        self.assertEquals([False, False, True], [ trace['error'] for trace in traces ])
+        self.assertEquals([], self.handler.records)
+
+        # It is a ring buffer
+        self.obj.login('user', 'secret')
+        traces = json.loads(log.export_traces())
+        self.assertEquals(3, len(traces))
+        self.assertEquals(LoggedClass.__module__ + '.LoggedClass.login', traces[-1]['method'])
+
+        log.disable_tracing()
+        self.obj.login('user', 'secret')
+        self.assertEquals([], log.get_traces())
+
+def suite():
+    return unittest.makeSuite(LoggedTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
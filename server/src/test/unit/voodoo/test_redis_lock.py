@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import sys
+import time
+import unittest
+import threading
+
+try:
+    import redis
+except ImportError:
+    REDIS_AVAILABLE = False
+else:
+    REDIS_AVAILABLE = True
+
+from voodoo.redis_lock import RedisLock, LockMetrics
+
+LOCK_KEY = 'voodoo:tests:lock'
+
+class RedisLockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.metrics = LockMetrics()
+        self.lock = self._create_lock()
+        self._clean()
+
+    def tearDown(self):
+        self._clean()
+
+    def _create_lock(self, ttl = 10):
+        return RedisLock(redis.Redis, LOCK_KEY, ttl = ttl, metrics = self.metrics)
+
+    def _clean(self):
+        redis.Redis().delete(LOCK_KEY, LOCK_KEY + ':signal')
+
+    def test_acquire_release(self):
+        token = self.lock.acquire(timeout = 0)
+        self.assertNotEquals(None, token)
+        self.assertEquals(None, self.lock.acquire(timeout = 0))
+        self.assertTrue(self.lock.release(token))
+
+        self.assertNotEquals(None, self.lock.acquire(timeout = 0))
+
+    def test_release_other_token(self):
+        token1 = self.lock.acquire()
+        self.lock.release(token1)
+        token2 = self.lock.acquire()
+
+        # The first owner can not release the lock anymore
+        self.assertFalse(self.lock.release(token1))
+        self.assertEquals(None, self.lock.acquire(timeout = 0))
+        self.assertTrue(self.lock.release(token2))
+
+        self.assertEquals(1, self.metrics.snapshot()['expired_releases'])
+
+    def test_expires(self):
+        lock = self._create_lock(ttl = 0.2)
+        token1 = lock.acquire()
+        token2 = lock.acquire(timeout = 2)
+        self.assertNotEquals(None, token2)
+        self.assertFalse(lock.release(token1))
+        self.assertTrue(lock.release(token2))
+
+    def test_never_expires(self):
+        lock = self._create_lock(ttl = None)
+        token = lock.acquire()
+        self.assertTrue(redis.Redis().ttl(LOCK_KEY) in (None, -1))
+        self.assertEquals(None, lock.acquire(timeout = 1))
+        self.assertTrue(lock.release(token))
+        self.assertNotEquals(None, lock.acquire(timeout = 0))
+
+    def test_waiters_are_woken_up(self):
+        token = self.lock.acquire()
+        acquired = []
+
+        def waiter():
+            waiter_token = self._create_lock().acquire(timeout = 5)
+            acquired.append(time.time())
+            self._create_lock().release(waiter_token)
+
+        thread = threading.Thread(target = waiter)
+        thread.start()
+        time.sleep(0.1)
+
+        released = time.time()
+        self.lock.release(token)
+        thread.join(5)
+
+        self.assertEquals(1, len(acquired))
+        # Far before the 1 second of the BLPOP timeout
+        self.assertTrue(acquired[0] - released < 0.5)
+
+        metrics = self.metrics.snapshot()
+        self.assertEquals(2, metrics['acquired'])
+        self.assertEquals(1, metrics['contended'])
+        self.assertEquals(2, metrics['released'])
+
+    def test_timeout(self):
+        self.lock.acquire()
+        initial = time.time()
+        self.assertEquals(None, self.lock.acquire(timeout = 1))
+        self.assertTrue(time.time() - initial >= 1)
+        self.assertEquals(1, self.metrics.snapshot()['timeouts'])
+
+def suite():
+    suites = []
+    if REDIS_AVAILABLE:
+        suites.append(unittest.makeSuite(RedisLockTestCase))
+    else:
+        print >> sys.stderr, "redis not available; skipping RedisLockTestCase"
+    return unittest.TestSuite(suites)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import time
+import unittest
+import threading
+
+from voodoo.threaded import run_concurrently, TimeoutError
+
+SHORT_TIMEOUT = 0.3
+
+class RunConcurrentlyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.gate = threading.Event()
+
+    def tearDown(self):
+        self.gate.set()
+
+    def _blocked(self):
+        self.gate.wait(5)
+        return 'blocked'
+
+    def _fail(self, message):
+        raise Exception(message)
+
+    def test_results(self):
+        tasks = [ ('add', lambda a, b : a + b, (1, 2)), ('fail', self._fail, ('failed',)) ]
+        results = dict( (key, (finished_ok, result)) for key, finished_ok, result in run_concurrently(tasks, workers = 5) )
+
+        self.assertEquals((True, 3), results['add'])
+        finished_ok, exc = results['fail']
+        self.assertFalse(finished_ok)
+        self.assertEquals('failed', str(exc))
+
+    def test_no_tasks(self):
+        self.assertEquals([], list(run_concurrently([], workers = 5)))
+
+    def test_bounded_workers(self):
+        running = []
+        max_running = []
+        lock = threading.Lock()
+
+        def task():
+            with lock:
+                running.append(None)
+                max_running.append(len(running))
+            time.sleep(0.01)
+            with lock:
+                running.pop()
+
+        tasks = [ (n, task, ()) for n in range(10) ]
+        results = list(run_concurrently(tasks, workers = 3))
+        self.assertEquals(10, len(results))
+        self.assertTrue(max(max_running) <= 3)
+
+    def test_timeout(self):
+        tasks = [ ('blocked', self._blocked, ()) ] + [ (n, lambda : 'ok', ()) for n in range(3) ]
+        t0 = time.time()
+        results = dict( (key, (finished_ok, result)) for key, finished_ok, result in run_concurrently(tasks, workers = 1, timeout = SHORT_TIMEOUT) )
+        self.assertTrue(time.time() - t0 < 5)
+
+        # The hanging task does not stall the rest, even with a single worker
+        finished_ok, exc = results['blocked']
+        self.assertFalse(finished_ok)
+        self.assertTrue(isinstance(exc, TimeoutError))
+        for n in range(3):
+            self.assertEquals((True, 'ok'), results[n])
+
+def suite():
+    return unittest.makeSuite(RunConcurrentlyTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
+
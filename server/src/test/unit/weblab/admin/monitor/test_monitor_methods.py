@@ -54,6 +54,9 @@ class ConfirmerMock(object):
     def enqueue_free_experiment(self, lab_coordaddress, reservation_id, lab_session_id, experiment_instance_id):
         pass
 
+    def stop(self):
+        pass
+
 @case_uses_module(Confirmer)
 @case_uses_module(UserProcessingServer)
 class MonitorMethodsTestCase(unittest.TestCase):
@@ -17,6 +17,12 @@ import unittest
 import datetime
 
 from voodoo.gen.coordinator.CoordAddress import CoordAddress
+from voodoo.sessions.session_id import SessionId
+from weblab.data.command import Command, NullCommand
+from weblab.data.dto.experiments import ExperimentAllowed, Experiment, ExperimentCategory, ExperimentClient
+import weblab.core.reservations as Reservation
+import weblab.core.coordinator.status as WSS
+import weblab.core.new_server as new_server
 from weblab.core.new_server import simplify_response
 
 class SimplifyResponseTestCase(unittest.TestCase):
@@ -108,6 +114,27 @@ class SimplifyResponseTestCase(unittest.TestCase):
                 }
             }, limit = 3)
 
+    def test_simplify_response_slots(self):
+        class A(object):
+            __slots__ = ('attr1',)
+            def __init__(self):
+                self.attr1 = "foo"
+
+        self._check(A(), {})
+
+    def test_simplify_response_attribute_in_class(self):
+        class A(object):
+            attr2 = "class"
+            def __init__(self):
+                self.attr1 = "foo"
+                self.attr2 = "bar"
+                self.method = lambda : None
+
+        self._check(A(), {"attr1" : "foo"})
+
+    def test_simplify_response_none(self):
+        self._check(None, {})
+
     def _check(self, msg, expected, limit = None):
         if limit is not None:
             simplified = simplify_response(msg, limit = limit)
@@ -115,9 +142,53 @@ class SimplifyResponseTestCase(unittest.TestCase):
             simplified = simplify_response(msg)
         self.assertEquals(simplified, expected)
 
+class EncodersTestCase(unittest.TestCase):
+
+    def _create_samples(self):
+        now = datetime.datetime(2009, 7, 19, 9, 39)
+        client = ExperimentClient('js', { 'html.file' : 'experiment.html' })
+        experiment = Experiment('ud-dummy', ExperimentCategory('Dummy experiments'), now, now, client, 1)
+        samples = [
+            SessionId('session'),
+            Command('ChangeSwitch on 0'),
+            NullCommand(),
+            Reservation.WaitingReservation('reservation;route', 5),
+            Reservation.WaitingInstances('reservation;route', 5),
+            Reservation.NullReservation(),
+            Reservation.WaitingConfirmationReservation('reservation;route', 'http://localhost/'),
+            Reservation.ConfirmedReservation('reservation;route', 100, '{}', 'http://localhost/', 'remote'),
+            Reservation.PostReservationReservation('reservation;route', True, '{}', '{}'),
+            WSS.WaitingQueueStatus('reservation', 5),
+            WSS.WaitingInstancesQueueStatus('reservation', 5),
+            WSS.WaitingConfirmationQueueStatus('reservation', 'http://localhost/'),
+            WSS.RemoteReservedStatus('reservation', 100, '{}', 'http://localhost/', 'remote'),
+            WSS.PostReservationStatus('reservation', True, '{}', '{}'),
+            WSS.LocalReservedStatus('reservation', CoordAddress('mach','inst','serv'), SessionId('lab_session'), { 'address' : 'lab:inst@mach' },
+                                    100, '{}', now, now, True, 90, 'http://localhost/'),
+            experiment,
+            experiment.category,
+            client,
+            ExperimentAllowed(experiment, 200, 5, True, 'permanent', 1, 'group'),
+        ]
+        return dict( (type(sample), sample) for sample in samples )
+
+    def test_registered_attributes(self):
+        # The encoders registered with register_attributes must return
+        # the same as inspecting the objects: otherwise attributes would
+        # be silently missing in the responses
+        samples = self._create_samples()
+        for klass, encoder in new_server._encoders.items():
+            if encoder.__name__ != 'attributes_encoder':
+                continue
+            self.assertTrue(klass in samples, "No sample instance of %s" % klass.__name__)
+            sample = samples[klass]
+            self.assertEquals(new_server._encode_dir(sample, 15, 0), simplify_response(sample), "%s encoder does not match its attributes" % klass.__name__)
 
 def suite():
-    return unittest.makeSuite(SimplifyResponseTestCase)
+    return unittest.TestSuite((
+            unittest.makeSuite(SimplifyResponseTestCase),
+            unittest.makeSuite(EncodersTestCase),
+        ))
 
 if __name__ == '__main__':
     unittest.main()
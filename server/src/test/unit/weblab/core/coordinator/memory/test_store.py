@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import os
+import shutil
+import tempfile
+import datetime
+import unittest
+
+import test.unit.configuration as configuration_module
+import voodoo.configuration as ConfigurationManager
+import voodoo.sessions.session_id as SessionId
+
+import weblab.core.coordinator.status as WSS
+import weblab.core.coordinator.memory.store as store_module
+from weblab.core.coordinator.memory.store import MemoryStore, Journal
+from weblab.core.coordinator.memory.coordinator import COORDINATOR_MEMORY_JOURNAL
+from weblab.core.coordinator.config_parser import COORDINATOR_LABORATORY_SERVERS
+from weblab.core.server import WEBLAB_CORE_SERVER_CLEAN_COORDINATOR
+from weblab.data.experiments import ExperimentId
+
+from test.unit.weblab.core.coordinator.test_coordinator import WrappedMemoryCoordinator, ConfirmerMock, coord_addr
+
+class MemoryStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _reopen(self, store):
+        store.close()
+        return MemoryStore(Journal(self.path))
+
+    def test_operations(self):
+        store = MemoryStore()
+        store.set('table', 'key', { 'a' : 1 })
+        self.assertEquals({ 'a' : 1 }, store.get('table', 'key'))
+        self.assertTrue(store.exists('table', 'key'))
+        self.assertTrue(store.delete('table', 'key'))
+        self.assertFalse(store.delete('table', 'key'))
+
+        self.assertTrue(store.add('sets', ('type', 'inst'), 'member'))
+        self.assertFalse(store.add('sets', ('type', 'inst'), 'member'))
+        self.assertTrue(store.is_member('sets', ('type', 'inst'), 'member'))
+        self.assertTrue(store.discard('sets', ('type', 'inst'), 'member'))
+        # Empty sets are removed
+        self.assertFalse(store.exists('sets', ('type', 'inst')))
+
+    def test_recovery(self):
+        store = MemoryStore(Journal(self.path))
+        store.set('table', 'key1', { 'a' : [1, 2], 'b' : u'\xf1'.encode('utf-8') })
+        store.set('table', 'key2', True)
+        store.delete('table', 'key2')
+        store.add('sets', ('type', 'inst'), 'member1')
+        store.add('sets', ('type', 'inst'), 'member2')
+        store.discard('sets', ('type', 'inst'), 'member1')
+        store.set('cleared', 'key', True)
+        store.clear('cleared')
+
+        store = self._reopen(store)
+        self.assertEquals({ 'a' : [1, 2], 'b' : u'\xf1'.encode('utf-8') }, store.get('table', 'key1'))
+        self.assertTrue(isinstance(store.get('table', 'key1').keys()[0], str))
+        self.assertFalse(store.exists('table', 'key2'))
+        self.assertEquals(set(['member2']), store.members('sets', ('type', 'inst')))
+        self.assertEquals([], store.keys('cleared'))
+
+    def test_corrupted_journal(self):
+        store = MemoryStore(Journal(self.path))
+        store.set('table', 'key1', 'value1')
+        store.close()
+
+        # The process died while writing
+        with open(self.path, 'ab') as f:
+            f.write('["set", "table", "key2", "val')
+
+        store = MemoryStore(Journal(self.path))
+        self.assertEquals('value1', store.get('table', 'key1'))
+        self.assertFalse(store.exists('table', 'key2'))
+
+        # The journal was rewritten without the corrupted line
+        store.set('table', 'key3', 'value3')
+        store = self._reopen(store)
+        self.assertEquals('value3', store.get('table', 'key3'))
+
+    def test_compaction(self):
+        original_min_compaction_entries = store_module.MIN_COMPACTION_ENTRIES
+        store_module.MIN_COMPACTION_ENTRIES = 10
+        try:
+            store = MemoryStore(Journal(self.path))
+            for n in range(100):
+                store.set('table', 'key', n)
+        finally:
+            store_module.MIN_COMPACTION_ENTRIES = original_min_compaction_entries
+
+        self.assertTrue(len(open(self.path).readlines()) <= 10)
+        store = self._reopen(store)
+        self.assertEquals(99, store.get('table', 'key'))
+
+class MemoryCoordinatorRecoveryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        self.cfg_manager = ConfigurationManager.ConfigurationManager()
+        self.cfg_manager.append_module(configuration_module)
+        self.cfg_manager._set_value(COORDINATOR_LABORATORY_SERVERS, {
+            'lab1:inst@machine' : {
+                'inst1|exp1|cat1' : 'res_inst1@res_type'
+            },
+        })
+        self.cfg_manager._set_value('core_scheduling_systems', {
+            "res_type" : ("PRIORITY_QUEUE", {'randomize_instances' : False}),
+        })
+        self.cfg_manager._set_value(COORDINATOR_MEMORY_JOURNAL, os.path.join(self.directory, 'journal'))
+
+        self.coordinator = WrappedMemoryCoordinator(None, self.cfg_manager, ConfirmerClass = ConfirmerMock)
+
+    def tearDown(self):
+        self.coordinator.stop()
+        shutil.rmtree(self.directory)
+
+    def _restart(self):
+        self.coordinator.stop()
+        self.cfg_manager._set_value(WEBLAB_CORE_SERVER_CLEAN_COORDINATOR, False)
+        self.coordinator = WrappedMemoryCoordinator(None, self.cfg_manager, ConfirmerClass = ConfirmerMock)
+
+    def test_recovery(self):
+        exp_id = ExperimentId('exp1', 'cat1')
+        _, reservation1_id = self.coordinator.reserve_experiment(exp_id, 30, 5, True, 'initial data', {}, {})
+        _, reservation2_id = self.coordinator.reserve_experiment(exp_id, 30, 5, True, 'initial data', {}, {})
+        now = datetime.datetime.fromtimestamp(self.coordinator.time_provider.get_time())
+        self.coordinator.confirm_experiment(coord_addr('expser:inst@mach'), exp_id, reservation1_id, 'lab1:inst@machine', SessionId.SessionId('the.session'), '{}', now, now, 'res_type', {})
+
+        self._restart()
+
+        status = self.coordinator.get_reservation_status(reservation1_id)
+        self.assertTrue(isinstance(status, WSS.LocalReservedStatus))
+        self.assertEquals('the.session', status.lab_session_id.id)
+        self.assertEquals(WSS.WaitingQueueStatus(reservation2_id, 0), self.coordinator.get_reservation_status(reservation2_id))
+
+        # The recovered queue works as before
+        self.coordinator.finish_reservation(reservation1_id)
+        self.assertEquals(WSS.WaitingConfirmationQueueStatus(reservation2_id, ''), self.coordinator.get_reservation_status(reservation2_id))
+
+def suite():
+    return unittest.TestSuite((
+            unittest.makeSuite(MemoryStoreTestCase),
+            unittest.makeSuite(MemoryCoordinatorRecoveryTestCase),
+        ))
+
+if __name__ == '__main__':
+    unittest.main()
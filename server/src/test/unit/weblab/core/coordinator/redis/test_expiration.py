@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import sys
+import time
+import unittest
+
+import test.unit.configuration as configuration_module
+import voodoo.configuration as ConfigurationManager
+
+from weblab.data.experiments import ExperimentId, ExperimentInstanceId
+from weblab.core.coordinator.resource import Resource
+from weblab.core.coordinator.config_parser import COORDINATOR_LABORATORY_SERVERS
+from weblab.core.coordinator.redis.constants import WEBLAB_RESOURCE_PQUEUE_DEADLINES, WEBLAB_RESOURCE_PQUEUE_RESERVATIONS
+import weblab.core.coordinator.status as WSS
+
+from test.unit.weblab.core.coordinator.test_coordinator import WrappedRedisCoordinator as WrappedCoordinator, ConfirmerMock, DEFAULT_REQUEST_INFO, DEFAULT_CONSUMER_DATA
+
+class ReservationsExpirationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cfg_manager = ConfigurationManager.ConfigurationManager()
+        self.cfg_manager.append_module(configuration_module)
+        self.cfg_manager._set_value(COORDINATOR_LABORATORY_SERVERS, {
+            'lab1:inst@machine' : {
+                'inst1|exp1|cat1' : 'res_inst1@res_type'
+            },
+        })
+        self.cfg_manager._set_value('core_scheduling_systems', { "res_type" : ("PRIORITY_QUEUE", {'randomize_instances' : False, 'expiration_check_period' : 0.01}) })
+
+        self.coordinator = WrappedCoordinator(None, self.cfg_manager, ConfirmerClass = ConfirmerMock)
+        self.coordinator._clean()
+        self.coordinator.add_experiment_instance_id("lab1:inst@machine", ExperimentInstanceId('inst1', 'exp1','cat1'), Resource("res_type", "res_inst1"))
+
+        self.client = self.coordinator._redis_maker()
+
+    def tearDown(self):
+        self.coordinator.stop()
+        self.coordinator._clean()
+
+    def _wait_for(self, condition, timeout = 2):
+        initial = time.time()
+        while not condition() and time.time() < initial + timeout:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def _reserve(self):
+        return self.coordinator.reserve_experiment(ExperimentId('exp1','cat1'), 30, 5, True, 'initial data', DEFAULT_REQUEST_INFO, DEFAULT_CONSUMER_DATA)
+
+    def _deadlines(self):
+        return dict(self.client.zrangebyscore(WEBLAB_RESOURCE_PQUEUE_DEADLINES % "res_type", '-inf', '+inf', withscores = True))
+
+    def test_deadlines_of_active_reservations(self):
+        now = time.time()
+        self.coordinator.time_provider._TEST_TIME = now
+
+        _, reservation1_id = self._reserve()
+        status, reservation2_id = self._reserve()
+        self.assertTrue(isinstance(status, WSS.WaitingQueueStatus))
+
+        # Only the active one has a deadline
+        self.assertEquals({ reservation1_id : now + 30 }, self._deadlines())
+
+        self.coordinator.finish_reservation(reservation1_id)
+        status = self.coordinator.get_reservation_status(reservation2_id)
+        self.assertTrue(isinstance(status, WSS.WaitingConfirmationQueueStatus))
+        self.assertEquals([ reservation2_id ], self._deadlines().keys())
+
+    def test_expired_without_requests(self):
+        now = time.time()
+        self.coordinator.time_provider._TEST_TIME = now
+
+        _, reservation1_id = self._reserve()
+        self.assertEquals([ reservation1_id ], self._deadlines().keys())
+
+        # Nobody asks anything, but the slot finishes
+        self.coordinator.time_provider._TEST_TIME = now + 31
+        self._wait_for(lambda : len(self._deadlines()) == 0)
+        self._wait_for(lambda : len(self.client.smembers(WEBLAB_RESOURCE_PQUEUE_RESERVATIONS % "res_type")) == 0)
+
+def suite():
+    suites = []
+    if WrappedCoordinator.REDIS_AVAILABLE:
+        suites.append(unittest.makeSuite(ReservationsExpirationTestCase))
+    else:
+        print >> sys.stderr, "redis not available; skipping ReservationsExpirationTestCase"
+    return unittest.TestSuite(suites)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import sys
+import json
+import time
+import unittest
+
+import test.unit.configuration as configuration_module
+import voodoo.configuration as ConfigurationManager
+
+from weblab.data.experiments import ExperimentId, ExperimentInstanceId
+from weblab.core.coordinator.resource import Resource
+from weblab.core.coordinator.config_parser import COORDINATOR_LABORATORY_SERVERS
+from weblab.core.coordinator.redis.notifications import ReservationStatusCache
+from weblab.core.coordinator.redis.constants import WEBLAB_RESOURCE_PQUEUE_EVENTS, EVENT_CONFIRMED, EVENT_REMOVED
+import weblab.core.coordinator.status as WSS
+
+from test.unit.weblab.core.coordinator.test_coordinator import WrappedRedisCoordinator as WrappedCoordinator, ConfirmerMock, DEFAULT_REQUEST_INFO, DEFAULT_CONSUMER_DATA
+
+class ReservationStatusCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = ReservationStatusCache("res_type")
+        self.cache.enable()
+
+    def tearDown(self):
+        self.cache.dispose()
+
+    def test_store_and_get(self):
+        self.assertEquals(None, self.cache.get("reservation1"))
+        self.cache.store("reservation1", "status1", self.cache.generation)
+        self.assertEquals("status1", self.cache.get("reservation1"))
+
+    def test_store_outdated(self):
+        generation = self.cache.generation
+        self.cache.process_event(EVENT_REMOVED, "reservation2")
+        self.cache.store("reservation1", "status1", generation)
+        self.assertEquals(None, self.cache.get("reservation1"))
+
+    def test_disabled(self):
+        self.cache.disable()
+        self.cache.store("reservation1", "status1", self.cache.generation)
+        self.assertEquals(None, self.cache.get("reservation1"))
+
+    def test_confirmed_only_invalidates_that_reservation(self):
+        self.cache.store("reservation1", "status1", self.cache.generation)
+        self.cache.store("reservation2", "status2", self.cache.generation)
+        self.cache.process_event(EVENT_CONFIRMED, "reservation1")
+        self.assertEquals(None,      self.cache.get("reservation1"))
+        self.assertEquals("status2", self.cache.get("reservation2"))
+
+    def test_other_events_invalidate_everything(self):
+        self.cache.store("reservation1", "status1", self.cache.generation)
+        self.cache.store("reservation2", "status2", self.cache.generation)
+        self.cache.process_event(EVENT_REMOVED, "reservation1")
+        self.assertEquals(None, self.cache.get("reservation1"))
+        self.assertEquals(None, self.cache.get("reservation2"))
+
+class QueueEventsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cfg_manager = ConfigurationManager.ConfigurationManager()
+        self.cfg_manager.append_module(configuration_module)
+        self.cfg_manager._set_value(COORDINATOR_LABORATORY_SERVERS, {
+            'lab1:inst@machine' : {
+                'inst1|exp1|cat1' : 'res_inst1@res_type'
+            },
+        })
+        self.cfg_manager._set_value('core_scheduling_systems', { "res_type" : ("PRIORITY_QUEUE", {'randomize_instances' : False}) })
+
+        self.coordinator = WrappedCoordinator(None, self.cfg_manager, ConfirmerClass = ConfirmerMock)
+        self.coordinator._clean()
+        self.coordinator.add_experiment_instance_id("lab1:inst@machine", ExperimentInstanceId('inst1', 'exp1','cat1'), Resource("res_type", "res_inst1"))
+
+        self.scheduler = self.coordinator.schedulers["res_type"]
+        self.cache     = self.scheduler._status_cache
+        self._wait_for(lambda : self.cache._enabled)
+
+    def tearDown(self):
+        self.coordinator.stop()
+        self.coordinator._clean()
+
+    def _wait_for(self, condition, timeout = 2):
+        initial = time.time()
+        while not condition() and time.time() < initial + timeout:
+            time.sleep(0.01)
+        self.assertTrue(condition())
+
+    def _reserve(self):
+        return self.coordinator.reserve_experiment(ExperimentId('exp1','cat1'), 30, 5, True, 'initial data', DEFAULT_REQUEST_INFO, DEFAULT_CONSUMER_DATA)
+
+    def test_waiting_status_is_cached_until_the_queue_changes(self):
+        _, reservation1_id = self._reserve()
+        status, reservation2_id = self._reserve()
+        self.assertTrue(isinstance(status, WSS.WaitingQueueStatus))
+
+        self.coordinator.get_reservation_status(reservation2_id)
+        self.assertEquals(status.position, self.cache.get(reservation2_id).position)
+
+        self.coordinator.finish_reservation(reservation1_id)
+        self.assertEquals(None, self.cache.get(reservation2_id))
+
+        status = self.coordinator.get_reservation_status(reservation2_id)
+        self.assertTrue(isinstance(status, WSS.WaitingConfirmationQueueStatus))
+
+    def test_events_from_other_core_servers(self):
+        self._reserve()
+        _, reservation2_id = self._reserve()
+        self.coordinator.get_reservation_status(reservation2_id)
+        self.assertNotEquals(None, self.cache.get(reservation2_id))
+
+        # Other core server publishes in redis directly
+        client = self.coordinator._redis_maker()
+        client.publish(WEBLAB_RESOURCE_PQUEUE_EVENTS % "res_type", json.dumps({ 'event' : EVENT_REMOVED, 'reservation_id' : 'other' }))
+        self._wait_for(lambda : self.cache.get(reservation2_id) is None)
+
+def suite():
+    suites = [ unittest.makeSuite(ReservationStatusCacheTestCase) ]
+    if WrappedCoordinator.REDIS_AVAILABLE:
+        suites.append(unittest.makeSuite(QueueEventsTestCase))
+    else:
+        print >> sys.stderr, "redis not available; skipping QueueEventsTestCase"
+    return unittest.TestSuite(suites)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,6 +15,7 @@
 
 import sys
 import json
+import datetime
 import unittest
 import test.unit.configuration as configuration_module
 import voodoo.configuration as ConfigurationManager
@@ -23,6 +24,7 @@ from weblab.data.experiments import ExperimentId
 from weblab.data.experiments import ExperimentInstanceId
 from weblab.core.coordinator.resource import Resource
 import weblab.core.coordinator.exc as CoordExc
+from weblab.core.coordinator.redis.constants import WEBLAB_RESERVATIONS_LATEST_ACCESS
 
 from test.unit.weblab.core.coordinator.test_coordinator import WrappedRedisCoordinator as WrappedCoordinator, ConfirmerMock
 
@@ -74,6 +76,45 @@ class ReservationsManagerTestCase(unittest.TestCase):
         self.assertTrue(reservation1 in sessions)
         self.assertTrue(reservation2 in sessions)
 
+    def test_list_expired_reservations(self):
+        exp_id = ExperimentId("exp1","cat1")
+
+        now = datetime.datetime(2013, 1, 1, 12, 0, 0)
+        reservation1 = self.reservations_manager.create(exp_id, "{}", REQUEST_INFO, lambda : now)
+        reservation2 = self.reservations_manager.create(exp_id, "{}", REQUEST_INFO, lambda : now + datetime.timedelta(seconds = 10))
+
+        self.assertEquals([], self.reservations_manager.list_expired_reservations(now))
+        self.assertEquals([reservation1], self.reservations_manager.list_expired_reservations(now + datetime.timedelta(seconds = 5)))
+
+        # Updating it moves it to the end
+        self.reservations_manager.now = lambda : now + datetime.timedelta(seconds = 20)
+        self.reservations_manager.update(reservation1)
+        self.assertEquals([reservation2], self.reservations_manager.list_expired_reservations(now + datetime.timedelta(seconds = 15)))
+
+        self.reservations_manager.delete(reservation2)
+        self.assertEquals([], self.reservations_manager.list_expired_reservations(now + datetime.timedelta(seconds = 15)))
+
+    def test_update_expired_reservation(self):
+        now = datetime.datetime(2013, 1, 1, 12, 0, 0)
+        self.reservations_manager.now = lambda : now
+
+        self.assertTrue(self.reservations_manager.update("not-existing-reservation"))
+        self.assertEquals([], self.reservations_manager.list_expired_reservations(now + datetime.timedelta(seconds = 5)))
+
+    def test_rebuild_latest_access_index(self):
+        exp_id = ExperimentId("exp1","cat1")
+
+        now = datetime.datetime(2013, 1, 1, 12, 0, 0)
+        reservation1 = self.reservations_manager.create(exp_id, "{}", REQUEST_INFO, lambda : now)
+
+        # As it was before the index existed
+        client = self.coordinator._redis_maker()
+        client.delete(WEBLAB_RESERVATIONS_LATEST_ACCESS)
+        self.assertEquals([], self.reservations_manager.list_expired_reservations(now + datetime.timedelta(seconds = 5)))
+
+        self.reservations_manager.rebuild_latest_access_index()
+        self.assertEquals([reservation1], self.reservations_manager.list_expired_reservations(now + datetime.timedelta(seconds = 5)))
+
 if WrappedCoordinator.REDIS_AVAILABLE:
     def suite():
         return unittest.makeSuite(ReservationsManagerTestCase)
@@ -13,14 +13,74 @@
 # Author: Pablo Orduña <pablo@ordunya.com>
 #
 
+import threading
 import unittest
 
 import test.unit.configuration as configuration_module
 import voodoo.configuration as ConfigurationManager
 
+import weblab.core.coordinator.checker as ResourcesChecker
+
+class FakeCoordinator(object):
+    def __init__(self, cfg_manager, laboratories):
+        self.cfg_manager  = cfg_manager
+        self.locator      = None
+        self.laboratories = laboratories
+        self.broken       = {}
+        self.fixed        = []
+
+    def list_laboratories_addresses(self):
+        return dict( (address, dict(experiments)) for address, experiments in self.laboratories.items() )
+
+    def mark_resource_as_broken(self, resource, message):
+        self.broken[resource] = message
+        return {}
+
+    def mark_resource_as_fixed(self, resource):
+        self.fixed.append(resource)
+        return {}
+
+    def notify_status(self, notifications):
+        pass
+
+class FakeResourcesChecker(ResourcesChecker.ResourcesChecker):
+    def __init__(self, coordinator, results, gate):
+        super(FakeResourcesChecker, self).__init__(coordinator)
+        self.results = results
+        self.gate    = gate
+
+    def check_laboratory(self, address_str, experiments):
+        if address_str not in self.results:
+            self.gate.wait(5) # It does not reply
+        return self.results.get(address_str, {})
+
 class ResourcesCheckerTestCase(unittest.TestCase):
-    def test_check_laboratory(self):
-        pass # TODO
+    def setUp(self):
+        self.cfg_manager = ConfigurationManager.ConfigurationManager()
+        self.cfg_manager.append_module(configuration_module)
+        self.cfg_manager._set_value(ResourcesChecker.RESOURCES_CHECKER_TIMEOUT, 0.3)
+        self.gate = threading.Event()
+
+    def tearDown(self):
+        self.gate.set()
+
+    def test_check(self):
+        coordinator = FakeCoordinator(self.cfg_manager, {
+                'lab1' : { 'exp1' : 'res1', 'exp2' : 'res2' },
+                'lab2' : { 'exp3' : 'res1', 'exp4' : 'res3' },
+                'lab3' : { 'exp5' : 'res4' },
+            })
+        results = {
+                'lab1' : { 'res1' : 'failed in lab1' },
+                'lab2' : { 'res1' : 'failed in lab2' },
+            }
+        checker = FakeResourcesChecker(coordinator, results, self.gate)
+        checker.check()
+
+        self.assertEquals(['res1'], coordinator.broken.keys())
+        self.assertEquals(set(['failed in lab1', 'failed in lab2']), set(coordinator.broken['res1'].split(';')))
+        # lab3 did not reply, so res4 is neither marked as broken nor as fixed
+        self.assertEquals(set(['res2', 'res3']), set(coordinator.fixed))
 
 def suite():
     return unittest.makeSuite(ResourcesCheckerTestCase)
@@ -14,13 +14,18 @@
 #
 
 import time
+import errno
+import socket
 import datetime
+import threading
 import unittest
 import mocker
 
 import voodoo.gen.coordinator.CoordAddress as CoordAddress
 import voodoo.gen.locator.EasyLocator      as EasyLocator
 import voodoo.sessions.session_id           as SessionId
+import voodoo.gen.exceptions.protocols.ProtocolErrors as ProtocolErrors
+import voodoo.gen.exceptions.locator.LocatorErrors   as LocatorErrors
 
 import test.unit.configuration as configuration_module
 import voodoo.configuration as ConfigurationManager
@@ -33,6 +38,7 @@ from weblab.core.coordinator.resource import Resource
 from weblab.core.coordinator.config_parser import COORDINATOR_LABORATORY_SERVERS
 
 from weblab.core.coordinator.gateway import create as coordinator_create, SQLALCHEMY
+import weblab.core.coordinator.confirmer as Confirmer
 
 import weblab.core.coordinator.status as WSS
 
@@ -71,6 +77,7 @@ class ConfirmerTestCase(mocker.MockerTestCase):
                 'inst1|exp1|cat1' : 'res_inst@res_type'
             },
         })
+        self.cfg_manager._set_value(Confirmer.CONFIRMER_RETRIES, 0)
 
         self.coordinator = coordinator_create(SQLALCHEMY, self.locator, self.cfg_manager)
         self.coordinator._clean()
@@ -193,9 +200,129 @@ class ConfirmerTestCase(mocker.MockerTestCase):
         expected_status =  WSS.WaitingInstancesQueueStatus(reservation1_id, 0)
         self.assertEquals( expected_status, status )
 
+    def test_free_experiment_retries(self):
+        self.coordinator.stop()
+        self.cfg_manager._set_value(Confirmer.CONFIRMER_RETRIES, 2)
+        self.cfg_manager._set_value(Confirmer.CONFIRMER_RETRY_DELAY, 0.01)
+        self.coordinator = coordinator_create(SQLALCHEMY, self.locator, self.cfg_manager)
+        self.confirmer   = self.coordinator.confirmer
+
+        mock_laboratory = self.mocker.mock()
+        mock_laboratory.free_experiment('lab_session_id')
+        self.mocker.throw( socket.error(errno.ECONNREFUSED, 'temporarily unavailable') )
+        mock_laboratory.free_experiment('lab_session_id')
+        self.mocker.result( '{}' )
+
+        self.mock_locator.real_mock = self.mocker.mock()
+        self.mock_locator.real_mock.get_server_from_coordaddress(
+                self.coord_address,
+                coord_addr(self.lab_address),
+                ServerType.Laboratory,
+                'all'
+        )
+        self.mocker.result((mock_laboratory,))
+        self.mocker.count(2)
+
+        self.mocker.replay()
+        self.confirmer.enqueue_free_experiment(self.lab_address, '5', 'lab_session_id', ExperimentInstanceId('inst1','exp1','cat1'))
+        self.confirmer._free_handler.join(5)
+        self.assertTrue(self.confirmer._free_handler.is_finished())
+        self.assertEquals(2, self.confirmer._free_handler.attempts)
+        self.assertEquals( None, self.confirmer._free_handler.raised_exc )
+
+    def test_free_experiment_laboratory_errors_not_retried(self):
+        self.coordinator.stop()
+        self.cfg_manager._set_value(Confirmer.CONFIRMER_RETRIES, 2)
+        self.cfg_manager._set_value(Confirmer.CONFIRMER_RETRY_DELAY, 0.01)
+        self.coordinator = coordinator_create(SQLALCHEMY, self.locator, self.cfg_manager)
+        self.confirmer   = self.coordinator.confirmer
+
+        mock_laboratory = self.mocker.mock()
+        mock_laboratory.free_experiment('lab_session_id')
+        self.mocker.throw( Exception('session not found') )
+
+        self.mock_locator.real_mock = self.mocker.mock()
+        self.mock_locator.real_mock.get_server_from_coordaddress(
+                self.coord_address,
+                coord_addr(self.lab_address),
+                ServerType.Laboratory,
+                'all'
+        )
+        self.mocker.result((mock_laboratory,))
+
+        self.mocker.replay()
+        self.confirmer.enqueue_free_experiment(self.lab_address, '5', 'lab_session_id', ExperimentInstanceId('inst1','exp1','cat1'))
+        self.confirmer._free_handler.join(5)
+        self.assertTrue(self.confirmer._free_handler.is_finished())
+        self.assertEquals(1, self.confirmer._free_handler.attempts)
+        self.assertEquals( None, self.confirmer._free_handler.raised_exc )
+
+    def test_transport_errors(self):
+        self.assertTrue(Confirmer.is_transport_error(socket.error(errno.ECONNREFUSED, 'refused')))
+        # As raised by the XML-RPC client and the locator
+        remote_error = ProtocolErrors.UnknownRemoteError('Unknown exception', socket.timeout('timed out'))
+        self.assertTrue(Confirmer.is_transport_error(remote_error))
+        self.assertTrue(Confirmer.is_transport_error(LocatorErrors.UnableToCompleteOperationError("Couldn't connect", remote_error)))
+
+        self.assertFalse(Confirmer.is_transport_error(Exception('session not found')))
+        self.assertFalse(Confirmer.is_transport_error(ProtocolErrors.UnknownRemoteError('Unknown exception', ValueError('session not found'))))
+        self.assertFalse(Confirmer.is_transport_error(LocatorErrors.UnableToCompleteOperationError("Couldn't connect")))
+
+class ConfirmerPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.gate  = threading.Event()
+        self.calls = []
+        self.results = []
+        self.pool  = Confirmer.ConfirmerPool(workers = 4, workers_per_laboratory = 2)
+
+    def tearDown(self):
+        self.gate.set()
+        self.pool.stop()
+
+    def _task(self, lab_address, name, key = None):
+        def call():
+            self.calls.append(name)
+            self.gate.wait(5)
+            return name
+        return Confirmer.ConfirmerTask(lab_address, call, (), self.results.append, self.results.append, key = key)
+
+    def test_workers_per_laboratory(self):
+        tasks = [ self.pool.submit(self._task('lab1', 'lab1-%s' % n)) for n in range(4) ]
+        other = self.pool.submit(self._task('lab2', 'lab2'))
+
+        # lab2 is not delayed by lab1, which can only use two workers
+        for _ in range(100):
+            if len(self.calls) == 3:
+                break
+            time.sleep(0.01)
+        time.sleep(0.05)
+        self.assertEquals(set(['lab1-0', 'lab1-1', 'lab2']), set(self.calls))
+        self.assertEquals(2, self.pool.get_stats()['queued'])
+
+        self.gate.set()
+        for task in tasks + [other]:
+            task.join(5)
+            self.assertTrue(task.is_finished())
+        self.assertEquals(5, len(self.results))
+
+    def test_coalesce(self):
+        # The only worker of lab1 is busy, so the rest wait in the queue
+        self.pool.submit(self._task('lab1', 'busy'))
+        self.pool.submit(self._task('lab1', 'busy2'))
+        first  = self.pool.submit(self._task('lab1', 'check', key = ('should_finish', 'reservation1')))
+        second = self.pool.submit(self._task('lab1', 'check', key = ('should_finish', 'reservation1')))
+        self.assertTrue(first is second)
+
+        self.gate.set()
+        first.join(5)
+        self.assertEquals(1, self.calls.count('check'))
 
 def suite():
-    return unittest.makeSuite(ConfirmerTestCase)
+    return unittest.TestSuite((
+            unittest.makeSuite(ConfirmerTestCase),
+            unittest.makeSuite(ConfirmerPoolTestCase),
+        ))
 
 if __name__ == '__main__':
     unittest.main()
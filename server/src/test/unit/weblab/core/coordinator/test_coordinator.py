@@ -26,6 +26,7 @@ import voodoo.sessions.session_id as SessionId
 
 import weblab.core.coordinator.sql.coordinator as sql_coordinator
 import weblab.core.coordinator.redis.coordinator as redis_coordinator
+import weblab.core.coordinator.memory.coordinator as memory_coordinator
 import weblab.core.coordinator.coordinator as AbstractCoordinator
 from weblab.data.experiments import ExperimentId
 from weblab.data.experiments import ExperimentInstanceId
@@ -59,6 +60,9 @@ class WrappedRedisCoordinator(redis_coordinator.Coordinator):
     REDIS_AVAILABLE = redis_coordinator.REDIS_AVAILABLE
     CoordinatorTimeProvider = WrappedTimeProvider
 
+class WrappedMemoryCoordinator(memory_coordinator.Coordinator):
+    CoordinatorTimeProvider = WrappedTimeProvider
+
 class ConfirmerMock(object):
     def __init__(self, coordinator, locator):
         self.uses_confirm = []
@@ -75,6 +79,8 @@ class ConfirmerMock(object):
         experiment_response = None
         initial_time = end_time = datetime.datetime.now()
         self.coordinator.confirm_resource_disposal(lab_coordaddress, reservation_id, lab_session_id, experiment_instance_id, experiment_response, initial_time, end_time)
+    def stop(self):
+        pass
 
 SLOW_CONFIRMER_TIME = 0.05
 
@@ -99,12 +105,16 @@ class SlowConfirmerMock(object):
 
         initial_time = end_time = datetime.datetime.now()
         self.coordinator.confirm_resource_disposal(lab_coordaddress, reservation_id, lab_session_id, experiment_instance_id, experiment_response, initial_time, end_time)
+    def stop(self):
+        pass
 
 
 def coord_addr(coord_addr_str):
     return CoordAddress.CoordAddress.translate_address( coord_addr_str )
 
 class AbstractCoordinatorTestCase(object):
+
+    SCHEDULER_OPTIONS = {}
     
     def setUp(self):
         self.maxDiff = None
@@ -120,11 +130,12 @@ class AbstractCoordinatorTestCase(object):
                 'inst2|exp1|cat1' : 'res_inst2@res_type'
             }
         })
+        scheduler_options = dict(randomize_instances = False, **self.SCHEDULER_OPTIONS)
         scheduling_systems = { 
-            "fpga boards"   : ("PRIORITY_QUEUE",    {'randomize_instances' : False}), 
-            "pld boards"     : ("PRIORITY_QUEUE",   {'randomize_instances' : False}),
-            "dummy boards"     : ("PRIORITY_QUEUE", {'randomize_instances' : False}),
-            "res_type"     : ("PRIORITY_QUEUE",     {'randomize_instances' : False}),
+            "fpga boards"   : ("PRIORITY_QUEUE",    scheduler_options), 
+            "pld boards"     : ("PRIORITY_QUEUE",   scheduler_options),
+            "dummy boards"     : ("PRIORITY_QUEUE", scheduler_options),
+            "res_type"     : ("PRIORITY_QUEUE",     scheduler_options),
         }
         self.cfg_manager._set_value('core_scheduling_systems', scheduling_systems)
 
@@ -672,6 +683,13 @@ if redis_coordinator.REDIS_AVAILABLE:
     class RedisCoordinatorTestCase(AbstractCoordinatorTestCase, unittest.TestCase):
         WrappedCoordinator = WrappedRedisCoordinator
 
+    class RedisClientSidePromotionCoordinatorTestCase(AbstractCoordinatorTestCase, unittest.TestCase):
+        WrappedCoordinator = WrappedRedisCoordinator
+        SCHEDULER_OPTIONS = { 'server_side_promotion' : False }
+
+class MemoryCoordinatorTestCase(AbstractCoordinatorTestCase, unittest.TestCase):
+    WrappedCoordinator = WrappedMemoryCoordinator
+
 class AbstractCoordinatorMultiResourceTestCase(object):
     def setUp(self):
         self.locator_mock = None
@@ -1153,6 +1171,9 @@ if redis_coordinator.REDIS_AVAILABLE:
     class RedisCoordinatorMultiResourceTestCase(AbstractCoordinatorMultiResourceTestCase, unittest.TestCase):
         WrappedCoordinator = WrappedRedisCoordinator
 
+class MemoryCoordinatorMultiResourceTestCase(AbstractCoordinatorMultiResourceTestCase, unittest.TestCase):
+    WrappedCoordinator = WrappedMemoryCoordinator
+
 class AbstractCoordinatorWithSlowConfirmerTestCase(object):
     def setUp(self):
         locator_mock = None
@@ -1198,15 +1219,22 @@ if redis_coordinator.REDIS_AVAILABLE:
     class RedisCoordinatorWithSlowConfirmerTestCase(AbstractCoordinatorWithSlowConfirmerTestCase, unittest.TestCase):
         WrappedCoordinator = WrappedRedisCoordinator
 
+class MemoryCoordinatorWithSlowConfirmerTestCase(AbstractCoordinatorWithSlowConfirmerTestCase, unittest.TestCase):
+    WrappedCoordinator = WrappedMemoryCoordinator
+
 def suite():
     suites = [
         unittest.makeSuite(SqlCoordinatorTestCase),
         unittest.makeSuite(SqlCoordinatorMultiResourceTestCase),
         unittest.makeSuite(SqlCoordinatorWithSlowConfirmerTestCase),
+        unittest.makeSuite(MemoryCoordinatorTestCase),
+        unittest.makeSuite(MemoryCoordinatorMultiResourceTestCase),
+        unittest.makeSuite(MemoryCoordinatorWithSlowConfirmerTestCase),
     ]
     if redis_coordinator.REDIS_AVAILABLE:
             suites.extend([
                 unittest.makeSuite(RedisCoordinatorTestCase),
+                unittest.makeSuite(RedisClientSidePromotionCoordinatorTestCase),
                 unittest.makeSuite(RedisCoordinatorMultiResourceTestCase),
                 unittest.makeSuite(RedisCoordinatorWithSlowConfirmerTestCase),
             ])
@@ -18,7 +18,7 @@ import datetime
 import test.unit.configuration as configuration_module
 import voodoo.configuration as ConfigurationManager
 
-from test.unit.weblab.core.coordinator.test_coordinator import WrappedSqlCoordinator, WrappedRedisCoordinator, ConfirmerMock
+from test.unit.weblab.core.coordinator.test_coordinator import WrappedSqlCoordinator, WrappedRedisCoordinator, WrappedMemoryCoordinator, ConfirmerMock
 
 class AbstractPostReservationDataManagerTestCase(object):
     def setUp(self):
@@ -87,12 +87,15 @@ class AbstractPostReservationDataManagerTestCase(object):
 class SqlPostReservationDataManagerTestCase(AbstractPostReservationDataManagerTestCase, unittest.TestCase):
     WrappedCoordinator = WrappedSqlCoordinator
 
+class MemoryPostReservationDataManagerTestCase(AbstractPostReservationDataManagerTestCase, unittest.TestCase):
+    WrappedCoordinator = WrappedMemoryCoordinator
+
 if WrappedRedisCoordinator.REDIS_AVAILABLE:
     class RedisPostReservationDataManagerTestCase(AbstractPostReservationDataManagerTestCase, unittest.TestCase):
         WrappedCoordinator = WrappedRedisCoordinator
 
 def suite():
-    suites = [unittest.makeSuite(SqlPostReservationDataManagerTestCase)]
+    suites = [unittest.makeSuite(SqlPostReservationDataManagerTestCase), unittest.makeSuite(MemoryPostReservationDataManagerTestCase)]
     if WrappedRedisCoordinator.REDIS_AVAILABLE:
         suites.append(unittest.makeSuite(RedisPostReservationDataManagerTestCase))
     return unittest.TestSuite(suites)
@@ -44,6 +44,25 @@ class DummyCoordinator(object):
     def is_post_reservation(self, reservation_id):
         return False
 
+class AliveUsersRegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.registry = AliveUsersCollection.AliveUsersRegistry(shards = 4)
+
+    def test_add_remove(self):
+        session_ids = [ SessionId.SessionId("session%s" % i) for i in xrange(10) ]
+        for session_id in session_ids:
+            self.registry.add(session_id)
+        self.registry.add(session_ids[0]) # no duplicates
+
+        self.assertEquals(10, len(self.registry))
+        self.assertEquals(sorted(session_ids), sorted(self.registry.snapshot()))
+
+        self.registry.remove(session_ids[0])
+        self.registry.remove(session_ids[0]) # no exception
+        self.assertFalse(session_ids[0] in self.registry)
+        self.assertTrue(session_ids[1] in self.registry)
+        self.assertEquals(9, len(self.registry))
+
 class AliveUsersCollectionTestCase(unittest.TestCase):
     def setUp(self):
         cfg_manager = ConfigurationManager.ConfigurationManager()
@@ -136,6 +155,18 @@ class AliveUsersCollectionTestCase(unittest.TestCase):
         expired_users = self.auc.check_expired_users()
         self.assertEquals(0, len(expired_users))
 
+    def test_removed_sessions(self):
+        session_id1 = self.create_session(self.tm.time())
+        session_id2 = self.create_session(self.tm.time() - 3600) # expired
+
+        self.auc.add_user(session_id1)
+        self.auc.add_user(session_id2)
+        self.auc.add_user(SessionId.SessionId("not.existing"))
+
+        expired_users = self.auc.check_expired_users()
+        self.assertEquals([ session_id2 ], expired_users)
+        self.assertEquals([ session_id1 ], self.auc.list_users())
+
     def test_three_sessions_one_expired(self):
         session_id1 = self.create_session(self.tm.time())
         session_id2 = self.create_session(self.tm.time() - 3600) # expired
@@ -199,7 +230,10 @@ class AliveUsersCollectionTestCase(unittest.TestCase):
 
 
 def suite():
-    return unittest.makeSuite(AliveUsersCollectionTestCase)
+    return unittest.TestSuite((
+                unittest.makeSuite(AliveUsersRegistryTestCase),
+                unittest.makeSuite(AliveUsersCollectionTestCase),
+            ))
 
 if __name__ == '__main__':
     unittest.main()
@@ -47,10 +47,10 @@ DATA_REQUEST2 = "{'foo' : 1}"
 DATA_REQUEST3 = "{'foo' : 1}"
 DATA_REQUEST4 = "{'foo' : 1}"
 
-def wait_for(retriever, iterations = 5, max_wait = 10):
+def wait_for(retriever, max_wait = 10):
+    """ Waits until everything put in the stores has been processed (stored, or waiting to be retried) """
     initial_time = time.time()
-    initial_iterations = retriever.iterations
-    while retriever.iterations - initial_iterations < iterations:
+    while retriever.get_stats()['backlog'] > 0:
         time.sleep(0.01)
         if time.time() - initial_time >= max_wait:
             raise AssertionError("Maximum time waiting reached")
@@ -83,7 +83,7 @@ class TemporalInformationRetrieverTestCase(unittest.TestCase):
         self.initial_timestamp = self.end_timestamp = time.time()
 
         request_info = {'username':'student1','role':'student','permission_scope' : 'user', 'permission_id' : student1.id}
-        exp_id = ExperimentId('ud-dummy','Dummy Experiments')
+        exp_id = ExperimentId('ud-dummy','Dummy experiments')
 
         self.entry1 = TemporalInformationStore.InitialInformationEntry(
                         RESERVATION1, exp_id, coord_addr('ser:inst@mach'),
@@ -99,10 +99,15 @@ class TemporalInformationRetrieverTestCase(unittest.TestCase):
                         DATA4, self.initial_time, self.end_time, request_info.copy(), DATA_REQUEST3)
 
 
+    def _list_usages(self):
+        # The usages of different reservations are stored concurrently
+        usages = self.dbmanager.list_usages_per_user('student1')
+        return sorted(usages, key = lambda usage : usage.reservation_id)
+
     def test_initial_finish(self):
         self.retriever.start()
         try:
-            usages = self.dbmanager.list_usages_per_user('student1')
+            usages = self._list_usages()
             self.assertEquals(0, len(usages))
 
             self.initial_store.put(self.entry1)
@@ -113,7 +118,7 @@ class TemporalInformationRetrieverTestCase(unittest.TestCase):
             # Wait and then populate the RESERVATION3 (the last one in the queue)
             wait_for(self.retriever)
 
-            usages = self.dbmanager.list_usages_per_user('student1')
+            usages = self._list_usages()
             # There are 3, and RESERVATION4 is waiting
             self.assertEquals(3, len(usages))
 
@@ -139,7 +144,7 @@ class TemporalInformationRetrieverTestCase(unittest.TestCase):
 
             wait_for(self.retriever)
 
-            usages = self.dbmanager.list_usages_per_user('student1')
+            usages = self._list_usages()
             # RESERVATION4 achieved
             self.assertEquals(4, len(usages))
 
@@ -181,14 +186,14 @@ class TemporalInformationRetrieverTestCase(unittest.TestCase):
     def test_commands(self):
         self.retriever.start()
         try:
-            usages = self.dbmanager.list_usages_per_user('student1')
+            usages = self._list_usages()
             self.assertEquals(0, len(usages))
 
             self.initial_store.put(self.entry1)
 
             wait_for(self.retriever)
 
-            usages = self.dbmanager.list_usages_per_user('student1')
+            usages = self._list_usages()
 
             self.assertEquals(1, len(usages))
 
@@ -219,7 +224,7 @@ class TemporalInformationRetrieverTestCase(unittest.TestCase):
 
             wait_for(self.retriever)
 
-            usages = self.dbmanager.list_usages_per_user('student1')
+            usages = self._list_usages()
             self.assertEquals(1, len(usages))
 
             full_usage1 = self.dbmanager.retrieve_usage(usages[0].experiment_use_id)
@@ -236,7 +241,7 @@ class TemporalInformationRetrieverTestCase(unittest.TestCase):
 
             wait_for(self.retriever)
 
-            usages = self.dbmanager.list_usages_per_user('student1')
+            usages = self._list_usages()
             self.assertEquals(2, len(usages))
 
             full_usage1 = self.dbmanager.retrieve_usage(usages[0].experiment_use_id)
@@ -254,7 +259,7 @@ class TemporalInformationRetrieverTestCase(unittest.TestCase):
 
             wait_for(self.retriever)
 
-            usages = self.dbmanager.list_usages_per_user('student1')
+            usages = self._list_usages()
             self.assertEquals(3, len(usages))
 
             full_usage1 = self.dbmanager.retrieve_usage(usages[0].experiment_use_id)
@@ -275,6 +280,66 @@ class TemporalInformationRetrieverTestCase(unittest.TestCase):
             self.assertFalse(self.retriever.isAlive())
 
 
+    def test_stats(self):
+        self.retriever.start()
+        try:
+            self.initial_store.put(self.entry1)
+            self.initial_store.put(self.entry2)
+            # The usage of RESERVATION4 does not exist yet
+            self.finished_store.put(RESERVATION4, DATA4, self.initial_time, self.end_time)
+
+            wait_for(self.retriever)
+
+            stats = self.retriever.get_stats()
+            self.assertEquals(0, stats['backlog'])
+            self.assertEquals(1, stats['pending'])
+            self.assertEquals(2, stats['stored'])
+            self.assertTrue(stats['max_latency'] >= stats['avg_latency'] > 0)
+
+            self.initial_store.put(self.entry4)
+            wait_for(self.retriever)
+
+            stats = self.retriever.get_stats()
+            self.assertEquals(0, stats['pending'])
+            self.assertEquals(4, stats['stored'])
+        finally:
+            self.retriever.stop()
+            self.retriever.join(1)
+            self.assertFalse(self.retriever.isAlive())
+
+    def test_database_errors_are_retried(self):
+        original_finish = self.dbmanager.finish_experiment_usages
+        calls = []
+        def failing_finish(finished_usages):
+            calls.append(finished_usages)
+            if len(calls) == 1:
+                raise Exception("Database not available")
+            return original_finish(finished_usages)
+
+        self.dbmanager.finish_experiment_usages = failing_finish
+        self.retriever.PRINT_ERRORS = False
+        self.retriever.retry_period = 0.01
+        self.retriever.start()
+        try:
+            self.initial_store.put(self.entry1)
+            wait_for(self.retriever)
+            self.finished_store.put(RESERVATION1, DATA1, self.initial_time, self.end_time)
+            wait_for(self.retriever)
+
+            initial_time = time.time()
+            while self.retriever.get_stats()['pending'] > 0 or len(calls) < 2:
+                time.sleep(0.01)
+                if time.time() - initial_time >= 10:
+                    raise AssertionError("Maximum time waiting reached")
+
+            usages = self._list_usages()
+            self.assertEquals(1, len(usages))
+            self.assertNotEquals(None, usages[0].end_date)
+        finally:
+            self.retriever.stop()
+            self.retriever.join(1)
+            self.assertFalse(self.retriever.isAlive())
+
 class FakeTemporalInformationRetriever(TemporalInformationRetriever.TemporalInformationRetriever):
 
     PRINT_ERRORS = False
@@ -16,6 +16,7 @@
 
 import unittest
 import time
+import datetime
 
 import test.unit.configuration as configuration
 
@@ -24,6 +25,11 @@ import voodoo.configuration as ConfigurationManager
 import voodoo.gen.coordinator.CoordAddress as CoordAddress
 
 import weblab.core.db as DatabaseGateway
+import weblab.db.model as model
+import weblab.db.rollups as rollups_module
+import weblab.db.file_hashes as file_hashes_module
+from weblab.db.rollups import check_rollups, rebuild_rollups
+from weblab.db.file_hashes import check_file_hash_index, rebuild_file_hash_index
 
 from weblab.data.experiments import ExperimentUsage, CommandSent, FileSent
 from weblab.data.experiments import ExperimentId
@@ -506,6 +512,236 @@ class DatabaseGatewayTestCase(unittest.TestCase):
 
         self.assertEquals("response",       full_usage1.sent_files[0].response.commandstring)
 
+    def test_store_commands(self):
+        student1, usage, _, _, _, _ = create_usage(self.gateway, 'my_reservation_id1')
+        create_usage(self.gateway, 'my_reservation_id2')
+
+        previous_command = self.gateway.append_command('my_reservation_id2', CommandSent(Command.Command("previous command"), time.time()))
+        previous_file    = self.gateway.append_file('my_reservation_id2', FileSent('path/to/previous', '{sha}1', time.time()))
+
+        complete_commands = [
+            ('my_reservation_id1', 1, CommandSent(Command.Command("complete command"), time.time(), Command.Command("complete response"), time.time())),
+            ('not_stored',         2, CommandSent(Command.Command("lost command"), time.time(), Command.Command("lost response"), time.time())),
+        ]
+        complete_files = [
+            ('my_reservation_id2', 3, FileSent('path/to/complete', '{sha}3', time.time(), Command.Command('file response'), time.time(), file_info = 'program')),
+        ]
+        command_requests = {
+            4 : ('my_reservation_id1', CommandSent(Command.Command("request"), time.time())),
+            5 : ('not_stored',         CommandSent(Command.Command("lost request"), time.time())),
+        }
+        file_requests = {
+            6 : ('my_reservation_id1', FileSent('path/to/request', '{sha}6', time.time())),
+        }
+        command_responses = [
+            (7, previous_command, Command.Command("previous response"), time.time()),
+            (8, -1,               Command.Command("lost response"),     time.time()),
+        ]
+        file_responses = [
+            (9, previous_file, Command.Command("previous file response"), time.time()),
+        ]
+
+        mappings = self.gateway.store_commands(complete_commands, command_requests, command_responses, complete_files, file_requests, file_responses)
+
+        self.assertEquals(set([2, 4, 5, 6, 8]), set(mappings))
+        self.assertFalse(mappings[2])
+        self.assertFalse(mappings[5])
+        self.assertFalse(mappings[8])
+        self.assertTrue(mappings[4])
+        self.assertTrue(mappings[6])
+
+        usages = dict( (u.reservation_id, u) for u in self.gateway.list_usages_per_user(student1.login) )
+        full_usage1 = self.gateway.retrieve_usage(usages['my_reservation_id1'].experiment_use_id)
+        full_usage2 = self.gateway.retrieve_usage(usages['my_reservation_id2'].experiment_use_id)
+
+        commands1 = dict( (c.command.commandstring, c) for c in full_usage1.commands )
+        self.assertEquals("complete response", commands1["complete command"].response.commandstring)
+        self.assertEquals(Command.NullCommand(), commands1["request"].response)
+        files1 = dict( (f.file_hash, f) for f in full_usage1.sent_files )
+        self.assertTrue('{sha}6' in files1)
+
+        commands2 = dict( (c.command.commandstring, c) for c in full_usage2.commands )
+        self.assertEquals("previous response", commands2["previous command"].response.commandstring)
+        self.assertTrue(commands2["previous command"].timestamp_after is not None)
+        files2 = dict( (f.file_hash, f) for f in full_usage2.sent_files )
+        self.assertEquals("previous file response", files2['{sha}1'].response.commandstring)
+        self.assertEquals("file response", files2['{sha}3'].response.commandstring)
+        self.assertEquals("program", files2['{sha}3'].file_info)
+
+        # The ids returned can be used later to store the responses
+        mappings = self.gateway.store_commands([], {}, [(10, mappings[4], Command.Command("response"), time.time())], [], {}, [])
+        self.assertEquals({}, mappings)
+        full_usage1 = self.gateway.retrieve_usage(usages['my_reservation_id1'].experiment_use_id)
+        commands1 = dict( (c.command.commandstring, c) for c in full_usage1.commands )
+        self.assertEquals("response", commands1["request"].response.commandstring)
+
+    def test_resolved_permissions_cached(self):
+        experiments = self.gateway.list_experiments('student2')
+        self.assertFalse(self.gateway.is_access_forward('student2'))
+        self.assertTrue(self.gateway.list_experiments('student2') is experiments)
+        self.assertEquals(1, len(self.gateway.list_experiments('student2', 'ud-pld', 'PLD experiments')))
+        self.assertEquals(0, len(self.gateway.list_experiments('student2', 'ud-pld', 'Dummy experiments')))
+        self.assertFalse(self.gateway.is_admin('student2'))
+
+        # Changes are not seen until the permissions are invalidated
+        student2 = self.gateway._get_user(self.session, 'student2')
+        permission = model.DbUserPermission(student2, 'admin_panel_access', 'student2::admin_panel_access', datetime.datetime.now())
+        forward_permission = model.DbUserPermission(student2, 'access_forward', 'student2::access_forward', datetime.datetime.now())
+        self.session.add(permission)
+        self.session.add(forward_permission)
+        self.session.commit()
+        try:
+            self.assertFalse(self.gateway.is_admin('student2'))
+            self.assertFalse(self.gateway.is_access_forward('student2'))
+            self.gateway.invalidate_permissions('student2')
+            self.assertTrue(self.gateway.is_admin('student2'))
+            self.assertTrue(self.gateway.is_instructor('student2'))
+            self.assertTrue(self.gateway.is_access_forward('student2'))
+        finally:
+            self.session.delete(permission)
+            self.session.delete(forward_permission)
+            self.session.commit()
+            self.gateway.invalidate_permissions()
+
+        self.assertFalse(self.gateway.is_admin('student2'))
+        self.assertFalse(self.gateway.is_access_forward('student2'))
+        self.assertRaises(DbProvidedUserNotFoundError, self.gateway.is_admin, 'this_user_does_not_exist')
+
+    def test_usage_rollups(self):
+        student1, initial_usage, _, _, _, _ = create_usage(self.gateway, 'my_reservation_id1')
+
+        usage2 = ExperimentUsage()
+        usage2.start_date     = time.time()
+        usage2.from_ip        = "130.206.138.17"
+        usage2.experiment_id  = ExperimentId("ud-dummy","Dummy experiments")
+        usage2.coord_address  = CoordAddress.CoordAddress("machine1","instance1","server1")
+        usage2.reservation_id = 'my_reservation_id2'
+        usage2.request_info   = {'facebook' : False, 'permission_scope' : 'user', 'permission_id' : student1.id}
+        self.gateway.store_experiment_usage(student1.login, usage2)
+
+        session = self.gateway.Session()
+        try:
+            self.assertEquals([], check_rollups(session))
+            rollups = session.query(model.DbUsageRollup).all()
+            self.assertEquals(2, sum([ rollup.uses for rollup in rollups ]))
+            self.assertEquals(1, sum([ rollup.timed_uses for rollup in rollups ]))
+            self.assertEquals(student1.id, rollups[0].user_id)
+            self.assertEquals(student1.id, rollups[0].user_permission_id)
+            self.assertEquals(0, rollups[0].group_permission_id)
+            self.assertEquals(1, sum([ rollup.uses for rollup in session.query(model.DbUsageDurationRollup).all() ]))
+        finally:
+            session.close()
+
+        # Finishing a use moves it to the timed uses
+        self.gateway.finish_experiment_usage('my_reservation_id2', time.time() + 5, CommandSent(Command.Command("@@@finish@@@"), time.time()))
+
+        session = self.gateway.Session()
+        try:
+            self.assertEquals([], check_rollups(session))
+            rollups = session.query(model.DbUsageRollup).all()
+            self.assertEquals(2, sum([ rollup.uses for rollup in rollups ]))
+            self.assertEquals(2, sum([ rollup.timed_uses for rollup in rollups ]))
+            self.assertEquals(2, sum([ rollup.uses for rollup in session.query(model.DbUsageDurationRollup).all() ]))
+
+            # Broken rollups are detected and rebuilt
+            session.execute(model.DbUsageRollup.__table__.delete())
+            self.assertEquals(len(rollups), len(check_rollups(session)))
+            self.assertEquals(len(rollups), rebuild_rollups(session)[0])
+            session.commit()
+            self.assertEquals([], check_rollups(session))
+        finally:
+            session.close()
+
+    def test_usage_rollups_inserted_concurrently(self):
+        # Another transaction inserts the same rollups between the UPDATE and the INSERT
+        inserted = []
+        def concurrent_insert(session, table, rows):
+            session.execute(table.insert(), rows)
+            inserted.append(table.name)
+            return False
+
+        original_try_insert = rollups_module.try_insert
+        rollups_module.try_insert = concurrent_insert
+        try:
+            create_usage(self.gateway, 'my_reservation_id1')
+        finally:
+            rollups_module.try_insert = original_try_insert
+
+        session = self.gateway.Session()
+        try:
+            self.assertEquals(2, len(inserted))
+            # The one inserted concurrently, and the one of this transaction
+            self.assertEquals(2, sum([ rollup.uses for rollup in session.query(model.DbUsageRollup).all() ]))
+            self.assertEquals(2, sum([ rollup.uses for rollup in session.query(model.DbUsageDurationRollup).all() ]))
+        finally:
+            session.close()
+
+    def test_file_hash_index(self):
+        student1, _, _, _, _, _ = create_usage(self.gateway, 'my_reservation_id1')
+        student2 = self.gateway._get_user(self.session, 'student2')
+
+        usage2 = ExperimentUsage()
+        usage2.start_date     = time.time()
+        usage2.from_ip        = "130.206.138.17"
+        usage2.experiment_id  = ExperimentId("ud-dummy","Dummy experiments")
+        usage2.coord_address  = CoordAddress.CoordAddress("machine1","instance1","server1")
+        usage2.reservation_id = 'my_reservation_id2'
+        usage2.request_info   = {'facebook' : False, 'permission_scope' : 'user', 'permission_id' : student2.id}
+        usage2.append_file(FileSent('path/to/copy', '{sha}12345', time.time()))
+        self.gateway.store_experiment_usage(student2.login, usage2)
+
+        # Files stored later by other users, and empty files (never indexed)
+        self.gateway.store_commands([], {}, [], [('my_reservation_id2', 1, FileSent('path/to/other', '{sha}123456', time.time()))], {}, [])
+        self.gateway.append_file('my_reservation_id2', FileSent('path/to/empty', '', time.time()))
+
+        session = self.gateway.Session()
+        try:
+            self.assertEquals([], check_file_hash_index(session))
+            index = dict( (row.file_hash, row) for row in session.query(model.DbFileHashIndex).all() )
+            self.assertEquals(set(['{sha}12345', '{sha}123456']), set(index))
+            for file_hash in index:
+                self.assertTrue(index[file_hash].shared)
+                self.assertEquals(student1.id, index[file_hash].first_user_id)
+
+            session.execute(model.DbFileHashIndex.__table__.delete())
+            self.assertEquals(2, len(check_file_hash_index(session)))
+            self.assertEquals(2, rebuild_file_hash_index(session))
+            session.commit()
+            self.assertEquals([], check_file_hash_index(session))
+        finally:
+            session.close()
+
+    def test_file_hash_index_inserted_concurrently(self):
+        student2 = self.gateway._get_user(self.session, 'student2')
+
+        # Another transaction inserts one of the hashes (submitted by student2) meanwhile
+        def concurrent_insert(session, table, rows):
+            if isinstance(rows, dict) and rows['file_hash'] == '{sha}12345':
+                row = dict(rows)
+                row['first_user_id'] = student2.id
+                session.execute(table.insert(), row)
+                return False
+            elif isinstance(rows, dict):
+                session.execute(table.insert(), rows)
+                return True
+            return False
+
+        original_try_insert = file_hashes_module.try_insert
+        file_hashes_module.try_insert = concurrent_insert
+        try:
+            create_usage(self.gateway, 'my_reservation_id1')
+        finally:
+            file_hashes_module.try_insert = original_try_insert
+
+        session = self.gateway.Session()
+        try:
+            index = dict( (row.file_hash, row) for row in session.query(model.DbFileHashIndex).all() )
+            self.assertEquals(set(['{sha}12345', '{sha}123456']), set(index))
+            self.assertTrue(index['{sha}12345'].shared)
+            self.assertFalse(index['{sha}123456'].shared)
+        finally:
+            session.close()
+
     def test_gather_permissions(self):
         student2 = self.gateway._get_user(self.session, "student2")
         permissions = self.gateway._gather_permissions(self.session, student2, "experiment_allowed")
@@ -17,6 +17,7 @@
 import os
 import unittest
 import time
+import threading
 
 import mocker
 
@@ -180,6 +181,78 @@ class UserProcessingServerTestCase(unittest.TestCase):
         with wlcontext(self.ups, session_id = sess_id):
             core_api.logout()
 
+    def test_poll(self):
+        db_sess_id = ValidDatabaseSessionId('student2', "student")
+        sess_id, _ = self.ups.do_reserve_session(db_sess_id)
+        exp_id = ExperimentId('ud-dummy','Dummy experiments')
+        lab_sess_id = SessionId.SessionId("lab_session_id")
+
+        self.lab_mock.reserve_experiment(exp_id, "{}")
+        self.mocker.result(lab_sess_id)
+        self.mocker.count(0, 1)
+        self.lab_mock.resolve_experiment_address(lab_sess_id)
+        self.mocker.result(CoordAddress.CoordAddress.translate_address('foo:bar@machine'))
+        self.mocker.count(0, 1)
+        self.mocker.replay()
+
+        with wlcontext(self.ups, session_id = sess_id):
+            reservation = core_api.reserve_experiment( exp_id, "{}", "{}")
+
+        reservation_session_id = SessionId.SessionId(reservation.reservation_id.id.split(';')[0])
+        reservations_session_manager = self.ups._reservations_session_manager
+        latest_poll, _ = reservations_session_manager.get_session(reservation_session_id)['session_polling']
+
+        time.sleep(0.01)
+        with wlcontext(self.ups, reservation_id = reservation.reservation_id):
+            core_api.poll()
+
+        reservation_session = reservations_session_manager.get_session(reservation_session_id)
+        new_latest_poll, _ = reservation_session['session_polling']
+        self.assertTrue(new_latest_poll > latest_poll)
+        # The rest of the session is kept
+        self.assertEquals(exp_id, reservation_session['experiment_id'])
+
+        with wlcontext(self.ups, session_id = sess_id):
+            core_api.logout()
+
+    def test_check_async_command_status_waits_without_locking(self):
+        lab = FakeAsyncLaboratory()
+        self.locator.lab = lab
+
+        db_sess_id = ValidDatabaseSessionId('student2', "student")
+        sess_id, _ = self.ups.do_reserve_session(db_sess_id)
+        with wlcontext(self.ups, session_id = sess_id):
+            reservation = core_api.reserve_experiment(ExperimentId('ud-dummy','Dummy experiments'), "{}", "{}")
+
+        self.ups._coordinator.confirmer._confirm_handler.join(10)
+        with wlcontext(self.ups, reservation_id = reservation.reservation_id):
+            self.assertEquals(Reservation.Reservation.CONFIRMED, core_api.get_reservation_status().status)
+
+        responses = []
+        def check_async_command_status():
+            with wlcontext(self.ups, reservation_id = reservation.reservation_id):
+                responses.append(core_api.check_async_command_status(['request'], 5))
+
+        checker = threading.Thread(target = check_async_command_status)
+        checker.start()
+        try:
+            lab.waiting.wait(5)
+            self.assertTrue(lab.waiting.isSet())
+
+            # While the laboratory waits, the reservation can still be used
+            with wlcontext(self.ups, reservation_id = reservation.reservation_id):
+                response = core_api.send_command(Command("command"))
+            self.assertEquals(Command("response"), response)
+            self.assertEquals([], responses)
+        finally:
+            lab.finished.set()
+            checker.join(5)
+
+        self.assertEquals([{ 'request' : ('ok', 'async response') }], responses)
+
+        with wlcontext(self.ups, session_id = sess_id):
+            core_api.logout()
+
     def test_reserve_experiment(self):
         db_sess_id = ValidDatabaseSessionId('student2', "student")
         sess_id, _ = self.ups.do_reserve_session(db_sess_id)
@@ -375,6 +448,33 @@ class FakeLocator(object):
             return self.lab
         raise Exception("Server not found")
 
+class FakeAsyncLaboratory(object):
+    def __init__(self):
+        self.waiting  = threading.Event()
+        self.finished = threading.Event()
+
+    def reserve_experiment(self, experiment_instance_id, client_initial_data, server_initial_data):
+        return SessionId.SessionId('lab_session_id'), '{}', { 'address' : 'server:laboratoryserver@labmachine' }
+
+    def resolve_experiment_address(self, lab_session_id):
+        return CoordAddress.CoordAddress.translate_address('foo:bar@machine')
+
+    def should_experiment_finish(self, lab_session_id):
+        return 0
+
+    def free_experiment(self, lab_session_id):
+        return '{}'
+
+    def send_command(self, lab_session_id, command):
+        return Command("response")
+
+    def check_async_command_status(self, lab_session_id, request_identifiers, wait = 0):
+        if not wait:
+            return { 'request' : ('running', None) }
+        self.waiting.set()
+        self.finished.wait(wait)
+        return { 'request' : ('ok', 'async response') }
+
 class FakeFacade(object):
     def __init__(self, *args, **kwargs):
         pass
@@ -178,6 +178,8 @@ class FakeConfirmer(object):
         pass
     def enqueue_free_experiment(self, *args):
         pass
+    def stop(self):
+        pass
 
 def generate_experiment(exp_name,exp_cat_name):
     cat = Category.ExperimentCategory(exp_cat_name)
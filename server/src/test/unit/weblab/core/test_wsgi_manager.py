@@ -1,5 +1,9 @@
+import time
+import socket
+import httplib
 import unittest
 import urllib2
+import threading
 
 from voodoo.configuration import ConfigurationManager
 
@@ -15,6 +19,17 @@ class HelloWorldApp(object):
         start_response('200 OK', [('Content-Type', 'text/plain')])
         yield 'Hello World\n'
 
+class EchoApp(object):
+    def __init__(self):
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, environ, start_response):
+        self.release.wait()
+        body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return [ '%s %s' % (environ['PATH_INFO'], body) ]
+
 class WsgiManagerTest(unittest.TestCase):
     def setUp(self):
         self.cfg_manager = ConfigurationManager()
@@ -39,8 +54,155 @@ class WsgiManagerTest(unittest.TestCase):
         finally:
             self.server.stop()
 
+class PoolWsgiManagerTest(unittest.TestCase):
+    def setUp(self):
+        self.cfg_manager = ConfigurationManager()
+        self.cfg_manager.append_module(configuration_module)
+
+        self.cfg_manager._set_value(configuration_doc.FACADE_TIMEOUT, 0.001)
+        self.cfg_manager._set_value(configuration_doc.CORE_FACADE_SERVER_MODE, wsgi_manager.POOL_MODE)
+        self.cfg_manager._set_value(configuration_doc.CORE_FACADE_WORKERS, 1)
+        self.cfg_manager._set_value(configuration_doc.CORE_FACADE_QUEUE_SIZE, 1)
+
+        self.current_port = new_port()
+        self.cfg_manager._set_value(configuration_doc.CORE_FACADE_PORT, self.current_port)
+
+    def _create_server(self, app):
+        server = wsgi_manager.WebLabWsgiServer(self.cfg_manager, application = app)
+        server.start()
+        return server
+
+    def _wait_for(self, server, key, value):
+        for _ in xrange(200):
+            if server.get_stats()[0][key] == value:
+                return
+            time.sleep(0.01)
+        self.fail("%s never reached %s" % (key, value))
+
+    @uses_module(wsgi_manager)
+    def test_keep_alive(self):
+        server = self._create_server(EchoApp())
+        try:
+            connection = httplib.HTTPConnection('127.0.0.1', self.current_port)
+            connection.request('POST', '/first', 'body')
+            sock = connection.sock
+            self.assertEquals('/first body', connection.getresponse().read())
+
+            connection.request('GET', '/second')
+            self.assertEquals('/second ', connection.getresponse().read())
+            # The same connection was used
+            self.assertTrue(connection.sock is sock)
+            connection.close()
+
+            stats = server.get_stats()[0]
+            self.assertEquals(2, stats['requests'])
+            self.assertEquals(1, stats['workers'])
+            # What is periodically logged
+            server._servers[0]._log_stats()
+        finally:
+            server.stop()
+
+    @uses_module(wsgi_manager)
+    def test_close_without_content_length(self):
+        server = self._create_server(HelloWorldApp())
+        try:
+            connection = httplib.HTTPConnection('127.0.0.1', self.current_port)
+            connection.request('GET', '/')
+            response = connection.getresponse()
+            self.assertEquals('close', response.getheader('Connection'))
+            self.assertEquals("Hello World\n", response.read())
+        finally:
+            server.stop()
+
+    @uses_module(wsgi_manager)
+    def test_silent_connection_does_not_take_a_worker(self):
+        server = self._create_server(EchoApp())
+        try:
+            # A client connects but does not send anything yet...
+            silent_socket = socket.create_connection(('127.0.0.1', self.current_port))
+
+            # ... so the only worker is still available for other clients
+            connection = httplib.HTTPConnection('127.0.0.1', self.current_port, timeout = 5)
+            connection.request('GET', '/other')
+            self.assertEquals('/other ', connection.getresponse().read())
+
+            silent_socket.sendall('GET /silent HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+            self.assertTrue('/silent ' in silent_socket.makefile().read())
+            silent_socket.close()
+            # Closed afterwards, so it does not take the only place in the queue
+            connection.close()
+        finally:
+            server.stop()
+
+    @uses_module(wsgi_manager)
+    def test_queue_full(self):
+        app = EchoApp()
+        app.release.clear()
+        server = self._create_server(app)
+        try:
+            # The only worker is blocked with the first request...
+            busy_connection = httplib.HTTPConnection('127.0.0.1', self.current_port)
+            busy_connection.request('GET', '/busy')
+            self._wait_for(server, 'busy_workers', 1)
+
+            # ... the second one waits in the queue...
+            queued_connection = httplib.HTTPConnection('127.0.0.1', self.current_port)
+            queued_connection.request('GET', '/queued')
+            self._wait_for(server, 'queued', 1)
+
+            # ... and the third one is rejected
+            rejected_connection = httplib.HTTPConnection('127.0.0.1', self.current_port)
+            rejected_connection.request('GET', '/rejected')
+            self.assertEquals(503, rejected_connection.getresponse().status)
+
+            app.release.set()
+            self.assertEquals('/busy ', busy_connection.getresponse().read())
+            self.assertEquals('/queued ', queued_connection.getresponse().read())
+            for connection in busy_connection, queued_connection, rejected_connection:
+                connection.close()
+
+            self.assertEquals(1, server.get_stats()[0]['rejected'])
+        finally:
+            app.release.set()
+            server.stop()
+
+    @uses_module(wsgi_manager)
+    def test_queue_full_with_connections_accepted_at_once(self):
+        app = EchoApp()
+        app.release.clear()
+        server = self._create_server(app)
+        try:
+            busy_connection = httplib.HTTPConnection('127.0.0.1', self.current_port)
+            busy_connection.request('GET', '/busy')
+            self._wait_for(server, 'busy_workers', 1)
+
+            # All of them are accepted while the queue is empty...
+            sockets = [ socket.create_connection(('127.0.0.1', self.current_port)) for _ in xrange(3) ]
+            self._wait_for(server, 'idle_connections', 3)
+
+            # ... but only one fits in the queue when they send the request
+            for sock in sockets:
+                sock.sendall('GET /burst HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n')
+            self._wait_for(server, 'rejected', 2)
+
+            app.release.set()
+            self.assertEquals('/busy ', busy_connection.getresponse().read())
+            busy_connection.close()
+
+            responses = []
+            for sock in sockets:
+                responses.append(sock.makefile().readline().split()[1])
+                sock.close()
+            self.assertEquals(['200', '503', '503'], sorted(responses))
+        finally:
+            app.release.set()
+            server.stop()
+
 def suite():
-    return unittest.makeSuite(WsgiManagerTest)
+    return unittest.TestSuite((
+            unittest.makeSuite(WsgiManagerTest),
+            unittest.makeSuite(PoolWsgiManagerTest),
+        ))
 
 if __name__ == '__main__':
     unittest.main()
@@ -37,5 +37,8 @@ class socket(object):
         else:
             raise RuntimeError("Unknown value for return_value in fake socket.connect()")
 
+    def settimeout(self, timeout):
+        pass
+
     def close(self):
         pass
@@ -0,0 +1,144 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import time
+import threading
+import unittest
+
+import weblab.data.command as Command
+import weblab.lab.async_request as AsyncRequest
+import weblab.lab.exc as LaboratoryErrors
+
+class FakeTime(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+class AsyncRequestEngineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.engines = []
+        self.gate = threading.Event()
+        self.executed = []
+
+    def tearDown(self):
+        self.gate.set()
+        for engine in self.engines:
+            engine.stop()
+
+    def _create_engine(self, **kwargs):
+        engine = AsyncRequest.AsyncRequestEngine(**kwargs)
+        self.engines.append(engine)
+        return engine
+
+    def _blocked(self, name):
+        self.gate.wait(5)
+        self.executed.append(name)
+        return Command.Command(name)
+
+    def _fail(self):
+        raise LaboratoryErrors.FailedToSendCommandError("failed")
+
+    def test_results(self):
+        engine = self._create_engine(workers = 2)
+        self.gate.set()
+        request_ok   = engine.submit('session1', self._blocked, 'result')
+        request_fail = engine.submit('session1', self._fail)
+
+        status = engine.get_status('session1', [request_ok, request_fail, 'unknown'], wait = 5)
+        while len([ s for s, _ in status.values() if s != AsyncRequest.STATUS_RUNNING ]) < 2:
+            status.update(engine.get_status('session1', [request_ok, request_fail], wait = 5))
+
+        self.assertEquals((AsyncRequest.STATUS_OK, 'result'), status[request_ok])
+        self.assertEquals((AsyncRequest.STATUS_ERROR, 'failed'), status[request_fail])
+
+        # Once retrieved, they are removed
+        self.assertEquals({}, engine.get_status('session1', [request_ok, request_fail]))
+        self.assertEquals(0, engine.get_stats()['results'])
+
+    def test_bounded_workers_and_fairness(self):
+        engine = self._create_engine(workers = 1)
+        # The first request blocks the only worker, and meanwhile
+        # session1 sends many requests and session2 sends one
+        engine.submit('session1', self._blocked, 'first')
+        for n in range(5):
+            engine.submit('session1', self._blocked, 'session1-%s' % n)
+        request2 = engine.submit('session2', self._blocked, 'session2')
+
+        self.assertEquals(1, engine.get_stats()['workers'])
+        self.gate.set()
+
+        status = engine.get_status('session2', [request2], wait = 5)
+        self.assertEquals((AsyncRequest.STATUS_OK, 'session2'), status[request2])
+        # session2 did not wait for all the requests of session1
+        self.assertTrue(self.executed.index('session2') <= 2, self.executed)
+
+    def test_max_pending_per_session(self):
+        engine = self._create_engine(workers = 1, max_pending_per_session = 2)
+        engine.submit('session1', self._blocked, 'first')
+        engine.submit('session1', self._blocked, 'second')
+        self.assertRaises(LaboratoryErrors.TooManyAsyncRequestsError, engine.submit, 'session1', self._blocked, 'third')
+        # Other sessions are not affected
+        engine.submit('session2', self._blocked, 'other')
+
+    def test_wait(self):
+        engine = self._create_engine(workers = 1, max_wait = 0.2)
+        request_id = engine.submit('session1', self._blocked, 'result')
+
+        # Without wait, it returns immediately
+        self.assertEquals({ request_id : (AsyncRequest.STATUS_RUNNING, None) }, engine.get_status('session1', [request_id]))
+
+        # The wait is limited by max_wait
+        t0 = time.time()
+        self.assertEquals({ request_id : (AsyncRequest.STATUS_RUNNING, None) }, engine.get_status('session1', [request_id], wait = 10))
+        self.assertTrue(time.time() - t0 < 5)
+
+        # It returns as soon as it finishes
+        threading.Timer(0.05, self.gate.set).start()
+        engine._max_wait = 5
+        self.assertEquals({ request_id : (AsyncRequest.STATUS_OK, 'result') }, engine.get_status('session1', [request_id], wait = 5))
+
+    def test_free_session(self):
+        engine = self._create_engine(workers = 1)
+        engine.submit('session1', self._blocked, 'running')
+        queued = engine.submit('session1', self._blocked, 'queued')
+        engine.free_session('session1')
+        self.assertEquals({}, engine.get_status('session1', [queued]))
+
+        self.gate.set()
+        engine.stop()
+        self.assertTrue('queued' not in self.executed)
+        self.assertEquals(0, engine.get_stats()['results'])
+
+    def test_results_expire(self):
+        fake_time = FakeTime()
+        engine = self._create_engine(workers = 1, result_ttl = 60, time_func = fake_time.time)
+        self.gate.set()
+        request_id = engine.submit('session1', self._blocked, 'result')
+        engine.stop()
+
+        self.assertEquals(1, engine.get_stats()['results'])
+        fake_time.now += 61
+        self.assertEquals({}, engine.get_status('session1', [request_id]))
+        self.assertEquals(0, engine.get_stats()['results'])
+
+def suite():
+    return unittest.makeSuite(AsyncRequestEngineTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
+
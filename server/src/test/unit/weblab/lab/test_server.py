@@ -341,6 +341,23 @@ class LaboratoryServerManagementTestCase(unittest.TestCase):
         fails = failing_experiment_instance_ids[self.experiment_instance_id]
         self.assertTrue(message in fails)
 
+    def test_check_experiments_resources_healthy_cache(self):
+        self._fake_is_up_and_running_handlers()
+        self.cfg_manager._set_value('laboratory_checks_healthy_cache_time', 60)
+        self.assertEquals(0, len(self.lab.do_check_experiments_resources()))
+
+        # The handlers were working a moment ago, so they are not checked again
+        FakeUrllib2.expected_action = FakeUrllib2.HTTP_BAD_CONTENT
+        self.assertEquals(0, len(self.lab.do_check_experiments_resources()))
+
+        self.cfg_manager._set_value('laboratory_checks_healthy_cache_time', 0)
+        self.assertEquals(2, len(self.lab.do_check_experiments_resources()))
+
+        # The failing handlers are always checked
+        self.cfg_manager._set_value('laboratory_checks_healthy_cache_time', 60)
+        FakeUrllib2.expected_action = FakeUrllib2.HTTP_OK
+        self.assertEquals(0, len(self.lab.do_check_experiments_resources()))
+
 class LaboratoryServerSendingTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -465,6 +482,22 @@ class LaboratoryServerSendingTestCase(unittest.TestCase):
                 break
         return
 
+    def test_check_async_command_status_wait(self):
+        lab_session_id, experiment_server_result, exp_info = self.lab.do_reserve_experiment(self.experiment_instance_id, {}, {})
+        self.fake_client.responses = ["result1"]
+
+        reqid = self.lab.do_send_async_command(lab_session_id, Command.Command("foo"))
+
+        # Waiting, a single check is enough
+        result = self.lab.do_check_async_command_status(lab_session_id.id, (reqid,), 5)
+        self.assertEquals(("ok", "result1"), result[reqid])
+
+        self.assertRaises(
+            LaboratoryErrors.SessionNotFoundInLaboratoryServerError,
+            self.lab.do_check_async_command_status,
+            "not_a_session", (reqid,), 5
+        )
+
     def test_send_async_file_ok(self):
         lab_session_id, experiment_server_result, exp_info = self.lab.do_reserve_experiment(self.experiment_instance_id, {}, {})
         files_sent = [ ("foo", "file_info1"), ("bar", "file_info2") ]
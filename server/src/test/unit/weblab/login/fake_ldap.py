@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+"""
+Stub of the python-ldap module, with a server where every user has the
+same password. It can be installed with install(ldap_auth).
+"""
+
+import sys
+import time
+
+PASSWORD = 'password'
+
+initialize_latency = 0
+bind_latency       = 0
+server_down        = False
+refuse_binds       = False
+connections        = []
+
+def reset():
+    global initialize_latency, bind_latency, server_down, refuse_binds, connections
+    initialize_latency = 0
+    bind_latency       = 0
+    server_down        = False
+    refuse_binds       = False
+    connections        = []
+
+class INVALID_CREDENTIALS(Exception):
+    pass
+
+class SERVER_DOWN(Exception):
+    pass
+
+class LDAPObject(object):
+
+    def __init__(self, uri):
+        self.uri              = uri
+        self.binds            = []
+        self.closed_by_server = False
+        self.unbound          = False
+
+    def simple_bind_s(self, who, cred):
+        if server_down or refuse_binds or self.closed_by_server:
+            raise SERVER_DOWN("Can't contact LDAP server")
+        time.sleep(bind_latency)
+        self.binds.append(who)
+        if cred != PASSWORD:
+            raise INVALID_CREDENTIALS("Invalid credentials")
+
+    def unbind_s(self):
+        self.unbound = True
+
+def initialize(uri):
+    if server_down:
+        raise SERVER_DOWN("Can't contact LDAP server")
+    time.sleep(initialize_latency)
+    connection = LDAPObject(uri)
+    connections.append(connection)
+    return connection
+
+class install(object):
+    """ Replaces the ldap module used by ldap_auth by this one until uninstall() is called """
+
+    def __init__(self, ldap_auth):
+        reset()
+        self.ldap_auth = ldap_auth
+        self.backup = ldap_auth.ldap, ldap_auth.LDAP_AVAILABLE, ldap_auth._ldap_provider.ldap_module
+        ldap_auth._pools.clear()
+        this_module = sys.modules[__name__]
+        ldap_auth.ldap = this_module
+        ldap_auth.LDAP_AVAILABLE = True
+        ldap_auth._ldap_provider.ldap_module = this_module
+
+    def uninstall(self):
+        self.ldap_auth._pools.clear()
+        self.ldap_auth.ldap, self.ldap_auth.LDAP_AVAILABLE, self.ldap_auth._ldap_provider.ldap_module = self.backup
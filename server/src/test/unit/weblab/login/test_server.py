@@ -19,6 +19,7 @@ import sys
 import unittest
 import mocker
 import time
+import threading
 
 try:
     import ldap
@@ -37,6 +38,8 @@ from weblab.core.server import UserProcessingServer
 import weblab.core.server as core_api
 import weblab.core.login.simple.ldap_auth as ldap_auth
 import weblab.core.login.exc as LoginErrors
+from weblab.core.login.simple import SimpleAuthnUserAuth
+from weblab.core.exc import DbUserNotFoundError
 
 import test.unit.configuration as configuration_module
 from test.util.wlcontext import wlcontext
@@ -139,8 +142,147 @@ class LoginServerTestCase(unittest.TestCase):
             self.assertTrue( isinstance(session_id, SessionId) )
             self.assertTrue( len(session_id.id) > 5 )
 
+class FakeUserAuth(SimpleAuthnUserAuth):
+    def __init__(self, password, remote = False, credentials_only = True, delay = 0, error = False):
+        self.password         = password
+        self.remote           = remote
+        self.credentials_only = credentials_only
+        self.delay            = delay
+        self.error            = error
+        self.calls            = 0
+        self.lock             = threading.Lock()
+
+    def authenticate(self, login, password):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise Exception("Server down")
+        return password == self.password
+
+    def __repr__(self):
+        return "FakeUserAuth(password=%r)" % self.password
+
+class FakeDb(object):
+    def __init__(self):
+        self.users = {}
+        self.calls = 0
+
+    def retrieve_role_and_user_auths(self, username):
+        self.calls += 1
+        if username not in self.users:
+            raise DbUserNotFoundError("User not found")
+        return 'student', self.users[username]
+
+class LoginManagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cfg_manager = ConfigurationManager.ConfigurationManager()
+        self.cfg_manager.append_module(configuration_module)
+        self.cfg_manager._set_value(login_manager.USER_AUTHS_CACHE_TIME, 10)
+        self.cfg_manager._set_value(login_manager.CREDENTIALS_CACHE_TIME, 0)
+        self.db = FakeDb()
+        self._backup_delay = login_manager.LOGIN_FAILED_DELAY
+        login_manager.LOGIN_FAILED_DELAY = 0
+
+    def tearDown(self):
+        login_manager.LOGIN_FAILED_DELAY = self._backup_delay
+
+    def _create_manager(self):
+        return login_manager.LoginManager(self.db, None, self.cfg_manager)
+
+    def test_user_auths_cached(self):
+        self.db.users[fake_right_user] = [ FakeUserAuth(fake_right_passwd) ]
+        manager = self._create_manager()
+        for _ in range(3):
+            db_session_id = manager._validate_simple_authn(fake_right_user, fake_right_passwd)
+            self.assertEquals(fake_right_user, db_session_id.username)
+        self.assertEquals(1, self.db.calls)
+
+    def test_user_auths_cache_disabled(self):
+        self.cfg_manager._set_value(login_manager.USER_AUTHS_CACHE_TIME, 0)
+        self.db.users[fake_right_user] = [ FakeUserAuth(fake_right_passwd) ]
+        manager = self._create_manager()
+        for _ in range(3):
+            manager._validate_simple_authn(fake_right_user, fake_right_passwd)
+        self.assertEquals(3, self.db.calls)
+
+    def test_password_changed(self):
+        self.db.users[fake_right_user] = [ FakeUserAuth(fake_right_passwd) ]
+        manager = self._create_manager()
+        manager._validate_simple_authn(fake_right_user, fake_right_passwd)
+
+        # The new password is accepted even if the old user auths are cached
+        self.db.users[fake_right_user] = [ FakeUserAuth('new password') ]
+        manager._validate_simple_authn(fake_right_user, 'new password')
+        self.assertRaises(LoginErrors.InvalidCredentialsError, manager._validate_simple_authn, fake_right_user, fake_right_passwd)
+
+    def test_user_removed(self):
+        self.db.users[fake_right_user] = [ FakeUserAuth(fake_right_passwd) ]
+        manager = self._create_manager()
+        manager._validate_simple_authn(fake_right_user, fake_right_passwd)
+        del self.db.users[fake_right_user]
+        self.assertRaises(LoginErrors.InvalidCredentialsError, manager._validate_simple_authn, fake_right_user, 'other password')
+        self.assertRaises(LoginErrors.InvalidCredentialsError, manager._validate_simple_authn, fake_right_user, fake_right_passwd)
+
+    def test_credentials_cached(self):
+        self.cfg_manager._set_value(login_manager.CREDENTIALS_CACHE_TIME, 10)
+        user_auth = FakeUserAuth(fake_right_passwd)
+        self.db.users[fake_right_user] = [ user_auth ]
+        manager = self._create_manager()
+
+        manager._validate_simple_authn(fake_right_user, fake_right_passwd)
+        manager._validate_simple_authn(fake_right_user, fake_right_passwd)
+        self.assertEquals(1, user_auth.calls)
+
+        # Failures are not cached, and the passwords are not stored
+        self.assertRaises(LoginErrors.InvalidCredentialsError, manager._validate_simple_authn, fake_right_user, fake_wrong_passwd)
+        self.assertRaises(LoginErrors.InvalidCredentialsError, manager._validate_simple_authn, fake_right_user, fake_wrong_passwd)
+        self.assertEquals(1, len(manager._credentials_cache))
+        self.assertFalse(fake_right_passwd in repr(manager._credentials_cache._data))
+
+    def test_credentials_not_cached_if_not_only_credentials(self):
+        self.cfg_manager._set_value(login_manager.CREDENTIALS_CACHE_TIME, 10)
+        # e.g. the TrustedIpAddressesUserAuth, which depends on the IP address
+        user_auth = FakeUserAuth(fake_right_passwd, credentials_only = False)
+        self.db.users[fake_right_user] = [ user_auth ]
+        manager = self._create_manager()
+
+        manager._validate_simple_authn(fake_right_user, fake_right_passwd)
+        manager._validate_simple_authn(fake_right_user, fake_right_passwd)
+        self.assertEquals(2, user_auth.calls)
+
+    def test_local_user_auths_first(self):
+        remote_user_auth = FakeUserAuth(fake_right_passwd, remote = True)
+        local_user_auth  = FakeUserAuth(fake_right_passwd)
+        self.db.users[fake_right_user] = [ remote_user_auth, local_user_auth ]
+        manager = self._create_manager()
+        manager._validate_simple_authn(fake_right_user, fake_right_passwd)
+        self.assertEquals(0, remote_user_auth.calls)
+        self.assertEquals(1, local_user_auth.calls)
+
+    def test_remote_user_auths_concurrently(self):
+        DELAY = 0.3
+        failing_user_auth = FakeUserAuth(fake_right_passwd, remote = True, delay = DELAY, error = True)
+        wrong_user_auth   = FakeUserAuth('other', remote = True, delay = DELAY)
+        right_user_auth   = FakeUserAuth(fake_right_passwd, remote = True, delay = DELAY)
+        self.db.users[fake_right_user] = [ failing_user_auth, wrong_user_auth, right_user_auth ]
+        manager = self._create_manager()
+
+        t0 = time.time()
+        manager._validate_simple_authn(fake_right_user, fake_right_passwd)
+        self.assertTrue(time.time() - t0 < 2 * DELAY)
+
+    def test_remote_errors(self):
+        self.db.users[fake_right_user] = [ FakeUserAuth(fake_right_passwd, remote = True, error = True), FakeUserAuth('other', remote = True) ]
+        manager = self._create_manager()
+        self.assertRaises(LoginErrors.LoginError, manager._validate_simple_authn, fake_right_user, fake_right_passwd)
+
 def suite():
-    return unittest.makeSuite(LoginServerTestCase)
+    return unittest.TestSuite((
+            unittest.makeSuite(LoginServerTestCase),
+            unittest.makeSuite(LoginManagerTestCase),
+        ))
 
 if __name__ == '__main__':
     unittest.main()
@@ -24,6 +24,7 @@ except ImportError:
     pass
 
 from test.util.optional_modules import OptionalModuleTestCase
+import test.unit.weblab.login.fake_ldap as FakeLdap
 import weblab.core.login.exc as LoginErrors
 import weblab.core.login.simple as auth_simple
 import weblab.core.login.simple.ldap_auth as ldap_auth
@@ -147,6 +148,10 @@ class LoginAuthTestCase(mocker.MockerTestCase):
 
     if ldap_auth.LDAP_AVAILABLE:
 
+        def setUp(self):
+            # Otherwise the connections of other tests would be reused
+            ldap_auth._pools.clear()
+
         def _create_user_auth(self):
             return create_user_auth(
                     auth_simple.LdapUserAuth.NAME,
@@ -162,7 +167,7 @@ class LoginAuthTestCase(mocker.MockerTestCase):
             ldap_module = self.mocker.mock()
             ldap_module.initialize('ldaps://castor.cdk.deusto.es')
             self.mocker.result(ldap_object)
-            ldap_object.unbind_s()
+            # The connection is not unbound, but kept in the pool
             ldap_auth._ldap_provider.ldap_module = ldap_module
 
             self.mocker.replay()
@@ -226,6 +231,78 @@ class LoginAuthTestCase(mocker.MockerTestCase):
         print >> sys.stderr, "LoginAuth tests skipped since ldap module is not available"
 
 
+class FakeTime(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+class LdapConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.fake_ldap = FakeLdap.install(ldap_auth)
+        self.user_auth = create_user_auth(
+                auth_simple.LdapUserAuth.NAME,
+                'ldap_uri=ldaps://castor.cdk.deusto.es;domain=cdk.deusto.es;base=dc=cdk,dc=deusto,dc=es',
+                None,
+            )
+
+    def tearDown(self):
+        self.fake_ldap.uninstall()
+
+    def test_reuse(self):
+        self.assertTrue(self.user_auth.authenticate(valid_user, FakeLdap.PASSWORD))
+        self.assertFalse(self.user_auth.authenticate(valid_user, invalid_passwd))
+        self.assertTrue(self.user_auth.authenticate(valid_user, FakeLdap.PASSWORD))
+
+        self.assertEquals(1, len(FakeLdap.connections))
+        self.assertEquals([valid_user + '@cdk.deusto.es'] * 3, FakeLdap.connections[0].binds)
+        stats = ldap_auth.get_pool('ldaps://castor.cdk.deusto.es').get_stats()
+        self.assertEquals(1, stats['created'])
+        self.assertEquals(2, stats['reused'])
+
+    def test_closed_connection_retried(self):
+        self.assertTrue(self.user_auth.authenticate(valid_user, FakeLdap.PASSWORD))
+        # The server closes the idle connection
+        FakeLdap.connections[0].closed_by_server = True
+
+        self.assertTrue(self.user_auth.authenticate(valid_user, FakeLdap.PASSWORD))
+        self.assertEquals(2, len(FakeLdap.connections))
+        self.assertTrue(FakeLdap.connections[0].unbound)
+
+    def test_server_down(self):
+        self.assertTrue(self.user_auth.authenticate(valid_user, FakeLdap.PASSWORD))
+        FakeLdap.server_down = True
+        self.assertRaises(LoginErrors.LdapInitializingError, self.user_auth.authenticate, valid_user, FakeLdap.PASSWORD)
+        self.assertEquals(0, ldap_auth.get_pool('ldaps://castor.cdk.deusto.es').get_stats()['idle'])
+
+    def test_binding_error(self):
+        FakeLdap.refuse_binds = True
+        self.assertRaises(LoginErrors.LdapBindingError, self.user_auth.authenticate, valid_user, FakeLdap.PASSWORD)
+        # A new connection is not retried
+        self.assertEquals(1, len(FakeLdap.connections))
+        self.assertTrue(FakeLdap.connections[0].unbound)
+
+    def test_pool_disabled(self):
+        ldap_auth._pools['ldaps://castor.cdk.deusto.es'] = ldap_auth.LdapConnectionPool('ldaps://castor.cdk.deusto.es', size = 0)
+        self.assertTrue(self.user_auth.authenticate(valid_user, FakeLdap.PASSWORD))
+        self.assertTrue(self.user_auth.authenticate(valid_user, FakeLdap.PASSWORD))
+        self.assertEquals(2, len(FakeLdap.connections))
+        self.assertTrue(FakeLdap.connections[0].unbound)
+        self.assertTrue(FakeLdap.connections[1].unbound)
+
+    def test_max_idle(self):
+        fake_time = FakeTime()
+        pool = ldap_auth.LdapConnectionPool('ldaps://castor.cdk.deusto.es', max_idle = 10, time_func = fake_time.time)
+        ldap_auth._pools['ldaps://castor.cdk.deusto.es'] = pool
+        self.assertTrue(self.user_auth.authenticate(valid_user, FakeLdap.PASSWORD))
+        fake_time.now += 11
+        self.assertTrue(self.user_auth.authenticate(valid_user, FakeLdap.PASSWORD))
+        self.assertEquals(2, len(FakeLdap.connections))
+        self.assertTrue(FakeLdap.connections[0].unbound)
+        self.assertFalse(FakeLdap.connections[1].unbound)
+
 class LdapNotAvailableTestCase(OptionalModuleTestCase):
 
     MODULE    = ldap_auth
@@ -245,6 +322,7 @@ def suite():
     return unittest.TestSuite((
                 unittest.makeSuite(DbUserAuthTestCase),
                 unittest.makeSuite(LoginAuthTestCase),
+                unittest.makeSuite(LdapConnectionPoolTestCase),
                 unittest.makeSuite(LdapNotAvailableTestCase),
             ))
 
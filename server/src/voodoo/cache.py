@@ -19,6 +19,7 @@ import weakref
 import threading
 import sys
 import time as time_module
+from collections import OrderedDict
 
 class _HasheableKey(object):
     """ If args are hasheable and there is no kwargs (which will
@@ -74,6 +75,159 @@ class _NotPicklableKey(object):
             if real_key == self._key:
                 return list_cache.pop(pos)[1]
 
+_MISSING = object()
+
+class _Flight(object):
+    """ A value being computed by a thread, which other threads wait for """
+    def __init__(self):
+        self.event    = threading.Event()
+        self.owner    = threading.current_thread()
+        self.value    = None
+        self.exc_info = None
+
+class CacheEngine(object):
+    """
+    Thread-safe cache of at most max_size entries (None for unbounded). When
+    it is full, the least recently used entry is evicted, and entries stored
+    more than ttl seconds ago (None for never) are not returned.
+
+    get_or_compute calls the function only once per key even if many threads
+    miss it at the same time: the rest wait for that result (or exception).
+    """
+    def __init__(self, max_size = None, ttl = None, time_func = None):
+        self.max_size  = max_size
+        self.ttl       = ttl
+        self._time     = time_func or time_module.time
+        self._lock     = threading.Lock()
+        self._entries  = OrderedDict() # key : (value, storage_time), least recently used first
+        self._flights  = {}            # key : _Flight
+
+        self.hits          = 0
+        self.misses        = 0
+        self.coalesced     = 0
+        self.evictions     = 0
+        self.expirations   = 0
+        self.invalidations = 0
+
+    def _lookup(self, key, now):
+        # The lock must be acquired
+        entry = self._entries.pop(key, _MISSING)
+        if entry is _MISSING:
+            return _MISSING
+        value, storage_time = entry
+        if self.ttl is not None and now - storage_time >= self.ttl:
+            self.expirations += 1
+            return _MISSING
+        # Now it's the most recently used
+        self._entries[key] = entry
+        return value
+
+    def _store(self, key, value, now):
+        # The lock must be acquired
+        self._entries.pop(key, None)
+        self._entries[key] = (value, now)
+        if self.max_size is not None:
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last = False)
+                self.evictions += 1
+
+    def get(self, key, default = None):
+        with self._lock:
+            value = self._lookup(key, self._time())
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._store(key, value, self._time())
+
+    def get_or_compute(self, key, func, *args, **kwargs):
+        """ Returns the value cached for key, or the result of func(*args, **kwargs) """
+        with self._lock:
+            now   = self._time()
+            value = self._lookup(key, now)
+            if value is not _MISSING:
+                self.hits += 1
+                return value
+            self.misses += 1
+
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = _Flight()
+                owner  = True
+            else:
+                owner  = False
+                self.coalesced += 1
+
+        if not owner:
+            if flight.owner is threading.current_thread():
+                # Recursive call with the same key: waiting would never end
+                return func(*args, **kwargs)
+            flight.event.wait()
+            if flight.exc_info is not None:
+                raise flight.exc_info[0], flight.exc_info[1], flight.exc_info[2]
+            return flight.value
+
+        try:
+            flight.value = func(*args, **kwargs)
+        except:
+            flight.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                # If it was invalidated in the meanwhile, it's not stored
+                if self._flights.get(key) is flight:
+                    self._flights.pop(key)
+                    if flight.exc_info is None:
+                        self._store(key, flight.value, now)
+            flight.event.set()
+        return flight.value
+
+    def invalidate(self, key):
+        """ Removes key. If it is being computed, the result will not be stored. """
+        with self._lock:
+            self._flights.pop(key, None)
+            if self._entries.pop(key, _MISSING) is _MISSING:
+                return False
+            self.invalidations += 1
+            return True
+
+    def clear(self):
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._flights.clear()
+
+    def purge_expired(self):
+        """ Removes the expired entries. Returns how many were removed. """
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            now = self._time()
+            expired_keys = [ key for key, (_, storage_time) in self._entries.iteritems() if now - storage_time >= self.ttl ]
+            for key in expired_keys:
+                self._entries.pop(key)
+            self.expirations += len(expired_keys)
+            return len(expired_keys)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size'          : len(self._entries),
+                'hits'          : self.hits,
+                'misses'        : self.misses,
+                'coalesced'     : self.coalesced,
+                'evictions'     : self.evictions,
+                'expirations'   : self.expirations,
+                'invalidations' : self.invalidations,
+            }
+
 _cache_registry = []
 _fast_cache_registry = []
 
@@ -90,36 +244,46 @@ class _CacheCleaner(threading.Thread):
 
     def clean_cache_obj(self, cache_obj):
 
+        # The instances which do not exist anymore will never be used again
+        for inst in cache_obj.dictionaries_per_inst.keys():
+            if isinstance(inst, weakref.ReferenceType) and inst() is None:
+                cache_obj.dictionaries_per_inst.pop(inst, None)
+        for inst in cache_obj.engines_per_inst.keys():
+            if isinstance(inst, weakref.ReferenceType) and inst() is None:
+                cache_obj.engines_per_inst.pop(inst, None)
+
+        for engine in cache_obj.engines_per_inst.values():
+            engine.purge_expired()
+
         cache_time = cache_obj.time
         if cache_time is None:
             return
 
         current_time = time_module.time()
-        for inst in cache_obj.dictionaries_per_inst:
-            inst_dict = cache_obj.dictionaries_per_inst[inst]['dict']
-            keys_to_remove = []
-            for key in inst_dict:
-                obj, storage_time = inst_dict[key]
+        for dictionaries in cache_obj.dictionaries_per_inst.values():
+            inst_dict = dictionaries['dict']
+            for key, (obj, storage_time) in inst_dict.items():
                 if current_time - storage_time > cache_time:
-                    keys_to_remove.append(key)
-            for key in keys_to_remove:
-                inst_dict.pop(key)
+                    inst_dict.pop(key, None)
 
-            inst_list = cache_obj.dictionaries_per_inst[inst]['list']
+            inst_list = dictionaries['list']
             i = 0
             while i < len(inst_list):
                 key, (obj, storage_time) = inst_list[i]
-                if current_time - storage_time < cache_time:
+                if current_time - storage_time > cache_time:
                     inst_list.pop(i)
                 else:
                     i += 1
 
     def clean_fast_cache_obj(self, fast_cache_obj):
+        if fast_cache_obj.cache is None:
+            # The engine evicts them
+            return
         for keys in fast_cache_obj.cache.keys():
             if len(keys) > 0:
                 if type(keys[0]) == weakref.ReferenceType:
                     if keys[0]() is None:
-                        fast_cache_obj.pop(keys[0])
+                        fast_cache_obj.cache.pop(keys, None)
 
     def run(self):
         while not self.stopping:
@@ -127,29 +291,32 @@ class _CacheCleaner(threading.Thread):
                 copy = _cache_registry[:]
                 for cache_obj in copy:
                     self.clean_cache_obj(cache_obj)
-                    time_module.sleep(1)
                 copy = _fast_cache_registry[:]
                 for fast_cache_obj in copy:
                     self.clean_fast_cache_obj(fast_cache_obj)
-                    time_module.sleep(1)
-                time_module.sleep(1)
             except Exception as e:
                 if DEBUGGING:
                     print "Error!",e
                     import traceback
                     traceback.print_exc()
+            time_module.sleep(1)
 
 _cache_cleaner = _CacheCleaner()
 _cache_cleaner.setDaemon(True)
 _cache_cleaner.start()
 
-def cache(time_to_wait = None, resource_manager = None):
-    """ cache(time in float seconds) -> decorator
+def cache(time_to_wait = None, resource_manager = None, max_size = None):
+    """ cache(time in float seconds[, max_size]) -> decorator
 
     Given "time" seconds (float), this decorator will cache during that
     time the output of the decorated function. This way, if someone calls
     the cache object with the same input within the next "time" time, the
     function will not be called and the output will be returned instead.
+
+    If max_size is provided, the outputs are stored in a CacheEngine of
+    at most max_size entries (per instance), and concurrent calls with
+    the same input wait for the first one instead of calling the function
+    again. Calls with arguments which can not be pickled are not cached.
     """
     class cache_obj(object):
         def __init__(self, func):
@@ -162,7 +329,11 @@ def cache(time_to_wait = None, resource_manager = None):
                     #   'list': []
                     # }
                  }
+            self.engines_per_inst = {
+                    # inst : CacheEngine (only if max_size is provided)
+                 }
             self._time        = time_to_wait
+            self._max_size    = max_size
             self._inst        = None
             _cache_registry.append(self)
 
@@ -192,7 +363,42 @@ def cache(time_to_wait = None, resource_manager = None):
             # For testing purposes
             return time_module.time()
 
+        def _generate_engine_key(self, args, kargs):
+            if kargs == {}:
+                try:
+                    hash(args)
+                except TypeError:
+                    pass
+                else:
+                    return args
+            try:
+                return pickle.dumps((args,kargs))
+            except:
+                return None
+
+        def _get_engine(self, inst):
+            engine = self.engines_per_inst.get(inst)
+            if engine is None:
+                with self.lock:
+                    engine = self.engines_per_inst.get(inst)
+                    if engine is None:
+                        engine = CacheEngine(self._max_size, self._time, lambda : self._get_time())
+                        self.engines_per_inst[inst] = engine
+            return engine
+
+        def _call_with_engine(self, args, kargs):
+            inst = self._inst
+            key  = self._generate_engine_key(args, kargs)
+            if inst is not None:
+                args = (inst(),) + args
+            if key is None:
+                return self.func[0](*args, **kargs)
+            return self._get_engine(inst).get_or_compute(key, self.func[0], *args, **kargs)
+
         def __call__(self, *args, **kargs):
+            if self._max_size is not None:
+                return self._call_with_engine(args, kargs)
+
             key = self._generate_key(args, kargs)
             current_time = self._get_time()
 
@@ -237,6 +443,8 @@ def cache(time_to_wait = None, resource_manager = None):
 
         def set_time(self, value):
             self._time = value
+            for engine in self.engines_per_inst.values():
+                engine.ttl = value
 
         time = property(get_time, set_time)
 
@@ -246,6 +454,30 @@ def cache(time_to_wait = None, resource_manager = None):
             except KeyError:
                 return
 
+        def invalidate(self, *args, **kargs):
+            """ Removes the output cached for these arguments (of the current instance, if it's a method) """
+            if self._max_size is not None:
+                key = self._generate_engine_key(args, kargs)
+                if key is not None:
+                    self._get_engine(self._inst).invalidate(key)
+            else:
+                self._remove_obj(self._generate_key(args, kargs), self._inst)
+
+        def clear(self):
+            """ Removes every output cached (of every instance) """
+            with self.lock:
+                self.dictionaries_per_inst.clear()
+                for engine in self.engines_per_inst.values():
+                    engine.clear()
+
+        def stats(self):
+            """ Counters of the engines (only if max_size is provided) """
+            total = {}
+            for engine in self.engines_per_inst.values():
+                for name, value in engine.stats().iteritems():
+                    total[name] = total.get(name, 0) + value
+            return total
+
     def wrapped_decorator(func):
         o = cache_obj(func)
         o.__name__ = func.__name__
@@ -258,29 +490,63 @@ class fast_cache(object):
     """ Fastest cache. Problems:
     a) Can't be used with unhashable types (dictionaries, lists, etc.)
     b) Doesn't support key arguments
+
+    It never evicts anything, unless it is created with fast_cache.bounded(max_size),
+    which stores the outputs in a CacheEngine.
     """
-    def __init__(self, func):
+    def __init__(self, func, max_size = None):
         self.func = func
-        self.cache = {}
+        if max_size is None:
+            self.cache   = {}
+            self._engine = None
+        else:
+            self.cache   = None
+            self._engine = CacheEngine(max_size)
         self._inst = None
         _fast_cache_registry.append(self)
 
+    @classmethod
+    def bounded(cls, max_size):
+        """ fast_cache.bounded(max_size) -> decorator """
+        return lambda func : cls(func, max_size)
+
     def __get__(self, inst, owner):
-        self._inst = weakref.ref(inst)
+        if inst is not None:
+            self._inst = weakref.ref(inst)
         return self
 
     def __call__(self, *args):
         try:
             if self._inst is not None:
+                # The instance is not kept in the keys, so it can be collected
+                key  = (self._inst,) + args
                 args = (self._inst(),) + args
+            else:
+                key  = args
 
-            if args in self.cache:
-                return self.cache[args]
+            if self._engine is not None:
+                return self._engine.get_or_compute(key, self.func, *args)
+
+            if key in self.cache:
+                return self.cache[key]
             else:
                 return_value = self.func(*args)
-                self.cache[args] = return_value
+                self.cache[key] = return_value
                 return return_value
         except TypeError:
             print >> sys.stderr, "Using fast_cache with func %s, a function that might receive unhashable arguments!!!" % self.func
             return self.func(*args)
 
+    def invalidate(self, *args):
+        key = args if self._inst is None else (self._inst,) + args
+        if self._engine is not None:
+            self._engine.invalidate(key)
+        else:
+            self.cache.pop(key, None)
+
+    def clear(self):
+        if self._engine is not None:
+            self._engine.clear()
+        else:
+            self.cache.clear()
+
@@ -15,6 +15,8 @@
 
 import os
 
+from sqlalchemy.exc import IntegrityError
+
 def generate_getconn(engine, user, password, host, port, dbname, dirname = None):
 
     kwargs = {}
@@ -91,3 +93,22 @@ def get_sqlite_dbname(dbname, dirname = None):
 def get_table_kwargs():
     return {'mysql_engine' : 'InnoDB'}
 
+def try_insert(session, table, rows):
+    """ Inserts the rows (a dict or a list of dicts) in the session transaction.
+    Returns False (without aborting the transaction) if any of them could not be
+    inserted because of a unique constraint, typically because another
+    transaction inserted it meanwhile; in that case, none of them is inserted. """
+    if session.get_bind().dialect.name == 'sqlite':
+        # sqlite locks the whole database for writing, so nobody can insert
+        # them meanwhile (and pysqlite does not support savepoints properly)
+        session.execute(table.insert(), rows)
+        return True
+
+    savepoint = session.begin_nested()
+    try:
+        session.execute(table.insert(), rows)
+    except IntegrityError:
+        savepoint.rollback()
+        return False
+    savepoint.commit()
+    return True
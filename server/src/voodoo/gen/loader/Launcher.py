@@ -28,6 +28,7 @@ import socket
 
 import logging.config
 
+import voodoo.log as log
 import voodoo.counter as counter
 import voodoo.process_starter as process_starter
 import voodoo.gen.loader.ServerLoader as ServerLoader
@@ -229,6 +230,7 @@ class Launcher(AbstractLauncher):
         logging.config.fileConfig(
                 self.logging_file_config
             )
+        log.refresh_levels()
 
         server_loader = ServerLoader.ServerLoader()
         instance_handler = server_loader.load_instance(
@@ -14,6 +14,7 @@
 #
 
 import voodoo.methods as voodoo_exported_methods
+import voodoo.log as log
 
 import voodoo.configuration as ConfigurationManager
 
@@ -21,6 +22,7 @@ import voodoo.gen.loader.ConfigurationParser as ConfigurationParser
 import voodoo.gen.loader.CoordinatorMapBuilder as CoordinatorMapBuilder
 
 import voodoo.gen.protocols.protocols as Protocols
+import voodoo.gen.protocols.ConnectionPool as ConnectionPool
 import voodoo.gen.protocols.Direct.Network as DirectNetwork
 import voodoo.gen.protocols.Direct.Address as DirectAddress
 
@@ -64,6 +66,18 @@ class ServerLoader(object):
                 instance_name
             )
 
+        instance_cfg_manager = self._create_config_manager_for_instance(
+                global_configuration,
+                machine_name,
+                instance_name
+            )
+
+        # The clients of all the servers of the instance share the pools of connections
+        ConnectionPool.configure(instance_cfg_manager)
+
+        # And the tracing of the logged methods
+        log.configure(instance_cfg_manager)
+
         machine  = global_configuration.machines[machine_name]
         instance = machine.instances[instance_name]
         started_servers = []
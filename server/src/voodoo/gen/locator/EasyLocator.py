@@ -149,11 +149,13 @@ def _generate_call_from_coordaddr(server_type, method):
                 )
 
         tested = 0
+        last_error = None
         for server in servers:
             tested += 1
             try:
                 return getattr(server, method)(*args, **kwargs)
-            except ProtocolErrors.RemoteError:
+            except ProtocolErrors.RemoteError as re:
+                last_error = re
                 log.log(
                     EasyLocator,
                     log.level.Warning,
@@ -168,6 +170,7 @@ def _generate_call_from_coordaddr(server_type, method):
 
         log.log( EasyLocator, log.level.Error, "Can't get a %s server! Error in get_server after testing %s servers " % (server_type, tested))
         raise LocatorErrors.UnableToCompleteOperationError(
-                "Couldn't connect to any %s" % server_type
+                "Couldn't connect to any %s" % server_type,
+                last_error
             )
     return _call_from_coordaddr
@@ -0,0 +1,247 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+"""
+Pools of persistent (HTTP/1.1 keep-alive) connections used by the XML-RPC
+and SOAP clients. There is a single pool per target address (host, port),
+shared by every client of that address in the process, so the number of
+calls in flight to a server is bounded by the size of its pool, and the
+connections are reused among calls instead of being opened for each one.
+
+The sizes and the timeout are configured with configure(cfg_manager),
+which is called by the ServerLoader when an instance is loaded.
+"""
+
+import time
+import errno
+import atexit
+import select
+import socket
+import httplib
+import threading
+
+RPC_CLIENT_POOL_SIZE      = 'rpc_client_pool_size'
+DEFAULT_RPC_CLIENT_POOL_SIZE = 50
+
+RPC_CLIENT_POOL_SIZES     = 'rpc_client_pool_sizes'
+DEFAULT_RPC_CLIENT_POOL_SIZES = {
+            # 'host:port' : size
+        }
+
+RPC_CLIENT_TIMEOUT        = 'rpc_client_timeout'
+DEFAULT_RPC_CLIENT_TIMEOUT = None # seconds; None means no timeout
+
+RPC_CLIENT_POOL_TIMEOUT   = 'rpc_client_pool_timeout'
+DEFAULT_RPC_CLIENT_POOL_TIMEOUT = 30.0 # seconds waiting for a connection; None means forever
+
+# Idle connections are discarded after this time, before the servers close them
+DEFAULT_MAX_IDLE = 15 # seconds
+
+# Errors raised when sending a request through a connection which the server
+# has closed. Only those raised while sending the request (see send_request)
+# can be retried: once it has been sent, the server might have processed it
+# even if the response is lost (e.g. BadStatusLine or ECONNRESET while reading
+# it), and the calls are not idempotent.
+_STALE_CONNECTION_ERRNOS = (errno.ECONNRESET, errno.ECONNABORTED, errno.EPIPE)
+
+def is_stale_connection_error(exc):
+    if isinstance(exc, socket.timeout):
+        return False
+    return isinstance(exc, socket.error) and exc.errno in _STALE_CONNECTION_ERRNOS
+
+class PoolTimeoutError(socket.error):
+    """ No connection of the pool was released in time """
+
+class StaleConnectionError(Exception):
+    """ The request could not be sent through a reused connection, since the
+    server had closed it. The server did not receive it, so the call can be
+    retried on a new connection. """
+
+def send_request(connection, reused, method, url, body, headers):
+    """ Sends the request through the connection. If it fails because the server
+    had closed the (reused) connection, it raises StaleConnectionError. """
+    try:
+        connection.request(method, url, body, headers)
+    except Exception as e:
+        if reused and is_stale_connection_error(e):
+            raise StaleConnectionError(e)
+        raise
+
+def _closed_by_server(connection):
+    """ Whether the server closed the idle connection (it is readable: either
+    the end of the stream or unexpected data, which is not valid either) """
+    sock = getattr(connection, 'sock', None)
+    if sock is None:
+        # Not connected yet (or already closed by httplib): it connects again
+        return False
+    try:
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(sock, select.POLLIN)
+            return len(poller.poll(0)) > 0
+        readable, _, _ = select.select([sock], [], [], 0)
+        return len(readable) > 0
+    except (select.error, socket.error, ValueError):
+        return True
+
+class HTTPConnectionPool(object):
+    """
+    A bounded pool of httplib connections to a single (host, port). acquire
+    blocks while there are already size connections in use, up to
+    acquire_timeout seconds.
+    """
+
+    def __init__(self, host, port, size = DEFAULT_RPC_CLIENT_POOL_SIZE, timeout = DEFAULT_RPC_CLIENT_TIMEOUT,
+                        max_idle = DEFAULT_MAX_IDLE, connection_class = httplib.HTTPConnection, time_func = time.time,
+                        acquire_timeout = DEFAULT_RPC_CLIENT_POOL_TIMEOUT):
+        self.host             = host
+        self.port             = port
+        self.size             = size
+        self.timeout          = timeout
+        self.max_idle         = max_idle
+        self.acquire_timeout  = acquire_timeout
+        self.connection_class = connection_class
+        self._time            = time_func
+
+        self._lock      = threading.Lock()
+        self._released  = threading.Condition(self._lock)
+        self._idle      = [] # [ (connection, last use) ], the most recently used at the end
+        self._in_use    = 0
+        self._created   = 0
+        self._reused    = 0
+        self._timeouts  = 0
+
+    def _wait_for_connection(self):
+        """ Waits until there are less than size connections in use. The lock must be held. """
+        deadline = None if self.acquire_timeout is None else time.time() + self.acquire_timeout
+        while self._in_use >= self.size:
+            if deadline is None:
+                self._released.wait()
+                continue
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self._timeouts += 1
+                raise PoolTimeoutError("No connection to %s:%s available after %s seconds (%s calls in flight)" % (self.host, self.port, self.acquire_timeout, self._in_use))
+            self._released.wait(remaining)
+
+    def acquire(self, reuse = True):
+        """ Returns (connection, reused), where reused states whether the connection had already
+        been used (and therefore the server might have closed it meanwhile). If reuse is False,
+        a new connection is always created. If no connection is released in acquire_timeout
+        seconds, it raises PoolTimeoutError. """
+        expired = []
+        connection = None
+        with self._lock:
+            self._wait_for_connection()
+            now = self._time()
+            while reuse and self._idle and connection is None:
+                candidate, last_use = self._idle.pop()
+                if now - last_use > self.max_idle or _closed_by_server(candidate):
+                    expired.append(candidate)
+                else:
+                    connection = candidate
+            # The rest are older
+            if connection is not None:
+                while self._idle and now - self._idle[0][1] > self.max_idle:
+                    expired.append(self._idle.pop(0)[0])
+            self._in_use += 1
+            if connection is None:
+                self._created += 1
+            else:
+                self._reused += 1
+
+        for expired_connection in expired:
+            expired_connection.close()
+
+        if connection is not None:
+            return connection, True
+
+        try:
+            return self.connection_class(self.host, self.port, timeout = self.timeout), False
+        except:
+            with self._lock:
+                self._in_use -= 1
+                self._released.notify()
+            raise
+
+    def release(self, connection, reusable = True):
+        """ Returns the connection to the pool. If it is not reusable (the server closed it,
+        or the call failed in the middle), it is closed. """
+        if not reusable:
+            connection.close()
+        with self._lock:
+            if reusable:
+                self._idle.append((connection, self._time()))
+            self._in_use -= 1
+            self._released.notify()
+
+    def close(self):
+        """ Closes the idle connections """
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for connection, _ in idle:
+            connection.close()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size'    : self.size,
+                'in_use'  : self._in_use,
+                'idle'    : len(self._idle),
+                'created' : self._created,
+                'reused'  : self._reused,
+                'timeouts' : self._timeouts,
+            }
+
+_pools      = {} # { (host, port) : pool }
+_pools_lock = threading.Lock()
+_pool_sizes = DEFAULT_RPC_CLIENT_POOL_SIZES.copy()
+_pool_size  = DEFAULT_RPC_CLIENT_POOL_SIZE
+_timeout    = DEFAULT_RPC_CLIENT_TIMEOUT
+_pool_timeout = DEFAULT_RPC_CLIENT_POOL_TIMEOUT
+
+def configure(cfg_manager):
+    """ Sets the sizes and the timeouts of the pools created from now on """
+    global _pool_size, _pool_sizes, _timeout, _pool_timeout
+    with _pools_lock:
+        _pool_size    = cfg_manager.get_value(RPC_CLIENT_POOL_SIZE,    DEFAULT_RPC_CLIENT_POOL_SIZE)
+        _pool_sizes   = cfg_manager.get_value(RPC_CLIENT_POOL_SIZES,   DEFAULT_RPC_CLIENT_POOL_SIZES)
+        _timeout      = cfg_manager.get_value(RPC_CLIENT_TIMEOUT,      DEFAULT_RPC_CLIENT_TIMEOUT)
+        _pool_timeout = cfg_manager.get_value(RPC_CLIENT_POOL_TIMEOUT, DEFAULT_RPC_CLIENT_POOL_TIMEOUT)
+
+def get_pool(host, port):
+    """ Returns the pool of connections to that address """
+    port = int(port)
+    with _pools_lock:
+        pool = _pools.get((host, port))
+        if pool is None:
+            size = _pool_sizes.get('%s:%s' % (host, port), _pool_size)
+            pool = HTTPConnectionPool(host, port, size = size, timeout = _timeout, acquire_timeout = _pool_timeout)
+            _pools[(host, port)] = pool
+        return pool
+
+def close_all():
+    """ Closes the idle connections of every pool, and forgets the pools """
+    with _pools_lock:
+        pools = _pools.values()
+        _pools.clear()
+    for pool in pools:
+        pool.close()
+
+# Otherwise the threads of the local servers would remain waiting on the idle
+# connections while the interpreter is finishing
+atexit.register(close_all)
@@ -25,6 +25,7 @@ else:
 
 import voodoo.gen.generators.ClientSkel as ClientSkel
 import voodoo.gen.exceptions.protocols.ProtocolErrors as ProtocolErrors
+import voodoo.gen.protocols.ConnectionPool as ConnectionPool
 import voodoo.log as log
 
 import voodoo.gen.protocols.SOAP.ServerSOAP as ServerSOAP
@@ -43,6 +44,61 @@ def _retrieve_class(complete_class_name):
         return None
     return getattr(module,class_name)
 
+if SOAPPY_AVAILABLE:
+    class PooledSOAPTransport(SOAPpy.HTTPTransport):
+        """
+        SOAPpy transport which takes a connection of the pool of the target
+        address for each call, instead of opening a new one each time.
+        """
+
+        def __init__(self, pool):
+            SOAPpy.HTTPTransport.__init__(self)
+            self._pool = pool
+
+        def call(self, addr, data, namespace, soapaction = None, encoding = None, http_proxy = None, config = SOAPpy.Config, timeout = None):
+            if not isinstance(addr, SOAPpy.SOAPAddress):
+                addr = SOAPpy.SOAPAddress(addr, config)
+
+            connection, reused = self._pool.acquire()
+            try:
+                return self._single_call(connection, reused, addr, data, namespace, soapaction, encoding)
+            except ConnectionPool.StaleConnectionError:
+                pass
+
+            # The server closed the idle connection before receiving the request.
+            # Retry once with a new one.
+            connection, _ = self._pool.acquire(reuse = False)
+            return self._single_call(connection, False, addr, data, namespace, soapaction, encoding)
+
+        def _single_call(self, connection, reused, addr, data, namespace, soapaction, encoding):
+            content_type = 'text/xml'
+            if encoding is not None:
+                content_type += '; charset=%s' % encoding
+
+            reusable = False
+            try:
+                ConnectionPool.send_request(connection, reused, "POST", addr.path, data, {
+                        "Host"         : addr.host,
+                        "User-agent"   : SOAPpy.SOAPUserAgent(),
+                        "Content-type" : content_type,
+                        "SOAPAction"   : '"%s"' % soapaction if soapaction else "",
+                    })
+                response = connection.getresponse(buffering = True)
+                response_data = response.read()
+                reusable = not response.will_close
+            finally:
+                self._pool.release(connection, reusable)
+
+            response_content_type = response.getheader("content-type", "text/xml")
+            if response.status == 500 and not (response_content_type.startswith("text/xml") and len(response_data) > 0):
+                raise SOAPpy.HTTPError(response.status, response.reason)
+            if response.status not in (200, 500):
+                raise SOAPpy.HTTPError(response.status, response.reason)
+
+            if namespace is None:
+                return response_data, None
+            return response_data, self.getNS(namespace, response_data)
+
 
 # Stubs of client methods to dynamically generate
 # All of them must have the same name format:
@@ -132,7 +188,8 @@ def generate(methods):
     class ClientSOAP(clientSkel):
         def __init__(self, url, port=80):
             if SOAPPY_AVAILABLE:
-                proxy = SOAPpy.SOAPProxy('http://'+url+':'+str(port))
+                pool = ConnectionPool.get_pool(url, port)
+                proxy = SOAPpy.SOAPProxy('http://'+url+':'+str(port), transport = lambda : PooledSOAPTransport(pool))
             else:
                 proxy = None
                 msg = "The optional library 'SOAPpy' is not available. The communications between different servers will not work through SOAP. Since the client is being instanciated, there will probably be uncommon errors."
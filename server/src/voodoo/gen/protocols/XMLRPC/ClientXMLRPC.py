@@ -14,12 +14,60 @@
 #
 import voodoo.gen.generators.ClientSkel as ClientSkel
 import voodoo.gen.exceptions.protocols.ProtocolErrors as ProtocolErrors
+import voodoo.gen.protocols.ConnectionPool as ConnectionPool
 
-import threading
 import xmlrpclib
 
 import voodoo.gen.protocols.XMLRPC.Errors as Exceptions
 
+class PooledTransport(xmlrpclib.Transport):
+    """
+    The default xmlrpclib transport keeps a single httplib connection, which does
+    not support concurrency. This one takes a connection of the pool of the target
+    address for each call, so there can be as many calls in flight as connections
+    in the pool, and the connections are kept alive among calls.
+    """
+
+    def __init__(self, pool, use_datetime = 0):
+        xmlrpclib.Transport.__init__(self, use_datetime)
+        self._pool = pool
+
+    def request(self, host, handler, request_body, verbose = 0):
+        connection, reused = self._pool.acquire()
+        try:
+            return self._single_request(connection, reused, host, handler, request_body, verbose)
+        except ConnectionPool.StaleConnectionError:
+            pass
+
+        # The server closed the idle connection before receiving the request.
+        # Retry once with a new one.
+        connection, _ = self._pool.acquire(reuse = False)
+        return self._single_request(connection, False, host, handler, request_body, verbose)
+
+    def _single_request(self, connection, reused, host, handler, request_body, verbose):
+        reusable = False
+        try:
+            connection.set_debuglevel(verbose)
+            ConnectionPool.send_request(connection, reused, "POST", handler, request_body, {
+                    "Content-Type" : "text/xml",
+                    "User-Agent"   : self.user_agent,
+                    "Host"         : host,
+                })
+            response = connection.getresponse(buffering = True)
+            data = response.read()
+            reusable = not response.will_close
+
+            if response.status != 200:
+                raise xmlrpclib.ProtocolError(host + handler, response.status, response.reason, response.msg)
+
+            self.verbose = verbose
+            parser, unmarshaller = self.getparser()
+            parser.feed(data)
+            parser.close()
+            return unmarshaller.close()
+        finally:
+            self._pool.release(connection, reusable)
+
 # Stubs of client methods to dynamically generate
 # All of them must have the same name format:
 #
@@ -38,11 +86,9 @@ def _generate_stub(METHOD_NAME):
         try:
             # 
             # The XML-RPC client relies on httplib, which does not support concurrency.
-            # Either we create a new connection each time, or we lock it and we support
-            # a single concurrent request (which is what we do here).
+            # The PooledTransport uses a different connection for each concurrent call.
             # 
-            with self._xmlrpc_lock:
-                return getattr(self._server,'Util.%s' % METHOD_NAME)(*parameters,**kparameters)
+            return getattr(self._server,'Util.%s' % METHOD_NAME)(*parameters,**kparameters)
         except xmlrpclib.Fault as ft:
             raise Exceptions.UnknownFaultType(
                     "Unknown fault type: " + str(ft.faultCode) + ": " + str(ft.faultString),
@@ -93,8 +139,8 @@ def generate(methods):
     class ClientXMLRPC(clientSkel):
 
         def __init__(self, url, port=80, uri='/'):
-            self._xmlrpc_lock = threading.Lock()
-            clientSkel.__init__(self,xmlrpclib.Server('http://'+url+':'+str(port)+uri, allow_none = True))
+            transport = PooledTransport(ConnectionPool.get_pool(url, port))
+            clientSkel.__init__(self,xmlrpclib.Server('http://'+url+':'+str(port)+uri, transport = transport, allow_none = True))
 
     # Adding properly the testing method to check availability
     if isinstance(methods,dict):
@@ -14,6 +14,7 @@
 #
 
 import SimpleXMLRPCServer
+import SocketServer
 import threading
 import new
 import types
@@ -27,11 +28,19 @@ import voodoo.resources_manager as ResourceManager
 #TODO: configuration
 MAX_TIMEOUT = 0.5
 
+# Persistent connections idle for longer than this are closed
+KEEP_ALIVE_TIMEOUT = 60 # seconds
+
 _xmlrpc_server = None
 _xmlrpc_server_functions = []
 _xmlrpc_server_lock = threading.Lock()
 
 class UtilRequestHandlerClass(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+
+    # Support persistent connections (see voodoo.gen.protocols.ConnectionPool)
+    protocol_version = "HTTP/1.1"
+    timeout = KEEP_ALIVE_TIMEOUT
+
     def log_message(self, format, *args):
         log.log(
                 UtilRequestHandlerClass,
@@ -70,10 +79,12 @@ def _generate_skeleton(METHOD_NAME):
             raise
     return _skeleton
 
-# TODO: Threading?
-class _AvoidTimeoutXMLRPCServer(SimpleXMLRPCServer.SimpleXMLRPCServer):
+# Each connection is handled in a different thread, as in the SOAP server,
+# so the concurrent calls of the clients are not serialized
+class _AvoidTimeoutXMLRPCServer(SocketServer.ThreadingMixIn, SimpleXMLRPCServer.SimpleXMLRPCServer):
 
     request_queue_size = 50 #TODO: configure this
+    daemon_threads = True
 
     def get_request(self):
         sock, addr = SimpleXMLRPCServer.SimpleXMLRPCServer.get_request(self)
@@ -14,16 +14,27 @@
 #
 import sys
 import time
+import json
+import atexit
 import traceback
-import StringIO
 import math
 import random
 import logging
 import threading
+import collections
 import new
 from functools import wraps
 from voodoo.cache import fast_cache
 
+LOG_TRACING      = 'log_tracing'
+DEFAULT_LOG_TRACING = False
+
+LOG_TRACING_SIZE = 'log_tracing_size'
+DEFAULT_LOG_TRACING_SIZE = 10000
+
+LOG_TRACING_FILE = 'log_tracing_file'
+DEFAULT_LOG_TRACING_FILE = None
+
 class level(object):
     Critical = 'Critical'
     Error    = 'Error'
@@ -31,30 +42,38 @@ class level(object):
     Info     = 'Info'
     Debug    = 'Debug'
 
-def log(instance_or_module_or_class, level, message, max_size = 250):
-    logging_log_level = getattr(logging,level.upper())
+def _get_logger_name(instance_or_module_or_class):
     if isinstance(instance_or_module_or_class,str):
-        logger_name = instance_or_module_or_class
+        return instance_or_module_or_class
     elif isinstance(instance_or_module_or_class, new.classobj) or isinstance(instance_or_module_or_class, type):
-        logger_name = instance_or_module_or_class.__module__ + '.' + instance_or_module_or_class.__name__
+        return instance_or_module_or_class.__module__ + '.' + instance_or_module_or_class.__name__
     else:
-        logger_name = instance_or_module_or_class.__class__.__module__ + '.' + instance_or_module_or_class.__class__.__name__
-    logger = logging.getLogger(logger_name)
-    if not logger.isEnabledFor(logging_log_level):
-        return
+        return instance_or_module_or_class.__class__.__module__ + '.' + instance_or_module_or_class.__class__.__name__
 
+def _log_message(logger, logging_log_level, message, max_size):
     message_repr = repr(message)
     if len(message_repr) > max_size:
         message_repr = message_repr[:max_size-3] + '...'
 
     logger.log(logging_log_level,message_repr)
 
+def log(instance_or_module_or_class, level, message, max_size = 250):
+    logging_log_level = getattr(logging,level.upper())
+    logger = _get_logger(_get_logger_name(instance_or_module_or_class))
+    if not logger.isEnabledFor(logging_log_level):
+        return
+
+    _log_message(logger, logging_log_level, message, max_size)
+
 def log_exc(instance_or_module_or_class, level):
-    f = StringIO.StringIO()
-    traceback.print_exc(file=f)
-    lines = f.getvalue().split('\n')
-    for line in lines:
-        log(instance_or_module_or_class, level, line)
+    logging_log_level = getattr(logging,level.upper())
+    logger = _get_logger(_get_logger_name(instance_or_module_or_class))
+    # The traceback is only formatted if it is going to be logged
+    if not logger.isEnabledFor(logging_log_level):
+        return
+
+    for line in traceback.format_exc().split('\n'):
+        _log_message(logger, logging_log_level, line, 250)
 
 _BASE_CALL_ID_STR = time.strftime("%Y_%m_%d-%H:%M:%S-",time.gmtime())
 _CALL_ID_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
@@ -80,6 +99,111 @@ def _get_logger(logger_name):
     """ logging.getLogger scales very bad when using threads. Caching its result is far faster """
     return logging.getLogger(logger_name)
 
+###########################################################
+#
+# logged checks whether the logger of each class is enabled
+# only once, so the methods are called without any overhead
+# when they are not logged. If the levels of the loggers are
+# changed after the first calls (e.g. logging is configured),
+# refresh_levels must be called.
+#
+
+_levels_generation = 0
+
+def refresh_levels():
+    """ Makes logged check again whether the loggers are enabled """
+    global _levels_generation
+    _levels_generation += 1
+
+def _get_enabled_logger(logger_name, logging_level):
+    logger = _get_logger(logger_name)
+    if logger.isEnabledFor(logging_level):
+        return logger
+    return None
+
+###########################################################
+#
+# When tracing is enabled, every call to a logged method is
+# stored (whether it is logged or not) in a ring buffer with
+# the name of the method, the reservation_id (the argument
+# with that name, or the one established for the thread with
+# set_trace_context), when it started and how long it took.
+#
+
+_traces = None
+_trace_context = threading.local()
+
+def enable_tracing(size = DEFAULT_LOG_TRACING_SIZE):
+    """ Stores the last size calls to logged methods """
+    global _traces
+    _traces = collections.deque(maxlen = size)
+
+def disable_tracing():
+    global _traces
+    _traces = None
+
+def is_tracing():
+    return _traces is not None
+
+def set_trace_context(reservation_id = None):
+    """ reservation_id of the calls performed by this thread which do not receive it """
+    _trace_context.reservation_id = reservation_id
+
+def get_traces():
+    traces = _traces
+    if traces is None:
+        return []
+    return list(traces)
+
+def export_traces(file_name = None):
+    """ Returns the traces as JSON, writing them in file_name if provided """
+    serialized = json.dumps(get_traces())
+    if file_name is not None:
+        with open(file_name, 'w') as f:
+            f.write(serialized)
+    return serialized
+
+def _export_traces_at_exit(file_name):
+    if _traces is not None:
+        export_traces(file_name)
+
+_exporting_files = set()
+
+def configure(cfg_manager):
+    """ Enables or disables tracing as configured """
+    if cfg_manager.get_value(LOG_TRACING, DEFAULT_LOG_TRACING):
+        enable_tracing(cfg_manager.get_value(LOG_TRACING_SIZE, DEFAULT_LOG_TRACING_SIZE))
+        file_name = cfg_manager.get_value(LOG_TRACING_FILE, DEFAULT_LOG_TRACING_FILE)
+        if file_name is not None and file_name not in _exporting_files:
+            _exporting_files.add(file_name)
+            atexit.register(_export_traces_at_exit, file_name)
+    else:
+        disable_tracing()
+
+def _traced_call(traces, method_name, reservation_id, f, args, kargs):
+    if reservation_id is None:
+        reservation_id = getattr(_trace_context, 'reservation_id', None)
+    else:
+        reservation_id = getattr(reservation_id, 'id', reservation_id)
+    if reservation_id is not None and not isinstance(reservation_id, basestring):
+        reservation_id = repr(reservation_id)
+
+    start = time.time()
+    error = True
+    try:
+        result = f(*args, **kargs)
+        error = False
+        return result
+    finally:
+        traces.append({
+            'method'         : method_name,
+            'reservation_id' : reservation_id,
+            'thread'         : threading.currentThread().getName(),
+            'start'          : start,
+            'duration'       : time.time() - start,
+            'error'          : error,
+        })
+
 # This code defers the logging requests to a thread pool
 # It's experimental code, so by default it's not enabled
 
@@ -150,6 +274,9 @@ def logged(level='debug', except_for=None, max_size = 250, is_class_method = Tru
         # def f(name1,name2,name3,*args,**kargs):
         # parameter_names will be ['name1','name2','name3']
         parameter_names = list(f.func_code.co_varnames[:f.func_code.co_argcount])
+        # args does not include "self" in methods
+        if is_class_method:
+            parameter_names = parameter_names[1:]
         func_name       = f.__name__
 
         levelname       = _levelname
@@ -321,54 +448,73 @@ def logged(level='debug', except_for=None, max_size = 250, is_class_method = Tru
                             'finish_time'   : strtime
                         }
 
+        reservation_id_position = parameter_names.index('reservation_id') if 'reservation_id' in parameter_names else None
+
+        def find_reservation_id(args, kargs):
+            if 'reservation_id' in kargs:
+                return kargs['reservation_id']
+            if reservation_id_position is not None and len(args) > reservation_id_position:
+                return args[reservation_id_position]
+            return None
+
+        def call(logger, traces, method_name, call_args, args, kargs):
+            def invoke():
+                if traces is None:
+                    return f(*call_args, **kargs)
+                return _traced_call(traces, method_name, find_reservation_id(args, kargs), f, call_args, kargs)
+
+            if logger is None:
+                return invoke()
+
+            log_writer = getattr(logger, levelname)
+
+            entry  = LogEntry()
+            header = HeaderLine(entry, log_writer)
+            header.log(args, kargs)
+            try:
+                result = invoke()
+            except:
+                footer_exc = FooterExcLine(entry, log_writer)
+                footer_exc.log()
+                raise
+            else:
+                footer_return = FooterReturnLine(entry, log_writer)
+                footer_return.log(result)
+
+            return result
+
         if is_class_method:
+            loggers = {
+                # class : (levels generation, logger if enabled or None, method name)
+            }
+
             @wraps(f)
             def wrapped(self,*args, **kargs):
-                logger_name = _get_full_class_name(self.__class__, f)
-                logger = _get_logger(logger_name)
-                if not logger.isEnabledFor(logging_level):
-                    return f(self, *args, **kargs)
+                cached = loggers.get(self.__class__)
+                if cached is None or cached[0] != _levels_generation:
+                    logger_name = _get_full_class_name(self.__class__, f)
+                    cached = loggers[self.__class__] = (_levels_generation, _get_enabled_logger(logger_name, logging_level), logger_name + '.' + func_name)
 
-                log_writer = getattr(logger, levelname)
+                traces = _traces
+                if cached[1] is None and traces is None:
+                    return f(self, *args, **kargs)
 
-                entry  = LogEntry()
-                header = HeaderLine(entry, log_writer)
-                header.log(args, kargs)
-                try:
-                    result = f(self,*args,**kargs)
-                except:
-                    footer_exc = FooterExcLine(entry, log_writer)
-                    footer_exc.log()
-                    raise
-                else:
-                    footer_return = FooterReturnLine(entry, log_writer)
-                    footer_return.log(result)
+                return call(cached[1], traces, cached[2], (self,) + args, args, kargs)
 
-                return result
         else: # For functions
+            method_name = f.__module__ + '.' + func_name
+            cached = [ None, None ] # levels generation, logger if enabled or None
+
             @wraps(f)
             def wrapped(*args, **kargs):
-                logger_name = f.__module__
-                logger = _get_logger(logger_name)
-                if not logger.isEnabledFor(logging_level):
-                    return f(*args, **kargs)
+                if cached[0] != _levels_generation:
+                    cached[:] = _levels_generation, _get_enabled_logger(f.__module__, logging_level)
 
-                log_writer = getattr(logger, levelname)
-
-                entry  = LogEntry()
-                header = HeaderLine(entry, log_writer)
-                header.log(args, kargs)
-                try:
-                    result = f(*args,**kargs)
-                except:
-                    footer_exc = FooterExcLine(entry, log_writer)
-                    footer_exc.log()
-                    raise
-                else:
-                    footer_return = FooterReturnLine(entry, log_writer)
-                    footer_return.log(result)
+                traces = _traces
+                if cached[1] is None and traces is None:
+                    return f(*args, **kargs)
 
-                return result
+                return call(cached[1], traces, method_name, args, args, kargs)
         return wrapped
     return real_logger
 
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import math
+import time
+import uuid
+import threading
+
+from voodoo.redis_script import RedisScript
+
+DEFAULT_TTL = 5 # seconds
+
+###########################################################
+#
+# A lock stored in a redis key. The key contains a random
+# token that only the owner knows, so the lock is only
+# removed by its owner (and never by someone whose lock
+# already expired).
+#
+# Waiters do not poll: they block in a BLPOP on a list
+# where the owner pushes a signal when releasing the lock.
+#
+# KEYS[1]: lock key
+#
+# ARGV[1]: token
+# ARGV[2]: TTL in milliseconds (0 if the lock never expires)
+#
+_ACQUIRE_SCRIPT = RedisScript("""
+if redis.call('exists', KEYS[1]) == 1 then
+    return 0
+end
+if tonumber(ARGV[2]) > 0 then
+    redis.call('psetex', KEYS[1], ARGV[2], ARGV[1])
+else
+    redis.call('set', KEYS[1], ARGV[1])
+end
+return 1
+""")
+
+#
+# KEYS[1]: lock key
+# KEYS[2]: signal list key
+#
+# ARGV[1]: token
+# ARGV[2]: TTL in milliseconds
+#
+_RELEASE_SCRIPT = RedisScript("""
+if redis.call('get', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+redis.call('del', KEYS[1])
+redis.call('del', KEYS[2])
+redis.call('rpush', KEYS[2], '1')
+redis.call('pexpire', KEYS[2], ARGV[2])
+return 1
+""")
+
+class LockMetrics(object):
+    """
+    Counters of how contended a group of locks is. The same instance can
+    be shared by every lock of the same kind.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquired         = 0
+        self.contended        = 0
+        self.timeouts         = 0
+        self.released         = 0
+        self.expired_releases = 0
+        self.total_wait_time  = 0.0
+        self.max_wait_time    = 0.0
+
+    def _register_acquire(self, acquired, waited, wait_time):
+        with self._lock:
+            if acquired:
+                self.acquired += 1
+            else:
+                self.timeouts += 1
+            if waited:
+                self.contended += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time    = max(self.max_wait_time, wait_time)
+
+    def _register_release(self, released):
+        with self._lock:
+            if released:
+                self.released += 1
+            else:
+                self.expired_releases += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'acquired'         : self.acquired,
+                'contended'        : self.contended,
+                'timeouts'         : self.timeouts,
+                'released'         : self.released,
+                'expired_releases' : self.expired_releases,
+                'total_wait_time'  : self.total_wait_time,
+                'max_wait_time'    : self.max_wait_time,
+            }
+
+class RedisLock(object):
+    """
+    Lock shared by every process connected to the same redis server.
+
+    acquire returns a token (or None if it was not acquired before
+    the timeout), which must be provided to release. If the owner does
+    not release the lock in ttl seconds, it expires. If ttl is None, the
+    lock never expires.
+    """
+    def __init__(self, redis_maker, key, ttl = DEFAULT_TTL, metrics = None):
+        self.redis_maker = redis_maker
+        self.key         = key
+        self.signal_key  = key + ':signal'
+        self.ttl         = ttl
+        self.metrics     = metrics
+
+    def acquire(self, timeout = None):
+        """ timeout: None waits forever; 0 does not wait at all """
+        client = self.redis_maker()
+        token  = uuid.uuid4().hex
+        ttl_ms = self._ttl_ms(0)
+
+        initial = time.time()
+        waited  = False
+        while True:
+            if _ACQUIRE_SCRIPT(client, keys = (self.key,), args = (token, ttl_ms)):
+                self._register_acquire(True, waited, initial)
+                return token
+
+            max_wait = self.ttl if self.ttl is not None else DEFAULT_TTL
+            if timeout is None:
+                remaining = max_wait
+            else:
+                remaining = min(initial + timeout - time.time(), max_wait)
+                if remaining <= 0:
+                    self._register_acquire(False, waited, initial)
+                    return None
+
+            # Wake up when the lock is released, or when it might have
+            # expired. BLPOP only supports seconds in old redis versions.
+            waited = True
+            client.blpop(self.signal_key, timeout = max(1, int(math.ceil(remaining))))
+
+    def release(self, token):
+        """ Returns False if the lock had already expired (and someone else might own it) """
+        client = self.redis_maker()
+        released = bool(_RELEASE_SCRIPT(client, keys = (self.key, self.signal_key), args = (token, self._ttl_ms(int(DEFAULT_TTL * 1000)))))
+        if self.metrics is not None:
+            self.metrics._register_release(released)
+        return released
+
+    def _ttl_ms(self, default):
+        if self.ttl is None:
+            return default
+        return int(self.ttl * 1000)
+
+    def _register_acquire(self, acquired, waited, initial):
+        if self.metrics is not None:
+            self.metrics._register_acquire(acquired, waited, time.time() - initial)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import hashlib
+
+try:
+    import redis
+except ImportError:
+    REDIS_AVAILABLE = False
+else:
+    REDIS_AVAILABLE = True
+
+class RedisScript(object):
+    """
+    Lua script run through EVALSHA. The script is only sent to the redis
+    server the first time, or whenever the server reports that it does not
+    know it (e.g. after a SCRIPT FLUSH or a restart).
+    """
+    def __init__(self, source):
+        self.source = source
+        self.sha    = hashlib.sha1(source).hexdigest()
+
+    def __call__(self, client, keys = (), args = ()):
+        keys = list(keys)
+        args = list(args)
+        try:
+            return client.evalsha(self.sha, len(keys), *(keys + args))
+        except redis.exceptions.ResponseError as e:
+            # Newer versions of redis-py raise NoScriptError; older ones
+            # provide a generic ResponseError with the NOSCRIPT prefix
+            no_script_error = getattr(redis.exceptions, 'NoScriptError', ())
+            if not isinstance(e, no_script_error) and not str(e).startswith('NOSCRIPT'):
+                raise
+        client.script_load(self.source)
+        return client.evalsha(self.sha, len(keys), *(keys + args))
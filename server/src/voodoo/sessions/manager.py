@@ -113,6 +113,44 @@ class SessionManager(object):
                 "Not a SessionId: %s " % sess_id
             )
 
+    def get_sessions(self, sess_ids):
+        """ Retrieves many sessions at once. Returns a dictionary
+        { sess_id : session } without those sessions which do not exist. """
+        for sess_id in sess_ids:
+            if not isinstance(sess_id,SessionId.SessionId):
+                raise SessionErrors.SessionInvalidSessionIdError(
+                    "Not a SessionId: %s " % sess_id
+                )
+        sessions = self.gateway.get_sessions([ sess_id.id for sess_id in sess_ids ])
+        return dict( (sess_id, sessions[sess_id.id]) for sess_id in sess_ids if sess_id.id in sessions )
+
+    @property
+    def atomic_field_updates(self):
+        """ Whether update_session_fields is cheaper than locking, retrieving
+        and storing the whole session """
+        return self.gateway.atomic_field_updates
+
+    def get_session_fields(self, sess_id, fields):
+        """ Retrieves only some fields of the session. Returns a dictionary
+        { field : value } without those fields which are not in the session. """
+        if isinstance(sess_id,SessionId.SessionId):
+            return self.gateway.get_session_fields(sess_id.id, fields)
+        else:
+            raise SessionErrors.SessionInvalidSessionIdError(
+                "Not a SessionId: %s " % sess_id
+            )
+
+    def update_session_fields(self, sess_id, fields):
+        """ Stores the fields provided ({ field : value }) without locking
+        the session. Only the fields which are already in the session are
+        updated, so a field removed by a concurrent request is not restored. """
+        if isinstance(sess_id,SessionId.SessionId):
+            return self.gateway.update_session_fields(sess_id.id, fields)
+        else:
+            raise SessionErrors.SessionInvalidSessionIdError(
+                "Not a SessionId: %s " % sess_id
+            )
+
     def get_session_locking(self, sess_id):
         if isinstance(sess_id,SessionId.SessionId):
             return self.gateway.get_session_locking(sess_id.id)
@@ -58,7 +58,7 @@ class SessionMemoryGateway(object):
 
         self._cfg_manager   = cfg_manager
         self._generator     = SessionGenerator.SessionGenerator()
-        self._serializer    = SessionSerializer.SessionSerializer()
+        self._serializer    = SessionSerializer.SessionSerializer(cfg_manager.get_doc_value(configuration_doc.SESSION_SERIALIZER))
 
         self._sessions      = {
                     # First char : (dict_lock, { session_id : session})
@@ -170,6 +170,27 @@ class SessionMemoryGateway(object):
         else:
             return session.obj
 
+    def get_sessions(self, session_ids):
+        session_ids_by_first_char = {}
+        for session_id in session_ids:
+            if len(session_id) > 0:
+                session_ids_by_first_char.setdefault(session_id[:1], []).append(session_id)
+
+        found = {}
+        for first_char, current_session_ids in session_ids_by_first_char.iteritems():
+            lock, sessions = self._sessions.get(first_char, (None, None))
+            if lock is None:
+                continue
+            with lock:
+                for session_id in current_session_ids:
+                    if session_id in sessions:
+                        found[session_id] = sessions[session_id].obj
+
+        if self._serialize:
+            return dict( (session_id, self._serializer.deserialize(obj)) for session_id, obj in found.iteritems() )
+        else:
+            return found
+
     def modify_session(self,sess_id, sess_obj):
         if self._serialize:
             sess_obj = self._serializer.serialize(sess_obj)
@@ -181,6 +202,40 @@ class SessionMemoryGateway(object):
                         )
             sessions[sess_id] = SessionObj(sess_obj)
 
+    @property
+    def atomic_field_updates(self):
+        # Fields are updated while holding the lock of the sessions dictionary.
+        # When serialized, the copy of the session of whoever locked it would
+        # overwrite those fields when unlocking, so it must not be used
+        return not self._serialize
+
+    def get_session_fields(self, session_id, fields):
+        session = self.get_session(session_id)
+        return dict( (field, session[field]) for field in fields if field in session )
+
+    def update_session_fields(self, session_id, fields):
+        lock, sessions = self._get_lock_and_sessions(session_id)
+        with lock:
+            if not session_id in sessions:
+                raise SessionErrors.SessionNotFoundError(
+                            "Session not found: " + session_id
+                        )
+            session_obj = sessions[session_id]
+            if self._serialize:
+                session = self._serializer.deserialize(session_obj.obj)
+            else:
+                session = session_obj.obj
+
+            # Only the fields already in the session are updated
+            for field, value in fields.iteritems():
+                if field in session:
+                    session[field] = value
+
+            if self._serialize:
+                session_obj.obj = self._serializer.serialize(session)
+            else:
+                session_obj.obj = session
+
     def get_session_locking(self, session_id):
         lock, sessions = self._get_lock_and_sessions(session_id)
         session_locks  = self._get_session_lock(session_id)
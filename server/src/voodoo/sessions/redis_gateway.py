@@ -15,10 +15,15 @@
 #
 
 import redis
-import time
+import threading
+
+import weblab.configuration_doc as configuration_doc
+
 import voodoo.sessions.generator  as SessionGenerator
 import voodoo.sessions.serializer as SessionSerializer
 import voodoo.sessions.exc as SessionErrors
+from voodoo.redis_lock import RedisLock, LockMetrics
+from voodoo.redis_script import RedisScript
 
 SESSION_REDIS_HOST = 'session_redis_host'
 DEFAULT_SESSION_REDIS_HOST = 'localhost'
@@ -32,6 +37,79 @@ DEFAULT_SESSION_REDIS_LOCK_HASH_KEY = "weblab_session:locks"
 SESSION_REDIS_KEY_PREFIX = "redis_session_key_prefix"
 DEFAULT_SESSION_REDIS_KEY_PREFIX = "weblab_session_data:"
 
+# Seconds after which a session lock expires even if its owner did not
+# release it. None (the default) means that, as session locks always did,
+# they never expire: a session might be locked for longer than any TTL
+# (e.g. during a slow call to a laboratory), and if the lock expired,
+# another thread would modify the session at the same time.
+SESSION_REDIS_LOCK_TTL = "redis_session_lock_ttl"
+DEFAULT_SESSION_REDIS_LOCK_TTL = None
+
+# Seconds waiting for a locked session before raising SessionAlreadyAcquiredError
+SESSION_REDIS_LOCK_TIMEOUT = "redis_session_lock_timeout"
+DEFAULT_SESSION_REDIS_LOCK_TIMEOUT = 120 # seconds
+
+# If True, each session is stored as a redis hash, where each key of
+# the session is a field serialized on its own. Otherwise, the whole
+# session is serialized into a single string.
+SESSION_REDIS_HASH_LAYOUT = "redis_session_hash_layout"
+DEFAULT_SESSION_REDIS_HASH_LAYOUT = False
+
+# Redis does not store empty hashes, so every session hash contains
+# this field (which is not a key of the session)
+SESSION_HASH_MARKER = '__session__'
+
+#
+# KEYS[1]: session key
+#
+# ARGV[1]: timeout
+# ARGV[2]: '1' if the whole session is replaced, '0' otherwise
+# ARGV[3]: number of fields removed (N)
+# ARGV[4 .. 3 + N]: fields removed
+# ARGV[4 + N .. ]: field, value, field, value...
+#
+_MODIFY_HASH_SCRIPT = RedisScript("""
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+if ARGV[2] == '1' then
+    redis.call('del', KEYS[1])
+    redis.call('hset', KEYS[1], '%(marker)s', '1')
+end
+local removed = tonumber(ARGV[3])
+for i = 4, 3 + removed do
+    redis.call('hdel', KEYS[1], ARGV[i])
+end
+for i = 4 + removed, #ARGV, 2 do
+    redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('expire', KEYS[1], ARGV[1])
+return 1
+""" % { 'marker' : SESSION_HASH_MARKER })
+
+#
+# Only the fields already in the session are updated: if a concurrent
+# request removed a field (e.g. the reservation finished), it is not
+# restored.
+#
+# KEYS[1]: session key
+#
+# ARGV[1]: timeout
+# ARGV[2 .. ]: field, value, field, value...
+#
+_UPDATE_HASH_FIELDS_SCRIPT = RedisScript("""
+if redis.call('exists', KEYS[1]) == 0 then
+    return 0
+end
+for i = 2, #ARGV, 2 do
+    if redis.call('hexists', KEYS[1], ARGV[i]) == 1 then
+        redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+redis.call('expire', KEYS[1], ARGV[1])
+return 1
+""")
+
 
 class SessionRedisGateway(object):
     
@@ -58,11 +136,23 @@ class SessionRedisGateway(object):
             db_index,
             self.session_lock_key, #class var
             self.session_key_prefix, #class var
+            self.lock_ttl,
+            self.lock_timeout,
+            self.hash_layout,
         ) = self._parse_config()
+
+        self.lock_metrics = LockMetrics()
+        # Per thread, so if a lock expired and another thread acquired it,
+        # the first thread does not release the lock of the second one:
+        #  - lock_tokens: session_id : lock token of the sessions locked by this thread
+        #  - locked_fields: session_id : { field : serialized value } of the sessions
+        #    locked by this thread, so only the fields changed are stored when
+        #    unlocking (hash layout only)
+        self._local = threading.local()
         
         
         self._generator  = SessionGenerator.SessionGenerator()
-        self._serializer = SessionSerializer.SessionSerializer()
+        self._serializer = SessionSerializer.SessionSerializer(self.cfg_manager.get_doc_value(configuration_doc.SESSION_SERIALIZER))
         
         
         #New pool or not new?
@@ -81,16 +171,49 @@ class SessionRedisGateway(object):
         db_index             = self.session_pool_id
         session_lock_key      = self.cfg_manager.get_value(SESSION_REDIS_KEY_PREFIX, DEFAULT_SESSION_REDIS_LOCK_HASH_KEY)
         session_key_prefix    = self.cfg_manager.get_value(SESSION_REDIS_KEY_PREFIX, DEFAULT_SESSION_REDIS_KEY_PREFIX)
-        return host, port, db_index, session_lock_key, session_key_prefix
+        lock_ttl              = self.cfg_manager.get_value(SESSION_REDIS_LOCK_TTL, DEFAULT_SESSION_REDIS_LOCK_TTL)
+        lock_timeout          = self.cfg_manager.get_value(SESSION_REDIS_LOCK_TIMEOUT, DEFAULT_SESSION_REDIS_LOCK_TIMEOUT)
+        hash_layout           = self.cfg_manager.get_value(SESSION_REDIS_HASH_LAYOUT, DEFAULT_SESSION_REDIS_HASH_LAYOUT)
+        return host, port, db_index, session_lock_key, session_key_prefix, lock_ttl, lock_timeout, hash_layout
+
+    @property
+    def atomic_field_updates(self):
+        # With the hash layout, fields are updated by redis itself
+        return self.hash_layout
+
+    def _serialize_fields(self, sess_obj):
+        return dict( (field, self._serializer.serialize(value)) for field, value in sess_obj.iteritems() )
+
+    def _deserialize_fields(self, serialized_fields):
+        serialized_fields = dict(serialized_fields)
+        serialized_fields.pop(SESSION_HASH_MARKER, None)
+        return dict( (field, self._serializer.deserialize(value)) for field, value in serialized_fields.iteritems() )
 
     def clear(self):
         client = self._client_creator()
         # Get all the sessions data
         session_redis_keys = client.keys(self.session_key_prefix + '*')
-        #append to the list the session lock key
-        session_redis_keys.append(self.session_lock_key)
+        #append to the list the session locks
+        session_redis_keys.extend(client.keys(self.session_lock_key + ':*'))
         #delete all
-        client.delete(*session_redis_keys)
+        if session_redis_keys:
+            client.delete(*session_redis_keys)
+        self._local = threading.local()
+
+    def _local_dict(self, name):
+        local_dict = getattr(self._local, name, None)
+        if local_dict is None:
+            local_dict = {}
+            setattr(self._local, name, local_dict)
+        return local_dict
+
+    @property
+    def _lock_tokens(self):
+        return self._local_dict('lock_tokens')
+
+    @property
+    def _locked_fields(self):
+        return self._local_dict('locked_fields')
     
     def create_session(self, desired_sess_id=None):
         client = self._client_creator()
@@ -105,8 +228,9 @@ class SessionRedisGateway(object):
         
         #lock session access with redis method
         while True:
-            done = client.hset(self.session_lock_key, new_id, 1)
-            if done == 1:
+            lock  = self._session_lock(new_id)
+            token = lock.acquire(timeout = 0)
+            if token is not None:
                 break
             else: 
                 if desired_sess_id is not None:
@@ -114,11 +238,19 @@ class SessionRedisGateway(object):
                 new_id = self._generator.generate_id()
 
         #Create session
-        pickled_session = self._serializer.serialize({})
-        client.setex(self.session_key_prefix + new_id, pickled_session, self.timeout)
-                
-        #Unlock session
-        client.hdel(self.session_lock_key, new_id)
+        try:
+            session_key = self.session_key_prefix + new_id
+            if self.hash_layout:
+                pipeline = client.pipeline()
+                pipeline.hset(session_key, SESSION_HASH_MARKER, '1')
+                pipeline.expire(session_key, self.timeout)
+                pipeline.execute()
+            else:
+                pickled_session = self._serializer.serialize({})
+                client.setex(session_key, pickled_session, self.timeout)
+        finally:
+            #Unlock session
+            lock.release(token)
         return new_id
     
     
@@ -129,9 +261,24 @@ class SessionRedisGateway(object):
     
     
     
+    def _get_serialized_fields(self, session_id, redis_client):
+        session_key = self.session_key_prefix + session_id
+
+        #get the whole hash and reset the expiration
+        pipeline = redis_client.pipeline(transaction = False)
+        pipeline.hgetall(session_key)
+        pipeline.expire(session_key, self.timeout)
+        serialized_fields = pipeline.execute()[0]
+        if not serialized_fields:
+            raise SessionErrors.SessionNotFoundError( "Session not found: " + session_id )
+        return serialized_fields
+
     def _get_session(self, session_id, redis_client):
         
         session_key = self.session_key_prefix + session_id
+
+        if self.hash_layout:
+            return self._deserialize_fields(self._get_serialized_fields(session_id, redis_client))
         
         #get the session
         pickled_session = redis_client.get(session_key)
@@ -150,34 +297,142 @@ class SessionRedisGateway(object):
         client = self._client_creator()
         return self._get_session(session_id, client)
 
+    def get_sessions(self, session_ids):
+        session_ids = list(session_ids)
+        if not session_ids:
+            return {}
+
+        session_keys = [ self.session_key_prefix + session_id for session_id in session_ids ]
+
+        #get every session and reset their expiration in a single round trip
+        pipeline = self._client_creator().pipeline(transaction = False)
+        if self.hash_layout:
+            for session_key in session_keys:
+                pipeline.hgetall(session_key)
+        else:
+            pipeline.mget(session_keys)
+        for session_key in session_keys:
+            pipeline.expire(session_key, self.timeout)
+        results = pipeline.execute()
+
+        sessions = {}
+        if self.hash_layout:
+            for session_id, serialized_fields in zip(session_ids, results[:len(session_ids)]):
+                if serialized_fields:
+                    sessions[session_id] = self._deserialize_fields(serialized_fields)
+        else:
+            for session_id, pickled_session in zip(session_ids, results[0]):
+                if pickled_session is not None:
+                    sessions[session_id] = self._serializer.deserialize(pickled_session)
+        return sessions
+
+    def get_session_fields(self, session_id, fields):
+        """ Retrieves only the fields requested of the session (those which
+        are not in the session are not returned) """
+        fields = list(fields)
+        client = self._client_creator()
+        if not self.hash_layout:
+            session = self._get_session(session_id, client)
+            return dict( (field, session[field]) for field in fields if field in session )
+
+        session_key = self.session_key_prefix + session_id
+        pipeline = client.pipeline(transaction = False)
+        pipeline.hmget(session_key, [ SESSION_HASH_MARKER ] + fields)
+        pipeline.expire(session_key, self.timeout)
+        values = pipeline.execute()[0]
+        if values[0] is None:
+            raise SessionErrors.SessionNotFoundError( "Session not found: " + session_id )
+
+        return dict( (field, self._serializer.deserialize(value)) for field, value in zip(fields, values[1:]) if value is not None )
+
+    def update_session_fields(self, session_id, fields):
+        """ Stores the values of the fields provided. Only the fields already
+        in the session are updated. With the hash layout, it does not lock the
+        session, since redis updates the fields atomically. """
+        client = self._client_creator()
+        if not self.hash_layout:
+            self._lock(client, session_id)
+            try:
+                session = self._get_session(session_id, client)
+                for field, value in fields.iteritems():
+                    if field in session:
+                        session[field] = value
+                self._modify_session(session_id, session, client)
+            finally:
+                self._unlock(session_id)
+            return
+
+        args = [ self.timeout ]
+        for field, serialized_value in self._serialize_fields(fields).iteritems():
+            args.extend((field, serialized_value))
+        if not _UPDATE_HASH_FIELDS_SCRIPT(client, keys = (self.session_key_prefix + session_id,), args = args):
+            raise SessionErrors.SessionNotFoundError( "Session not found: " + session_id )
+
+    def _session_lock(self, session_id):
+        return RedisLock(self._client_creator, self.session_lock_key + ':' + session_id, ttl = self.lock_ttl, metrics = self.lock_metrics)
+
     def _lock(self, client, session_id):
-        #lock session access with redis method
-        while True:
-            done = client.hset(self.session_lock_key, session_id, 1)
-            
-            if done == 1:
-                break
-            else: 
-                time.sleep(0.05)
+        #lock session access with redis method; waiters are woken up when it is released
+        token = self._session_lock(session_id).acquire(timeout = self.lock_timeout)
+        if token is None:
+            raise SessionErrors.SessionAlreadyAcquiredError("Session already acquired: %s" % session_id)
+        self._lock_tokens[session_id] = token
+
+    def _unlock(self, session_id):
+        token = self._lock_tokens.pop(session_id, None)
+        if token is not None:
+            self._session_lock(session_id).release(token)
 
     def get_session_locking(self, session_id):        
         client = self._client_creator()
         self._lock(client, session_id)
 
         try:
-            session = self._get_session(session_id, client)
+            if self.hash_layout:
+                serialized_fields = self._get_serialized_fields(session_id, client)
+                serialized_fields.pop(SESSION_HASH_MARKER, None)
+                self._locked_fields[session_id] = serialized_fields
+                session = self._deserialize_fields(serialized_fields)
+            else:
+                session = self._get_session(session_id, client)
         except SessionErrors.SessionNotFoundError:
             #Unlock session
-            client.hdel(self.session_lock_key, session_id)
+            self._unlock(session_id)
             raise SessionErrors.SessionNotFoundError( "Session not found: " + session_id )
             
         return session
 
 
 
+    def _modify_hash(self, sess_id, sess_obj, redis_client, original_fields = None):
+        """ If the original serialized fields are provided, only the fields
+        changed are stored and only those removed are deleted """
+        if not isinstance(sess_obj, dict):
+            if not redis_client.exists(self.session_key_prefix + sess_id):
+                raise SessionErrors.SessionNotFoundError( "Session not found: " + sess_id )
+            raise SessionErrors.SessionNotSerializableError( "Only dictionaries can be stored with the hash layout: %r" % sess_obj )
+
+        serialized_fields = self._serialize_fields(sess_obj)
+        if original_fields is None:
+            removed = []
+            changed = serialized_fields
+        else:
+            removed = [ field for field in original_fields if field not in serialized_fields ]
+            changed = dict( (field, value) for field, value in serialized_fields.iteritems() if original_fields.get(field) != value )
+
+        args = [ self.timeout, '1' if original_fields is None else '0', len(removed) ] + removed
+        for field, serialized_value in changed.iteritems():
+            args.extend((field, serialized_value))
+        if not _MODIFY_HASH_SCRIPT(redis_client, keys = (self.session_key_prefix + sess_id,), args = args):
+            raise SessionErrors.SessionNotFoundError( "Session not found: " + sess_id )
+
     def _modify_session(self, sess_id, sess_obj, redis_client):
         
         session_key = self.session_key_prefix + sess_id
+
+        if self.hash_layout:
+            self._modify_hash(sess_id, sess_obj, redis_client)
+            return
         
         #insert session again and restart the expiration
         pickled_session = self._serializer.serialize(sess_obj)
@@ -198,17 +453,21 @@ class SessionRedisGateway(object):
     def modify_session_unlocking(self, sess_id, sess_obj):
         try:
             client = self._client_creator()
-            self._modify_session(sess_id, sess_obj, client)
+            original_fields = self._locked_fields.pop(sess_id, None)
+            if self.hash_layout and original_fields is not None:
+                self._modify_hash(sess_id, sess_obj, client, original_fields)
+            else:
+                self._modify_session(sess_id, sess_obj, client)
         finally:
             #Unlock session
-            client.hdel(self.session_lock_key, sess_id)
+            self._unlock(sess_id)
         
         
         
     def unlock_without_modifying(self, sess_id):
         
-        client = self._client_creator()
-        client.hdel(self.session_lock_key, sess_id)
+        self._locked_fields.pop(sess_id, None)
+        self._unlock(sess_id)
         
     
     def list_sessions(self):
@@ -226,9 +485,8 @@ class SessionRedisGateway(object):
         
     
     def delete_expired_sessions(self):
-        # Redis makes this for us :) but the locks don't expire so we
-        # delete the ones that don't have session (zombies)
-        self._delete_zombie_locks()
+        # Redis makes this for us :) and the locks expire too
+        pass
     
     def _delete_session(self, sess_id, redis_client):
         
@@ -250,38 +508,6 @@ class SessionRedisGateway(object):
            self._delete_session(sess_id, client)
         finally:
             #Delete the lock always
-            client.hdel(self.session_lock_key, sess_id)  
+            self._locked_fields.pop(sess_id, None)
+            self._unlock(sess_id)
 
-
-    def _delete_zombie_locks(self):
-        
-        client = self._client_creator()
-        #Get all the hashes
-        keys = client.hkeys(self.session_lock_key)
-        
-        # No keys, no zombie, no work
-        if len(keys) == 0:
-            return
-
-        # Obtain the existance of all those keys in a single command
-        existance_pipeline = client.pipeline()
-
-        for key in keys:
-            existance_pipeline.exists(self.session_key_prefix + key)
-
-        results = existance_pipeline.execute()
-
-        # If every element exists, no work to do
-        if all(results):
-            return
-
-         # Otherwise, mark the elements to delete in a pipeline
-        deleting_pipeline = client.pipeline()
-
-        for key, exists in zip(keys, results):
-            if not exists:
-                deleting_pipeline.hdel(self.session_lock_key, key)
-
-        # And delete them
-        deleting_pipeline.execute()
-        
@@ -12,35 +12,194 @@
 #
 # Author: Pablo Orduña <pablo@ordunya.com>
 #
+import json
 import cPickle as pickle
 
+try:
+    import msgpack
+except ImportError:
+    MSGPACK_AVAILABLE = False
+else:
+    MSGPACK_AVAILABLE = True
+
 import voodoo.sessions.exc as SessionErrors
+import voodoo.sessions.session_id as SessionId
+from voodoo.gen.coordinator.CoordAddress import CoordAddress
+
+PICKLE  = 'pickle'
+JSON    = 'json'
+MSGPACK = 'msgpack'
+
+###########################################################
+#
+# JSON and msgpack only support basic types, so sessions
+# are first converted into a "plain" structure: tuples and
+# the registered types are stored as { TYPE_KEY : name,
+# VALUE_KEY : plain value }. ASCII unicode objects are also
+# tagged, since both codecs return ASCII strings as unicode
+# and they are restored as str. If a session contains
+# anything else (or any str which is not ASCII, or any
+# ASCII unicode dictionary key), it is serialized with
+# pickle.
+#
+
+TYPE_KEY  = '__type__'
+VALUE_KEY = '__value__'
+
+class _NotPlainError(TypeError):
+    pass
+
+# name : (klass, to_plain, from_plain)
+_types_by_name  = {}
+# klass : name
+_names_by_class = {}
+
+def register_type(klass, name, to_plain, from_plain):
+    """ Make instances of klass serializable with the JSON and msgpack codecs """
+    _types_by_name[name]   = (klass, to_plain, from_plain)
+    _names_by_class[klass] = name
+
+register_type(SessionId.SessionId, 'SessionId', lambda sess_id : sess_id.id,      SessionId.SessionId)
+register_type(CoordAddress,        'CoordAddress', lambda address : address.address, CoordAddress.translate_address)
+
+def _is_ascii(unicode_obj):
+    try:
+        unicode_obj.encode('ascii')
+    except UnicodeEncodeError:
+        return False
+    return True
+
+def _to_plain(obj):
+    obj_type = type(obj)
+    if obj is None or obj_type in (bool, int, long, float):
+        return obj
+    elif obj_type == unicode:
+        if _is_ascii(obj):
+            return { TYPE_KEY : 'unicode', VALUE_KEY : obj }
+        return obj
+    elif obj_type == str:
+        try:
+            obj.decode('ascii')
+        except UnicodeDecodeError:
+            raise _NotPlainError("Not ASCII str found")
+        return obj
+    elif obj_type == list:
+        return [ _to_plain(element) for element in obj ]
+    elif obj_type == tuple:
+        return { TYPE_KEY : 'tuple', VALUE_KEY : [ _to_plain(element) for element in obj ] }
+    elif obj_type == dict:
+        plain = {}
+        for key, value in obj.iteritems():
+            if type(key) not in (str, unicode) or key == TYPE_KEY or (type(key) == unicode and _is_ascii(key)):
+                raise _NotPlainError("Unsupported dictionary key: %r" % key)
+            plain[_to_plain(key)] = _to_plain(value)
+        return plain
+    elif obj_type in _names_by_class:
+        _, to_plain, _ = _types_by_name[_names_by_class[obj_type]]
+        return { TYPE_KEY : _names_by_class[obj_type], VALUE_KEY : _to_plain(to_plain(obj)) }
+    else:
+        raise _NotPlainError("Unsupported type: %s" % obj_type)
+
+def _from_plain(obj):
+    obj_type = type(obj)
+    if obj_type == unicode:
+        # str objects are always ASCII, and they are restored as such
+        # (ASCII unicode objects are tagged)
+        try:
+            return obj.encode('ascii')
+        except UnicodeEncodeError:
+            return obj
+    elif obj_type == list:
+        return [ _from_plain(element) for element in obj ]
+    elif obj_type == dict:
+        if TYPE_KEY in obj:
+            name  = obj[TYPE_KEY]
+            if name == 'unicode':
+                return unicode(obj[VALUE_KEY])
+            value = _from_plain(obj[VALUE_KEY])
+            if name == 'tuple':
+                return tuple(value)
+            _, _, from_plain = _types_by_name[name]
+            return from_plain(value)
+        return dict( (_from_plain(key), _from_plain(value)) for key, value in obj.iteritems() )
+    else:
+        return obj
+
+class PickleCodec(object):
+    prefix = "{pickle}"
+
+    def encode(self, sess_obj):
+        return pickle.dumps(sess_obj, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+class JsonCodec(object):
+    prefix = "{json}"
+
+    def encode(self, sess_obj):
+        return json.dumps(_to_plain(sess_obj), separators = (',', ':'))
+
+    def decode(self, data):
+        return _from_plain(json.loads(data))
+
+class MsgpackCodec(object):
+    prefix = "{msgpack}"
+
+    def encode(self, sess_obj):
+        return msgpack.packb(_to_plain(sess_obj), use_bin_type = True)
+
+    def decode(self, data):
+        return _from_plain(msgpack.unpackb(data, raw = False))
+
+CODECS = {
+    PICKLE : PickleCodec(),
+    JSON   : JsonCodec(),
+}
+if MSGPACK_AVAILABLE:
+    CODECS[MSGPACK] = MsgpackCodec()
 
 class SessionSerializer(object):
+    """
+    Serializes the sessions with the codec selected (pickle by default).
+    Sessions can always be deserialized, whatever the codec they were
+    serialized with, since each codec adds its own prefix.
+    """
+    def __init__(self, codec = PICKLE):
+        if codec not in CODECS:
+            raise SessionErrors.SessionSerializationNotImplementedError(
+                    "Session serializer not available: %s" % codec
+                )
+        self._codec  = CODECS[codec]
+        self._pickle = CODECS[PICKLE]
+
     def serialize(self,sess_obj):
+        if self._codec is not self._pickle:
+            try:
+                return self._codec.prefix + self._codec.encode(sess_obj)
+            except _NotPlainError:
+                pass # Use pickle
+
         try:
-            sess_obj_serialized = pickle.dumps(sess_obj)
+            sess_obj_serialized = self._pickle.encode(sess_obj)
         except (pickle.PickleError, TypeError) as pe:
             raise SessionErrors.SessionNotSerializableError(
                     "Session object not serializable with pickle: %s" % pe,
                     pe
             )
-        return "{pickle}".encode() + sess_obj_serialized
+        return self._pickle.prefix + sess_obj_serialized
 
     def deserialize(self,sess_obj_serialized):
-        if sess_obj_serialized.startswith("{pickle}".encode()):
-            sos = sess_obj_serialized[len("{pickle}".encode()):]
-            try:
-                deserialized = pickle.loads(sos)
-            except (pickle.PickleError, TypeError) as pe:
-                raise SessionErrors.SessionNotDeserializableError(
-                    "Session object not deserializable with pickle: %s" % pe,
-                    pe
-            )
-
-            return deserialized
-        else:
-            raise SessionErrors.SessionSerializationNotImplementedError(
-                    "Session serialization not implemented"
+        for codec in CODECS.values():
+            if sess_obj_serialized.startswith(codec.prefix):
+                sos = sess_obj_serialized[len(codec.prefix):]
+                try:
+                    return codec.decode(sos)
+                except Exception as e:
+                    raise SessionErrors.SessionNotDeserializableError(
+                        "Session object not deserializable with %s: %s" % (codec.prefix, e),
+                        e
                 )
-
+        raise SessionErrors.SessionSerializationNotImplementedError(
+                "Session serialization not implemented"
+            )
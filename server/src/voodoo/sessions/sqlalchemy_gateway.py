@@ -33,6 +33,9 @@ import voodoo.sessions.exc as SessionErrors
 
 MAX_TIME_TRYING_TO_LOCK  = 300 # seconds
 
+# Maximum number of session ids in a single IN (...) clause
+MAX_SESSIONS_PER_QUERY = 500
+
 class SessionSqlalchemyGateway(object):
 
     engine = None
@@ -60,7 +63,7 @@ class SessionSqlalchemyGateway(object):
         SessionSqlalchemyGateway.dbname = dbname
 
         self._generator  = SessionGenerator.SessionGenerator()
-        self._serializer = SessionSerializer.SessionSerializer()
+        self._serializer = SessionSerializer.SessionSerializer(self.cfg_manager.get_doc_value(configuration_doc.SESSION_SERIALIZER))
 
         self._lock       = DbLock.DbLock(cfg_manager, session_pool_id)
 
@@ -140,6 +143,25 @@ class SessionSqlalchemyGateway(object):
         pickled_sess_obj = str(session_object)
         return self._serializer.deserialize(pickled_sess_obj)
 
+    def get_sessions(self, session_ids):
+        session_objects = {}
+        session_ids = list(session_ids)
+        session = self._session_maker()
+        try:
+            now = datetime.datetime.now()
+            for pos in xrange(0, len(session_ids), MAX_SESSIONS_PER_QUERY):
+                current_session_ids = session_ids[pos:pos + MAX_SESSIONS_PER_QUERY]
+                results = session.query(DbData.Session.sess_id, DbData.Session.session_obj).filter(and_(DbData.Session.session_pool_id == self.session_pool_id, DbData.Session.sess_id.in_(current_session_ids))).all()
+                for sess_id, session_obj in results:
+                    session_objects[sess_id] = session_obj
+
+                if results:
+                    session.query(DbData.Session).filter(and_(DbData.Session.session_pool_id == self.session_pool_id, DbData.Session.sess_id.in_([ sess_id for sess_id, _ in results ]))).update({ 'latest_access' : now }, synchronize_session = False)
+            session.commit()
+        finally:
+            session.close()
+        return dict( (sess_id, self._serializer.deserialize(str(session_obj))) for sess_id, session_obj in session_objects.iteritems() )
+
     def modify_session(self, sess_id, sess_obj):
         serialized_sess_obj = self._serializer.serialize(sess_obj)
 
@@ -157,6 +179,22 @@ class SessionSqlalchemyGateway(object):
         finally:
             session.close()
 
+    # The whole session is stored again, so the session must be locked
+    atomic_field_updates = False
+
+    def get_session_fields(self, session_id, fields):
+        session = self.get_session(session_id)
+        return dict( (field, session[field]) for field in fields if field in session )
+
+    def update_session_fields(self, session_id, fields):
+        session = self.get_session_locking(session_id)
+        try:
+            for field, value in fields.iteritems():
+                if field in session:
+                    session[field] = value
+        finally:
+            self.modify_session_unlocking(session_id, session)
+
     def get_session_locking(self, session_id):
         self._lock.acquire(session_id)
         try:
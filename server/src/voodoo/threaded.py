@@ -13,6 +13,8 @@
 # Author: Pablo Orduña <pablo@ordunya.com>
 #
 
+import time
+import Queue
 import StringIO
 import traceback
 import threading
@@ -129,3 +131,90 @@ def threaded(resource_manager = None, logging = True):
 
     return wrapped_threaded
 
+
+class TimeoutError(Exception):
+    pass
+
+def run_concurrently(tasks, workers, timeout = None, time_func = time.time):
+    """
+    run_concurrently is a generator that runs the tasks in a bounded number of
+    threads, and yields the results as soon as each task finishes:
+
+    tasks = [ (key1, func1, args1), (key2, func2, args2) ]
+    for key, finished_ok, result in run_concurrently(tasks, workers = 5, timeout = 10):
+        if finished_ok:
+            print "%s returned %s" % (key, result)
+        else:
+            print "%s raised %s" % (key, result)
+
+    If a task takes longer than timeout seconds (since it started), a TimeoutError is
+    yielded as its result, and its thread is abandoned (it is a daemon thread, and
+    its result will be discarded), so a single hanging task can not stall the rest.
+    """
+    pending = Queue.Queue()
+    for task in tasks:
+        pending.put(task)
+
+    remaining = len(tasks)
+    if remaining == 0:
+        return
+
+    events = Queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                key, func, args = pending.get_nowait()
+            except Queue.Empty:
+                return
+            events.put(('started', key, time_func()))
+            try:
+                result = func(*args)
+            except Exception as e:
+                events.put(('finished', key, (False, e)))
+            else:
+                events.put(('finished', key, (True, result)))
+
+    def start_worker():
+        thread = threading.Thread(target = worker, name = counter.next_name("run_concurrently"))
+        thread.setDaemon(True)
+        thread.start()
+
+    for _ in xrange(min(workers, remaining)):
+        start_worker()
+
+    started  = {} # key : start time, of the tasks running
+    finished = set()
+    while remaining > 0:
+        if timeout is None or not started:
+            wait = None if timeout is None else timeout
+        else:
+            wait = max(0, min(started.values()) + timeout - time_func())
+
+        try:
+            event, key, value = events.get(timeout = wait)
+        except Queue.Empty:
+            # Every task which has reached the deadline is abandoned, and
+            # a new worker takes its place
+            now = time_func()
+            for key, start_time in started.items():
+                if start_time + timeout <= now:
+                    started.pop(key)
+                    finished.add(key)
+                    remaining -= 1
+                    if not pending.empty():
+                        start_worker()
+                    yield key, False, TimeoutError("Timed out after %s seconds" % timeout)
+            continue
+
+        if key in finished:
+            continue # It had already timed out
+
+        if event == 'started':
+            started[key] = value
+        else:
+            started.pop(key, None)
+            finished.add(key)
+            remaining -= 1
+            finished_ok, result = value
+            yield key, finished_ok, result
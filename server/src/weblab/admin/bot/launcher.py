@@ -24,6 +24,7 @@ import weblab.admin.bot.wl_process as WebLabProcess
 import weblab.admin.bot.data as Data
 
 import voodoo.mapper as mapper
+import voodoo.log as log
 
 class BotLauncher(object):
 
@@ -47,6 +48,7 @@ class BotLauncher(object):
 
     def _set_logging_cfg(self):
         logging.config.fileConfig(self.logging_cfg_file_name)
+        log.refresh_levels()
 
     def _set_users(self):
         self.users = len(self.scenario)
@@ -78,13 +78,9 @@ def get_experiment_ups_session_ids(category, experiment):
 
     user_session_mgr   = ups._session_manager
     session_mgr        = ups._alive_users_collection._session_manager
-    users_session_mgr  = ups._alive_users_collection._users_session_manager
-    global_sid         = ups._alive_users_collection._experiments_server_session_id
-
-    global_sobj = users_session_mgr.get_session(global_sid)
 
     return_value = []
-    for session_id in global_sobj:
+    for session_id in ups._alive_users_collection.list_users():
         session_obj = session_mgr.get_session(session_id)
         current_exp = session_obj['experiment_id']
         if current_exp.exp_name == experiment and current_exp.cat_name == category:
@@ -101,12 +97,9 @@ def list_all_users():
 
     session_mgr = ups._session_manager
     session_ids = session_mgr.list_sessions()
-    global_sid  = ups._alive_users_collection._experiments_server_session_id
 
     sessions = []
     for session_id in session_ids:
-        if session_id == global_sid:
-            continue
         try:
             session = session_mgr.get_session(session_id)
         except SessionErrors.SessionError:
@@ -126,12 +119,8 @@ def get_ups_session_ids_from_username(login):
     session_mgr = ups._session_manager
     session_ids = session_mgr.list_sessions()
 
-    global_sid  = ups._alive_users_collection._experiments_server_session_id
-
     ups_session_ids = []
     for session_id in session_ids:
-        if session_id == global_sid:
-            continue
         try:
             session = session_mgr.get_session(session_id)
         except SessionErrors.SessionError:
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import sys
+
+from optparse import OptionParser
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from weblab.admin.cli.controller import DbConfiguration
+from weblab.admin.script.utils import run_with_config
+from weblab.db.rollups import rebuild_rollups, check_rollups
+from weblab.db.file_hashes import rebuild_file_hash_index, check_file_hash_index
+
+#########################################################################################
+#
+#
+#
+#      W E B L A B     R O L L U P S
+#
+#
+#
+
+def weblab_rollups(directory):
+    option_parser = OptionParser()
+
+    option_parser.add_option( "--check",
+                              action="store_true",
+                              dest="check",
+                              default=False,
+                              help = "Compare the usage rollups and the file hash index with the stored uses (default)." )
+
+    option_parser.add_option( "--rebuild",
+                              action="store_true",
+                              dest="rebuild",
+                              default=False,
+                              help = "Rebuild the usage rollups and the file hash index from the stored uses. The core servers should be stopped." )
+
+    options, _ = option_parser.parse_args()
+
+    def on_dir(directory, configuration_files):
+        db_conf = DbConfiguration(configuration_files)
+        engine = create_engine(db_conf.build_url(), echo=False, convert_unicode=True)
+
+        Session = sessionmaker(bind=engine)
+        session = Session()
+        try:
+            if options.rebuild:
+                rollups, durations = rebuild_rollups(session)
+                file_hashes = rebuild_file_hash_index(session)
+                session.commit()
+                print "Usage rollups rebuilt: %s rows in the usage rollup; %s rows in the duration rollup." % (rollups, durations)
+                print "File hash index rebuilt: %s file hashes." % file_hashes
+                return 0
+
+            differences = check_rollups(session)
+            for table_name, key, expected, stored in differences:
+                print "%s %s: expected %s; stored %s" % (table_name, key, expected, stored)
+
+            file_hash_differences = check_file_hash_index(session)
+            for file_hash, expected, stored in file_hash_differences:
+                print "FileHashIndex %s: expected (first use, shared) %s; stored %s" % (file_hash, expected, stored)
+            differences.extend(file_hash_differences)
+
+            if differences:
+                print >> sys.stderr, "%s differences found. Run with --rebuild to fix them." % len(differences)
+                return 1
+
+            print "The usage rollups and the file hash index are up to date."
+            return 0
+        finally:
+            session.close()
+
+    sys.exit(run_with_config(directory, on_dir))
+
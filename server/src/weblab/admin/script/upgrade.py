@@ -21,6 +21,7 @@ import abc
 import json
 
 from sqlalchemy import create_engine
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.orm import sessionmaker
 
 import weblab.db.model as model
@@ -28,6 +29,8 @@ from weblab.admin.cli.controller import DbConfiguration
 from weblab.admin.script.utils import run_with_config
 
 from weblab.db.upgrade import DbUpgrader
+from weblab.db.rollups import rebuild_rollups
+from weblab.db.file_hashes import rebuild_file_hash_index
 
 #########################################################################################
 # 
@@ -112,6 +115,72 @@ class DatabaseUpgrader(Upgrader):
         self.upgrader.upgrade()
         print "Upgrade completed."
 
+def _create_session(db_conf):
+    engine = create_engine(db_conf.build_url(), echo=False, convert_unicode=True)
+    return sessionmaker(bind=engine)()
+
+class UsageRollupsUpgrader(Upgrader):
+    """ Fills the usage rollups (see weblab.db.rollups) with the uses stored before they existed """
+    def __init__(self, directory, configuration_files):
+        self.db_conf = DbConfiguration(configuration_files)
+
+    def _session(self):
+        return _create_session(self.db_conf)
+
+    def check_updated(self):
+        session = self._session()
+        try:
+            if session.query(model.DbUserUsedExperiment).first() is None:
+                return True
+            return session.query(model.DbUsageRollup).first() is not None
+        except DBAPIError:
+            # The database has not been upgraded yet
+            return False
+        finally:
+            session.close()
+
+    def upgrade(self):
+        print "Calculating the usage rollups."
+        sys.stdout.flush()
+        session = self._session()
+        try:
+            rebuild_rollups(session)
+            session.commit()
+        finally:
+            session.close()
+        print "Usage rollups calculated."
+
+class FileHashIndexUpgrader(Upgrader):
+    """ Fills the file hash index (see weblab.db.file_hashes) with the files stored before it existed """
+    def __init__(self, directory, configuration_files):
+        self.db_conf = DbConfiguration(configuration_files)
+
+    def _session(self):
+        return _create_session(self.db_conf)
+
+    def check_updated(self):
+        session = self._session()
+        try:
+            if session.query(model.DbUserFile).first() is None:
+                return True
+            return session.query(model.DbFileHashIndex).first() is not None
+        except DBAPIError:
+            # The database has not been upgraded yet
+            return False
+        finally:
+            session.close()
+
+    def upgrade(self):
+        print "Calculating the file hash index."
+        sys.stdout.flush()
+        session = self._session()
+        try:
+            rebuild_file_hash_index(session)
+            session.commit()
+        finally:
+            session.close()
+        print "File hash index calculated."
+
 class ConfigurationExperiments2db(Upgrader):
     def __init__(self, directory, configuration_files):
         self.db_conf = DbConfiguration(configuration_files)
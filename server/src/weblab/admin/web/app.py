@@ -1,8 +1,10 @@
 import os
 import sys
 import urlparse
+import itertools
 import traceback
 
+from sqlalchemy import event
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 from flask import Flask, request, redirect, url_for, escape
@@ -17,6 +19,7 @@ import weblab.core.server
 import weblab.configuration_doc as configuration_doc
 from weblab.data import ValidDatabaseSessionId
 from weblab.db import db
+from weblab.core.db import PERMISSIONS_MODELS
 
 import weblab.admin.web as web
 import weblab.admin.web.admin_views as admin_views
@@ -53,7 +56,14 @@ class AdministrationApplication(object):
 
         self.ups = ups
 
-        db_session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=db.engine))
+        session_maker = sessionmaker(autocommit=False, autoflush=False, bind=db.engine)
+        db_session = scoped_session(session_maker)
+
+        # The core server keeps the permissions of each user resolved, so whenever
+        # the panels change them, they must be resolved again
+        event.listen(session_maker, 'after_flush',    self._on_flush)
+        event.listen(session_maker, 'after_commit',   self._on_commit)
+        event.listen(session_maker, 'after_rollback', self._on_rollback)
 
         files_directory = cfg_manager.get_doc_value(configuration_doc.CORE_STORE_STUDENTS_PROGRAMS_PATH)
         core_server_url  = cfg_manager.get_value( 'core_server_url', '' )
@@ -154,6 +164,20 @@ class AdministrationApplication(object):
         # 
         self.bypass_authz = bypass_authz
 
+    def _on_flush(self, session, flush_context):
+        for instance in itertools.chain(session.new, session.dirty, session.deleted):
+            if isinstance(instance, PERMISSIONS_MODELS):
+                session._weblab_permissions_changed = True
+                break
+
+    def _on_commit(self, session):
+        if getattr(session, '_weblab_permissions_changed', False):
+            session._weblab_permissions_changed = False
+            self.ups._db_manager.invalidate_permissions()
+
+    def _on_rollback(self, session):
+        session._weblab_permissions_changed = False
+
     def is_admin(self):
         if self.bypass_authz:
             return True
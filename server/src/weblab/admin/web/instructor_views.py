@@ -13,10 +13,14 @@ from flask import redirect, request, Response
 from flask.ext.admin import expose, AdminIndexView, BaseView
 from flask.ext.admin.contrib.sqla import ModelView
 
-from sqlalchemy import sql, func as sa_func, distinct, not_, outerjoin
+from sqlalchemy import sql, func as sa_func, not_
+from sqlalchemy.orm import aliased
+
+from voodoo.cache import CacheEngine
 
 import weblab.permissions as permissions
 import weblab.db.model as model
+from weblab.db.file_hashes import get_file_hash_version
 from .community import best_partition
 
 def get_app_instance():
@@ -286,41 +290,42 @@ def generate_timetable(days_data):
 
     return timetable
 
-EMPTY_HASHES = (
-    '',
-    '{sha}f96cea198ad1dd5617ac084a3d92c6107708c0ef', # '{sha}' + hashlib.new("sha", "").hexdigest()
-    '{sha}da39a3ee5e6b4b0d3255bfef95601890afd80709', # '{sha}' + sha.new("").hexdigest()
-    '<file not yet stored>',
-)
+# The plagiarism results only change when new files are stored (see get_file_hash_version)
+PLAGIARISM_CACHE = CacheEngine(max_size = 200)
+
+def generate_links(session, condition, cache_key = None):
+    """ Returns the links between users who submitted the same file, and the hashes involved.
+    If cache_key is provided, the result is reused until new files are stored. """
+    if cache_key is None:
+        return _generate_links(session, condition)
+
+    version = get_file_hash_version(session)
+    return PLAGIARISM_CACHE.get_or_compute(('links', cache_key, version), _generate_links, session, condition)
 
-def generate_links(session, condition):
+def _generate_links(session, condition):
     hashes = defaultdict(list)
     # 
     # {
     #     'file_hash' : [(use.id, user.id, datetime, login), (use.id,user.id, datetime, login), (use.id, user.id, datetime, login)]
     # }
     #
-    multiuser_file_hashes = sql.select(
-                            [model.DbUserFile.file_hash],
-                            sql.and_( 
-                                condition,
-                                model.DbUserFile.experiment_use_id == model.DbUserUsedExperiment.id,
-                                model.DbUser.id == model.DbUserUsedExperiment.user_id,
-                                not_(model.DbUserFile.file_hash.in_(EMPTY_HASHES))
-                            ),
-                            use_labels = True
-                        ).group_by(model.DbUserFile.file_hash).having(sa_func.count(distinct(model.DbUserUsedExperiment.user_id)) > 1).alias('foo')
-
-    joined = outerjoin(multiuser_file_hashes, model.DbUserFile, model.DbUserFile.file_hash == multiuser_file_hashes.c.UserFile_file_hash)
-
+    # Only those hashes which (according to the index) were submitted by more than one user,
+    # and which were first submitted by someone who was not a teacher (it's only a problem when
+    # the file has been previously submitted by someone who was not a teacher)
+    first_user = aliased(model.DbUser)
     files_query = sql.select(
                             [model.DbUserUsedExperiment.id, model.DbUserUsedExperiment.user_id, model.DbUserFile.file_hash, model.DbUser.login, model.DbUser.full_name, model.DbUserUsedExperiment.start_date],
                             sql.and_( 
                                 condition,
+                                model.DbFileHashIndex.shared == True,
+                                model.DbUserFile.file_hash == model.DbFileHashIndex.file_hash,
                                 model.DbUserFile.experiment_use_id == model.DbUserUsedExperiment.id,
-                                model.DbUser.id == model.DbUserUsedExperiment.user_id
+                                model.DbUser.id == model.DbUserUsedExperiment.user_id,
+                                first_user.id == model.DbFileHashIndex.first_user_id,
+                                first_user.role_id == model.DbRole.id,
+                                not_(model.DbRole.name.in_(('administrator', 'professor', 'admin', 'instructor')))
                             )
-                        ).select_from(joined)
+                        ).order_by(model.DbUserUsedExperiment.start_date, model.DbUserUsedExperiment.start_date_micro, model.DbUserUsedExperiment.id)
 
     user_id_cache = {}
     for use in session.execute(files_query):
@@ -335,31 +340,14 @@ def generate_links(session, condition):
         user_id_cache[user_id] = login
         hashes[file_hash].append((use_id, user_id, start_date, login))
 
+    # The file might have been shared with users out of this condition
+    for file_hash, uses in hashes.items():
+        if len(set(use[1] for use in uses)) < 2:
+            hashes.pop(file_hash)
+
     if not hashes:
         return {}, {}
 
-    # No group by since there is no easy way to order correctly, and the amount of data is not
-    # huge
-    query = sql.select( [model.DbUserFile.file_hash, model.DbRole.name], 
-                        sql.and_(
-                            model.DbUserFile.experiment_use_id == model.DbUserUsedExperiment.id,
-                            model.DbUserUsedExperiment.user_id == model.DbUser.id,
-                            model.DbUser.role_id == model.DbRole.id,
-                            model.DbUserFile.file_hash.in_(hashes.keys())
-                        )).order_by(model.DbUserUsedExperiment.start_date)
-
-    correct_file_hashes = set()
-    for file_hash, role_name in session.execute(query):
-        if file_hash in correct_file_hashes:
-            continue
-        
-        if role_name in ('administrator', 'professor', 'admin', 'instructor'):
-            hashes.pop(file_hash, None)
-        else:
-            correct_file_hashes.add(file_hash)
-
-    # Filter those hashes which were first used by users who were instructor, admin, etc.
-    # It's only a problem when the file has been previously submitted by someone who was not a teacher
     links = defaultdict(list)
 
     # With the remaining, calculate the copies
@@ -373,11 +361,21 @@ def generate_links(session, condition):
     return links, hashes
 
 
-def gefx(session, condition):
-    links, _ = generate_links(session, condition)
+def gefx(session, condition, cache_key = None):
+    links, _ = generate_links(session, condition, cache_key)
     if not links:
         return "This groups does not have any detected plagiarism"
 
+    if cache_key is None:
+        contents = _gefx(links)
+    else:
+        # Building the graph and finding the communities is expensive, so they
+        # are reused until new files are stored
+        version = get_file_hash_version(session)
+        contents = PLAGIARISM_CACHE.get_or_compute(('gefx', cache_key, version), _gefx, links)
+    return Response(contents, mimetype='text/xml')
+
+def _gefx(links):
     G = nx.DiGraph()
     
     for source_node in links:
@@ -412,7 +410,7 @@ def gefx(session, condition):
 
     output = StringIO()
     nx.write_gexf(G, output)
-    return Response(output.getvalue(), mimetype='text/xml')
+    return output.getvalue()
 
 def to_human(seconds):
     if seconds < 60:
@@ -442,7 +440,9 @@ def to_nvd3(timeline):
     return nvd3
 
 
-def generate_info(panel, session, condition, experiments, results):
+def generate_info(panel, session, where, experiments, results, cache_key = None):
+    """ where(klass) returns the condition the uses (or rollups) must satisfy. cache_key
+    identifies the condition to reuse the plagiarism results (see generate_links) """
     results['statistics'].update({
         'uses' : 0,
         'total_time' : 0
@@ -459,6 +459,10 @@ def generate_info(panel, session, condition, experiments, results):
     # if len(permission_ids) > 1:
     #     pass
 
+    # Everything but the links is calculated on the rollups (see weblab.db.rollups)
+    rollup           = model.DbUsageRollup
+    rollup_condition = where(rollup)
+
     # Get the totals
     users_time = defaultdict(int)
     # {
@@ -471,13 +475,15 @@ def generate_info(panel, session, condition, experiments, results):
 
     user_id_cache = {}
     users = defaultdict(int)
-    for user_id, login, full_name, uses in session.execute(sql.select([model.DbUser.id, model.DbUser.login, model.DbUser.full_name, sa_func.count(model.DbUserUsedExperiment.id)], 
-                                                            sql.and_( model.DbUserUsedExperiment.user_id == model.DbUser.id,
-                                                            condition )
-                                                    ).group_by(model.DbUserUsedExperiment.user_id)):
+    for user_id, login, full_name, uses in session.execute(sql.select([model.DbUser.id, model.DbUser.login, model.DbUser.full_name, sa_func.sum(rollup.uses)], 
+                                                            sql.and_( rollup.user_id == model.DbUser.id,
+                                                            rollup_condition )
+                                                    ).group_by(rollup.user_id)):
+        if not uses:
+            continue
         user_id_cache[user_id] = login
-        users[login, full_name] = uses
-        results['statistics']['uses'] += uses
+        users[login, full_name] = int(uses)
+        results['statistics']['uses'] += int(uses)
 
     per_hour = defaultdict(lambda : defaultdict(int))
     # {
@@ -486,10 +492,11 @@ def generate_info(panel, session, condition, experiments, results):
     #     }
     # }
     week_days = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
-    for hour, week_day, uses in session.execute(sql.select([model.DbUserUsedExperiment.start_date_hour, model.DbUserUsedExperiment.start_date_weekday, sa_func.count(model.DbUserUsedExperiment.id)],
-                                                            condition
-                                                    ).group_by(model.DbUserUsedExperiment.start_date_hour, model.DbUserUsedExperiment.start_date_weekday)):
-        per_hour[week_days[week_day]][hour] = uses
+    for hour, week_day, uses in session.execute(sql.select([rollup.start_date_hour, rollup.start_date_weekday, sa_func.sum(rollup.uses)],
+                                                            rollup_condition
+                                                    ).group_by(rollup.start_date_hour, rollup.start_date_weekday)):
+        if uses:
+            per_hour[week_days[week_day]][hour] = int(uses)
 
     per_day = defaultdict(int)
     # {
@@ -501,45 +508,49 @@ def generate_info(panel, session, condition, experiments, results):
     # }
     min_day = datetime.date(2100, 1, 1)
     max_day = datetime.date(1900, 1, 1)
-    for start_date_date, uses in session.execute(sql.select([model.DbUserUsedExperiment.start_date_date, sa_func.count(model.DbUserUsedExperiment.id)],
-                                                           condition 
-                                                    ).group_by(model.DbUserUsedExperiment.start_date_date)):
+    for start_date_date, uses in session.execute(sql.select([rollup.start_date_date, sa_func.sum(rollup.uses)],
+                                                           rollup_condition 
+                                                    ).group_by(rollup.start_date_date)):
+        if not uses:
+            continue
         if start_date_date > max_day:
             max_day = start_date_date
         if start_date_date < min_day:
             min_day = start_date_date
-        per_day[start_date_date.strftime('%Y-%m-%d')] = uses
+        per_day[start_date_date.strftime('%Y-%m-%d')] = int(uses)
         week_day = start_date_date.weekday()
-        per_week[start_date_date - datetime.timedelta(days = week_day)] += uses
+        per_week[start_date_date - datetime.timedelta(days = week_day)] += int(uses)
 
-    for user_id, microseconds in session.execute(sql.select([model.DbUserUsedExperiment.user_id, sa_func.sum(model.DbUserUsedExperiment.session_time_micro)],
-                                                            sql.and_(condition,
-                                                            model.DbUserUsedExperiment.session_time_micro != None)
-                                                    ).group_by(model.DbUserUsedExperiment.user_id)):
-        users_time[user_id_cache[user_id]] = microseconds / 1000000
+    for user_id, timed_uses, microseconds in session.execute(sql.select([rollup.user_id, sa_func.sum(rollup.timed_uses), sa_func.sum(rollup.session_time_micro)],
+                                                            rollup_condition
+                                                    ).group_by(rollup.user_id)):
+        if timed_uses and user_id in user_id_cache:
+            users_time[user_id_cache[user_id]] = int(microseconds) / 1000000
     results['users_time'] = users_time
                                                 
     per_block_size = defaultdict(int)
     NUM_BLOCKS = 20
     block_size = max_time / NUM_BLOCKS
-    for session_time_seconds, count_cases in session.execute(sql.select([model.DbUserUsedExperiment.session_time_seconds, sa_func.count(model.DbUserUsedExperiment.session_time_seconds)], condition)
-                                                                  .group_by(model.DbUserUsedExperiment.session_time_seconds)):
-        if session_time_seconds is not None:
-            per_block_size[ int(session_time_seconds / block_size) ] += count_cases
+    duration_rollup = model.DbUsageDurationRollup
+    for session_time_seconds, count_cases in session.execute(sql.select([duration_rollup.session_time_seconds, sa_func.sum(duration_rollup.uses)], where(duration_rollup))
+                                                                  .group_by(duration_rollup.session_time_seconds)):
+        if count_cases:
+            per_block_size[ int(session_time_seconds / block_size) ] += int(count_cases)
 
 
     for start_date_date, session_time_micro, session_number in session.execute(
                                                         sql.select(
-                                                            [  model.DbUserUsedExperiment.start_date_date, 
-                                                               sa_func.sum(model.DbUserUsedExperiment.session_time_micro), 
-                                                               sa_func.count(model.DbUserUsedExperiment.id) ], 
-                                                            sql.and_(condition,
-                                                            model.DbUserUsedExperiment.session_time_micro != None)
-                                                            ).group_by(model.DbUserUsedExperiment.start_date_date)):
-        time_per_day[start_date_date.strftime('%Y-%m-%d')] = session_time_micro / session_number / 1000000
-        results['statistics']['total_time'] += session_time_micro / 1000000
+                                                            [  rollup.start_date_date, 
+                                                               sa_func.sum(rollup.session_time_micro), 
+                                                               sa_func.sum(rollup.timed_uses) ], 
+                                                            rollup_condition
+                                                            ).group_by(rollup.start_date_date)):
+        if not session_number:
+            continue
+        time_per_day[start_date_date.strftime('%Y-%m-%d')] = int(session_time_micro) / int(session_number) / 1000000
+        results['statistics']['total_time'] += int(session_time_micro) / 1000000
     
-    links, hashes = generate_links(session, condition)
+    links, hashes = generate_links(session, where(model.DbUserUsedExperiment), cache_key)
     # hashes = { file_hash : [ (use.id, user.id, datetime, login), ... ] }
     results['links'] = links
 
@@ -700,7 +711,7 @@ def generate_info(panel, session, condition, experiments, results):
     results['users_timeline_bar_data'] = json.dumps(users_timeline_bar_data)
 
 
-def generate_group_info(panel, session, group, condition, experiments):
+def generate_group_info(panel, session, group, where, experiments, cache_key = None):
     results = dict(
         mode =  'group',
         statistics = {
@@ -709,11 +720,11 @@ def generate_group_info(panel, session, group, condition, experiments):
         experiments = sorted(experiments),
     )
 
-    generate_info(panel, session, condition, experiments, results)
+    generate_info(panel, session, where, experiments, results, cache_key)
 
     return panel.render('instructor_group_stats.html', results = results, group = group, group_id = group.id, statistics = results['statistics'])
 
-def generate_user_in_group_info(panel, session, user, group, condition, experiments):
+def generate_user_in_group_info(panel, session, user, group, where, experiments):
     results = dict(
         mode =  'user_in_group',
         statistics = {
@@ -721,11 +732,11 @@ def generate_user_in_group_info(panel, session, user, group, condition, experime
         experiments = sorted(experiments),
     )
 
-    generate_info(panel, session, condition, experiments, results)
+    generate_info(panel, session, where, experiments, results)
 
     return panel.render('instructor_group_stats.html', results = results, user = user, group = group, group_id = group.id, statistics = results['statistics'])
 
-def generate_user_in_total_info(panel, session, user, condition, experiments):
+def generate_user_in_total_info(panel, session, user, where, experiments):
     results = dict(
         mode =  'user_in_total',
         statistics = {
@@ -733,7 +744,7 @@ def generate_user_in_total_info(panel, session, user, condition, experiments):
         experiments = sorted(experiments),
     )
 
-    generate_info(panel, session, condition, experiments, results)
+    generate_info(panel, session, where, experiments, results)
 
     return panel.render('instructor_group_stats.html', results = results, user = user, statistics = results['statistics'])
 
@@ -742,12 +753,12 @@ def generate_total_info(panel, session, experiments):
     results = dict(
         mode =  'total',
         statistics = {
-            'users' : session.query(model.DbUser).count(),
+            'users' : session.execute(sql.select([sa_func.count(model.DbUser.id)])).scalar(),
         },
         experiments = sorted(experiments),
     )
 
-    generate_info(panel, session, True, experiments, results)
+    generate_info(panel, session, lambda klass : True, experiments, results, 'total')
 
     return panel.render('instructor_group_stats.html', results = results, group_id = 'total', statistics = results['statistics'])
 
@@ -766,6 +777,7 @@ class GroupStats(InstructorView):
     def gefx(self, group_id):
         if group_id == 'total' and get_app_instance().is_admin():
             condition = True
+            cache_key = 'total'
         else:
             try:
                 group_id = int(group_id)
@@ -779,7 +791,8 @@ class GroupStats(InstructorView):
                 permission_ids.add(permission.id)
 
             condition = model.DbUserUsedExperiment.group_permission_id.in_(permission_ids)
-        return gefx(self.session, condition)
+            cache_key = ('group', group_id, frozenset(permission_ids))
+        return gefx(self.session, condition, cache_key)
 
     @expose('/groups/<int:group_id>/')
     def group_stats(self, group_id):
@@ -801,11 +814,9 @@ class GroupStats(InstructorView):
                 time_allowed = int(permission.get_parameter(permissions.TIME_ALLOWED).value)
                 experiments['%s@%s' % (exp_id, cat_id)].append((time_allowed, permission.id))
 
-            condition = model.DbUserUsedExperiment.group_permission_id.in_(permission_ids)
-            # condition = True
-            # condition = sql.and_( model.DbUserUsedExperiment.start_date >= datetime.datetime(2013, 3, 4, 0, 0, 0), model.DbUserUsedExperiment.start_date < datetime.datetime(2013, 6, 2, 0, 0, 0) )
-            # condition = sql.and_( model.DbUserUsedExperiment.start_date >= datetime.datetime(1971, 1, 1, 0, 0, 0))
-            return generate_group_info(self, self.session, group, condition, experiments)
+            where = lambda klass : klass.group_permission_id.in_(permission_ids)
+            cache_key = ('group', group_id, frozenset(permission_ids))
+            return generate_group_info(self, self.session, group, where, experiments, cache_key)
 
         return "Error: you don't have permission to see that group" # TODO
 
@@ -867,11 +878,8 @@ class GroupStats(InstructorView):
             else:
                 user_id = -1
 
-            condition = sql.and_(model.DbUserUsedExperiment.group_permission_id.in_(permission_ids), model.DbUserUsedExperiment.user_id == user_id)
-            # condition = True
-            # condition = sql.and_( model.DbUserUsedExperiment.start_date >= datetime.datetime(2013, 3, 4, 0, 0, 0), model.DbUserUsedExperiment.start_date < datetime.datetime(2013, 6, 2, 0, 0, 0) )
-            # condition = sql.and_( model.DbUserUsedExperiment.start_date >= datetime.datetime(1971, 1, 1, 0, 0, 0))
-            return generate_user_in_group_info(self, self.session, user, group, condition, experiments)
+            where = lambda klass : sql.and_(klass.group_permission_id.in_(permission_ids), klass.user_id == user_id)
+            return generate_user_in_group_info(self, self.session, user, group, where, experiments)
 
         return "Error: you don't have permission to see that group" # TODO
 
@@ -906,8 +914,8 @@ class GroupStats(InstructorView):
             else:
                 return "User not found"
 
-            condition = model.DbUserUsedExperiment.user_id == user_id
-            return generate_user_in_total_info(self, self.session, user, condition, experiments)
+            where = lambda klass : klass.user_id == user_id
+            return generate_user_in_total_info(self, self.session, user, where, experiments)
 
         return "Error: you don't have permission to see that group" # TODO
 
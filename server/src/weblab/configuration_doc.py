@@ -66,6 +66,42 @@ _sorted_variables.extend([
     (MAIL_NOTIFICATION_SUBJECT, _Argument(ADMIN_NOTIFIER, basestring,  "[WebLab] CRITICAL ERROR!", "(Optional) Subject of the notification mail")),
 ])
 
+# 
+# Communications
+# 
+
+COMMUNICATIONS = (COMMON, 'Communications')
+DESCRIPTIONS[COMMUNICATIONS] = """The XML-RPC and SOAP clients used among servers (e.g. from the Core Server to the Laboratory Server) keep a pool of persistent connections for each server they contact, shared by all the servers of the same instance."""
+
+RPC_CLIENT_POOL_SIZE  = 'rpc_client_pool_size'
+RPC_CLIENT_POOL_SIZES = 'rpc_client_pool_sizes'
+RPC_CLIENT_TIMEOUT    = 'rpc_client_timeout'
+RPC_CLIENT_POOL_TIMEOUT = 'rpc_client_pool_timeout'
+
+_sorted_variables.extend([
+    (RPC_CLIENT_POOL_SIZE,  _Argument(COMMUNICATIONS, int,   50,   "Maximum number of concurrent calls (and connections) to each server. Calls that wait for the server (such as check_async_command_status, up to laboratory_async_max_wait seconds) hold a connection meanwhile, so it must be large enough for them and for the rest of the calls")),
+    (RPC_CLIENT_POOL_SIZES, _Argument(COMMUNICATIONS, dict,  {},   "Maximum number of concurrent calls to particular servers, overriding rpc_client_pool_size. Example: {'localhost:10029' : 30}")),
+    (RPC_CLIENT_TIMEOUT,    _Argument(COMMUNICATIONS, float, None, "Seconds that a call waits for the server in each network operation. None means no timeout")),
+    (RPC_CLIENT_POOL_TIMEOUT, _Argument(COMMUNICATIONS, float, 30.0, "Seconds that a call waits for a connection when there are already rpc_client_pool_size calls in flight to the same server. Then, the call fails with a connection error. None means waiting forever")),
+])
+
+# 
+# Logging
+# 
+
+LOGGING = (COMMON, 'Logging')
+DESCRIPTIONS[LOGGING] = """The methods which are logged can also be traced: the last calls (the method, the reservation_id, when it started and how long it took) are kept in memory, whether they are logged or not, and can be exported as JSON with voodoo.log.export_traces."""
+
+LOG_TRACING      = 'log_tracing'
+LOG_TRACING_SIZE = 'log_tracing_size'
+LOG_TRACING_FILE = 'log_tracing_file'
+
+_sorted_variables.extend([
+    (LOG_TRACING,      _Argument(LOGGING, bool,       False, "Trace the calls to the logged methods")),
+    (LOG_TRACING_SIZE, _Argument(LOGGING, int,        10000, "Number of calls kept in memory (the older are discarded)")),
+    (LOG_TRACING_FILE, _Argument(LOGGING, basestring, None,  "If provided, file where the traces are written as JSON when the process finishes")),
+])
+
 # 
 # Database 
 #
@@ -106,6 +142,7 @@ DESCRIPTIONS[SESSIONS] = """The session configuration is mainly used by the Core
 
 SESSION_MANAGER_DEFAULT_TIMEOUT              = 'session_manager_default_timeout'
 SESSION_MEMORY_GATEWAY_SERIALIZE             = 'session_memory_gateway_serialize'
+SESSION_SERIALIZER                           = 'session_serializer'
 
 SESSION_SQLALCHEMY_ENGINE                    = 'session_sqlalchemy_engine'
 SESSION_SQLALCHEMY_HOST                      = 'session_sqlalchemy_host'
@@ -138,6 +175,7 @@ _sorted_variables.extend([
 
     (SESSION_MANAGER_DEFAULT_TIMEOUT,              _Argument(SESSIONS, int,  3600 * 2,          "Maximum time that a session will be stored in a Session Manager. In seconds.")),
     (SESSION_MEMORY_GATEWAY_SERIALIZE,             _Argument(SESSIONS, bool, False,             "Sessions can be stored in a database or in memory. If they are stored in memory, they can be serialized in memory or not, to check the behaviour")),
+    (SESSION_SERIALIZER,                           _Argument(SESSIONS, basestring, 'pickle',    "How sessions are serialized: pickle, json or msgpack (if installed). Sessions that can not be serialized with json or msgpack are serialized with pickle, and sessions serialized with any of them can always be read")),
 ])
 
 
@@ -193,11 +231,27 @@ CORE_FACADE_SERVER_ROUTE            = 'core_facade_server_route'
 
 CORE_FACADE_BIND                    = 'core_facade_bind'
 CORE_FACADE_PORT                    = 'core_facade_port'
+CORE_FACADE_SERVER_MODE             = 'core_facade_server_mode'
+CORE_FACADE_WORKERS                 = 'core_facade_workers'
+CORE_FACADE_QUEUE_SIZE              = 'core_facade_queue_size'
+CORE_FACADE_BACKLOG                 = 'core_facade_backlog'
+CORE_FACADE_KEEP_ALIVE_TIMEOUT      = 'core_facade_keep_alive_timeout'
+CORE_FACADE_REUSE_PORT              = 'core_facade_reuse_port'
+CORE_FACADE_ACCESS_LOG              = 'core_facade_access_log'
+CORE_FACADE_STATS_PERIOD            = 'core_facade_stats_period'
 
 _sorted_variables.extend([
     (CORE_FACADE_SERVER_ROUTE,            _Argument(CORE_FACADE, basestring, 'default-route-to-server', """Identifier of the server or groups of servers that will receive requests, for load balancing purposes.""")),
     (CORE_FACADE_BIND,                    _Argument(CORE_FACADE, basestring, '',                 """Binding address for the main facade at Core server""")), 
     (CORE_FACADE_PORT,                    _Argument(CORE_FACADE, int, NO_DEFAULT,                """Binding address for the main facade at Core Server""")),
+    (CORE_FACADE_SERVER_MODE,             _Argument(CORE_FACADE, basestring, 'threaded',         """How the HTTP requests are served. 'threaded' creates a new thread per connection, closed after each request. 'pool' serves them with a fixed pool of workers (core_facade_workers) and HTTP/1.1 keep-alive connections, which is recommended when many students are polling at the same time.""")),
+    (CORE_FACADE_WORKERS,                 _Argument(CORE_FACADE, int, 20,                        """Number of threads processing requests in the 'pool' mode.""")),
+    (CORE_FACADE_QUEUE_SIZE,              _Argument(CORE_FACADE, int, 200,                       """In the 'pool' mode, maximum number of connections waiting for a worker. Beyond it, new requests are answered with a 503 error instead of waiting.""")),
+    (CORE_FACADE_BACKLOG,                 _Argument(CORE_FACADE, int, 50,                        """Size of the queue of connections not yet accepted by the operating system (listen backlog).""")),
+    (CORE_FACADE_KEEP_ALIVE_TIMEOUT,      _Argument(CORE_FACADE, float, 15.0,                    """In the 'pool' mode, seconds that an idle keep-alive connection is kept open. It is also the timeout for reading or writing in the socket.""")),
+    (CORE_FACADE_REUSE_PORT,              _Argument(CORE_FACADE, bool, False,                    """Set SO_REUSEPORT (Linux 3.9 or higher) so several core server processes listen in the same core_facade_port and the operating system distributes the connections among them. They must share the sessions and the coordinator (redis or sqlalchemy), as in any other deployment with several core servers.""")),
+    (CORE_FACADE_ACCESS_LOG,              _Argument(CORE_FACADE, bool, True,                     """Log every request (at Info level). It can be disabled in servers with many requests.""")),
+    (CORE_FACADE_STATS_PERIOD,            _Argument(CORE_FACADE, float, 60.0,                    """In the 'pool' mode, seconds between logging (at Info level) the state of the pool: busy workers, queued and idle connections, requests, rejected requests and their latency. 0 disables it.""")),
 ])
 
 # 
@@ -205,7 +259,7 @@ _sorted_variables.extend([
 # 
 
 COORDINATOR = (CORE_SERVER, 'Scheduling')
-DESCRIPTIONS[COORDINATOR] = """This is the configuration variables used by the scheduling backend (called Coordinator). Basically, you can choose among redis or a SQL based one, and customize the one selected."""
+DESCRIPTIONS[COORDINATOR] = """This is the configuration variables used by the scheduling backend (called Coordinator). Basically, you can choose among redis, a SQL based one or one in the memory of the process (only for deployments with a single core server), and customize the one selected."""
 
 COORDINATOR_IMPL               = 'core_coordination_impl'
 COORDINATOR_DB_HOST            = 'core_coordinator_db_host'
@@ -216,9 +270,15 @@ COORDINATOR_DB_PASSWORD        = 'core_coordinator_db_password'
 COORDINATOR_DB_ENGINE          = 'core_coordinator_db_engine'
 COORDINATOR_LABORATORY_SERVERS = 'core_coordinator_laboratory_servers'
 COORDINATOR_CLEAN              = 'core_coordinator_clean'
+CONFIRMER_WORKERS              = 'core_confirmer_workers'
+CONFIRMER_WORKERS_PER_LAB      = 'core_confirmer_workers_per_laboratory'
+CONFIRMER_RETRIES              = 'core_confirmer_retries'
+CONFIRMER_RETRY_DELAY          = 'core_confirmer_retry_delay'
+COORDINATOR_MEMORY_JOURNAL     = 'core_coordinator_memory_journal'
+COORDINATOR_MEMORY_JOURNAL_FSYNC = 'core_coordinator_memory_journal_fsync'
 
 _sorted_variables.extend([
-    (COORDINATOR_IMPL,               _Argument(COORDINATOR, basestring, "sqlalchemy", "Which scheduling backend will be used. Current implementations: 'redis', 'sqlalchemy'.")),
+    (COORDINATOR_IMPL,               _Argument(COORDINATOR, basestring, "sqlalchemy", "Which scheduling backend will be used. Current implementations: 'redis', 'sqlalchemy', 'memory'.")),
     (COORDINATOR_DB_HOST,            _Argument(COORDINATOR, basestring, "localhost", """Host of the database server.""")), 
     (COORDINATOR_DB_PORT,            _Argument(COORDINATOR, int, None,        """Port of the database server.""")), 
     (COORDINATOR_DB_NAME,            _Argument(COORDINATOR, basestring, "WebLabCoordination", """Name of the coordination database.""")), 
@@ -227,6 +287,12 @@ _sorted_variables.extend([
     (COORDINATOR_DB_ENGINE,          _Argument(COORDINATOR, basestring, "mysql", """Driver used for the coordination database. We currently have only tested MySQL, although it should be possible to use other engines.""")), 
     (COORDINATOR_LABORATORY_SERVERS, _Argument(COORDINATOR, list, NO_DEFAULT, """Available laboratory servers. It's a list of strings, having each string this format: "lab1:inst@mach;exp1|ud-fpga|FPGA experiments", for the "lab1" in the instance "inst" at the machine "mach", which will handle the experiment instance "exp1" of the experiment type "ud-fpga" of the category "FPGA experiments". A laboratory can handle many experiments, and each experiment type may have many experiment instances with unique identifiers (such as "exp1" of "ud-fpga|FPGA experiments").""")), 
     (COORDINATOR_CLEAN,              _Argument(COORDINATOR, bool, True, """Whether this server will clean the coordinator tables or not. If there are two core servers, and one of them is turned off, you don't want that it deletes everything on the database when that server is turned on, because all the sessions handled by the other core server will be lost.""")), 
+    (CONFIRMER_WORKERS,              _Argument(COORDINATOR, int, 20, """Maximum number of threads calling the laboratory servers to reserve and free experiments or to check if they should finish.""")), 
+    (CONFIRMER_WORKERS_PER_LAB,      _Argument(COORDINATOR, int, 5, """Maximum number of concurrent calls to each laboratory server. The calls to different laboratories are done in turns.""")), 
+    (CONFIRMER_RETRIES,              _Argument(COORDINATOR, int, 2, """Number of times that reserving or freeing an experiment is retried, if the laboratory can not be reached, before marking it as broken. Errors raised by the laboratory are not retried.""")), 
+    (CONFIRMER_RETRY_DELAY,          _Argument(COORDINATOR, float, 1, """Seconds before retrying a call to a laboratory server. It is doubled in each retry.""")), 
+    (COORDINATOR_MEMORY_JOURNAL,     _Argument(COORDINATOR, basestring, None, """Only for the 'memory' scheduling backend. File where every change is appended, so the reservations can be recovered if the server is restarted (which requires core_coordinator_clean to be False). If None, nothing is stored.""")), 
+    (COORDINATOR_MEMORY_JOURNAL_FSYNC, _Argument(COORDINATOR, bool, False, """Only for the 'memory' scheduling backend. Whether every change of the journal is flushed to the disk, so it is not lost even if the machine crashes. It is slower.""")), 
 ])
 
 
@@ -254,6 +320,25 @@ _sorted_variables.extend([
     (LOGIN_FACADE_SERVER_ROUTE,            _Argument(LOGIN_FACADE, basestring, 'default-route-to-server', """Identifier of the server or groups of servers that will receive requests, for load balancing purposes.""")),
 ])
 
+# 
+# Authentication
+# 
+
+LOGIN_AUTHENTICATION = (LOGIN_SERVER, 'Authentication')
+DESCRIPTIONS[LOGIN_AUTHENTICATION] = """The credentials of the users (e.g. the password in the database or in a LDAP server) are checked on each login. When many users log in at the same time (e.g. at the beginning of an exam), the following variables reduce the cost of each login."""
+
+LOGIN_USER_AUTHS_CACHE_TIME  = 'login_user_auths_cache_time'
+LOGIN_CREDENTIALS_CACHE_TIME = 'login_credentials_cache_time'
+LOGIN_LDAP_POOL_SIZE         = 'login_ldap_pool_size'
+LOGIN_LDAP_POOL_MAX_IDLE     = 'login_ldap_pool_max_idle'
+
+_sorted_variables.extend([
+    (LOGIN_USER_AUTHS_CACHE_TIME,  _Argument(LOGIN_AUTHENTICATION, float, 0,  """Seconds that the role and the authentication methods of a user are cached after retrieving them from the database. If a login fails with the cached ones, they are retrieved again. However, during that time, the previous password of a user whose password was changed (or the password of a user, or of an authentication method, that was removed) still works, since the cached ones accept it. 0 disables the cache.""")), 
+    (LOGIN_CREDENTIALS_CACHE_TIME, _Argument(LOGIN_AUTHENTICATION, float, 0,  """Seconds that a successful login is cached (by a salted hash of the username and the password), so logging in again with the same password does not check it again (e.g. in the LDAP server). 0 disables the cache.""")), 
+    (LOGIN_LDAP_POOL_SIZE,         _Argument(LOGIN_AUTHENTICATION, int,   10, """Number of idle connections kept open to each LDAP server, so they are reused among logins. 0 closes each connection after the login.""")), 
+    (LOGIN_LDAP_POOL_MAX_IDLE,     _Argument(LOGIN_AUTHENTICATION, float, 60, """Seconds that an idle connection to a LDAP server is kept open.""")), 
+])
+
 
 
 ######################################
@@ -269,12 +354,26 @@ LABORATORY_SESSION_TYPE              = 'laboratory_session_type'
 LABORATORY_SESSION_POOL_ID           = 'laboratory_session_pool_id'
 LABORATORY_ASSIGNED_EXPERIMENTS      = 'laboratory_assigned_experiments'
 LABORATORY_EXCLUDE_CHECKING          = 'laboratory_exclude_checking'
+LABORATORY_ASYNC_WORKERS             = 'laboratory_async_workers'
+LABORATORY_ASYNC_MAX_PENDING         = 'laboratory_async_max_pending_per_session'
+LABORATORY_ASYNC_RESULT_TTL          = 'laboratory_async_result_ttl'
+LABORATORY_ASYNC_MAX_WAIT            = 'laboratory_async_max_wait'
+LABORATORY_CHECKS_WORKERS            = 'laboratory_checks_workers'
+LABORATORY_CHECKS_TIMEOUT            = 'laboratory_checks_timeout'
+LABORATORY_CHECKS_HEALTHY_CACHE_TIME = 'laboratory_checks_healthy_cache_time'
 
 _sorted_variables.extend([
     (LABORATORY_SESSION_TYPE,         _Argument(LABORATORY, basestring, "Memory", """What type of session manager the Core Server will use: Memory or MySQL.""")), 
     (LABORATORY_SESSION_POOL_ID,      _Argument(LABORATORY, basestring, "LaboratoryServer", """See "core_session_pool_id" in the core server.""")), 
     (LABORATORY_ASSIGNED_EXPERIMENTS, _Argument(LABORATORY, list, NO_DEFAULT, """List of strings representing which experiments are available through this particular laboratory server. Each string contains something like 'exp1|ud-fpga|FPGA experiments;fpga:inst@mach', where exp1|ud-fpga|FPGA experiments is the identifier of the experiment, and "fpga:inst@mach" is the WebLab Address of the experiment server.""")), 
     (LABORATORY_EXCLUDE_CHECKING,     _Argument(LABORATORY, list, [], """List of ids of experiments upon which checks will not be run""")), 
+    (LABORATORY_ASYNC_WORKERS,        _Argument(LABORATORY, int, 10, """Maximum number of threads running asynchronous commands and files at the same time. The requests of the different sessions are run in turns.""")), 
+    (LABORATORY_ASYNC_MAX_PENDING,    _Argument(LABORATORY, int, 50, """Maximum number of asynchronous requests not finished in a single session. Further requests will fail.""")), 
+    (LABORATORY_ASYNC_RESULT_TTL,     _Argument(LABORATORY, int, 600, """Seconds that the result of an asynchronous request is kept if it is not retrieved.""")), 
+    (LABORATORY_ASYNC_MAX_WAIT,       _Argument(LABORATORY, int, 5, """Maximum seconds that check_async_command_status will wait for a request to finish. Meanwhile, the call holds one of the connections of the core server to this laboratory (see rpc_client_pool_size and rpc_client_pool_timeout), so every user waiting reduces the connections available to the rest of the calls, including reserving and freeing the experiment. Keep it far below rpc_client_pool_timeout.""")), 
+    (LABORATORY_CHECKS_WORKERS,       _Argument(LABORATORY, int, 10, """Maximum number of threads checking the resources (experiment servers and handlers) at the same time.""")), 
+    (LABORATORY_CHECKS_TIMEOUT,       _Argument(LABORATORY, int, 30, """Seconds after which a resource check that has not finished is considered failed.""")), 
+    (LABORATORY_CHECKS_HEALTHY_CACHE_TIME, _Argument(LABORATORY, int, 0, """Seconds during which a handler that reported no error is not checked again. Handlers which reported errors are always checked. 0 disables it.""")), 
 ])
 
 
@@ -17,14 +17,54 @@ import time
 import threading
 import Queue
 
-import voodoo.sessions.manager as SessionManager
+import voodoo.log as log
+
 from weblab.core.reservation_processor import ReservationProcessor
 
 USER_PROCESSING_TIME_BETWEEN_CHECKS = 'core_time_between_checks'
 DEFAULT_TIME_BETWEEN_CHECKS         = 2 # seconds
 
-ALIVE_USERS_SESSION_POOL = "core_alive_users_session_pool_id"
-DEFAULT_ALIVE_USERS_SESSION_POOL = "AliveUsersSessionPool"
+ALIVE_USERS_SHARDS = "core_alive_users_shards"
+DEFAULT_ALIVE_USERS_SHARDS = 16
+
+class AliveUsersRegistry(object):
+    """
+    Set of the alive reservation session ids of this core server. It is
+    split in shards, each of them with its own lock, so adding and
+    removing users in different shards never block each other, and
+    retrieving all of them only blocks one shard at a time.
+    """
+    def __init__(self, shards = DEFAULT_ALIVE_USERS_SHARDS):
+        self._shards = [ (threading.Lock(), set()) for _ in xrange(shards) ]
+
+    def _shard(self, reservation_session_id):
+        return self._shards[hash(reservation_session_id) % len(self._shards)]
+
+    def add(self, reservation_session_id):
+        lock, users = self._shard(reservation_session_id)
+        with lock:
+            users.add(reservation_session_id)
+
+    def remove(self, reservation_session_id):
+        lock, users = self._shard(reservation_session_id)
+        with lock:
+            users.discard(reservation_session_id)
+
+    def __contains__(self, reservation_session_id):
+        lock, users = self._shard(reservation_session_id)
+        with lock:
+            return reservation_session_id in users
+
+    def __len__(self):
+        return sum( len(users) for _, users in self._shards )
+
+    def snapshot(self):
+        """ Copy of every alive user at this moment """
+        reservation_session_ids = []
+        for lock, users in self._shards:
+            with lock:
+                reservation_session_ids.extend(users)
+        return reservation_session_ids
 
 class AliveUsersCollection(object):
     """
@@ -44,20 +84,21 @@ class AliveUsersCollection(object):
         - check_expired_users: checks and removes the users whose
             session has expired
 
-    The first two methods manage the sessions which actively are alive.
+    The first two methods manage the sessions which actively are alive. They
+    are stored in an AliveUsersRegistry, local to this core server, so they
+    are O(1) and they do not block any other core server.
 
     The last method finds expired sessions, removes them from the alive
-    list and returns them. To do so, it checks all the alive sessions and
-    removes those expired. Since this may become into blocking more often
-    than required, and the operation may become too heavy, we use a config
-    variable which checks that in each UPS the check_expired_users isn't
-    called more often than a certain amount of time.
+    list and returns them. To do so, it checks a copy of all the alive
+    sessions and removes those expired, so add_user and remove_user are
+    not blocked in the meanwhile. Since the operation may become too heavy,
+    we use a config variable which checks that in each UPS the
+    check_expired_users isn't called more often than a certain amount of
+    time.
 
     This is checked per UPS server, not in the global memory, since placing
     it in global memory would actually create some blocking which wouldn't
-    be desired. This way, the amount of calls to global memory is reduced
-    to "once in a certain amount of time" + when adding/removing an alive
-    user.
+    be desired.
     """
     def __init__(self, locator, cfg_manager, session_type, session_manager, coordinator, commands_store, finished_reservations_store):
         # This is an optimization. It shouldn't be stored in the SessionManager
@@ -79,17 +120,10 @@ class AliveUsersCollection(object):
 
         self._time_module     = time
 
-        pool = cfg_manager.get_value(ALIVE_USERS_SESSION_POOL, DEFAULT_ALIVE_USERS_SESSION_POOL)
-        # timeout = None: don't expire! Ever!
-        self._users_session_manager = SessionManager.SessionManager(cfg_manager, session_type, pool, timeout = None )
-
-        self._experiments_server_session_id = self._users_session_manager.create_session()
-        self._users_session_manager.modify_session(
-                self._experiments_server_session_id,
-                [
-                    # session_id,
-                ]
-            )
+        # Each core server has always had its own list of alive users, so
+        # there is no need to store them out of this process
+        shards = cfg_manager.get_value(ALIVE_USERS_SHARDS, DEFAULT_ALIVE_USERS_SHARDS)
+        self._alive_users = AliveUsersRegistry(shards)
 
     def _set_min_time_between_checks(self):
         self._min_time_between_checks = self._cfg_manager.get_value( USER_PROCESSING_TIME_BETWEEN_CHECKS, DEFAULT_TIME_BETWEEN_CHECKS )
@@ -113,29 +147,21 @@ class AliveUsersCollection(object):
             return False
 
     def add_user(self, reservation_session_id):
-        reservation_session_ids = self._users_session_manager.get_session_locking( self._experiments_server_session_id )
-        try:
-            if reservation_session_ids.count(reservation_session_id) == 0:
-                reservation_session_ids.append(reservation_session_id)
-        finally:
-            self._users_session_manager.modify_session_unlocking( self._experiments_server_session_id, reservation_session_ids )
+        self._alive_users.add(reservation_session_id)
 
     def remove_user(self, reservation_session_id):
-        reservation_session_ids = self._users_session_manager.get_session_locking( self._experiments_server_session_id )
-        try:
-            if reservation_session_ids.count(reservation_session_id) > 0:
-                reservation_session_ids.remove(reservation_session_id)
-        finally:
-            self._users_session_manager.modify_session_unlocking( self._experiments_server_session_id, reservation_session_ids )
+        self._alive_users.remove(reservation_session_id)
+
+    def list_users(self):
+        return self._alive_users.snapshot()
 
-    def _check_expired(self, reservation_session_id):
+    def _check_expired(self, reservation_session_id, reservation_session):
         # Do not lock. If the user is doing something, the method
         # would get locked here. And if the user is doing something,
         # the information is stored in a transactional way, so it
         # shouldn't be a problem. Anyway, it would be nice that
         # after the "poll" method the UPS modified the (updated)
         # session without unlocking.
-        reservation_session = self._session_manager.get_session(reservation_session_id)
         reservation_processor = ReservationProcessor( self._cfg_manager, reservation_session_id, reservation_session, self._coordinator, self._locator, self._commands_store)
         return reservation_processor.is_expired()
 
@@ -143,8 +169,17 @@ class AliveUsersCollection(object):
     def _find_expired_session_ids(self, reservation_session_ids):
         expired_reservation_session_ids = []
 
+        # Every session is retrieved at once (e.g. a single round trip
+        # to redis), instead of one by one
+        reservation_sessions = self._session_manager.get_sessions(reservation_session_ids)
+
         for reservation_session_id in reservation_session_ids:
-            if self._check_expired(reservation_session_id):
+            reservation_session = reservation_sessions.get(reservation_session_id)
+            if reservation_session is None:
+                # The session does not exist anymore, so there is nothing to be freed
+                log.log( AliveUsersCollection, log.level.Warning, "Alive reservation session %s not found; removing it" % reservation_session_id)
+                self._alive_users.remove(reservation_session_id)
+            elif self._check_expired(reservation_session_id, reservation_session):
                 expired_reservation_session_ids.append(reservation_session_id)
 
         return expired_reservation_session_ids
@@ -173,28 +208,16 @@ class AliveUsersCollection(object):
         """
         expired_reservation_session_ids = []
 
-        finished_session_ids = self._find_finished_session_ids()
-        if len(finished_session_ids) > 0:
-            reservation_session_ids = self._users_session_manager.get_session_locking( self._experiments_server_session_id )
-            try:
-
-                for finished_session_id in finished_session_ids:
-                    if finished_session_id in reservation_session_ids:
-                        reservation_session_ids.remove(finished_session_id)
-                    expired_reservation_session_ids.append(finished_session_id)
-
-            finally:
-                self._users_session_manager.modify_session_unlocking( self._experiments_server_session_id, reservation_session_ids )
+        for finished_session_id in self._find_finished_session_ids():
+            self._alive_users.remove(finished_session_id)
+            expired_reservation_session_ids.append(finished_session_id)
 
         if self._time_between_checkes_finished():
-            reservation_session_ids = self._users_session_manager.get_session_locking( self._experiments_server_session_id )
-            try:
-                    found_expired_reservation_session_ids = self._find_expired_session_ids(reservation_session_ids)
+            # No lock is held while checking the sessions
+            found_expired_reservation_session_ids = self._find_expired_session_ids(self._alive_users.snapshot())
 
-                    for expired_reservation_session_id in found_expired_reservation_session_ids:
-                        reservation_session_ids.remove(expired_reservation_session_id)
-            finally:
-                self._users_session_manager.modify_session_unlocking( self._experiments_server_session_id, reservation_session_ids )
+            for expired_reservation_session_id in found_expired_reservation_session_ids:
+                self._alive_users.remove(expired_reservation_session_id)
             expired_reservation_session_ids.extend(found_expired_reservation_session_ids)
 
         return expired_reservation_session_ids
@@ -17,13 +17,23 @@ import traceback
 
 import voodoo.log as log
 import voodoo.gen.coordinator.CoordAddress as CoordAddress
+from voodoo.threaded import run_concurrently
 
 import weblab.data.server_type as ServerType
 
+RESOURCES_CHECKER_WORKERS = 'core_resources_checker_workers'
+DEFAULT_RESOURCES_CHECKER_WORKERS = 10
+
+RESOURCES_CHECKER_TIMEOUT = 'core_resources_checker_timeout'
+DEFAULT_RESOURCES_CHECKER_TIMEOUT = 60 # seconds
+
 class ResourcesChecker(object):
     def __init__(self, coordinator):
         self.coordinator = coordinator
         self.locator     = coordinator.locator
+        cfg_manager      = coordinator.cfg_manager
+        self.workers     = cfg_manager.get_value(RESOURCES_CHECKER_WORKERS, DEFAULT_RESOURCES_CHECKER_WORKERS)
+        self.timeout     = cfg_manager.get_value(RESOURCES_CHECKER_TIMEOUT, DEFAULT_RESOURCES_CHECKER_TIMEOUT)
 
     def check(self):
         try:
@@ -32,9 +42,22 @@ class ResourcesChecker(object):
             # Use a common broken_resources to avoid endless loops if a resource is registered
             # in labs in more than one laboratory server (and one might state that it works while
             # other might state that it doesn't).
+            #
+            # The laboratories are checked concurrently, so a laboratory which
+            # does not reply does not delay the checks of the rest.
+            #
             broken_resources = {}
-            for laboratory_address_str in experiments_per_laboratory:
-                new_broken_resources = self.check_laboratory(laboratory_address_str, experiments_per_laboratory[laboratory_address_str])
+            tasks = [ (laboratory_address_str, self.check_laboratory, (laboratory_address_str, experiments_per_laboratory[laboratory_address_str]))
+                        for laboratory_address_str in experiments_per_laboratory ]
+            for laboratory_address_str, finished_ok, new_broken_resources in run_concurrently(tasks, self.workers, self.timeout):
+                if not finished_ok:
+                    # check_laboratory does not raise exceptions, so it timed out. Its resources are
+                    # not marked as broken or fixed, since their status is unknown.
+                    log.log( ResourcesChecker, log.level.Error,
+                            "Laboratory %s did not reply to the resources check: %s" % (laboratory_address_str, new_broken_resources))
+                    experiments_per_laboratory.pop(laboratory_address_str)
+                    continue
+
                 for broken_resource in new_broken_resources:
                     if broken_resource in broken_resources:
                         broken_resources[broken_resource] += ';' + new_broken_resources[broken_resource]
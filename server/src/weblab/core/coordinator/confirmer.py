@@ -13,15 +13,23 @@
 # Author: Pablo Orduña <pablo@ordunya.com>
 #
 
+import time
+import heapq
+import socket
+import httplib
 import datetime
+import threading
 import traceback
+from collections import deque
 
-from voodoo.threaded import threaded
 import voodoo.log as log
 from voodoo.log import logged
+import voodoo.counter as counter
 
 import voodoo.resources_manager as ResourceManager
 import voodoo.gen.coordinator.CoordAddress as CoordAddress
+import voodoo.gen.exceptions.protocols.ProtocolErrors as ProtocolErrors
+import voodoo.gen.exceptions.locator.LocatorErrors as LocatorErrors
 import voodoo.sessions.session_id as SessionId
 
 import weblab.data.server_type as ServerType
@@ -30,6 +38,275 @@ _resource_manager = ResourceManager.CancelAndJoinResourceManager("Coordinator")
 
 DEBUG = False
 
+CONFIRMER_WORKERS = 'core_confirmer_workers'
+DEFAULT_CONFIRMER_WORKERS = 20
+
+CONFIRMER_WORKERS_PER_LABORATORY = 'core_confirmer_workers_per_laboratory'
+DEFAULT_CONFIRMER_WORKERS_PER_LABORATORY = 5
+
+CONFIRMER_RETRIES = 'core_confirmer_retries'
+DEFAULT_CONFIRMER_RETRIES = 2
+
+CONFIRMER_RETRY_DELAY = 'core_confirmer_retry_delay'
+DEFAULT_CONFIRMER_RETRY_DELAY = 1 # seconds; doubled in each retry
+
+# Idle workers finish after this time, so an idle core server does not keep threads
+WORKER_IDLE_TIMEOUT = 30 # seconds
+
+# Errors communicating with the laboratory (including the PoolTimeoutError of
+# the RPC clients, which is a socket.error). Only these are retried: those
+# raised by the laboratory itself would be raised again.
+_TRANSPORT_ERRORS = (socket.error, httplib.HTTPException)
+
+def is_transport_error(exc):
+    # The RPC clients and the locator wrap the original exception
+    while exc is not None:
+        if isinstance(exc, _TRANSPORT_ERRORS):
+            return True
+        if isinstance(exc, ProtocolErrors.RemoteError):
+            exc = getattr(exc, 'cause_exception', None)
+        elif isinstance(exc, LocatorErrors.UnableToCompleteOperationError) and len(exc.args) > 1:
+            exc = exc.args[1]
+        else:
+            return False
+    return False
+
+class ConfirmerTask(object):
+    """
+    A call to a laboratory server. func is called in a worker; if it fails
+    communicating with the laboratory, it is retried up to retries times
+    (waiting retry_delay, doubled each time). If it still fails, or the
+    laboratory raises any other exception, on_failure(exc) is called.
+    Otherwise on_success(result) is called. join waits until it is finished.
+    """
+
+    def __init__(self, lab_address, func, args, on_success, on_failure, retries = 0, retry_delay = 0, key = None):
+        self.lab_address = lab_address
+        self.func        = func
+        self.args        = args
+        self.on_success  = on_success
+        self.on_failure  = on_failure
+        self.retries     = retries
+        self.retry_delay = retry_delay
+        self.key         = key
+
+        self.attempts      = 0
+        self.enqueued_time = None
+        self.raised_exc    = None
+        self._finished     = threading.Event()
+
+    def join(self, timeout = None):
+        self._finished.wait(timeout)
+
+    def is_finished(self):
+        return self._finished.isSet()
+
+    # The same interface of the threads that handled each call before
+    def isAlive(self):
+        return not self.is_finished()
+
+class _ConfirmerWorker(threading.Thread):
+    def __init__(self, pool):
+        super(_ConfirmerWorker, self).__init__(name = counter.next_name("ConfirmerWorker"))
+        self.setDaemon(True)
+        self.pool      = pool
+        self.cancelled = False
+
+    def run(self):
+        try:
+            self.pool._run_worker(self)
+        finally:
+            _resource_manager.remove_resource(self)
+
+    def cancel(self):
+        self.pool._cancel_worker(self)
+
+class ConfirmerPool(object):
+    """
+    Runs ConfirmerTasks in a bounded set of workers. Each laboratory server has
+    its own queue and a limit of calls in flight, and the queues are served in
+    turns, so a laboratory which is slow to reply does not take every worker.
+    Tasks with a key are coalesced: while one is waiting in the queue, submitting
+    another one with the same key returns the one in the queue.
+    """
+
+    def __init__(self, workers = DEFAULT_CONFIRMER_WORKERS, workers_per_laboratory = DEFAULT_CONFIRMER_WORKERS_PER_LABORATORY, time_func = time.time):
+        self._max_workers            = workers
+        self._workers_per_laboratory = workers_per_laboratory
+        self._time                   = time_func
+
+        self._lock      = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+
+        self._queues    = {}      # { lab_address : deque([ task ]) }
+        self._labs      = deque() # lab_addresses with queued tasks, in turns
+        self._running   = {}      # { lab_address : tasks running }
+        self._delayed   = []      # heap of (time, sequence, task) waiting to be retried
+        self._sequence  = 0
+        self._keys      = {}      # { key : queued task }
+
+        self._workers      = []
+        self._idle_workers = 0
+        self._stopped      = False
+
+    def submit(self, task):
+        with self._lock:
+            if task.key is not None and task.key in self._keys:
+                return self._keys[task.key]
+
+            if task.key is not None:
+                self._keys[task.key] = task
+            task.enqueued_time = self._time()
+            self._enqueue(task)
+            self._wake_worker()
+        return task
+
+    def retry(self, task, delay):
+        with self._lock:
+            self._sequence += 1
+            heapq.heappush(self._delayed, (self._time() + delay, self._sequence, task))
+            self._wake_worker()
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            workers = self._workers[:]
+            self._condition.notify_all()
+
+        for worker in workers:
+            if worker is not threading.currentThread():
+                worker.join()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'workers'      : len(self._workers),
+                'idle_workers' : self._idle_workers,
+                'queued'       : sum([ len(queue) for queue in self._queues.values() ]),
+                'delayed'      : len(self._delayed),
+                'running'      : sum(self._running.values()),
+            }
+
+    def _enqueue(self, task):
+        queue = self._queues.get(task.lab_address)
+        if queue is None:
+            queue = self._queues[task.lab_address] = deque()
+            self._labs.append(task.lab_address)
+        queue.append(task)
+
+    def _wake_worker(self):
+        if self._idle_workers == 0 and len(self._workers) < self._max_workers:
+            worker = _ConfirmerWorker(self)
+            self._workers.append(worker)
+            _resource_manager.add_resource(worker)
+            worker.start()
+        else:
+            self._condition.notify_all()
+
+    def _cancel_worker(self, worker):
+        with self._lock:
+            worker.cancelled = True
+            self._condition.notify_all()
+
+    def _pop_task(self):
+        """ Returns the next task of a laboratory with free slots, or None """
+        now = self._time()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, _, task = heapq.heappop(self._delayed)
+            self._enqueue(task)
+
+        for _ in xrange(len(self._labs)):
+            lab_address = self._labs.popleft()
+            queue = self._queues[lab_address]
+            if self._running.get(lab_address, 0) >= self._workers_per_laboratory:
+                self._labs.append(lab_address)
+                continue
+
+            task = queue.popleft()
+            if queue:
+                self._labs.append(lab_address)
+            else:
+                del self._queues[lab_address]
+            if task.key is not None and self._keys.get(task.key) is task:
+                del self._keys[task.key]
+            self._running[lab_address] = self._running.get(lab_address, 0) + 1
+            return task
+        return None
+
+    def _next_task(self, worker):
+        """ Waits for the next task. Returns None if the worker must finish. """
+        with self._lock:
+            while True:
+                if self._stopped or worker.cancelled:
+                    self._workers.remove(worker)
+                    return None
+
+                task = self._pop_task()
+                if task is not None:
+                    return task
+
+                if self._delayed:
+                    wait = max(0, self._delayed[0][0] - self._time())
+                elif not self._queues:
+                    wait = WORKER_IDLE_TIMEOUT
+                else:
+                    wait = None # Until a task of a busy laboratory finishes
+
+                self._idle_workers += 1
+                try:
+                    self._condition.wait(wait)
+                finally:
+                    self._idle_workers -= 1
+
+                if wait == WORKER_IDLE_TIMEOUT and not self._queues and not self._delayed:
+                    self._workers.remove(worker)
+                    return None
+
+    def _task_finished(self, task):
+        with self._lock:
+            self._running[task.lab_address] -= 1
+            if self._running[task.lab_address] == 0:
+                del self._running[task.lab_address]
+            self._condition.notify_all()
+
+    def _run_worker(self, worker):
+        while True:
+            task = self._next_task(worker)
+            if task is None:
+                return
+
+            try:
+                self._run_task(task)
+            finally:
+                self._task_finished(task)
+
+    def _run_task(self, task):
+        task.attempts += 1
+        try:
+            result = task.func(*task.args)
+        except Exception as e:
+            if DEBUG:
+                traceback.print_exc()
+            if task.attempts <= task.retries and is_transport_error(e):
+                delay = task.retry_delay * 2 ** (task.attempts - 1)
+                log.log( ReservationConfirmer, log.level.Warning, "Exception calling laboratory %s (attempt %s; retrying in %s seconds): %s" % (task.lab_address, task.attempts, delay, e) )
+                self.retry(task, delay)
+                return
+            callback, argument = task.on_failure, e
+        else:
+            callback, argument = task.on_success, result
+
+        try:
+            callback(argument)
+        except Exception as e:
+            task.raised_exc = e
+            if DEBUG:
+                traceback.print_exc()
+            log.log(ReservationConfirmer, log.level.Critical, "Unexpected exception processing the response of laboratory %s" % task.lab_address)
+            log.log_exc(ReservationConfirmer, log.level.Critical)
+        finally:
+            task._finished.set()
+
 class ReservationConfirmer(object):
     def __init__(self, coordinator, locator):
         self.coordinator                        = coordinator
@@ -37,6 +314,19 @@ class ReservationConfirmer(object):
         self._enqueuing_timeout                 = 0
         self._initialize_and_dispose_experiment = True
 
+        cfg_manager = coordinator.cfg_manager
+        self._retries     = cfg_manager.get_value(CONFIRMER_RETRIES, DEFAULT_CONFIRMER_RETRIES)
+        self._retry_delay = cfg_manager.get_value(CONFIRMER_RETRY_DELAY, DEFAULT_CONFIRMER_RETRY_DELAY)
+        self._pool        = ConfirmerPool(cfg_manager.get_value(CONFIRMER_WORKERS, DEFAULT_CONFIRMER_WORKERS),
+                                        cfg_manager.get_value(CONFIRMER_WORKERS_PER_LABORATORY, DEFAULT_CONFIRMER_WORKERS_PER_LABORATORY))
+
+        self._labservers  = {} # { lab_coordaddress : labserver }
+
+        self._stats_lock          = threading.Lock()
+        self._confirmations       = 0
+        self._confirmation_time   = 0.0
+        self._max_confirmation_time = 0.0
+
     def _get_enqueuing_timeout(self):
         return self._enqueuing_timeout
 
@@ -45,46 +335,63 @@ class ReservationConfirmer(object):
 
     enqueuing_timeout = property(_get_enqueuing_timeout, _set_enqueuing_timeout)
 
+    def stop(self):
+        self._pool.stop()
+
+    def get_stats(self):
+        """ Returns the state of the queues and the latency of the confirmations (since
+        they are enqueued until the laboratory replies, retries included) """
+        stats = self._pool.get_stats()
+        with self._stats_lock:
+            stats['confirmations'] = self._confirmations
+            stats['average_confirmation_time'] = self._confirmation_time / self._confirmations if self._confirmations else 0.0
+            stats['max_confirmation_time'] = self._max_confirmation_time
+        return stats
+
+    def _get_labserver(self, lab_coordaddress):
+        # The proxy locates the laboratory in each call, so it can be reused
+        labserver = self._labservers.get(lab_coordaddress)
+        if labserver is None:
+            labserver = self.locator.get_server_from_coordaddr(lab_coordaddress, ServerType.Laboratory)
+            self._labservers[lab_coordaddress] = labserver
+        return labserver
+
+    def _add_confirmation_time(self, task):
+        elapsed = time.time() - task.enqueued_time
+        with self._stats_lock:
+            self._confirmations += 1
+            self._confirmation_time += elapsed
+            self._max_confirmation_time = max(self._max_confirmation_time, elapsed)
+
     @logged()
     def enqueue_confirmation(self, lab_coordaddress_str, reservation_id, experiment_instance_id, client_initial_data, server_initial_data, resource_type_name):
-        # We can stablish a politic such as using
-        # thread pools or a queue of threads or something
-        # like that... here
         lab_coordaddress = CoordAddress.CoordAddress.translate_address(lab_coordaddress_str)
         self._confirm_handler = self._confirm_experiment(lab_coordaddress, reservation_id, experiment_instance_id, client_initial_data, server_initial_data, resource_type_name)
         self._confirm_handler.join(self._enqueuing_timeout)
 
-    @threaded(_resource_manager)
-    @logged()
     def _confirm_experiment(self, lab_coordaddress, reservation_id, experiment_instance_id, client_initial_data, server_initial_data, resource_type_name):
-        try:
+        def reserve():
             initial_time = datetime.datetime.now()
-            try:
-                labserver = self.locator.get_server_from_coordaddr(lab_coordaddress, ServerType.Laboratory)
-                reservation_result  = labserver.reserve_experiment(experiment_instance_id, client_initial_data, server_initial_data)
-                lab_session_id, server_initialization_response, exp_info = reservation_result
-            except Exception as e:
-                if DEBUG:
-                    traceback.print_exc()
-                log.log( ReservationConfirmer, log.level.Error, "Exception confirming experiment: %s" % e )
-                log.log_exc( ReservationConfirmer, log.level.Warning )
-
-                self.coordinator.mark_experiment_as_broken(experiment_instance_id, [str(e)])
-            else:
-                end_time = datetime.datetime.now()
-                experiment_coordaddress = CoordAddress.CoordAddress.translate_address(exp_info['address'])
-                self.coordinator.confirm_experiment(experiment_coordaddress, experiment_instance_id.to_experiment_id(), reservation_id, lab_coordaddress.address, lab_session_id, server_initialization_response, initial_time, end_time, resource_type_name, exp_info)
-        except:
-            if DEBUG:
-                traceback.print_exc()
-            log.log(ReservationConfirmer, log.level.Critical, "Unexpected exception confirming experiment")
-            log.log_exc(ReservationConfirmer, log.level.Critical)
+            labserver = self._get_labserver(lab_coordaddress)
+            lab_session_id, server_initialization_response, exp_info = labserver.reserve_experiment(experiment_instance_id, client_initial_data, server_initial_data)
+            return lab_session_id, server_initialization_response, exp_info, initial_time, datetime.datetime.now()
+
+        def on_success((lab_session_id, server_initialization_response, exp_info, initial_time, end_time)):
+            self._add_confirmation_time(task)
+            experiment_coordaddress = CoordAddress.CoordAddress.translate_address(exp_info['address'])
+            self.coordinator.confirm_experiment(experiment_coordaddress, experiment_instance_id.to_experiment_id(), reservation_id, lab_coordaddress.address, lab_session_id, server_initialization_response, initial_time, end_time, resource_type_name, exp_info)
+
+        def on_failure(e):
+            self._add_confirmation_time(task)
+            log.log( ReservationConfirmer, log.level.Error, "Exception confirming experiment: %s" % e )
+            log.log_exc( ReservationConfirmer, log.level.Warning )
+            self.coordinator.mark_experiment_as_broken(experiment_instance_id, [str(e)])
+
+        task = ConfirmerTask(lab_coordaddress, reserve, (), on_success, on_failure, self._retries, self._retry_delay)
+        return self._pool.submit(task)
 
     @logged()
     def enqueue_free_experiment(self, lab_coordaddress_str, reservation_id, lab_session_id, experiment_instance_id):
-        # We can stablish a policy such as using
-        # thread pools or a queue of threads or something
-        # like that... here
         if lab_session_id is None: # If the user didn't manage to obtain a session_id, don't call the free_experiment method
             experiment_response = None
             initial_time = end_time = datetime.datetime.now()
@@ -94,55 +401,41 @@ class ReservationConfirmer(object):
             self._free_handler = self._free_experiment(lab_coordaddress, reservation_id, lab_session_id, experiment_instance_id)
             self._free_handler.join(self._enqueuing_timeout)
 
-
-    @threaded(_resource_manager)
-    @logged()
     def _free_experiment(self, lab_coordaddress, reservation_id, lab_session_id, experiment_instance_id):
-        try:
+        def free():
             initial_time = datetime.datetime.now()
-            try:
-                labserver = self.locator.get_server_from_coordaddr(lab_coordaddress, ServerType.Laboratory)
-                experiment_response = labserver.free_experiment(SessionId.SessionId(lab_session_id))
-            except Exception as e:
-                if DEBUG:
-                    traceback.print_exc()
-                log.log( ReservationConfirmer, log.level.Error, "Exception freeing experiment: %s" % e )
-                log.log_exc( ReservationConfirmer, log.level.Warning )
-
-                self.coordinator.mark_experiment_as_broken(experiment_instance_id, [str(e)])
-            else: # Everything went fine
-                end_time = datetime.datetime.now()
-                self.coordinator.confirm_resource_disposal(lab_coordaddress.address, reservation_id, lab_session_id, experiment_instance_id, experiment_response, initial_time, end_time)
-        except:
-            if DEBUG:
-                traceback.print_exc()
-            log.log(ReservationConfirmer, log.level.Critical, "Unexpected exception freeing experiment")
-            log.log_exc(ReservationConfirmer, log.level.Critical)
+            labserver = self._get_labserver(lab_coordaddress)
+            experiment_response = labserver.free_experiment(SessionId.SessionId(lab_session_id))
+            return experiment_response, initial_time, datetime.datetime.now()
 
+        def on_success((experiment_response, initial_time, end_time)):
+            self.coordinator.confirm_resource_disposal(lab_coordaddress.address, reservation_id, lab_session_id, experiment_instance_id, experiment_response, initial_time, end_time)
+
+        def on_failure(e):
+            log.log( ReservationConfirmer, log.level.Error, "Exception freeing experiment: %s" % e )
+            log.log_exc( ReservationConfirmer, log.level.Warning )
+            self.coordinator.mark_experiment_as_broken(experiment_instance_id, [str(e)])
+
+        task = ConfirmerTask(lab_coordaddress, free, (), on_success, on_failure, self._retries, self._retry_delay)
+        return self._pool.submit(task)
 
     def enqueue_should_finish(self, lab_coordaddress_str, lab_session_id, reservation_id):
         lab_coordaddress = CoordAddress.CoordAddress.translate_address(lab_coordaddress_str)
         self._should_finish(lab_coordaddress, lab_session_id, reservation_id)
 
-    @threaded(_resource_manager)
-    @logged()
     def _should_finish(self, lab_coordaddress, lab_session_id, reservation_id):
-        try:
-            try:
-                labserver = self.locator.get_server_from_coordaddr(lab_coordaddress, ServerType.Laboratory)
-                received_experiment_response = labserver.should_experiment_finish(lab_session_id)
-                experiment_response = float(received_experiment_response)
-            except Exception as e:
-                if DEBUG:
-                    traceback.print_exc()
-                log.log( ReservationConfirmer, log.level.Error, "Exception checking if the experiment should finish: %s" % e )
-                log.log_exc( ReservationConfirmer, log.level.Warning )
-                self.coordinator.confirm_should_finish(lab_coordaddress.address, lab_session_id, reservation_id, 0) # Don't try again with this reservation
-            else:
-                self.coordinator.confirm_should_finish(lab_coordaddress.address, lab_session_id, reservation_id, experiment_response)
-        except:
-            if DEBUG:
-                traceback.print_exc()
-            log.log(ReservationConfirmer, log.level.Critical, "Unexpected exception checking should_finish")
-            log.log_exc(ReservationConfirmer, log.level.Critical)
+        def should_finish():
+            labserver = self._get_labserver(lab_coordaddress)
+            return float(labserver.should_experiment_finish(lab_session_id))
+
+        def on_success(experiment_response):
+            self.coordinator.confirm_should_finish(lab_coordaddress.address, lab_session_id, reservation_id, experiment_response)
+
+        def on_failure(e):
+            log.log( ReservationConfirmer, log.level.Error, "Exception checking if the experiment should finish: %s" % e )
+            log.log_exc( ReservationConfirmer, log.level.Warning )
+            self.coordinator.confirm_should_finish(lab_coordaddress.address, lab_session_id, reservation_id, 0) # Don't try again with this reservation
 
+        # If the same reservation is already waiting to be checked, it is not checked twice
+        task = ConfirmerTask(lab_coordaddress, should_finish, (), on_success, on_failure, key = ('should_finish', reservation_id))
+        return self._pool.submit(task)
@@ -585,5 +585,6 @@ class AbstractCoordinator(object):
     def stop(self):
         for scheduler in self.schedulers.values():
             scheduler.stop()
+        self.confirmer.stop()
 
 
@@ -17,6 +17,7 @@ from weblab.core.coordinator.confirmer import ReservationConfirmer
 
 SQLALCHEMY = 'sqlalchemy'
 REDIS      = 'redis'
+MEMORY     = 'memory'
 
 
 def create(name, locator, cfg_manager, ConfirmerClass = ReservationConfirmer):
@@ -26,6 +27,9 @@ def create(name, locator, cfg_manager, ConfirmerClass = ReservationConfirmer):
     elif name == REDIS:
         from weblab.core.coordinator.redis.coordinator import Coordinator as Coordinator_redis
         return Coordinator_redis(locator, cfg_manager, ConfirmerClass)
+    elif name == MEMORY:
+        from weblab.core.coordinator.memory.coordinator import Coordinator as Coordinator_memory
+        return Coordinator_memory(locator, cfg_manager, ConfirmerClass)
     else:
         raise Exception("Coordinator %s not found" % name)
         
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+#
+# Tables of the MemoryStore
+#
+
+EXPERIMENT_TYPES              = 'experiment_types'              # experiment_id_str : True
+EXPERIMENT_RESOURCES          = 'experiment_types:resource_types' # experiment_id_str : set(resource_type)
+EXPERIMENT_INSTANCES          = 'experiment_types:instances'    # experiment_id_str : set(inst_name)
+EXPERIMENT_INSTANCE           = 'experiment_types:instance'     # (experiment_id_str, inst_name) : { LAB_COORD, RESOURCE_INST }
+EXPERIMENT_RESERVATIONS       = 'experiment_types:reservations' # experiment_id_str : set(reservation_id)
+
+RESOURCES                     = 'resources'                     # resource_type : True
+RESOURCE_INSTANCES            = 'resources:instances'           # resource_type : set(resource_instance)
+RESOURCE_SLOTS                = 'resources:slots'               # resource_type : set(resource_instance)
+RESOURCE_WORKING              = 'resources:working'             # resource_type : set(resource_instance)
+RESOURCE_INSTANCE_EXPERIMENTS = 'resources:instance_experiments' # (resource_type, resource_instance) : set(experiment_instance_id_str)
+
+RESERVATIONS                  = 'reservations'                  # reservation_id : { EXPERIMENT_TYPE, REQUEST_INFO, ... }
+RESERVATIONS_CURRENT          = 'reservations:current'          # reservation_id : True
+RESERVATIONS_ACTIVE_SCHEDULERS = 'reservations:active_schedulers' # reservation_id : set(resource_type)
+
+POST_RESERVATIONS             = 'reservations:post_reservations' # reservation_id : { INITIAL_DATA, FINISHED, END_DATA, EXPIRATION }
+
+RESOURCE_PQUEUE               = 'resources:%s:pqueue'           # reservation_id : { TIME, PRIORITY, ... }
+
+#
+# Fields
+#
+
+LAB_COORD                    = 'laboratory_coord_address'
+RESOURCE_INST                = 'resource_instance'
+
+CLIENT_INITIAL_DATA          = 'client_initial_data'
+SERVER_INITIAL_DATA          = 'server_initial_data'
+REQUEST_INFO                 = 'request_info'
+EXPERIMENT_TYPE              = 'experiment_type'
+EXPERIMENT_INSTANCE          = 'experiment_instance'
+RESOURCE_INSTANCE            = 'resource_instance'
+
+START_TIME                   = 'start_time'
+TIME                         = 'time'
+INITIALIZATION_IN_ACCOUNTING = 'initialization_in_accounting'
+PRIORITY                     = 'priority'
+POSITION                     = 'position'
+TIMESTAMP_BEFORE             = 'timestamp_before'
+TIMESTAMP_AFTER              = 'timestamp_after'
+LAB_SESSION_ID               = 'lab_session_id'
+INITIAL_CONFIGURATION        = 'initial_configuration'
+ACTIVE_STATUS                = 'active_status'
+EXP_INFO                     = 'exp_info'
+
+STATUS_RESERVED              = 'status_reserved'
+STATUS_WAITING_CONFIRMATION  = 'status_waiting_confirmation'
+
+INITIAL_DATA                 = 'initial_data'
+END_DATA                     = 'end_data'
+FINISHED                     = 'finished'
+EXPIRATION                   = 'expiration'
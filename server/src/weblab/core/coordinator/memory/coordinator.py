@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+"""
+Coordinator which keeps everything in the memory of the process, for
+deployments with a single core server. It does not support the external
+schedulers (EXTERNAL_WEBLAB_DEUSTO, ILAB_BATCH_QUEUE).
+
+If core_coordinator_memory_journal is set, every change is appended to that
+file, and it is recovered from it when the server starts. Take into
+account that core_coordinator_clean must be False for that, since
+otherwise everything is removed when the server starts.
+"""
+
+from voodoo.typechecker import typecheck, ITERATION
+from voodoo.log import logged
+import voodoo.log as log
+
+from weblab.core.coordinator.memory.store import MemoryStore, Journal
+import weblab.core.coordinator.memory.resource_manager as ResourcesManager
+import weblab.core.coordinator.memory.reservations_manager as ReservationsManager
+import weblab.core.coordinator.memory.post_reservation as PostReservationDataManager
+
+from weblab.core.coordinator.redis.meta_scheduler import IndependentSchedulerAggregator
+from weblab.core.coordinator.redis.no_scheduler import NoScheduler
+from weblab.core.coordinator.memory.priority_queue_scheduler import PriorityQueueScheduler
+from weblab.core.coordinator.resource import Resource
+
+from weblab.core.coordinator.coordinator import AbstractCoordinator
+from weblab.core.coordinator.coordinator import NO_SCHEDULER, PRIORITY_QUEUE
+
+COORDINATOR_MEMORY_JOURNAL       = 'core_coordinator_memory_journal'
+DEFAULT_COORDINATOR_MEMORY_JOURNAL = None
+
+COORDINATOR_MEMORY_JOURNAL_FSYNC = 'core_coordinator_memory_journal_fsync'
+DEFAULT_COORDINATOR_MEMORY_JOURNAL_FSYNC = False
+
+class Coordinator(AbstractCoordinator):
+
+    SCHEDULING_SYSTEMS = {
+        NO_SCHEDULER           : NoScheduler,
+        PRIORITY_QUEUE         : PriorityQueueScheduler,
+    }
+
+    AGGREGATOR = IndependentSchedulerAggregator
+
+    def __init__(self, locator, cfg_manager, ConfirmerClass = None):
+        journal_path = cfg_manager.get_value(COORDINATOR_MEMORY_JOURNAL, DEFAULT_COORDINATOR_MEMORY_JOURNAL)
+        if journal_path is not None:
+            fsync = cfg_manager.get_value(COORDINATOR_MEMORY_JOURNAL_FSYNC, DEFAULT_COORDINATOR_MEMORY_JOURNAL_FSYNC)
+            journal = Journal(journal_path, fsync = fsync)
+        else:
+            journal = None
+        self.store = MemoryStore(journal)
+
+        super(Coordinator, self).__init__(self.store, locator, cfg_manager, ConfirmerClass)
+
+    def stop(self):
+        super(Coordinator, self).stop()
+
+        self.store.close()
+
+    def _initialize_managers(self):
+        self.reservations_manager          = ReservationsManager.ReservationsManager(self.store)
+        self.resources_manager             = ResourcesManager.ResourcesManager(self.store)
+        self.post_reservation_data_manager = PostReservationDataManager.PostReservationDataManager(self.store, self.time_provider)
+
+    @typecheck(Resource, ITERATION(basestring))
+    @logged()
+    def mark_resource_as_broken(self, resource_instance, messages = []):
+        scheduler = self._get_scheduler_per_resource(resource_instance)
+
+        anything_changed = False
+        changed = scheduler.removing_current_resource_slot(self.store, resource_instance)
+        anything_changed = anything_changed or changed
+
+        changed = self.resources_manager.mark_resource_as_broken(resource_instance)
+        anything_changed = anything_changed or changed
+
+        if anything_changed:
+            log.log( Coordinator, log.level.Warning,
+                    "Resource %s marked as broken: %r" % (resource_instance, messages) )
+
+            if self.notifications_enabled:
+                return self._notify_experiment_status('broken', resource_instance, messages)
+        return {}
+
+    def _release_resource_instance(self, experiment_instance_id):
+        resource_instance = self.resources_manager.get_resource_instance_by_experiment_instance_id(experiment_instance_id)
+        self.resources_manager.release_resource_instance(resource_instance)
+
+    def _delete_reservation(self, reservation_id):
+        self.reservations_manager.delete(reservation_id)
+
+    def _clean(self):
+        for scheduler in self.schedulers.values():
+            scheduler._clean()
+
+        self.reservations_manager._clean()
+        self.resources_manager._clean()
+        self.post_reservation_data_manager._clean()
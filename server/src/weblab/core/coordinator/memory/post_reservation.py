@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import time
+import datetime
+
+from voodoo.typechecker import typecheck
+
+import weblab.core.coordinator.status as WSS
+
+from weblab.core.coordinator.memory.constants import (
+    POST_RESERVATIONS,
+
+    FINISHED,
+    INITIAL_DATA,
+    END_DATA,
+    EXPIRATION,
+)
+
+class PostReservationDataManager(object):
+    def __init__(self, store, time_provider):
+        self._store         = store
+        self.time_provider  = time_provider
+        self.force_deletion = False
+
+    @typecheck(basestring, datetime.datetime, datetime.datetime, basestring)
+    def create(self, reservation_id, date, expiration_date, initial_data):
+        time_difference = expiration_date - datetime.datetime.utcnow()
+        remaining_seconds = time_difference.days * 3600 * 24 + time_difference.seconds
+
+        self._store.set(POST_RESERVATIONS, reservation_id, {
+                    INITIAL_DATA : initial_data,
+                    FINISHED     : False,
+                    EXPIRATION   : time.time() + remaining_seconds,
+                })
+
+    @typecheck(basestring)
+    def delete(self, reservation_id):
+        self._store.delete(POST_RESERVATIONS, reservation_id)
+
+    @typecheck(basestring, basestring)
+    def finish(self, reservation_id, end_data):
+        post_reservation_data = self._find_data(reservation_id)
+        if post_reservation_data is None:
+            return
+
+        post_reservation_data = dict(post_reservation_data)
+        post_reservation_data[END_DATA] = end_data
+        post_reservation_data[FINISHED] = True
+        self._store.set(POST_RESERVATIONS, reservation_id, post_reservation_data)
+
+    def _find_data(self, reservation_id):
+        post_reservation_data = self._store.get(POST_RESERVATIONS, reservation_id)
+        if post_reservation_data is None or post_reservation_data[EXPIRATION] <= time.time():
+            return None
+        return post_reservation_data
+
+    @typecheck(basestring)
+    def find(self, reservation_id):
+        post_reservation_data = self._find_data(reservation_id)
+        if post_reservation_data is None:
+            return None
+
+        return WSS.PostReservationStatus(reservation_id, post_reservation_data[FINISHED], post_reservation_data[INITIAL_DATA], post_reservation_data.get(END_DATA))
+
+    ##############################################################
+    #
+    # Clean expired PostReservationRetrievedData
+    #
+    def clean_expired(self):
+        # As in redis, the tester can force the deletion
+        if self.force_deletion:
+            self._clean()
+
+        now = time.time()
+        for reservation_id, post_reservation_data in self._store.items(POST_RESERVATIONS):
+            if post_reservation_data[EXPIRATION] <= now:
+                self._store.delete(POST_RESERVATIONS, reservation_id)
+
+    def _clean(self):
+        self._store.clear(POST_RESERVATIONS)
@@ -0,0 +1,601 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import heapq
+import random
+import datetime
+import threading
+import json
+
+from voodoo.log import logged
+import voodoo.log as log
+from voodoo.typechecker import typecheck
+
+import voodoo.gen.coordinator.CoordAddress as CoordAddress
+import voodoo.sessions.session_id as SessionId
+from voodoo.override import Override
+
+from weblab.core.coordinator.exc import ExpiredSessionError
+from weblab.core.coordinator.scheduler import Scheduler
+import weblab.core.coordinator.status as WSS
+
+from weblab.core.coordinator.resource import Resource
+
+from weblab.data.experiments import ExperimentInstanceId, ExperimentId
+
+from weblab.core.coordinator.redis.expiration import ReservationsExpirationWorker
+
+from weblab.core.coordinator.memory.constants import (
+    RESOURCE_PQUEUE,
+
+    LAB_COORD,
+    CLIENT_INITIAL_DATA,
+    REQUEST_INFO,
+    EXPERIMENT_TYPE,
+    EXPERIMENT_INSTANCE,
+    START_TIME,
+    TIME,
+    INITIALIZATION_IN_ACCOUNTING,
+    PRIORITY,
+    POSITION,
+    TIMESTAMP_BEFORE,
+    TIMESTAMP_AFTER,
+    LAB_SESSION_ID,
+    EXP_INFO,
+    INITIAL_CONFIGURATION,
+    RESOURCE_INSTANCE,
+    ACTIVE_STATUS,
+    STATUS_RESERVED,
+    STATUS_WAITING_CONFIRMATION,
+)
+
+EXPIRATION_TIME  = 3600 # seconds
+
+# Priority of the reservations which are put back in the queue because
+# the resource they were using is broken, so they go first
+REQUEUED_PRIORITY = -1
+
+def exc_checker(func):
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except:
+            log.log(
+                PriorityQueueScheduler, log.level.Error,
+                "Unexpected exception while running %s" % func.__name__ )
+            log.log_exc(PriorityQueueScheduler, log.level.Warning)
+            raise
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+class PriorityQueueScheduler(Scheduler):
+    """
+    Priority queue kept in the memory of the process. The data of each
+    reservation is kept in the store (so it is journaled, if the store has
+    a journal), while the queue itself (a heap of (priority, position,
+    reservation_id)), the deadlines of the slots (another heap) and which
+    reservation is using each resource instance are rebuilt from it when
+    the scheduler is created.
+
+    Every resource type has its own scheduler, and therefore its own lock.
+    Nothing slow (such as calling the laboratories) is done while holding it.
+    """
+
+    def __init__(self, generic_scheduler_arguments, randomize_instances = True, expiration_check_period = 1, **kwargs):
+        super(PriorityQueueScheduler, self).__init__(generic_scheduler_arguments, **kwargs)
+
+        self.randomize_instances = randomize_instances
+        self._store = self.data_manager
+        self._table = RESOURCE_PQUEUE % self.resource_type_name
+
+        self._lock = threading.RLock()
+        self._rebuild()
+
+        # If a period (in seconds) is provided, the expired reservations
+        # are also removed in background, and not only when a user asks
+        # for something.
+        if expiration_check_period:
+            self._expiration_worker = ReservationsExpirationWorker(self, expiration_check_period)
+            self._expiration_worker.start()
+        else:
+            self._expiration_worker = None
+
+    def _rebuild(self):
+        with self._lock:
+            self._queue     = [] # heap of (priority, position, reservation_id)
+            self._waiting   = {} # reservation_id : its entry in the queue
+            self._positions = None # reservation_id : position in the queue, calculated when needed
+            self._deadlines = [] # heap of (slot deadline, reservation_id)
+            self._deadline_by_reservation = {} # reservation_id : slot deadline
+            self._instance_reservations   = {} # resource_instance : reservation_id
+            self._next_position = 0
+
+            for reservation_id, reservation_data in self._store.items(self._table):
+                self._next_position = max(self._next_position, reservation_data[POSITION] + 1)
+                if ACTIVE_STATUS in reservation_data:
+                    resource_instance = Resource.parse(reservation_data[RESOURCE_INSTANCE])
+                    self._instance_reservations[resource_instance.resource_instance] = reservation_id
+                    self._set_deadline(reservation_id, self._get_slot_deadline(reservation_data))
+                else:
+                    self._enqueue(reservation_id, reservation_data[PRIORITY], reservation_data[POSITION])
+
+    @Override(Scheduler)
+    def stop(self):
+        if self._expiration_worker is not None:
+            self._expiration_worker.stop()
+
+    @Override(Scheduler)
+    def is_remote(self):
+        return False
+
+    #
+    # The in-memory indexes. All of them must be called with the lock
+    #
+    def _enqueue(self, reservation_id, priority, position):
+        entry = (priority, position, reservation_id)
+        self._waiting[reservation_id] = entry
+        heapq.heappush(self._queue, entry)
+        self._positions = None
+
+    def _dequeue(self, reservation_id):
+        # The entry remains in the heap, and it is discarded when it is on the top
+        if self._waiting.pop(reservation_id, None) is not None:
+            self._positions = None
+
+    def _get_position(self, reservation_id):
+        if self._positions is None:
+            self._positions = dict( (entry[2], position) for position, entry in enumerate(sorted(self._waiting.itervalues())) )
+        return self._positions.get(reservation_id)
+
+    def _set_deadline(self, reservation_id, slot_deadline):
+        if slot_deadline is None:
+            self._deadline_by_reservation.pop(reservation_id, None)
+        else:
+            self._deadline_by_reservation[reservation_id] = slot_deadline
+            heapq.heappush(self._deadlines, (slot_deadline, reservation_id))
+
+    def _get_data(self, reservation_id):
+        # The store returns the stored object, so it must be copied before changing it
+        reservation_data = self._store.get(self._table, reservation_id)
+        if reservation_data is None:
+            return None
+        return dict(reservation_data)
+
+    @exc_checker
+    @logged()
+    @Override(Scheduler)
+    @typecheck(typecheck.ANY, typecheck.ANY, Resource)
+    def removing_current_resource_slot(self, store, resource):
+        with self._lock:
+            current_reservation_id = self._instance_reservations.pop(resource.resource_instance, None)
+            if current_reservation_id is None:
+                return False
+
+            self.reservations_manager.downgrade_confirmation(current_reservation_id)
+            self.resources_manager.release_resource(resource)
+
+            # Remove data that was added when confirmed
+            reservation_data = self._get_data(current_reservation_id)
+            if reservation_data is None:
+                return True
+
+            reservation_data.pop(ACTIVE_STATUS,    None)
+            reservation_data.pop(TIMESTAMP_BEFORE, None)
+            reservation_data.pop(TIMESTAMP_AFTER,  None)
+            reservation_data.pop(LAB_SESSION_ID,   None)
+            reservation_data.pop(EXP_INFO,         None)
+            # Add back to the queue
+            reservation_data[PRIORITY] = REQUEUED_PRIORITY
+            self._store.set(self._table, current_reservation_id, reservation_data)
+            self._set_deadline(current_reservation_id, None)
+            self._enqueue(current_reservation_id, REQUEUED_PRIORITY, reservation_data[POSITION])
+            return True
+
+    @exc_checker
+    @logged()
+    @Override(Scheduler)
+    def reserve_experiment(self, reservation_id, experiment_id, time, priority, initialization_in_accounting, client_initial_data, request_info):
+        """
+        priority: the less, the more priority
+        """
+        with self._lock:
+            # Within the same priority, the requests are sorted by the order they came
+            position = self._next_position
+            self._next_position += 1
+
+            generic_data = {
+                TIME                         : time,
+                INITIALIZATION_IN_ACCOUNTING : initialization_in_accounting,
+                PRIORITY                     : priority,
+                POSITION                     : position,
+            }
+            self._store.set(self._table, reservation_id, generic_data)
+            self._enqueue(reservation_id, priority, position)
+
+        return self.get_reservation_status(reservation_id)
+
+    #######################################################################
+    #
+    # Given a reservation_id, it returns in which state the reservation is
+    #
+    @exc_checker
+    @logged()
+    @Override(Scheduler)
+    def get_reservation_status(self, reservation_id):
+        self._remove_expired_reservations()
+
+        expired = self.reservations_manager.update(reservation_id)
+        if expired:
+            self._delete_reservation(reservation_id)
+            raise ExpiredSessionError("Expired reservation")
+
+        self._update_queues()
+
+        reservation_id_with_route = '%s;%s.%s' % (reservation_id, reservation_id, self.core_server_route)
+
+        with self._lock:
+            reservation_data = self._store.get(self._table, reservation_id)
+            if reservation_data is None:
+                log.log(
+                    PriorityQueueScheduler, log.level.Error,
+                    "get_reservation_status called with a reservation_id that is not registered. Returning a WaitingInstanceStatus")
+                return WSS.WaitingInstancesQueueStatus(reservation_id_with_route, 50)
+
+            if ACTIVE_STATUS not in reservation_data:
+                position = self._get_position(reservation_id)
+
+        if ACTIVE_STATUS in reservation_data:
+            # Reserved or Waiting reservation
+            status = reservation_data[ACTIVE_STATUS]
+
+            # It may be just waiting for the experiment server to respond
+            if status == STATUS_WAITING_CONFIRMATION:
+                return WSS.WaitingConfirmationQueueStatus(reservation_id_with_route, self.core_server_url)
+
+            # Or the experiment server already responded and therefore we have all this data
+            str_lab_coord_address        = reservation_data[LAB_COORD]
+            obtained_time                = reservation_data[TIME]
+            initialization_in_accounting = reservation_data[INITIALIZATION_IN_ACCOUNTING]
+            lab_session_id               = reservation_data[LAB_SESSION_ID]
+            initial_configuration        = reservation_data[INITIAL_CONFIGURATION]
+            timestamp_before_tstamp      = reservation_data[TIMESTAMP_BEFORE]
+            timestamp_after_tstamp       = reservation_data[TIMESTAMP_AFTER]
+            if EXP_INFO in reservation_data and reservation_data[EXP_INFO]:
+                exp_info                 = json.loads(reservation_data[EXP_INFO])
+            else:
+                exp_info                 = {}
+            timestamp_before             = datetime.datetime.fromtimestamp(timestamp_before_tstamp)
+            timestamp_after              = datetime.datetime.fromtimestamp(timestamp_after_tstamp)
+            lab_coord_address            = CoordAddress.CoordAddress.translate_address(str_lab_coord_address)
+
+            if initialization_in_accounting:
+                before = timestamp_before_tstamp
+            else:
+                before = timestamp_after_tstamp
+
+            if before is not None:
+                remaining = (before + obtained_time) - self.time_provider.get_time()
+            else:
+                remaining = obtained_time
+
+            return WSS.LocalReservedStatus(reservation_id_with_route, lab_coord_address, SessionId.SessionId(lab_session_id), exp_info, obtained_time, initial_configuration, timestamp_before, timestamp_after, initialization_in_accounting, remaining, self.core_server_url)
+
+        # else it's waiting
+        if position is None:
+            log.log(
+                PriorityQueueScheduler, log.level.Error,
+                "get_reservation_status called with a reservation_id that is not in the queue. Returning a WaitingInstanceStatus")
+            return WSS.WaitingInstancesQueueStatus(reservation_id_with_route, 50)
+
+        if self.resources_manager.are_resource_instances_working(self.resource_type_name):
+            return WSS.WaitingQueueStatus(reservation_id_with_route, position)
+        else:
+            return WSS.WaitingInstancesQueueStatus(reservation_id_with_route, position)
+
+    ################################################################
+    #
+    # Called when it is confirmed by the Laboratory Server.
+    #
+    @exc_checker
+    @logged()
+    @Override(Scheduler)
+    def confirm_experiment(self, reservation_id, lab_session_id, initial_configuration, exp_info):
+        self._remove_expired_reservations()
+
+        with self._lock:
+            reservation_data = self._get_data(reservation_id)
+            if reservation_data is None:
+                return
+
+            resource_instance_str = reservation_data.get(RESOURCE_INSTANCE)
+            if resource_instance_str is not None:
+                resource_instance = Resource.parse(resource_instance_str)
+                if not self.resources_manager.check_working(resource_instance):
+                    # TODO: if the experiment is broken and the student is ACTIVE_STATUS, something should be done
+                    #
+                    return
+
+            reservation_data[LAB_SESSION_ID]        = lab_session_id.id
+            reservation_data[INITIAL_CONFIGURATION] = initial_configuration
+            reservation_data[TIMESTAMP_AFTER]       = self.time_provider.get_time()
+            reservation_data[ACTIVE_STATUS]         = STATUS_RESERVED
+            reservation_data[EXP_INFO]              = json.dumps(exp_info)
+
+            self._store.set(self._table, reservation_id, reservation_data)
+            self._dequeue(reservation_id)
+            self._set_deadline(reservation_id, self._get_slot_deadline(reservation_data))
+
+    ################################################################
+    #
+    # Called when the user disconnects or finishes the resource.
+    #
+    @exc_checker
+    @logged()
+    @Override(Scheduler)
+    def finish_reservation(self, reservation_id):
+        self._remove_expired_reservations()
+
+        with self._lock:
+            reservation_data = self._store.get(self._table, reservation_id)
+            if reservation_data is None:
+                return
+
+            if ACTIVE_STATUS in reservation_data:
+                enqueue_free_experiment_args = self._clean_current_reservation(reservation_id)
+            else:
+                enqueue_free_experiment_args = None
+
+            self._delete_reservation(reservation_id)
+
+        if enqueue_free_experiment_args is not None:
+            self.confirmer.enqueue_free_experiment(*enqueue_free_experiment_args)
+
+    def _clean_current_reservation(self, reservation_id):
+        enqueue_free_experiment_args = None
+        with self._lock:
+            reservation_data = self._store.get(self._table, reservation_id)
+            if reservation_data is not None:
+                downgraded = self.reservations_manager.downgrade_confirmation(reservation_id)
+                if downgraded:
+                    resource_instance_str = reservation_data.get(RESOURCE_INSTANCE)
+                    if resource_instance_str is not None:
+                        resource_instance = Resource.parse(resource_instance_str)
+                        if self._instance_reservations.get(resource_instance.resource_instance) == reservation_id:
+                            self._instance_reservations.pop(resource_instance.resource_instance)
+                        self.resources_manager.release_resource(resource_instance)
+                        lab_session_id          = reservation_data.get(LAB_SESSION_ID)
+                        experiment_instance_str = reservation_data.get(EXPERIMENT_INSTANCE)
+                        experiment_instance_id  = ExperimentInstanceId.parse(experiment_instance_str)
+                        if experiment_instance_id is not None:
+                            # If the experiment instance doesn't exist, there is no need to call the free_experiment method
+                            lab_coord_address  = reservation_data.get(LAB_COORD)
+                            enqueue_free_experiment_args = (lab_coord_address, reservation_id, lab_session_id, experiment_instance_id)
+                # otherwise the student has been removed
+        return enqueue_free_experiment_args
+
+    def update(self):
+        self._update_queues()
+
+    #############################################################
+    #
+    # Take the queue of a given Resource Type and update it
+    #
+    @exc_checker
+    def _update_queues(self):
+        ###########################################################
+        # There are reasons why a waiting reservation may not be
+        # able to be promoted while the next one is (for instance,
+        # if it is waiting for an experiment which is not available
+        # in any of the free instances). Those are put back in
+        # the queue once the rest have been checked, so they will
+        # have another chance in the next run of _update_queues.
+        #
+        promotions = []
+        with self._lock:
+            skipped = []
+            try:
+                while self._queue:
+                    free_instances = self.resources_manager.list_free_resource_instances(self.resource_type_name)
+                    if len(free_instances) == 0:
+                        break
+
+                    entry = heapq.heappop(self._queue)
+                    reservation_id = entry[2]
+                    if self._waiting.get(reservation_id) != entry:
+                        # It was removed from the queue
+                        continue
+
+                    if self.randomize_instances:
+                        random.shuffle(free_instances)
+                    else:
+                        free_instances.sort(key = lambda resource : (resource.resource_type, resource.resource_instance))
+
+                    promotion = self._promote(reservation_id, free_instances)
+                    if promotion is None:
+                        skipped.append(entry)
+                    else:
+                        promotions.append(promotion)
+            finally:
+                for entry in skipped:
+                    heapq.heappush(self._queue, entry)
+
+        # Calling the laboratories might take long, so it is done in other
+        # threads, but even enqueuing it is done without the lock
+        for promotion in promotions:
+            self._enqueue_confirmation(*promotion)
+
+    def _promote(self, reservation_id, free_instances):
+        """ Tries to assign one of the free instances to the waiting reservation. It must be called with the lock """
+        pqueue_reservation_data = self._get_data(reservation_id)
+        reservation_data        = self.reservations_manager.get_reservation_data(reservation_id)
+        if pqueue_reservation_data is None or reservation_data is None:
+            # the student is not here anymore
+            self._dequeue(reservation_id)
+            return None
+
+        requested_experiment_type = ExperimentId.parse(reservation_data[EXPERIMENT_TYPE])
+
+        for free_instance in free_instances:
+            working = self.resources_manager.check_working(free_instance)
+            if not working:
+                # The instance is not working
+                continue
+
+            selected_experiment_instance = None
+            experiment_instances = self.resources_manager.list_experiment_instance_ids_by_resource(free_instance)
+            for experiment_instance in experiment_instances:
+                if experiment_instance.to_experiment_id() == requested_experiment_type:
+                    selected_experiment_instance = experiment_instance
+
+            if selected_experiment_instance is None:
+                # This resource is not valid for this user, other free_instance should be selected
+                continue
+
+            confirmed = self.reservations_manager.confirm(reservation_id)
+            if not confirmed:
+                # student has already been confirmed somewhere else
+                return None
+
+            acquired = self.resources_manager.acquire_resource(free_instance)
+            if not acquired:
+                # the instance has been acquired by other scheduler. unconfirm student and
+                # try again with other free_instance
+                self.reservations_manager.downgrade_confirmation(reservation_id)
+                continue
+
+            start_time = self.time_provider.get_time()
+            laboratory_coord_address = self.resources_manager.get_laboratory_coordaddress_by_experiment_instance_id(selected_experiment_instance)
+
+            pqueue_reservation_data[START_TIME]          = start_time
+            pqueue_reservation_data[TIMESTAMP_BEFORE]    = start_time
+            pqueue_reservation_data[ACTIVE_STATUS]       = STATUS_WAITING_CONFIRMATION
+            pqueue_reservation_data[RESOURCE_INSTANCE]   = free_instance.to_weblab_str()
+            pqueue_reservation_data[EXPERIMENT_INSTANCE] = selected_experiment_instance.to_weblab_str()
+            pqueue_reservation_data[LAB_COORD]           = laboratory_coord_address
+            self._store.set(self._table, reservation_id, pqueue_reservation_data)
+
+            self._dequeue(reservation_id)
+            self._instance_reservations[free_instance.resource_instance] = reservation_id
+            self._set_deadline(reservation_id, self._get_slot_deadline(pqueue_reservation_data))
+
+            return (reservation_id, selected_experiment_instance, laboratory_coord_address, start_time, reservation_data, pqueue_reservation_data)
+
+        return None
+
+    def _enqueue_confirmation(self, reservation_id, selected_experiment_instance, laboratory_coord_address, start_time, reservation_data, pqueue_reservation_data):
+        total_time                   = pqueue_reservation_data[TIME]
+        initialization_in_accounting = pqueue_reservation_data[INITIALIZATION_IN_ACCOUNTING]
+
+        client_initial_data = reservation_data[CLIENT_INITIAL_DATA]
+        request_info        = json.loads(reservation_data[REQUEST_INFO])
+        username            = request_info.get('username')
+        locale              = request_info.get('locale')
+
+        deserialized_server_initial_data = {
+                'priority.queue.slot.length'                       : '%s' % total_time,
+                'priority.queue.slot.start'                        : '%s' % datetime.datetime.fromtimestamp(start_time),
+                'priority.queue.slot.initialization_in_accounting' : initialization_in_accounting,
+                'request.experiment_id.experiment_name'            : selected_experiment_instance.exp_name,
+                'request.experiment_id.category_name'              : selected_experiment_instance.cat_name,
+                'request.username'                                 : username,
+                'request.full_name'                                : username,
+                'request.locale'                                   : locale,
+            }
+        server_initial_data = json.dumps(deserialized_server_initial_data)
+        self.confirmer.enqueue_confirmation(laboratory_coord_address, reservation_id, selected_experiment_instance, client_initial_data, server_initial_data, self.resource_type_name)
+
+    def _get_slot_deadline(self, pqueue_reservation_data):
+        """ When does the slot of an active reservation finish (None if it can not be known yet) """
+        if ACTIVE_STATUS not in pqueue_reservation_data:
+            return None
+
+        total_time                   = pqueue_reservation_data[TIME]
+        timestamp_before             = pqueue_reservation_data[TIMESTAMP_BEFORE]
+        timestamp_after              = pqueue_reservation_data.get(TIMESTAMP_AFTER)
+        initialization_in_accounting = pqueue_reservation_data[INITIALIZATION_IN_ACCOUNTING]
+        # if timestamp_after is None and initialization should not be considered,
+        # then we can not calculate if the time has expired, so we skip it (it will
+        # be considered as expired for lack of latest access)
+        if timestamp_after is None and not initialization_in_accounting:
+            return None
+
+        timestamp = timestamp_before if initialization_in_accounting else timestamp_after
+        return timestamp + total_time
+
+    ################################################
+    #
+    # Remove all reservations whose session has expired
+    #
+    @exc_checker
+    def _remove_expired_reservations(self):
+        now = self.time_provider.get_time()
+
+        enqueue_free_experiment_args_retrieved = []
+
+        with self._lock:
+            # Only the reservations whose slot should have finished by now are
+            # checked. The heap may contain old deadlines of reservations which
+            # were confirmed or removed later, which are discarded.
+            while self._deadlines and self._deadlines[0][0] <= now:
+                slot_deadline, reservation_id = heapq.heappop(self._deadlines)
+                if self._deadline_by_reservation.get(reservation_id) != slot_deadline:
+                    continue
+
+                enqueue_free_experiment_args = self._clean_current_reservation(reservation_id)
+                enqueue_free_experiment_args_retrieved.append(enqueue_free_experiment_args)
+                self._delete_reservation(reservation_id)
+                self.reservations_manager.delete(reservation_id)
+
+            # Anybody with latest_access later than this point is expired
+            current_expiration_time = datetime.datetime.utcfromtimestamp(now - EXPIRATION_TIME)
+
+            for expired_reservation_id in self.reservations_manager.list_expired_reservations(current_expiration_time):
+                pqueue_reservation_data = self._store.get(self._table, expired_reservation_id)
+                if pqueue_reservation_data is None:
+                    continue
+
+                if ACTIVE_STATUS in pqueue_reservation_data:
+                    enqueue_free_experiment_args = self._clean_current_reservation(expired_reservation_id)
+                    enqueue_free_experiment_args_retrieved.append(enqueue_free_experiment_args)
+
+                self._delete_reservation(expired_reservation_id)
+                self.reservations_manager.delete(expired_reservation_id)
+
+        for enqueue_free_experiment_args in enqueue_free_experiment_args_retrieved:
+            if enqueue_free_experiment_args is not None:
+                self.confirmer.enqueue_free_experiment(*enqueue_free_experiment_args)
+
+    def _delete_reservation(self, reservation_id):
+        with self._lock:
+            reservation_data = self._store.get(self._table, reservation_id)
+            if reservation_data is not None and RESOURCE_INSTANCE in reservation_data:
+                resource_instance = Resource.parse(reservation_data[RESOURCE_INSTANCE])
+                if self._instance_reservations.get(resource_instance.resource_instance) == reservation_id:
+                    self._instance_reservations.pop(resource_instance.resource_instance)
+
+            self._store.delete(self._table, reservation_id)
+            self._dequeue(reservation_id)
+            self._deadline_by_reservation.pop(reservation_id, None)
+
+    ##############################################################
+    #
+    # ONLY FOR TESTING: It completely removes the whole database
+    #
+    @Override(Scheduler)
+    def _clean(self):
+        with self._lock:
+            self._store.clear(self._table)
+            self._rebuild()
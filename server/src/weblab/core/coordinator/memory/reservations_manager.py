@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import time
+import uuid
+import json
+import thread
+import datetime
+import threading
+import collections
+
+from weblab.data.experiments import ExperimentId
+import weblab.core.coordinator.exc as CoordExc
+from voodoo.typechecker import typecheck
+import voodoo.log as log
+
+from weblab.core.coordinator.memory.constants import (
+    RESERVATIONS,
+    RESERVATIONS_CURRENT,
+    RESERVATIONS_ACTIVE_SCHEDULERS,
+    EXPERIMENT_TYPES,
+    EXPERIMENT_RESERVATIONS,
+
+    CLIENT_INITIAL_DATA,
+    SERVER_INITIAL_DATA,
+    REQUEST_INFO,
+    EXPERIMENT_TYPE,
+)
+
+def _timestamp(moment):
+    return time.mktime(moment.timetuple()) + moment.microsecond / 1e6
+
+class ReservationsManager(object):
+    """
+    The reservations are stored in the store (and therefore in the journal,
+    if any), but not their latest access, which changes every time the user
+    asks for the status. After a restart, the latest access of every
+    recovered reservation is the moment when it was recovered.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self.now = datetime.datetime.utcnow
+
+        self._lock = threading.Lock()
+        # reservation_id : latest access, sorted by the latest access
+        self._latest_access = collections.OrderedDict()
+        self._finishing     = set()
+
+        # reservation_id : [ thread owning the lock, times locked ]
+        self._reservation_locks     = {}
+        self._reservation_locks_cond = threading.Condition(threading.Lock())
+
+        now_timestamp = _timestamp(self.now())
+        for reservation_id in self._store.keys(RESERVATIONS):
+            self._latest_access[reservation_id] = now_timestamp
+
+    def _clean(self):
+        with self._lock:
+            self._latest_access.clear()
+            self._finishing.clear()
+        self._store.clear(RESERVATIONS)
+        self._store.clear(RESERVATIONS_CURRENT)
+        self._store.clear(RESERVATIONS_ACTIVE_SCHEDULERS)
+        self._store.clear(EXPERIMENT_RESERVATIONS)
+
+    def list_all_reservations(self):
+        return self._store.keys(RESERVATIONS)
+
+    def lock_reservation(self, reservation_id, timeout = 10):
+        """ As in the redis coordinator, returns the token that must be
+        provided to unlock_reservation, or None if it was not locked """
+        current_thread = thread.get_ident()
+        deadline = time.time() + timeout
+        with self._reservation_locks_cond:
+            while True:
+                owner = self._reservation_locks.get(reservation_id)
+                if owner is None:
+                    self._reservation_locks[reservation_id] = [current_thread, 1]
+                    return current_thread
+                if owner[0] == current_thread:
+                    owner[1] += 1
+                    return current_thread
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    # As the redis coordinator, keep working without the lock
+                    log.log(ReservationsManager, log.level.Warning, "Could not lock reservation %s in %s seconds" % (reservation_id, timeout))
+                    return None
+                self._reservation_locks_cond.wait(remaining)
+
+    def unlock_reservation(self, reservation_id, token):
+        if token is None:
+            return
+        with self._reservation_locks_cond:
+            owner = self._reservation_locks.get(reservation_id)
+            if owner is None or owner[0] != token:
+                return
+            owner[1] -= 1
+            if owner[1] == 0:
+                self._reservation_locks.pop(reservation_id)
+                self._reservation_locks_cond.notify_all()
+
+    @typecheck(ExperimentId, (basestring, dict), basestring, typecheck.ANY)
+    def create(self, experiment_id, client_initial_data, request_info, now = None):
+        if now is None:
+            now = datetime.datetime.utcnow
+        else:
+            self.now = now
+
+        now_timestamp = _timestamp(now())
+
+        with self._lock:
+            reservation_id = str(uuid.uuid4())
+            while self._store.exists(RESERVATIONS, reservation_id):
+                reservation_id = str(uuid.uuid4())
+
+            reservation_data = {
+                REQUEST_INFO        : request_info,
+                SERVER_INITIAL_DATA : "{}",
+                CLIENT_INITIAL_DATA : json.dumps(client_initial_data),
+                EXPERIMENT_TYPE     : experiment_id.to_weblab_str()
+            }
+            self._store.set(RESERVATIONS, reservation_id, reservation_data)
+            self._store.add(EXPERIMENT_RESERVATIONS, experiment_id.to_weblab_str(), reservation_id)
+            self._latest_access[reservation_id] = now_timestamp
+
+        return reservation_id
+
+    def get_experiment_id(self, reservation_id):
+        reservation_data = self.get_reservation_data(reservation_id)
+        if reservation_data is None:
+            raise CoordExc.ExpiredSessionError("Expired reservation: no experiment id found for that reservation (%s)" % reservation_id)
+        return ExperimentId.parse(reservation_data[EXPERIMENT_TYPE])
+
+    def get_reservation_data(self, reservation_id):
+        return self._store.get(RESERVATIONS, reservation_id)
+
+    def get_request_info_and_client_initial_data(self, reservation_id):
+        reservation_data = self.get_reservation_data(reservation_id)
+        if reservation_data is None:
+            return "{}", "{}"
+        return reservation_data[REQUEST_INFO], reservation_data[CLIENT_INITIAL_DATA]
+
+    def update(self, reservation_id):
+        now_timestamp = _timestamp(self.now())
+        with self._lock:
+            if self._latest_access.pop(reservation_id, None) is None:
+                # It does not exist anymore, so it is expired
+                return True
+            self._latest_access[reservation_id] = now_timestamp
+            return False
+
+    def confirm(self, reservation_id):
+        with self._lock:
+            if not self._store.exists(RESERVATIONS, reservation_id):
+                raise CoordExc.ExpiredSessionError("Expired reservation")
+
+            if self._store.exists(RESERVATIONS_CURRENT, reservation_id):
+                return False
+            self._store.set(RESERVATIONS_CURRENT, reservation_id, True)
+            return True
+
+    def downgrade_confirmation(self, reservation_id):
+        return self._store.delete(RESERVATIONS_CURRENT, reservation_id)
+
+    def list_expired_reservations(self, expiration_time):
+        expiration_timestamp = _timestamp(expiration_time)
+
+        expired = []
+        with self._lock:
+            # _latest_access is sorted by the latest access, so only the
+            # expired reservations are checked
+            for reservation_id, latest_access in self._latest_access.iteritems():
+                if latest_access >= expiration_timestamp:
+                    break
+                expired.append(reservation_id)
+        return expired
+
+    def list_sessions(self, experiment_id):
+        """ list_sessions( experiment_id ) -> [ session_id ] """
+        if not self._store.exists(EXPERIMENT_TYPES, experiment_id.to_weblab_str()):
+            raise CoordExc.ExperimentNotFoundError("Experiment %s not found" % experiment_id)
+
+        return list(self._store.members(EXPERIMENT_RESERVATIONS, experiment_id.to_weblab_str()))
+
+    def initialize_deletion(self, reservation_id):
+        with self._lock:
+            if reservation_id in self._finishing:
+                return False
+            self._finishing.add(reservation_id)
+            return True
+
+    def clean_deletion(self, reservation_id):
+        with self._lock:
+            self._finishing.discard(reservation_id)
+
+    def delete(self, reservation_id):
+        with self._lock:
+            self._latest_access.pop(reservation_id, None)
+            reservation_data = self._store.get(RESERVATIONS, reservation_id)
+            if reservation_data is not None:
+                self._store.discard(EXPERIMENT_RESERVATIONS, reservation_data[EXPERIMENT_TYPE], reservation_id)
+            self._store.delete(RESERVATIONS, reservation_id)
+            self._store.delete(RESERVATIONS_CURRENT, reservation_id)
+            self._store.delete(RESERVATIONS_ACTIVE_SCHEDULERS, reservation_id)
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import threading
+
+from weblab.data.experiments import ExperimentId, ExperimentInstanceId
+from weblab.core.coordinator.resource import Resource
+import weblab.core.coordinator.exc as CoordExc
+
+from voodoo.typechecker import typecheck
+
+from weblab.core.coordinator.memory.constants import (
+    EXPERIMENT_TYPES,
+    EXPERIMENT_RESOURCES,
+    EXPERIMENT_INSTANCES,
+    EXPERIMENT_INSTANCE,
+
+    RESOURCES,
+    RESOURCE_INSTANCES,
+    RESOURCE_SLOTS,
+    RESOURCE_WORKING,
+    RESOURCE_INSTANCE_EXPERIMENTS,
+    RESERVATIONS_ACTIVE_SCHEDULERS,
+
+    LAB_COORD,
+    RESOURCE_INST,
+)
+
+class ResourcesManager(object):
+    def __init__(self, store):
+        self._store = store
+        # Only for registering experiment instances. Acquiring and releasing
+        # slots is atomic in the store
+        self._lock  = threading.Lock()
+
+    @typecheck(Resource)
+    def add_resource(self, resource):
+        self._store.set(RESOURCES, resource.resource_type, True)
+        self._store.add(RESOURCE_INSTANCES, resource.resource_type, resource.resource_instance)
+        self._store.add(RESOURCE_SLOTS,     resource.resource_type, resource.resource_instance)
+        self._store.add(RESOURCE_WORKING,   resource.resource_type, resource.resource_instance)
+
+    @typecheck(ExperimentId, basestring)
+    def add_experiment_id(self, experiment_id, resource_type):
+        self._store.set(RESOURCES, resource_type, True)
+        self._store.set(EXPERIMENT_TYPES, experiment_id.to_weblab_str(), True)
+
+    @typecheck(basestring, ExperimentInstanceId, Resource)
+    def add_experiment_instance_id(self, laboratory_coord_address, experiment_instance_id, resource):
+        self.add_resource(resource)
+
+        experiment_id     = experiment_instance_id.to_experiment_id()
+        experiment_id_str = experiment_id.to_weblab_str()
+
+        self.add_experiment_id(experiment_id, resource.resource_type)
+
+        with self._lock:
+            experiment_instance_key = (experiment_id_str, experiment_instance_id.inst_name)
+            experiment_instance = self._store.get(EXPERIMENT_INSTANCE, experiment_instance_key)
+            if experiment_instance is not None:
+                if experiment_instance[LAB_COORD] != laboratory_coord_address:
+                    raise CoordExc.InvalidExperimentConfigError("Attempt to register the experiment %s in the laboratory %s; this experiment is already registered in the laboratory %s" % (experiment_instance_id, laboratory_coord_address, experiment_instance[LAB_COORD]))
+                if experiment_instance[RESOURCE_INST] != resource.to_weblab_str():
+                    raise CoordExc.InvalidExperimentConfigError("Attempt to register the experiment %s with resource %s when it was already bound to resource %s" % (experiment_instance_id, resource, experiment_instance[RESOURCE_INST]))
+
+            self._store.add(EXPERIMENT_INSTANCES, experiment_id_str, experiment_instance_id.inst_name)
+            self._store.add(EXPERIMENT_RESOURCES, experiment_id_str, resource.resource_type)
+            self._store.add(RESOURCE_INSTANCE_EXPERIMENTS, (resource.resource_type, resource.resource_instance), experiment_instance_id.to_weblab_str())
+            self._store.set(EXPERIMENT_INSTANCE, experiment_instance_key, {
+                        LAB_COORD     : laboratory_coord_address,
+                        RESOURCE_INST : resource.to_weblab_str(),
+                    })
+
+    @typecheck(Resource)
+    def acquire_resource(self, current_resource):
+        return self._store.discard(RESOURCE_SLOTS, current_resource.resource_type, current_resource.resource_instance)
+
+    @typecheck(Resource)
+    def release_resource(self, current_resource):
+        self._store.add(RESOURCE_SLOTS, current_resource.resource_type, current_resource.resource_instance)
+
+    @typecheck(Resource)
+    def release_resource_instance(self, resource):
+        return self.release_resource(resource)
+
+    @typecheck(basestring)
+    def list_free_resource_instances(self, resource_type):
+        return [ Resource(resource_type, resource_instance) for resource_instance in self._store.members(RESOURCE_SLOTS, resource_type) ]
+
+    @typecheck(ExperimentId)
+    def get_resource_types_by_experiment_id(self, experiment_id):
+        experiment_id_str = experiment_id.to_weblab_str()
+        if not self._store.exists(EXPERIMENT_RESOURCES, experiment_id_str):
+            raise CoordExc.ExperimentNotFoundError("Experiment not found: %s" % experiment_id)
+        return self._store.members(EXPERIMENT_RESOURCES, experiment_id_str)
+
+    def _get_experiment_instance(self, experiment_instance_id):
+        experiment_id_str = experiment_instance_id.to_experiment_id().to_weblab_str()
+        return self._store.get(EXPERIMENT_INSTANCE, (experiment_id_str, experiment_instance_id.inst_name))
+
+    @typecheck(ExperimentInstanceId)
+    def get_resource_instance_by_experiment_instance_id(self, experiment_instance_id):
+        experiment_instance = self._get_experiment_instance(experiment_instance_id)
+        if experiment_instance is None:
+            raise CoordExc.ExperimentNotFoundError("Experiment not found: %s" % experiment_instance_id)
+
+        return Resource.parse(experiment_instance[RESOURCE_INST])
+
+    def get_laboratory_coordaddress_by_experiment_instance_id(self, experiment_instance_id):
+        experiment_instance = self._get_experiment_instance(experiment_instance_id)
+        if experiment_instance is None:
+            return None
+        return experiment_instance[LAB_COORD]
+
+    @typecheck(Resource)
+    def mark_resource_as_broken(self, resource):
+        return self._store.discard(RESOURCE_WORKING, resource.resource_type, resource.resource_instance)
+
+    @typecheck(Resource)
+    def mark_resource_as_fixed(self, resource):
+        return self._store.add(RESOURCE_WORKING, resource.resource_type, resource.resource_instance)
+
+    @typecheck(ExperimentInstanceId)
+    def remove_resource_instance_id(self, experiment_instance_id):
+        experiment_id_str = experiment_instance_id.to_experiment_id().to_weblab_str()
+
+        with self._lock:
+            experiment_instance = self._get_experiment_instance(experiment_instance_id)
+            if experiment_instance is not None:
+                # else it does not exist
+                resource = Resource.parse(experiment_instance[RESOURCE_INST])
+                self._store.discard(EXPERIMENT_INSTANCES, experiment_id_str, experiment_instance_id.inst_name)
+                self._store.delete(EXPERIMENT_INSTANCE, (experiment_id_str, experiment_instance_id.inst_name))
+                self._store.discard(RESOURCE_INSTANCE_EXPERIMENTS, (resource.resource_type, resource.resource_instance), experiment_instance_id.to_weblab_str())
+
+    @typecheck(Resource)
+    def remove_resource_instance(self, resource):
+        if self._store.discard(RESOURCE_INSTANCES, resource.resource_type, resource.resource_instance):
+            # else it did not exist
+            resource_instance_key = (resource.resource_type, resource.resource_instance)
+            experiment_instances = self._store.members(RESOURCE_INSTANCE_EXPERIMENTS, resource_instance_key)
+            self._store.delete(RESOURCE_INSTANCE_EXPERIMENTS, resource_instance_key)
+            for experiment_instance in experiment_instances:
+                experiment_instance_id = ExperimentInstanceId.parse(experiment_instance)
+                self.remove_resource_instance_id(experiment_instance_id)
+
+    @typecheck(basestring)
+    def are_resource_instances_working(self, resource_type):
+        return self._store.exists(RESOURCE_WORKING, resource_type)
+
+    @typecheck(Resource)
+    def check_working(self, resource):
+        if resource is None:
+            return False
+        return self._store.is_member(RESOURCE_WORKING, resource.resource_type, resource.resource_instance)
+
+    def list_resources(self):
+        return self._store.keys(RESOURCES)
+
+    def list_resource_instances(self):
+        resource_instances = []
+        for resource_type in self._store.keys(RESOURCES):
+            for resource_instance in self._store.members(RESOURCE_INSTANCES, resource_type):
+                resource_instances.append(Resource(resource_type, resource_instance))
+        return resource_instances
+
+    @typecheck(basestring)
+    def list_resource_instances_by_type(self, resource_type_name):
+        return [ Resource(resource_type_name, resource_instance) for resource_instance in self._store.members(RESOURCE_INSTANCES, resource_type_name) ]
+
+    def list_experiments(self):
+        return [ ExperimentId.parse(exp_type) for exp_type in self._store.keys(EXPERIMENT_TYPES) ]
+
+    @typecheck(ExperimentId)
+    def list_experiment_instances_by_type(self, experiment_id):
+        return [
+            ExperimentInstanceId(inst, experiment_id.exp_name, experiment_id.cat_name)
+            for inst in self._store.members(EXPERIMENT_INSTANCES, experiment_id.to_weblab_str()) ]
+
+    @typecheck(basestring)
+    def list_experiment_instance_ids_by_resource_type(self, resource_type):
+        experiment_instance_ids = []
+        for resource in self.list_resource_instances_by_type(resource_type):
+            experiment_instance_ids.extend(self.list_experiment_instance_ids_by_resource(resource))
+        return experiment_instance_ids
+
+    @typecheck(Resource)
+    def list_experiment_instance_ids_by_resource(self, resource):
+        members = self._store.members(RESOURCE_INSTANCE_EXPERIMENTS, (resource.resource_type, resource.resource_instance))
+        return [ ExperimentInstanceId.parse(member) for member in members ]
+
+    def list_laboratories_addresses(self):
+        laboratory_addresses = {
+            # laboratory_coord_address : {
+            #         experiment_instance_id : resource_instance
+            # }
+        }
+
+        for (experiment_type, experiment_instance_name), experiment_instance in self._store.items(EXPERIMENT_INSTANCE):
+            experiment_id = ExperimentId.parse(experiment_type)
+            experiment_instance_id = ExperimentInstanceId(experiment_instance_name, experiment_id.exp_name, experiment_id.cat_name)
+            current = laboratory_addresses.setdefault(experiment_instance[LAB_COORD], {})
+            current[experiment_instance_id] = Resource.parse(experiment_instance[RESOURCE_INST])
+
+        return laboratory_addresses
+
+    @typecheck(basestring, ExperimentId, basestring)
+    def associate_scheduler_to_reservation(self, reservation_id, experiment_id, resource_type_name):
+        self._store.add(RESERVATIONS_ACTIVE_SCHEDULERS, reservation_id, resource_type_name)
+
+    def dissociate_scheduler_from_reservation(self, reservation_id, experiment_id, resource_type_name):
+        return self._store.discard(RESERVATIONS_ACTIVE_SCHEDULERS, reservation_id, resource_type_name)
+
+    def clean_associations_for_reservation(self, reservation_id, experiment_id):
+        self._store.delete(RESERVATIONS_ACTIVE_SCHEDULERS, reservation_id)
+
+    def retrieve_schedulers_per_reservation(self, reservation_id, experiment_id):
+        return list(self._store.members(RESERVATIONS_ACTIVE_SCHEDULERS, reservation_id))
+
+    def _clean(self):
+        for table_name in (EXPERIMENT_TYPES, EXPERIMENT_RESOURCES, EXPERIMENT_INSTANCES, EXPERIMENT_INSTANCE,
+                            RESOURCES, RESOURCE_INSTANCES, RESOURCE_SLOTS, RESOURCE_WORKING, RESOURCE_INSTANCE_EXPERIMENTS):
+            self._store.clear(table_name)
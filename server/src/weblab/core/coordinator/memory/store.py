@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+"""
+State of the in-process coordinator. It is a set of named tables (dicts),
+each of them protected by its own lock. The values of a key are either
+plain JSON-serializable values (set and delete) or sets of strings (add
+and discard).
+
+Optionally, every change is appended to a Journal, so the state can be
+recovered when the process is restarted after a crash. The journal is
+compacted (rewritten with only the current state) when it is opened and
+whenever it grows too much.
+"""
+
+import os
+import json
+import threading
+
+import voodoo.log as log
+
+OP_SET     = 'set'
+OP_DELETE  = 'delete'
+OP_ADD     = 'add'
+OP_DISCARD = 'discard'
+OP_CLEAR   = 'clear'
+
+# The journal is not compacted below this number of entries
+MIN_COMPACTION_ENTRIES = 10000
+
+def _to_str(value):
+    # json returns unicode strings, while the rest of the coordinator
+    # (as the redis one) works with utf-8 encoded str
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [ _to_str(element) for element in value ]
+    if isinstance(value, dict):
+        return dict( (_to_str(k), _to_str(v)) for k, v in value.iteritems() )
+    return value
+
+def _decode_key(key):
+    key = _to_str(key)
+    if isinstance(key, list):
+        return tuple(key)
+    return key
+
+class Journal(object):
+    """
+    Append-only file with one change per line. If fsync is True, every
+    change is flushed to the disk before returning (otherwise only to the
+    operating system, so a crash of the process does not lose anything,
+    but a crash of the machine might lose the latest changes).
+    """
+
+    def __init__(self, path, fsync = False):
+        self.path    = path
+        self.fsync   = fsync
+        self.entries = 0
+        self._lock   = threading.Lock()
+        self._file   = None
+
+    def replay(self, apply_change):
+        """ Calls apply_change(op, table, key, value) for every change stored """
+        if not os.path.exists(self.path):
+            return 0
+
+        replayed = 0
+        with open(self.path, 'rb') as f:
+            for line_number, line in enumerate(f):
+                try:
+                    op, table, key, value = json.loads(line)
+                except ValueError:
+                    # The process died while writing the last change
+                    log.log(Journal, log.level.Warning, "Ignoring the corrupted line %s and the rest of the journal %s" % (line_number + 1, self.path))
+                    break
+                apply_change(str(op), str(table), _decode_key(key), _to_str(value))
+                replayed += 1
+        return replayed
+
+    def append(self, op, table, key, value):
+        line = json.dumps([op, table, key, value]) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.entries += 1
+
+    def rewrite(self, changes):
+        """ Atomically replaces the journal by the provided changes """
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            entries = 0
+            with open(tmp_path, 'wb') as f:
+                for op, table, key, value in changes:
+                    f.write(json.dumps([op, table, key, value]) + '\n')
+                    entries += 1
+                f.flush()
+                os.fsync(f.fileno())
+
+            if self._file is not None:
+                self._file.close()
+            os.rename(tmp_path, self.path)
+            self._file = open(self.path, 'ab')
+            self.entries = entries
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+class MemoryStore(object):
+
+    def __init__(self, journal = None):
+        self._journal      = journal
+        self._tables       = {} # name : dict
+        self._locks        = {} # name : lock of that table
+        self._tables_lock  = threading.Lock()
+        self._compaction_threshold = MIN_COMPACTION_ENTRIES
+
+        if journal is not None:
+            replayed = journal.replay(self._replay_change)
+            log.log(MemoryStore, log.level.Info, "%s changes recovered from the journal %s" % (replayed, journal.path))
+            self.compact()
+
+    def _table(self, name):
+        with self._tables_lock:
+            table = self._tables.get(name)
+            if table is None:
+                table = self._tables[name] = {}
+                self._locks[name] = threading.Lock()
+            return table, self._locks[name]
+
+    def _replay_change(self, op, table_name, key, value):
+        table, _ = self._table(table_name)
+        self._apply(table, op, key, value)
+
+    def _apply(self, table, op, key, value):
+        """ Applies the change and returns if anything changed """
+        if op == OP_SET:
+            table[key] = value
+            return True
+        elif op == OP_DELETE:
+            if key not in table:
+                return False
+            del table[key]
+            return True
+        elif op == OP_ADD:
+            members = table.get(key)
+            if members is None:
+                members = table[key] = set()
+            elif value in members:
+                return False
+            members.add(value)
+            return True
+        elif op == OP_DISCARD:
+            members = table.get(key)
+            if members is None or value not in members:
+                return False
+            members.remove(value)
+            if not members:
+                table.pop(key)
+            return True
+        elif op == OP_CLEAR:
+            changed = len(table) > 0
+            table.clear()
+            return changed
+        raise ValueError("Unknown operation: %r" % op)
+
+    def _change(self, table_name, op, key = None, value = None):
+        table, lock = self._table(table_name)
+        compact = False
+        with lock:
+            changed = self._apply(table, op, key, value)
+            if changed and self._journal is not None:
+                self._journal.append(op, table_name, key, value)
+                compact = self._journal.entries > self._compaction_threshold
+        if compact:
+            self.compact()
+        return changed
+
+    #
+    # Changes
+    #
+    def set(self, table_name, key, value):
+        self._change(table_name, OP_SET, key, value)
+
+    def delete(self, table_name, key):
+        return self._change(table_name, OP_DELETE, key)
+
+    def add(self, table_name, key, member):
+        return self._change(table_name, OP_ADD, key, member)
+
+    def discard(self, table_name, key, member):
+        return self._change(table_name, OP_DISCARD, key, member)
+
+    def clear(self, table_name):
+        return self._change(table_name, OP_CLEAR)
+
+    #
+    # Queries
+    #
+    def get(self, table_name, key, default = None):
+        table, _ = self._table(table_name)
+        return table.get(key, default)
+
+    def exists(self, table_name, key):
+        table, _ = self._table(table_name)
+        return key in table
+
+    def members(self, table_name, key):
+        table, lock = self._table(table_name)
+        with lock:
+            return set(table.get(key, ()))
+
+    def is_member(self, table_name, key, member):
+        table, lock = self._table(table_name)
+        with lock:
+            return member in table.get(key, ())
+
+    def keys(self, table_name):
+        table, lock = self._table(table_name)
+        with lock:
+            return table.keys()
+
+    def items(self, table_name):
+        table, lock = self._table(table_name)
+        with lock:
+            return [ (key, set(value) if isinstance(value, set) else value) for key, value in table.iteritems() ]
+
+    #
+    # Journal management
+    #
+    def compact(self):
+        """ Rewrites the journal with the current state """
+        if self._journal is None:
+            return
+
+        while True:
+            with self._tables_lock:
+                table_names = sorted(self._tables)
+                locks = [ self._locks[name] for name in table_names ]
+
+            # Always in the same order: the locks of the tables, then the lock
+            # of the list of tables (so no table is created meanwhile) and
+            # then the lock of the journal
+            for lock in locks:
+                lock.acquire()
+            try:
+                with self._tables_lock:
+                    if sorted(self._tables) != table_names:
+                        # Somebody created a table meanwhile
+                        continue
+
+                    changes = []
+                    for table_name in table_names:
+                        for key, value in self._tables[table_name].iteritems():
+                            if isinstance(value, set):
+                                for member in value:
+                                    changes.append((OP_ADD, table_name, key, member))
+                            else:
+                                changes.append((OP_SET, table_name, key, value))
+
+                    self._journal.rewrite(changes)
+                    self._compaction_threshold = max(MIN_COMPACTION_ENTRIES, 2 * len(changes))
+                    return
+            finally:
+                for lock in reversed(locks):
+                    lock.release()
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
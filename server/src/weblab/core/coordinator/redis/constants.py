@@ -33,9 +33,11 @@ WEBLAB_RESOURCE_PQUEUE_INSTANCE_RESERVATIONS = 'weblab:resources:%s:%s:reservati
 WEBLAB_RESOURCE_PQUEUE_POSITIONS             = 'weblab:resources:%s:reservations:pqueue:positions'
 WEBLAB_RESOURCE_PQUEUE_MAP                   = 'weblab:resources:%s:reservations:pqueue:map'
 WEBLAB_RESOURCE_PQUEUE_SORTED                = 'weblab:resources:%s:reservations:pqueue:sorted'
+WEBLAB_RESOURCE_PQUEUE_EVENTS                = 'weblab:resources:%s:reservations:pqueue:events'
+WEBLAB_RESOURCE_PQUEUE_DEADLINES             = 'weblab:resources:%s:reservations:pqueue:deadlines'
 
-WEBLAB_RESERVATIONS_LOCK              = 'weblab:reservations:lock'
 WEBLAB_RESERVATIONS                   = 'weblab:reservations'
+WEBLAB_RESERVATIONS_LATEST_ACCESS     = 'weblab:reservations:latest_access'
 WEBLAB_RESERVATIONS_FINISHING         = 'weblab:reservations:finishing'
 WEBLAB_RESERVATION                    = 'weblab:reservations:%s'
 WEBLAB_RESERVATION_STATUS             = 'weblab:reservations:%s:status'
@@ -82,3 +84,11 @@ STATUS_WAITING_CONFIRMATION  = 'status_waiting_confirmation'
 INITIAL_DATA                 = 'initial_data'
 END_DATA                     = 'end_data'
 FINISHED                     = 'finished'
+
+# Queue events
+EVENT_RESERVED               = 'reserved'
+EVENT_PROMOTED               = 'promoted'
+EVENT_CONFIRMED              = 'confirmed'
+EVENT_REQUEUED               = 'requeued'
+EVENT_REMOVED                = 'removed'
+EVENT_RESOURCES_CHANGED      = 'resources_changed'
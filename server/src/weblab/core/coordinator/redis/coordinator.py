@@ -88,6 +88,7 @@ class Coordinator(AbstractCoordinator):
 
     def _initialize_managers(self):
         self.reservations_manager          = ReservationsManager.ReservationsManager(self._redis_maker)
+        self.reservations_manager.rebuild_latest_access_index()
         self.resources_manager             = ResourcesManager.ResourcesManager(self._redis_maker)
         self.post_reservation_data_manager = PostReservationDataManager.PostReservationDataManager(self._redis_maker, self.time_provider)
 
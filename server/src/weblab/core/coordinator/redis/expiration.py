@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import threading
+
+import voodoo.log as log
+import voodoo.counter as counter
+import voodoo.resources_manager as ResourceManager
+
+_resource_manager = ResourceManager.CancelAndJoinResourceManager("UserProcessingServer")
+
+class ReservationsExpirationWorker(threading.Thread):
+    """
+    Periodically removes the expired reservations of a scheduler, so
+    reservations whose slot has finished are released even if nobody
+    is polling.
+    """
+    def __init__(self, scheduler, period):
+        super(ReservationsExpirationWorker, self).__init__()
+        self.setName(counter.next_name("ReservationsExpirationWorker"))
+        self.setDaemon(True)
+        self.scheduler = scheduler
+        self.period    = period
+        self._stopped  = threading.Event()
+
+    def start(self):
+        super(ReservationsExpirationWorker, self).start()
+        _resource_manager.add_resource(self)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        _resource_manager.remove_resource(self)
+
+    def cancel(self):
+        self.stop()
+
+    def run(self):
+        while not self._stopped.is_set():
+            self._stopped.wait(self.period)
+            if self._stopped.is_set():
+                break
+
+            try:
+                self.scheduler._remove_expired_reservations()
+            except:
+                log.log(ReservationsExpirationWorker, log.level.Error, "Exception removing expired reservations")
+                log.log_exc(ReservationsExpirationWorker, log.level.Warning)
@@ -103,7 +103,7 @@ class IndependentSchedulerAggregator(Scheduler):
 
         original_server_uuids = list(request_info.get(SERVER_UUIDS, []))
 
-        self.reservations_manager.lock_reservation(reservation_id)
+        lock_token = self.reservations_manager.lock_reservation(reservation_id)
         try:
             for resource_type_name in self.sorted_schedulers:
                 # TODO: catch possible exceptions and "continue"
@@ -144,7 +144,7 @@ class IndependentSchedulerAggregator(Scheduler):
 
             return self.select_best_reservation_status(all_reservation_status.values())
         finally:
-            self.reservations_manager.unlock_reservation(reservation_id)
+            self.reservations_manager.unlock_reservation(reservation_id, lock_token)
 
     @Override(Scheduler)
     def get_uuids(self):
@@ -174,7 +174,7 @@ class IndependentSchedulerAggregator(Scheduler):
 
             print tabs, "<", url, self.schedulers.values(), ">"
 
-        self.reservations_manager.lock_reservation(reservation_id)
+        lock_token = self.reservations_manager.lock_reservation(reservation_id)
         try:
             assigned_resource_type_name = None
 
@@ -226,7 +226,7 @@ class IndependentSchedulerAggregator(Scheduler):
                 IndependentSchedulerAggregator, log.level.Info,
                 "Had to select for reservation_id %s among %s and chose %s" % (reservation_id, str(all_reservation_status.values()), str(best_reservation) ), max_size = 100000)
         finally:
-            self.reservations_manager.unlock_reservation(reservation_id)
+            self.reservations_manager.unlock_reservation(reservation_id, lock_token)
 
         if DEBUG:
             print tabs, "</", url, best_reservation, "/>"
@@ -240,7 +240,7 @@ class IndependentSchedulerAggregator(Scheduler):
 
         # TODO: does this make sense? locking is not used anywhere
         if locking:
-            self.reservations_manager.lock_reservation(reservation_id)
+            lock_token = self.reservations_manager.lock_reservation(reservation_id)
         try:
             initial_reservation_schedulers = self.resources_manager.retrieve_schedulers_per_reservation(reservation_id, self.experiment_id)
             if assigned_resource_type_name not in initial_reservation_schedulers:
@@ -272,7 +272,7 @@ class IndependentSchedulerAggregator(Scheduler):
                     removed.add(resource_type_name)
         finally:
             if locking:
-                self.reservations_manager.unlock_reservation(reservation_id)
+                self.reservations_manager.unlock_reservation(reservation_id, lock_token)
 
         return removed
 
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import time
+import json
+import weakref
+import threading
+
+import voodoo.log as log
+import voodoo.counter as counter
+import voodoo.resources_manager as ResourceManager
+
+from weblab.core.coordinator.redis.constants import (
+    WEBLAB_RESOURCE_PQUEUE_EVENTS,
+    EVENT_CONFIRMED,
+)
+
+_resource_manager = ResourceManager.CancelAndJoinResourceManager("UserProcessingServer")
+
+###########################################################
+#
+# Every change in the queue of a resource type (a new
+# reservation, a promotion, a confirmation, a reservation
+# removed, a resource broken or fixed...) is published in
+# the redis channel of that resource type. Each core server
+# listens to those channels and keeps in memory the latest
+# status of the reservations waiting in the queue, so
+# polling clients can be answered without asking redis nor
+# waiting for the scheduler, as long as nothing changed.
+#
+
+# resource_type_name : WeakSet(ReservationStatusCache)
+_local_caches      = {}
+_local_caches_lock = threading.Lock()
+
+def publish_queue_event(client, resource_type_name, event, reservation_id = None):
+    message = json.dumps({ 'event' : event, 'reservation_id' : reservation_id })
+    client.publish(WEBLAB_RESOURCE_PQUEUE_EVENTS % resource_type_name, message)
+
+    # The caches of this process are notified right away, so the core
+    # server performing the change never answers with an outdated status
+    _dispatch_locally(resource_type_name, event, reservation_id)
+
+def _dispatch_locally(resource_type_name, event, reservation_id):
+    with _local_caches_lock:
+        caches = list(_local_caches.get(resource_type_name, ()))
+
+    for cache in caches:
+        cache.process_event(event, reservation_id)
+
+class ReservationStatusCache(object):
+    """
+    In-memory cache of the status of the reservations of a resource type.
+
+    The cache is disabled until the QueueEventsListener is subscribed to
+    the events of the resource type, and whenever that subscription is
+    lost, since events might have been missed.
+    """
+    def __init__(self, resource_type_name):
+        self.resource_type_name = resource_type_name
+
+        self._lock       = threading.Lock()
+        self._statuses   = {}
+        self._generation = 0
+        self._enabled    = False
+
+        with _local_caches_lock:
+            _local_caches.setdefault(resource_type_name, weakref.WeakSet()).add(self)
+
+    def dispose(self):
+        with _local_caches_lock:
+            _local_caches.get(self.resource_type_name, set()).discard(self)
+
+    @property
+    def generation(self):
+        """ Take it before calculating a status, and provide it to store it """
+        return self._generation
+
+    def get(self, reservation_id):
+        return self._statuses.get(reservation_id)
+
+    def store(self, reservation_id, status, generation):
+        with self._lock:
+            # If anything changed while the status was being calculated,
+            # the status might be outdated, so it is not stored
+            if self._enabled and generation == self._generation:
+                self._statuses[reservation_id] = status
+
+    def invalidate(self, reservation_id):
+        with self._lock:
+            self._generation += 1
+            self._statuses.pop(reservation_id, None)
+
+    def invalidate_all(self):
+        with self._lock:
+            self._generation += 1
+            self._statuses.clear()
+
+    def enable(self):
+        with self._lock:
+            self._generation += 1
+            self._statuses.clear()
+            self._enabled = True
+
+    def disable(self):
+        with self._lock:
+            self._generation += 1
+            self._statuses.clear()
+            self._enabled = False
+
+    def process_event(self, event, reservation_id):
+        if event == EVENT_CONFIRMED and reservation_id is not None:
+            # Only the status of that reservation changes
+            self.invalidate(reservation_id)
+        else:
+            # Any other change may alter the position of everyone
+            self.invalidate_all()
+
+class QueueEventsListener(threading.Thread):
+    """
+    Listens to the events published for a resource type and applies them
+    to a ReservationStatusCache.
+    """
+
+    RETRY_TIME = 1 # seconds
+
+    def __init__(self, redis_maker, cache):
+        super(QueueEventsListener, self).__init__()
+        self.setName(counter.next_name("QueueEventsListener"))
+        self.setDaemon(True)
+        self.redis_maker = redis_maker
+        self.cache       = cache
+        self.channel     = WEBLAB_RESOURCE_PQUEUE_EVENTS % cache.resource_type_name
+        self.stopped     = False
+        self._pubsub     = None
+
+    def start(self):
+        super(QueueEventsListener, self).start()
+        _resource_manager.add_resource(self)
+
+    def stop(self):
+        self.stopped = True
+        pubsub = self._pubsub
+        if pubsub is not None:
+            try:
+                pubsub.unsubscribe()
+            except:
+                pass # It is being stopped anyway
+        self.join(self.RETRY_TIME * 2)
+        _resource_manager.remove_resource(self)
+
+    def cancel(self):
+        self.stop()
+
+    def run(self):
+        while not self.stopped:
+            try:
+                self._pubsub = self.redis_maker().pubsub()
+                self._pubsub.subscribe(self.channel)
+                if self.stopped:
+                    break
+
+                for message in self._pubsub.listen():
+                    if self.stopped:
+                        break
+
+                    if message['type'] == 'subscribe':
+                        # From now on, no change will be missed
+                        self.cache.enable()
+                    elif message['type'] == 'message':
+                        data = json.loads(message['data'])
+                        self.cache.process_event(data.get('event'), data.get('reservation_id'))
+            except:
+                if not self.stopped:
+                    log.log(QueueEventsListener, log.level.Error, "Error listening to %s; retrying in %s seconds" % (self.channel, self.RETRY_TIME))
+                    log.log_exc(QueueEventsListener, log.level.Warning)
+            finally:
+                # Events might be missed from now on
+                self.cache.disable()
+                self._close()
+
+            if not self.stopped:
+                time.sleep(self.RETRY_TIME)
+
+    def _close(self):
+        pubsub, self._pubsub = self._pubsub, None
+        if pubsub is not None:
+            close = getattr(pubsub, 'close', None) or getattr(pubsub, 'reset', None)
+            if close is not None:
+                try:
+                    close()
+                except:
+                    pass
@@ -35,15 +35,21 @@ from weblab.core.coordinator.resource import Resource
 
 from weblab.data.experiments import ExperimentInstanceId, ExperimentId
 
+from weblab.core.coordinator.redis.promotion import PROMOTION_SCRIPT
+from weblab.core.coordinator.redis.notifications import publish_queue_event, ReservationStatusCache, QueueEventsListener
+from weblab.core.coordinator.redis.expiration import ReservationsExpirationWorker
+
 from weblab.core.coordinator.redis.constants import (
     WEBLAB_RESOURCE_RESERVATION_PQUEUE,
     WEBLAB_RESOURCE_SLOTS,
+    WEBLAB_RESOURCE_WORKING,
     WEBLAB_RESOURCE_RESERVATIONS,
     WEBLAB_RESOURCE_PQUEUE_RESERVATIONS,
     WEBLAB_RESOURCE_PQUEUE_POSITIONS,
     WEBLAB_RESOURCE_PQUEUE_MAP,
     WEBLAB_RESOURCE_PQUEUE_SORTED,
     WEBLAB_RESOURCE_PQUEUE_INSTANCE_RESERVATIONS,
+    WEBLAB_RESOURCE_PQUEUE_DEADLINES,
 
     LAB_COORD,
     CLIENT_INITIAL_DATA,
@@ -63,6 +69,12 @@ from weblab.core.coordinator.redis.constants import (
     ACTIVE_STATUS,
     STATUS_RESERVED,
     STATUS_WAITING_CONFIRMATION,
+
+    EVENT_RESERVED,
+    EVENT_PROMOTED,
+    EVENT_CONFIRMED,
+    EVENT_REQUEUED,
+    EVENT_REMOVED,
 )
 
 EXPIRATION_TIME  = 3600 # seconds
@@ -95,17 +107,56 @@ TIME_ANTI_RACE_CONDITIONS = 0.1
 
 class PriorityQueueScheduler(Scheduler):
 
-    def __init__(self, generic_scheduler_arguments, randomize_instances = True, **kwargs):
+    def __init__(self, generic_scheduler_arguments, randomize_instances = True, server_side_promotion = True, status_notifications = True, expiration_check_period = 1, **kwargs):
         super(PriorityQueueScheduler, self).__init__(generic_scheduler_arguments, **kwargs)
 
         self.randomize_instances = randomize_instances
 
+        # If True, waiting reservations are promoted by a Lua script running
+        # in the redis server (which requires redis >= 2.6). Otherwise, they
+        # are promoted from here, one redis command at a time.
+        self.server_side_promotion = server_side_promotion
+
         self._synchronizer = SchedulerTransactionsSynchronizer(self)
         self._synchronizer.start()
 
+        # If True, the statuses of the waiting reservations are kept in
+        # memory, and they are only calculated again when the events
+        # published by any core server notify that the queue changed.
+        if status_notifications:
+            self._status_cache    = ReservationStatusCache(self.resource_type_name)
+            self._events_listener = QueueEventsListener(self.redis_maker, self._status_cache)
+            self._events_listener.start()
+        else:
+            self._status_cache    = None
+            self._events_listener = None
+
+        # The end of the slot of every active reservation is indexed in a
+        # sorted set, so only those reservations whose slot has already
+        # finished are checked. Reservations confirmed by a previous
+        # version of the scheduler are indexed here.
+        self._rebuild_deadlines()
+
+        # If a period (in seconds) is provided, the expired reservations
+        # are also removed in background, and not only when a user asks
+        # for something.
+        if expiration_check_period:
+            self._expiration_worker = ReservationsExpirationWorker(self, expiration_check_period)
+            self._expiration_worker.start()
+        else:
+            self._expiration_worker = None
+
     @Override(Scheduler)
     def stop(self):
         self._synchronizer.stop()
+        if self._expiration_worker is not None:
+            self._expiration_worker.stop()
+        if self._events_listener is not None:
+            self._events_listener.stop()
+            self._status_cache.dispose()
+
+    def _publish(self, client, event, reservation_id = None):
+        publish_queue_event(client, self.resource_type_name, event, reservation_id)
 
     @Override(Scheduler)
     def is_remote(self):
@@ -135,6 +186,7 @@ class PriorityQueueScheduler(Scheduler):
                 reservation_data.pop(EXP_INFO,         None)
                 reservation_data_str = json.dumps(reservation_data)
                 reservation_data = client.set(weblab_reservation_pqueue, reservation_data_str)
+                client.zrem(WEBLAB_RESOURCE_PQUEUE_DEADLINES % self.resource_type_name, current_reservation_id)
                 # Add back to the queue
 
                 weblab_resource_pqueue_map          = WEBLAB_RESOURCE_PQUEUE_MAP          % self.resource_type_name
@@ -142,6 +194,7 @@ class PriorityQueueScheduler(Scheduler):
 
                 filled_reservation_id = client.hget(weblab_resource_pqueue_map, current_reservation_id)
                 client.zadd(weblab_resource_pqueue_sorted, filled_reservation_id, -1)
+                self._publish(client, EVENT_REQUEUED, current_reservation_id)
                 return True
            
         return False
@@ -187,6 +240,8 @@ class PriorityQueueScheduler(Scheduler):
         
         pipeline.execute()
 
+        self._publish(client, EVENT_RESERVED, reservation_id)
+
         return self.get_reservation_status(reservation_id)
 
 
@@ -205,6 +260,14 @@ class PriorityQueueScheduler(Scheduler):
         if expired:
             self._delete_reservation(reservation_id)
             raise ExpiredSessionError("Expired reservation")
+
+        if self._status_cache is not None:
+            cached_status = self._status_cache.get(reservation_id)
+            if cached_status is not None:
+                return cached_status
+            generation = self._status_cache.generation
+        else:
+            generation = None
    
         self._synchronizer.request_and_wait()
 
@@ -228,7 +291,8 @@ class PriorityQueueScheduler(Scheduler):
             
             # It may be just waiting for the experiment server to respond
             if status == STATUS_WAITING_CONFIRMATION:
-                return WSS.WaitingConfirmationQueueStatus(reservation_id_with_route, self.core_server_url)
+                status = WSS.WaitingConfirmationQueueStatus(reservation_id_with_route, self.core_server_url)
+                return self._cache_status(reservation_id, status, generation)
 
             # Or the experiment server already responded and therefore we have all this data
             str_lab_coord_address        = reservation_data[LAB_COORD]
@@ -277,9 +341,15 @@ class PriorityQueueScheduler(Scheduler):
             return self.get_reservation_status(reservation_id)
 
         if self.resources_manager.are_resource_instances_working(self.resource_type_name):
-            return WSS.WaitingQueueStatus(reservation_id_with_route, position)
+            status = WSS.WaitingQueueStatus(reservation_id_with_route, position)
         else:
-            return WSS.WaitingInstancesQueueStatus(reservation_id_with_route, position)
+            status = WSS.WaitingInstancesQueueStatus(reservation_id_with_route, position)
+        return self._cache_status(reservation_id, status, generation)
+
+    def _cache_status(self, reservation_id, status, generation):
+        if self._status_cache is not None:
+            self._status_cache.store(reservation_id, status, generation)
+        return status
 
 
     ################################################################
@@ -316,6 +386,9 @@ class PriorityQueueScheduler(Scheduler):
 
         pqueue_reservation_data_str = json.dumps(pqueue_reservation_data)
         client.set(weblab_reservation_pqueue, pqueue_reservation_data_str)
+        client.zadd(WEBLAB_RESOURCE_PQUEUE_DEADLINES % self.resource_type_name, reservation_id, self._get_slot_deadline(pqueue_reservation_data))
+
+        self._publish(client, EVENT_CONFIRMED, reservation_id)
 
     ################################################################
     #
@@ -382,6 +455,44 @@ class PriorityQueueScheduler(Scheduler):
     #
     @exc_checker
     def _update_queues(self):
+        if self.server_side_promotion:
+            self._update_queues_server_side()
+        else:
+            self._update_queues_client_side()
+
+    def _update_queues_server_side(self):
+        ###########################################################
+        # The whole promotion (take the first waiting reservations
+        # which can be promoted, acquire a free working slot for
+        # each, select an experiment instance of the requested type
+        # and store the new state) is performed atomically by a
+        # single script in the redis server, so there is no need
+        # to confirm and downgrade if other core server changed
+        # something in the meanwhile.
+        #
+        client = self.redis_maker()
+
+        weblab_resource_pqueue_sorted = WEBLAB_RESOURCE_PQUEUE_SORTED % self.resource_type_name
+        weblab_resource_slots         = WEBLAB_RESOURCE_SLOTS         % self.resource_type_name
+        weblab_resource_working       = WEBLAB_RESOURCE_WORKING       % self.resource_type_name
+        weblab_resource_deadlines     = WEBLAB_RESOURCE_PQUEUE_DEADLINES % self.resource_type_name
+
+        start_time = self.time_provider.get_time()
+
+        promotions = PROMOTION_SCRIPT(client, 
+                        keys = (weblab_resource_pqueue_sorted, weblab_resource_slots, weblab_resource_working, weblab_resource_deadlines), 
+                        args = (self.resource_type_name, json.dumps(start_time), 1 if self.randomize_instances else 0, random.randint(0, 2 ** 30)))
+
+        for reservation_id, _, experiment_instance_str, laboratory_coord_address, reservation_data_str, pqueue_reservation_data_str in promotions:
+            self._publish(client, EVENT_PROMOTED, reservation_id)
+
+            selected_experiment_instance = ExperimentInstanceId.parse(experiment_instance_str)
+            reservation_data             = json.loads(reservation_data_str)
+            pqueue_reservation_data      = json.loads(pqueue_reservation_data_str)
+
+            self._enqueue_confirmation(reservation_id, selected_experiment_instance, laboratory_coord_address, start_time, reservation_data, pqueue_reservation_data)
+
+    def _update_queues_client_side(self):
         ###########################################################
         # There are reasons why a waiting reservation may not be
         # able to be promoted while the next one is. For instance,
@@ -489,19 +600,12 @@ class PriorityQueueScheduler(Scheduler):
                 pqueue_reservation_data = json.loads(pqueue_reservation_data_str)
 
                 start_time                                 = self.time_provider.get_time()
-                total_time                                 = pqueue_reservation_data[TIME]
                 pqueue_reservation_data[START_TIME]        = start_time
 
 
                 pqueue_reservation_data[TIMESTAMP_BEFORE]  = start_time
                 pqueue_reservation_data[ACTIVE_STATUS]     = STATUS_WAITING_CONFIRMATION
                 pqueue_reservation_data[RESOURCE_INSTANCE] = free_instance.to_weblab_str()
-                initialization_in_accounting               = pqueue_reservation_data[INITIALIZATION_IN_ACCOUNTING]
-
-                client_initial_data       = reservation_data[CLIENT_INITIAL_DATA]
-                request_info              = json.loads(reservation_data[REQUEST_INFO])
-                username                  = request_info.get('username')
-                locale                    = request_info.get('locale')
 
                 requested_experiment_type = ExperimentId.parse(reservation_data[EXPERIMENT_TYPE])
 
@@ -524,37 +628,90 @@ class PriorityQueueScheduler(Scheduler):
                 pqueue_reservation_data[LAB_COORD] = laboratory_coord_address
                 client.set(weblab_reservation_pqueue, json.dumps(pqueue_reservation_data))
 
+                slot_deadline = self._get_slot_deadline(pqueue_reservation_data)
+                if slot_deadline is not None:
+                    client.zadd(WEBLAB_RESOURCE_PQUEUE_DEADLINES % self.resource_type_name, first_waiting_reservation_id, slot_deadline)
+
                 filled_reservation_id = client.hget(weblab_resource_pqueue_map, first_waiting_reservation_id)
                 client.zrem(weblab_resource_pqueue_sorted, filled_reservation_id)
+                self._publish(client, EVENT_PROMOTED, first_waiting_reservation_id)
 
-                #
-                # Enqueue the confirmation, since it might take a long time
-                # (for instance, if the laboratory server does not reply because
-                # of any network problem, or it just takes too much in replying),
-                # so this method might take too long. That's why we enqueue these
-                # petitions and run them in other threads.
-                #
-                deserialized_server_initial_data = {
-                        'priority.queue.slot.length'                       : '%s' % total_time,
-                        'priority.queue.slot.start'                        : '%s' % datetime.datetime.fromtimestamp(start_time),
-                        'priority.queue.slot.initialization_in_accounting' : initialization_in_accounting,
-                        'request.experiment_id.experiment_name'            : selected_experiment_instance.exp_name,
-                        'request.experiment_id.category_name'              : selected_experiment_instance.cat_name,
-                        'request.username'                                 : username,
-                        'request.full_name'                                : username,
-                        'request.locale'                                   : locale,
-                        # TODO: add the username and user full name here
-                    }
-                server_initial_data = json.dumps(deserialized_server_initial_data)
-                # server_initial_data will contain information such as "what was the last experiment used?".
-                # If a single resource was used by a binary experiment, then the next time may not require reprogramming the device
-                self.confirmer.enqueue_confirmation(laboratory_coord_address, first_waiting_reservation_id, selected_experiment_instance, client_initial_data, server_initial_data, self.resource_type_name)
+                self._enqueue_confirmation(first_waiting_reservation_id, selected_experiment_instance, laboratory_coord_address, start_time, reservation_data, pqueue_reservation_data)
                 #
                 # After it, keep in the while True in order to add the next
                 # reservation
                 #
                 break
 
+    def _enqueue_confirmation(self, reservation_id, selected_experiment_instance, laboratory_coord_address, start_time, reservation_data, pqueue_reservation_data):
+        total_time                   = pqueue_reservation_data[TIME]
+        initialization_in_accounting = pqueue_reservation_data[INITIALIZATION_IN_ACCOUNTING]
+
+        client_initial_data = reservation_data[CLIENT_INITIAL_DATA]
+        request_info        = json.loads(reservation_data[REQUEST_INFO])
+        username            = request_info.get('username')
+        locale              = request_info.get('locale')
+
+        #
+        # Enqueue the confirmation, since it might take a long time
+        # (for instance, if the laboratory server does not reply because
+        # of any network problem, or it just takes too much in replying),
+        # so this method might take too long. That's why we enqueue these
+        # petitions and run them in other threads.
+        #
+        deserialized_server_initial_data = {
+                'priority.queue.slot.length'                       : '%s' % total_time,
+                'priority.queue.slot.start'                        : '%s' % datetime.datetime.fromtimestamp(start_time),
+                'priority.queue.slot.initialization_in_accounting' : initialization_in_accounting,
+                'request.experiment_id.experiment_name'            : selected_experiment_instance.exp_name,
+                'request.experiment_id.category_name'              : selected_experiment_instance.cat_name,
+                'request.username'                                 : username,
+                'request.full_name'                                : username,
+                'request.locale'                                   : locale,
+                # TODO: add the username and user full name here
+            }
+        server_initial_data = json.dumps(deserialized_server_initial_data)
+        # server_initial_data will contain information such as "what was the last experiment used?".
+        # If a single resource was used by a binary experiment, then the next time may not require reprogramming the device
+        self.confirmer.enqueue_confirmation(laboratory_coord_address, reservation_id, selected_experiment_instance, client_initial_data, server_initial_data, self.resource_type_name)
+
+    def _get_slot_deadline(self, pqueue_reservation_data):
+        """ When does the slot of an active reservation finish (None if it can not be known yet) """
+        if ACTIVE_STATUS not in pqueue_reservation_data:
+            return None
+
+        total_time                   = pqueue_reservation_data[TIME]
+        timestamp_before             = pqueue_reservation_data[TIMESTAMP_BEFORE]
+        timestamp_after              = pqueue_reservation_data.get(TIMESTAMP_AFTER)
+        initialization_in_accounting = pqueue_reservation_data[INITIALIZATION_IN_ACCOUNTING]
+        # if timestamp_after is None and initialization should not be considered,
+        # then we can not calculate if the time has expired, so we skip it (it will
+        # be considered as expired for lack of LATEST_ACCESS
+        if timestamp_after is None and not initialization_in_accounting:
+            return None
+
+        timestamp = timestamp_before if initialization_in_accounting else timestamp_after
+        return timestamp + total_time
+
+    def _rebuild_deadlines(self):
+        client = self.redis_maker()
+        weblab_resource_pqueue_reservations = WEBLAB_RESOURCE_PQUEUE_RESERVATIONS % self.resource_type_name
+        weblab_resource_deadlines           = WEBLAB_RESOURCE_PQUEUE_DEADLINES    % self.resource_type_name
+        reservations = list(client.smembers(weblab_resource_pqueue_reservations))
+
+        pipeline = client.pipeline()
+        for reservation_id in reservations:
+            pipeline.get(WEBLAB_RESOURCE_RESERVATION_PQUEUE % (self.resource_type_name, reservation_id))
+        results = pipeline.execute()
+
+        pipeline = client.pipeline()
+        for reservation_id, reservation_data in zip(reservations, results):
+            if reservation_data is not None:
+                slot_deadline = self._get_slot_deadline(json.loads(reservation_data))
+                if slot_deadline is not None:
+                    pipeline.zadd(weblab_resource_deadlines, reservation_id, slot_deadline)
+        pipeline.execute()
+
     ################################################
     #
     # Remove all reservations whose session has expired
@@ -566,35 +723,34 @@ class PriorityQueueScheduler(Scheduler):
         enqueue_free_experiment_args_retrieved = []
 
         client = self.redis_maker()
-        weblab_resource_pqueue_reservations = WEBLAB_RESOURCE_PQUEUE_RESERVATIONS % self.resource_type_name 
-        reservations = [ reservation_id for reservation_id in client.smembers(weblab_resource_pqueue_reservations) ]
+        weblab_resource_deadlines = WEBLAB_RESOURCE_PQUEUE_DEADLINES % self.resource_type_name
+
+        # Only the reservations whose slot should have finished by now are
+        # retrieved. Other core servers (or the expiration worker) might
+        # be processing the same ones, so each is only processed by the
+        # one that manages to remove it from the sorted set.
+        for reservation_id in client.zrangebyscore(weblab_resource_deadlines, '-inf', now):
+            if not client.zrem(weblab_resource_deadlines, reservation_id):
+                continue
 
-        # Since there might be a lot of reservations, create a pipeline and retrieve 
-        # every reservation data in a row
-        pipeline = client.pipeline()
-        for reservation_id in reservations:
             weblab_reservation_pqueue = WEBLAB_RESOURCE_RESERVATION_PQUEUE % (self.resource_type_name, reservation_id)
-            pipeline.get(weblab_reservation_pqueue)
-        results = pipeline.execute()
-       
-        for reservation_id, reservation_data in zip(reservations, results):
-            if reservation_data is not None:
-                data = json.loads(reservation_data)
-                if ACTIVE_STATUS in data:
-                    total_time                   = data[TIME]
-                    timestamp_before             = data[TIMESTAMP_BEFORE]
-                    timestamp_after              = data.get(TIMESTAMP_AFTER)
-                    initialization_in_accounting = data[INITIALIZATION_IN_ACCOUNTING]
-                    # if timestamp_after is None and initialization should not be considered,
-                    # then we can not calculate if the time has expired, so we skip it (it will
-                    # be considered as expired for lack of LATEST_ACCESS
-                    if timestamp_after is not None or initialization_in_accounting:
-                        timestamp = timestamp_before if initialization_in_accounting else timestamp_after
-                        if now >= timestamp + total_time: # Expired
-                            enqueue_free_experiment_args = self._clean_current_reservation(reservation_id)
-                            enqueue_free_experiment_args_retrieved.append(enqueue_free_experiment_args)
-                            self._delete_reservation(reservation_id)
-                            self.reservations_manager.delete(reservation_id)
+            reservation_data = client.get(weblab_reservation_pqueue)
+            if reservation_data is None:
+                continue
+
+            slot_deadline = self._get_slot_deadline(json.loads(reservation_data))
+            if slot_deadline is None:
+                continue
+
+            if now < slot_deadline:
+                # The reservation changed in the meanwhile (e.g. it was confirmed)
+                client.zadd(weblab_resource_deadlines, reservation_id, slot_deadline)
+                continue
+
+            enqueue_free_experiment_args = self._clean_current_reservation(reservation_id)
+            enqueue_free_experiment_args_retrieved.append(enqueue_free_experiment_args)
+            self._delete_reservation(reservation_id)
+            self.reservations_manager.delete(reservation_id)
 
         # Anybody with latest_access later than this point is expired
         current_expiration_time = datetime.datetime.utcfromtimestamp(now - EXPIRATION_TIME)
@@ -622,6 +778,7 @@ class PriorityQueueScheduler(Scheduler):
         weblab_resource_pqueue_reservations          = WEBLAB_RESOURCE_PQUEUE_RESERVATIONS % self.resource_type_name
         weblab_resource_pqueue_map                   = WEBLAB_RESOURCE_PQUEUE_MAP    % self.resource_type_name
         weblab_resource_pqueue_sorted                = WEBLAB_RESOURCE_PQUEUE_SORTED % self.resource_type_name
+        weblab_resource_pqueue_deadlines             = WEBLAB_RESOURCE_PQUEUE_DEADLINES % self.resource_type_name
         weblab_reservation_pqueue                    = WEBLAB_RESOURCE_RESERVATION_PQUEUE % (self.resource_type_name, reservation_id)
 
         resource_instances = self.resources_manager.list_resource_instances_by_type(self.resource_type_name)
@@ -634,12 +791,15 @@ class PriorityQueueScheduler(Scheduler):
             pipeline.srem(weblab_resource_pqueue_instance_reservations, reservation_id)
 
         pipeline.srem(weblab_resource_pqueue_reservations, reservation_id)
+        pipeline.zrem(weblab_resource_pqueue_deadlines, reservation_id)
         pipeline.delete(weblab_reservation_pqueue)
         pipeline.execute()
 
         filled_reservation_id = client.hget(weblab_resource_pqueue_map, reservation_id)
         client.hdel(weblab_resource_pqueue_map, reservation_id)
         client.zrem(weblab_resource_pqueue_sorted, filled_reservation_id)
+
+        self._publish(client, EVENT_REMOVED, reservation_id)
         
 
     ##############################################################
@@ -660,4 +820,8 @@ class PriorityQueueScheduler(Scheduler):
         client.delete(WEBLAB_RESOURCE_PQUEUE_POSITIONS    % self.resource_type_name)
         client.delete(WEBLAB_RESOURCE_PQUEUE_MAP          % self.resource_type_name)
         client.delete(WEBLAB_RESOURCE_PQUEUE_SORTED       % self.resource_type_name)
+        client.delete(WEBLAB_RESOURCE_PQUEUE_DEADLINES    % self.resource_type_name)
+
+        if self._status_cache is not None:
+            self._status_cache.invalidate_all()
 
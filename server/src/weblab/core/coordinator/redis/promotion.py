@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+#-*-*- encoding: utf-8 -*-*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+import json
+
+from voodoo.redis_script import RedisScript
+
+from weblab.core.coordinator.redis.constants import (
+    WEBLAB_RESERVATION,
+    WEBLAB_RESERVATION_STATUS,
+    WEBLAB_RESOURCE_RESERVATION_PQUEUE,
+    WEBLAB_RESOURCE_PQUEUE_INSTANCE_RESERVATIONS,
+    WEBLAB_RESOURCE_INSTANCE_EXPERIMENTS,
+    WEBLAB_EXPERIMENT_INSTANCE,
+
+    CURRENT,
+    LAB_COORD,
+    EXPERIMENT_TYPE,
+    EXPERIMENT_INSTANCE,
+    RESOURCE_INSTANCE,
+    START_TIME,
+    TIME,
+    INITIALIZATION_IN_ACCOUNTING,
+    TIMESTAMP_BEFORE,
+    ACTIVE_STATUS,
+    STATUS_WAITING_CONFIRMATION,
+)
+
+# The start time is written by the script as a placeholder and replaced
+# afterwards by its JSON representation, since cjson only encodes 14
+# significant digits and the timestamps would lose the microseconds.
+START_TIME_PLACEHOLDER = 'WEBLAB_PROMOTION_START_TIME'
+
+_CONSTANTS = [
+    ('WEBLAB_RESERVATION',                           WEBLAB_RESERVATION),
+    ('WEBLAB_RESERVATION_STATUS',                    WEBLAB_RESERVATION_STATUS),
+    ('WEBLAB_RESOURCE_RESERVATION_PQUEUE',           WEBLAB_RESOURCE_RESERVATION_PQUEUE),
+    ('WEBLAB_RESOURCE_PQUEUE_INSTANCE_RESERVATIONS', WEBLAB_RESOURCE_PQUEUE_INSTANCE_RESERVATIONS),
+    ('WEBLAB_RESOURCE_INSTANCE_EXPERIMENTS',         WEBLAB_RESOURCE_INSTANCE_EXPERIMENTS),
+    ('WEBLAB_EXPERIMENT_INSTANCE',                   WEBLAB_EXPERIMENT_INSTANCE),
+    ('CURRENT',                                      CURRENT),
+    ('LAB_COORD',                                    LAB_COORD),
+    ('EXPERIMENT_TYPE',                              EXPERIMENT_TYPE),
+    ('EXPERIMENT_INSTANCE',                          EXPERIMENT_INSTANCE),
+    ('RESOURCE_INSTANCE',                            RESOURCE_INSTANCE),
+    ('START_TIME',                                   START_TIME),
+    ('TIME',                                         TIME),
+    ('INITIALIZATION_IN_ACCOUNTING',                 INITIALIZATION_IN_ACCOUNTING),
+    ('TIMESTAMP_BEFORE',                             TIMESTAMP_BEFORE),
+    ('ACTIVE_STATUS',                                ACTIVE_STATUS),
+    ('STATUS_WAITING_CONFIRMATION',                  STATUS_WAITING_CONFIRMATION),
+    ('START_TIME_PLACEHOLDER',                       START_TIME_PLACEHOLDER),
+]
+
+#
+# KEYS[1]: weblab:resources:%s:reservations:pqueue:sorted
+# KEYS[2]: weblab:resources:%s:slots
+# KEYS[3]: weblab:resources:%s:working
+# KEYS[4]: weblab:resources:%s:reservations:pqueue:deadlines
+#
+# ARGV[1]: resource type name
+# ARGV[2]: start time, JSON encoded
+# ARGV[3]: '1' if the free instances must be randomized, '0' otherwise
+# ARGV[4]: random seed
+#
+# Returns a list of promotions. Each promotion is a list of:
+#
+#   [ reservation_id, resource instance, experiment instance,
+#     laboratory coord address, reservation data, pqueue data ]
+#
+# where both data fields are the JSON documents as they were before
+# the promotion.
+#
+_PROMOTION_BODY = """
+local pqueue_sorted  = KEYS[1]
+local resource_slots = KEYS[2]
+local working        = KEYS[3]
+local deadlines      = KEYS[4]
+
+local resource_type = ARGV[1]
+local start_time    = ARGV[2]
+local randomize     = ARGV[3] == '1'
+
+local free_instances = redis.call('smembers', resource_slots)
+if #free_instances == 0 then
+    return {}
+end
+
+if randomize then
+    math.randomseed(tonumber(ARGV[4]))
+    for i = #free_instances, 2, -1 do
+        local j = math.random(i)
+        free_instances[i], free_instances[j] = free_instances[j], free_instances[i]
+    end
+else
+    table.sort(free_instances)
+end
+
+local promotions = {}
+
+local waiting = redis.call('zrangebyscore', pqueue_sorted, -10000, 10000)
+for _, filled_reservation_id in ipairs(waiting) do
+    if #free_instances == 0 then
+        break
+    end
+
+    local reservation_id = string.sub(filled_reservation_id, string.find(filled_reservation_id, '_', 1, true) + 1)
+
+    local reservation_status     = string.format(WEBLAB_RESERVATION_STATUS, reservation_id)
+    local reservation_pqueue     = string.format(WEBLAB_RESOURCE_RESERVATION_PQUEUE, resource_type, reservation_id)
+    local reservation_data_str   = redis.call('get', string.format(WEBLAB_RESERVATION, reservation_id))
+    local pqueue_data_str        = redis.call('get', reservation_pqueue)
+
+    -- Skip students who are not here anymore or who have already been
+    -- confirmed in other resource type
+    if reservation_data_str and pqueue_data_str and redis.call('hexists', reservation_status, CURRENT) == 0 then
+        local reservation_data   = cjson.decode(reservation_data_str)
+        local requested_type     = reservation_data[EXPERIMENT_TYPE]
+
+        for position, free_instance in ipairs(free_instances) do
+            if redis.call('sismember', working, free_instance) == 1 then
+                local selected_experiment_instance = nil
+                local instance_experiments = redis.call('smembers', string.format(WEBLAB_RESOURCE_INSTANCE_EXPERIMENTS, resource_type, free_instance))
+                for _, experiment_instance in ipairs(instance_experiments) do
+                    local separator = string.find(experiment_instance, ':', 1, true)
+                    if separator and string.sub(experiment_instance, separator + 1) == requested_type then
+                        selected_experiment_instance = experiment_instance
+                    end
+                end
+
+                if selected_experiment_instance then
+                    local separator     = string.find(selected_experiment_instance, ':', 1, true)
+                    local instance_name = string.sub(selected_experiment_instance, 1, separator - 1)
+                    local lab_coord     = redis.call('hget', string.format(WEBLAB_EXPERIMENT_INSTANCE, requested_type, instance_name), LAB_COORD)
+
+                    redis.call('hset', reservation_status, CURRENT, 1)
+                    redis.call('srem', resource_slots, free_instance)
+                    redis.call('sadd', string.format(WEBLAB_RESOURCE_PQUEUE_INSTANCE_RESERVATIONS, resource_type, free_instance), reservation_id)
+
+                    local pqueue_data = cjson.decode(pqueue_data_str)
+                    pqueue_data[START_TIME]          = START_TIME_PLACEHOLDER
+                    pqueue_data[TIMESTAMP_BEFORE]    = START_TIME_PLACEHOLDER
+                    pqueue_data[ACTIVE_STATUS]       = STATUS_WAITING_CONFIRMATION
+                    pqueue_data[RESOURCE_INSTANCE]   = free_instance .. '@' .. resource_type
+                    pqueue_data[EXPERIMENT_INSTANCE] = selected_experiment_instance
+                    pqueue_data[LAB_COORD]           = lab_coord or cjson.null
+
+                    local serialized = string.gsub(cjson.encode(pqueue_data), '"' .. START_TIME_PLACEHOLDER .. '"', start_time)
+                    redis.call('set', reservation_pqueue, serialized)
+
+                    -- If the initialization counts, the slot already started
+                    if pqueue_data[INITIALIZATION_IN_ACCOUNTING] then
+                        local deadline = tonumber(start_time) + pqueue_data[TIME]
+                        redis.call('zadd', deadlines, string.format('%.17g', deadline), reservation_id)
+                    end
+                    redis.call('zrem', pqueue_sorted, filled_reservation_id)
+
+                    table.remove(free_instances, position)
+                    table.insert(promotions, { reservation_id, free_instance, selected_experiment_instance, lab_coord, reservation_data_str, pqueue_data_str })
+                    break
+                end
+            end
+        end
+    end
+end
+
+return promotions
+"""
+
+def _build_source():
+    declarations = [ 'local %s = %s' % (name, json.dumps(value)) for name, value in _CONSTANTS ]
+    return '\n'.join(declarations) + '\n' + _PROMOTION_BODY
+
+PROMOTION_SCRIPT = RedisScript(_build_source())
+
@@ -21,11 +21,12 @@ import datetime
 from weblab.data.experiments import ExperimentId
 import weblab.core.coordinator.exc as CoordExc
 from voodoo.typechecker import typecheck
-from voodoo.resources_manager import is_testing
+from voodoo.redis_lock import RedisLock, LockMetrics
+import voodoo.log as log
 
 from weblab.core.coordinator.redis.constants import (
-    WEBLAB_RESERVATIONS_LOCK,
     WEBLAB_RESERVATIONS,
+    WEBLAB_RESERVATIONS_LATEST_ACCESS,
     WEBLAB_RESERVATION,
     WEBLAB_RESERVATION_STATUS,
     WEBLAB_RESERVATIONS_INDIVIDUAL_LOCK,
@@ -44,10 +45,13 @@ from weblab.core.coordinator.redis.constants import (
     EXPERIMENT_TYPE,
 )
 
+LOCK_TTL = 5 # seconds
+
 class ReservationsManager(object):
     def __init__(self, redis_maker):
         self._redis_maker = redis_maker
         self.now = datetime.datetime.utcnow
+        self.lock_metrics = LockMetrics()
 
     def _clean(self):
         client = self._redis_maker()
@@ -58,24 +62,28 @@ class ReservationsManager(object):
             client.delete(WEBLAB_RESERVATIONS_ACTIVE_SCHEDULERS % reservation_id)
             client.delete(WEBLAB_RESERVATIONS_INDIVIDUAL_LOCK % reservation_id)
 
-        client.delete(WEBLAB_RESERVATIONS_LOCK)
+        client.delete(WEBLAB_RESERVATIONS_LATEST_ACCESS)
         client.delete(WEBLAB_RESERVATIONS)
 
     def list_all_reservations(self):
         client = self._redis_maker()
         return client.smembers(WEBLAB_RESERVATIONS)
 
-    def lock_reservation(self, reservation_id, timeout = 10):
-        client = self._redis_maker()
-        individual_lock = WEBLAB_RESERVATIONS_INDIVIDUAL_LOCK % reservation_id
-        initial = time.time()
-        while not client.setnx(individual_lock, '') and time.time() < initial + 10:
-            time.sleep(0.05)
-        client.expire(individual_lock, 5)
+    def _reservation_lock(self, reservation_id):
+        return RedisLock(self._redis_maker, WEBLAB_RESERVATIONS_INDIVIDUAL_LOCK % reservation_id, ttl = LOCK_TTL, metrics = self.lock_metrics)
 
-    def unlock_reservation(self, reservation_id):
-        client = self._redis_maker()
-        client.delete(WEBLAB_RESERVATIONS_INDIVIDUAL_LOCK % reservation_id)
+    def lock_reservation(self, reservation_id, timeout = 10):
+        """ Returns the lock token that must be provided to unlock_reservation,
+        or None if the lock could not be acquired """
+        token = self._reservation_lock(reservation_id).acquire(timeout)
+        if token is None:
+            # As it always did, keep working without the lock
+            log.log(ReservationsManager, log.level.Warning, "Could not lock reservation %s in %s seconds" % (reservation_id, timeout))
+        return token
+
+    def unlock_reservation(self, reservation_id, token):
+        if token is not None:
+            self._reservation_lock(reservation_id).release(token)
 
     @typecheck(ExperimentId, (basestring, dict), basestring, typecheck.ANY)
     def create(self, experiment_id, client_initial_data, request_info, now = None):
@@ -113,6 +121,7 @@ class ReservationsManager(object):
 
             pipeline = client.pipeline()
             pipeline.hset(weblab_reservation_status, LATEST_ACCESS, now_timestamp)
+            pipeline.zadd(WEBLAB_RESERVATIONS_LATEST_ACCESS, reservation_id, now_timestamp)
             pipeline.set(weblab_reservation, serialized_reservation_data)
             pipeline.sadd(weblab_resource_reservations, reservation_id)
             pipeline.execute()
@@ -151,9 +160,21 @@ class ReservationsManager(object):
 
         weblab_reservation_status = WEBLAB_RESERVATION_STATUS % reservation_id
         
-        expired = client.hset(weblab_reservation_status, LATEST_ACCESS, now_timestamp)
+        pipeline = client.pipeline()
+        pipeline.hset(weblab_reservation_status, LATEST_ACCESS, now_timestamp)
+        pipeline.zadd(WEBLAB_RESERVATIONS_LATEST_ACCESS, reservation_id, now_timestamp)
+        expired, _ = pipeline.execute()
         # if it has created it, it means that it is expired
-        return expired != 0
+        if expired != 0:
+            # The caller only removes the scheduler data, so neither the status
+            # just created nor the reservation in the index must remain, or it
+            # would be rescanned forever
+            pipeline = client.pipeline()
+            pipeline.delete(weblab_reservation_status)
+            pipeline.zrem(WEBLAB_RESERVATIONS_LATEST_ACCESS, reservation_id)
+            pipeline.execute()
+            return True
+        return False
 
 
     def confirm(self, reservation_id):
@@ -173,37 +194,28 @@ class ReservationsManager(object):
     def list_expired_reservations(self, expiration_time):
         expiration_timestamp = time.mktime(expiration_time.timetuple()) + expiration_time.microsecond / 1e6
         client = self._redis_maker()
-        
-        # This is not a problem in SQL, since we say "retrieve only those that have expired"
-        # However, I simply don't know how to say that in redis, even using expire or expireat. 
-        # The only way I can think of is to check the whole table of reservations. So we have
-        # established a mechanism based on expiration to avoid performing this more than once per
-        # second
 
-        acquired = client.hset(WEBLAB_RESERVATIONS_LOCK, "locked", 1)
-        if not acquired and not is_testing():
-            # When testing, we want to avoid that two calls return different results, so 
-            # we ignore the mechanism
-            return []
+        # WEBLAB_RESERVATIONS_LATEST_ACCESS is sorted by the latest access, 
+        # so only the expired reservations are retrieved
+        return client.zrangebyscore(WEBLAB_RESERVATIONS_LATEST_ACCESS, '-inf', '(%r' % expiration_timestamp)
+
+    def rebuild_latest_access_index(self):
+        """ Index those reservations created before WEBLAB_RESERVATIONS_LATEST_ACCESS existed """
+        client = self._redis_maker()
 
-        client.expire(WEBLAB_RESERVATIONS_LOCK, 1) # Every second
+        reservation_ids = list(client.smembers(WEBLAB_RESERVATIONS))
 
-        reservation_ids = client.smembers(WEBLAB_RESERVATIONS)
-        
         pipeline = client.pipeline()
         for reservation_id in reservation_ids:
             weblab_reservation_status = WEBLAB_RESERVATION_STATUS % reservation_id
             pipeline.hget(weblab_reservation_status, LATEST_ACCESS)
+        latest_accesses = pipeline.execute()
 
-        expired_reservation_ids = []
-        for reservation_id, latest_access_str in zip(reservation_ids, pipeline.execute()):
-            if latest_access_str is None:
-                continue
-            latest_access = float(latest_access_str)
-            if latest_access is not None and latest_access < expiration_timestamp:
-                expired_reservation_ids.append(reservation_id)
-
-        return expired_reservation_ids
+        pipeline = client.pipeline()
+        for reservation_id, latest_access_str in zip(reservation_ids, latest_accesses):
+            if latest_access_str is not None:
+                pipeline.zadd(WEBLAB_RESERVATIONS_LATEST_ACCESS, reservation_id, float(latest_access_str))
+        pipeline.execute()
 
     def list_sessions(self, experiment_id ):
         """ list_sessions( experiment_id ) -> [ session_id ] """
@@ -227,6 +239,7 @@ class ReservationsManager(object):
         client = self._redis_maker()
       
         client.srem(WEBLAB_RESERVATIONS, reservation_id)
+        client.zrem(WEBLAB_RESERVATIONS_LATEST_ACCESS, reservation_id)
         weblab_reservation            = WEBLAB_RESERVATION                    % reservation_id
         weblab_reservation_status     = WEBLAB_RESERVATION_STATUS             % reservation_id
         weblab_reservation_schedulers = WEBLAB_RESERVATIONS_ACTIVE_SCHEDULERS % reservation_id
@@ -21,6 +21,8 @@ import weblab.core.coordinator.exc as CoordExc
 
 from voodoo.typechecker import typecheck
 
+from weblab.core.coordinator.redis.notifications import publish_queue_event
+
 from weblab.core.coordinator.redis.constants import (
     WEBLAB_EXPERIMENT_TYPES,
     WEBLAB_EXPERIMENT_RESOURCES,
@@ -40,6 +42,8 @@ from weblab.core.coordinator.redis.constants import (
     RESOURCE_INST,
     EXPERIMENT_TYPE,
     RESOURCE_TYPE,
+
+    EVENT_RESOURCES_CHANGED,
 )
 
 class ResourcesManager(object):
@@ -52,7 +56,8 @@ class ResourcesManager(object):
         client.sadd(WEBLAB_RESOURCES, resource.resource_type)
         client.sadd(WEBLAB_RESOURCE % resource.resource_type,         resource.resource_instance)
         client.sadd(WEBLAB_RESOURCE_SLOTS   % resource.resource_type, resource.resource_instance)
-        client.sadd(WEBLAB_RESOURCE_WORKING % resource.resource_type, resource.resource_instance)
+        if client.sadd(WEBLAB_RESOURCE_WORKING % resource.resource_type, resource.resource_instance):
+            publish_queue_event(client, resource.resource_type, EVENT_RESOURCES_CHANGED)
         
     @typecheck(ExperimentId, basestring)
     def add_experiment_id(self, experiment_id, resource_type):
@@ -150,14 +155,20 @@ class ResourcesManager(object):
     def mark_resource_as_broken(self, resource):
         client = self._redis_maker()
         weblab_resource_working = WEBLAB_RESOURCE_WORKING % resource.resource_type
-        return client.srem(weblab_resource_working, resource.resource_instance) != 0
+        changed = client.srem(weblab_resource_working, resource.resource_instance) != 0
+        if changed:
+            publish_queue_event(client, resource.resource_type, EVENT_RESOURCES_CHANGED)
+        return changed
 
     @typecheck(Resource)
     def mark_resource_as_fixed(self, resource):
         client = self._redis_maker()
 
         weblab_resource_working = WEBLAB_RESOURCE_WORKING % resource.resource_type
-        return client.sadd(weblab_resource_working, resource.resource_instance) != 0
+        changed = client.sadd(weblab_resource_working, resource.resource_instance) != 0
+        if changed:
+            publish_queue_event(client, resource.resource_type, EVENT_RESOURCES_CHANGED)
+        return changed
 
     @typecheck(ExperimentInstanceId)
     def remove_resource_instance_id(self, experiment_instance_id):
@@ -21,7 +21,7 @@ import random
 from voodoo.log import logged
 import voodoo.log as log
 
-from sqlalchemy import not_
+from sqlalchemy import not_, or_, and_, func
 from sqlalchemy.orm import join
 from sqlalchemy.orm.exc import StaleDataError, ConcurrentModificationError
 from sqlalchemy.exc import IntegrityError, OperationalError
@@ -145,6 +145,14 @@ class PriorityQueueScheduler(Scheduler):
     def get_reservation_status(self, reservation_id):
         self._remove_expired_reservations()
 
+        while True:
+            status = self._get_reservation_status(reservation_id)
+            if status is not None:
+                return status
+            time.sleep(TIME_ANTI_RACE_CONDITIONS * random.random())
+
+    def _get_reservation_status(self, reservation_id):
+        """ Returns the status, or None if it changed meanwhile and it must be retrieved again """
         try:
             session = self.session_maker()
             try:
@@ -153,14 +161,12 @@ class PriorityQueueScheduler(Scheduler):
             finally:
                 session.close()
         except StaleDataError:
-            time.sleep(TIME_ANTI_RACE_CONDITIONS * random.random())
-            return self.get_reservation_status(reservation_id)
+            return None
 
         self._synchronizer.request_and_wait()
 
         reservation_id_with_route = '%s;%s.%s' % (reservation_id, reservation_id, self.core_server_route)
 
-        return_current_status = False
         session = self.session_maker()
         try:
             #
@@ -220,44 +226,42 @@ class PriorityQueueScheduler(Scheduler):
             waiting_reservation = session.query(WaitingReservation).filter_by(reservation_id = reservation_id, resource_type_id = resource_type.id).first()
 
             if waiting_reservation is None:
-                waiting_reservations = []
+                #
+                # The position has changed and it is not in the queue anymore!
+                # This has happened using WebLab Bot with 65 users.
+                #
+                return None
+
             else:
-                
                 #
                 # If it has not been assigned to any laboratory, then it might
                 # be waiting in the queue of that resource type (Waiting) or
                 # waiting for instances (WaitingInstances, meaning that there is
                 # no resource of that type implemented)
-                #
-                waiting_reservations = session.query(WaitingReservation)\
-                        .filter(WaitingReservation.resource_type == waiting_reservation.resource_type).order_by(WaitingReservation.priority, WaitingReservation.id).all()
+                position = self._get_queue_position(session, waiting_reservation)
 
-            if waiting_reservation is None or waiting_reservation not in waiting_reservations:
-                #
-                # The position has changed and it is not in the list anymore!
-                # This has happened using WebLab Bot with 65 users.
-                #
-                return_current_status = True
-
-            else:
-                position      = waiting_reservations.index(waiting_reservation)
-                remaining_working_instances = False
-                for resource_instance in waiting_reservation.resource_type.instances:
-                    if resource_instance.slot is not None:
-                        remaining_working_instances = True
-                        break
+                remaining_working_instances = session.query(CurrentResourceSlot.id)\
+                        .join(CurrentResourceSlot.resource_instance)\
+                        .filter(ResourceInstance.resource_type_id == resource_type.id)\
+                        .first() is not None
         finally:
             session.close()
 
-        if return_current_status:
-            time.sleep(TIME_ANTI_RACE_CONDITIONS * random.random())
-            return self.get_reservation_status(reservation_id)
-
         if remaining_working_instances:
             return WSS.WaitingQueueStatus(reservation_id_with_route, position)
         else:
             return WSS.WaitingInstancesQueueStatus(reservation_id_with_route, position)
 
+    def _get_queue_position(self, session, waiting_reservation):
+        # The position is the number of reservations ahead in the queue
+        # (ordered by priority and id), counted in the ix_pq_waiting_queue
+        # index instead of retrieving the whole queue.
+        return session.query(func.count(WaitingReservation.id))\
+                .filter(WaitingReservation.resource_type_id == waiting_reservation.resource_type_id)\
+                .filter(or_(WaitingReservation.priority < waiting_reservation.priority,
+                            and_(WaitingReservation.priority == waiting_reservation.priority, WaitingReservation.id < waiting_reservation.id)))\
+                .scalar()
+
 
     ################################################################
     #
@@ -129,3 +129,4 @@ class WaitingReservation(Base):
                 )
 
 Index('ix_pq_waiting_rese_reso', WaitingReservation.reservation_id, WaitingReservation.resource_type_id)
+Index('ix_pq_waiting_queue', WaitingReservation.resource_type_id, WaitingReservation.priority, WaitingReservation.id)
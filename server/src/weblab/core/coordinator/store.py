@@ -14,9 +14,42 @@
 #
 
 from abc import ABCMeta, abstractmethod
+import time
 import Queue
 from voodoo.representable import Representable
 
+class MultiplexedInformationQueue(object):
+    """ Single queue fed by many stores (see TemporalInformationStore.attach),
+    so a single reader is woken up as soon as any of them receives information,
+    instead of polling each store in turn. Each item is a tuple (kind,
+    information, time when it was put). """
+
+    def __init__(self):
+        self.queue = Queue.Queue()
+
+    def put(self, kind, information):
+        self.queue.put_nowait((kind, information, time.time()))
+
+    def wake_up(self):
+        """ Wakes up the reader, which will receive None """
+        self.queue.put_nowait(None)
+
+    def get(self, timeout = None):
+        """ Waits until there is any item (forever by default) """
+        try:
+            return self.queue.get(True, timeout)
+        except Queue.Empty:
+            return None
+
+    def task_done(self):
+        """ The item retrieved has been processed """
+        self.queue.task_done()
+
+    def backlog(self):
+        """ Items put and not processed yet """
+        with self.queue.mutex:
+            return self.queue.unfinished_tasks
+
 class TemporalInformationStore(object):
     """ Temporal synchronized store for initial and finishing information.
 
@@ -34,6 +67,27 @@ class TemporalInformationStore(object):
 
     def __init__(self):
         self.queue = Queue.Queue()
+        self._multiplexer = None
+        self._kind        = None
+
+    def attach(self, multiplexer, kind):
+        """ From now on, the information put in this store is sent to the
+        multiplexer (a MultiplexedInformationQueue), tagged with kind. """
+        self._kind        = kind
+        self._multiplexer = multiplexer
+        while True:
+            try:
+                information = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            multiplexer.put(kind, information)
+
+    def _put(self, information):
+        multiplexer = self._multiplexer
+        if multiplexer is None:
+            self.queue.put_nowait(information)
+        else:
+            multiplexer.put(self._kind, information)
 
     def get(self, timeout = None):
         """Get the first introduced object, waiting timeout time.
@@ -72,11 +126,11 @@ class InitialInformationEntry(object):
 
 class InitialTemporalInformationStore(TemporalInformationStore):
     def put(self, initial_information_entry):
-        self.queue.put_nowait(initial_information_entry)
+        self._put(initial_information_entry)
 
 class FinishTemporalInformationStore(TemporalInformationStore):
     def put(self, reservation_id, obj, initial_time, end_time):
-        self.queue.put_nowait((reservation_id, obj, initial_time, end_time))
+        self._put((reservation_id, obj, initial_time, end_time))
 
 class CommandOrFileInformationEntry(object):
     
@@ -92,9 +146,9 @@ class CommandOrFileInformationEntry(object):
 
 class CommandsTemporalInformationStore(TemporalInformationStore):
     def put(self, command_information_entry):
-        self.queue.put_nowait(command_information_entry)
+        self._put(command_information_entry)
 
 class CompletedInformationStore(TemporalInformationStore):
     def put(self, username, usage, callback):
-        self.queue.put_nowait((username, usage, callback))
+        self._put((username, usage, callback))
 
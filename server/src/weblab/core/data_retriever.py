@@ -14,17 +14,54 @@
 #
 
 import threading
+import Queue
 import time
 
 import voodoo.log as log
+import voodoo.counter as counter
 
 from weblab.data.experiments import CommandSent, ExperimentUsage, FileSent
 import weblab.core.file_storer as file_storer
 import weblab.data.command as Command
+from weblab.core.coordinator.store import MultiplexedInformationQueue
+
+USAGE_WRITERS = 'core_usage_writers'
+DEFAULT_USAGE_WRITERS = 4
+
+USAGE_BATCH_SIZE = 'core_usage_batch_size'
+DEFAULT_USAGE_BATCH_SIZE = 1000
+
+USAGE_RETRY_PERIOD = 'core_usage_retry_period'
+DEFAULT_USAGE_RETRY_PERIOD = 0.1 # seconds
+
+# Kinds of information of the MultiplexedInformationQueue
+INITIAL   = 'initial'
+FINISHED  = 'finished'
+COMMAND   = 'command'
+COMPLETED = 'completed'
+
+def _get_reservation_id(kind, information):
+    if kind in (INITIAL, COMMAND):
+        return information.reservation_id
+    elif kind == FINISHED:
+        reservation_id, _, _, _ = information
+        return reservation_id
+    else: # COMPLETED
+        _, usage, _ = information
+        return usage.reservation_id
+
+def _timestamp(date):
+    return time.mktime(date.timetuple()) + date.microsecond / 1e6
 
 class TemporalInformationRetriever(threading.Thread):
     """
-    This class retrieves continuously the information of initial and finished experiments.
+    This class retrieves continuously the information of initial and finished experiments,
+    the commands and files sent and the completed usages, and stores them in the database.
+
+    Every store feeds a single MultiplexedInformationQueue, so this thread only wakes up
+    when there is information. It dispatches each entry to one of the UsageWriters,
+    always the same one for the same reservation_id, so the entries of a reservation are
+    stored in order while the rest are stored concurrently.
     """
 
     PRINT_ERRORS = True
@@ -40,197 +77,371 @@ class TemporalInformationRetriever(threading.Thread):
         self.completed_store      = completed_store
         self.iterations           = 0
         self.db_manager           = db_manager
-        self.timeout              = None # Take the default of TemporalInformationStore
         self.entry_id2command_id  = {}
         self.entry_id2command_id_lock = threading.Lock()
+
+        self.batch_size   = cfg_manager.get_value(USAGE_BATCH_SIZE, DEFAULT_USAGE_BATCH_SIZE)
+        self.retry_period = cfg_manager.get_value(USAGE_RETRY_PERIOD, DEFAULT_USAGE_RETRY_PERIOD)
+
+        self.queue = MultiplexedInformationQueue()
+        initial_store.attach(self.queue, INITIAL)
+        finished_store.attach(self.queue, FINISHED)
+        commands_store.attach(self.queue, COMMAND)
+        completed_store.attach(self.queue, COMPLETED)
+
+        writers = cfg_manager.get_value(USAGE_WRITERS, DEFAULT_USAGE_WRITERS)
+        self.writers = [ UsageWriter(self) for _ in xrange(writers) ]
+
+        self._gauges_lock  = threading.Lock()
+        self.flushes       = 0
+        self.stored        = 0
+        self.last_latency  = 0.0
+        self.max_latency   = 0.0
+        self.total_latency = 0.0
+
+        self.setName(counter.next_name("TemporalInformationRetriever"))
         self.setDaemon(True)
 
     def run(self):
-        while self.keep_running:
-            try:
-                self.iterations += 1
-                self.iterate()
-            except:
-                if self.PRINT_ERRORS:
-                    import traceback
-                    traceback.print_exc()
-                log.log( TemporalInformationRetriever, log.level.Critical, "Exception iterating in TemporalInformationRetriever!!!")
-                log.log_exc( TemporalInformationRetriever, log.level.Critical )
+        for writer in self.writers:
+            writer.start()
+        try:
+            while self.keep_running:
+                try:
+                    self.iterations += 1
+                    self.iterate()
+                except:
+                    if self.PRINT_ERRORS:
+                        import traceback
+                        traceback.print_exc()
+                    log.log( TemporalInformationRetriever, log.level.Critical, "Exception iterating in TemporalInformationRetriever!!!")
+                    log.log_exc( TemporalInformationRetriever, log.level.Critical )
+        finally:
+            for writer in self.writers:
+                writer.stop()
+            for writer in self.writers:
+                writer.join(1)
 
     def stop(self):
         self.keep_running = False
+        self.queue.wake_up()
 
     def iterate(self):
-        self.iterate_initial()
-        if self.keep_running and self.commands_store.empty() and self.completed_store.empty():
-            self.iterate_finish()
-        if self.keep_running:
-            self.iterate_command()
-        if self.keep_running:
-            self.iterate_completed()
+        item = self.queue.get()
+        if item is None:
+            # Woken up by stop
+            self.queue.task_done()
+            return
+
+        kind, information, _ = item
+        reservation_id = _get_reservation_id(kind, information)
+        self.writers[hash(reservation_id) % len(self.writers)].put(item)
+
+    def _register_flush(self, latencies):
+        if not latencies:
+            return
+        with self._gauges_lock:
+            self.flushes       += 1
+            self.stored        += len(latencies)
+            self.last_latency   = max(latencies)
+            self.max_latency    = max(self.max_latency, self.last_latency)
+            self.total_latency += sum(latencies)
+
+    def get_stats(self):
+        """ Gauges of how far behind the database the usage information is """
+        with self._gauges_lock:
+            stats = {
+                'flushes'      : self.flushes,
+                'stored'       : self.stored,
+                'last_latency' : self.last_latency,
+                'max_latency'  : self.max_latency,
+                'avg_latency'  : self.total_latency / self.stored if self.stored else 0.0,
+            }
+        # Not stored yet, and waiting to be retried (e.g. waiting for the initial information)
+        stats['backlog'] = self.queue.backlog()
+        stats['pending'] = sum( len(writer.pending) for writer in self.writers )
+        return stats
+
+class UsageWriter(threading.Thread):
+    """
+    Stores the information dispatched by the TemporalInformationRetriever. Everything
+    received (up to batch_size entries) is stored at once: the new usages in a single
+    transaction, the commands and files in another, and the finished usages in another.
 
-    def iterate_initial(self):
-        initial_information = self.initial_store.get(timeout=self.timeout)
-        if initial_information is not None:
+    The information which can not be stored yet (e.g. the usage is finished before its
+    initial information is stored) is retried every retry_period seconds.
+    """
+    def __init__(self, retriever):
+        threading.Thread.__init__(self)
+        self.retriever    = retriever
+        self.db_manager   = retriever.db_manager
+        self.cfg_manager  = retriever.cfg_manager
+        self.queue        = Queue.Queue()
+        self.pending      = []
+        self.keep_running = True
+        self.setName(counter.next_name("UsageWriter"))
+        self.setDaemon(True)
 
-            initial_timestamp = time.mktime(initial_information.initial_time.timetuple()) + initial_information.initial_time.microsecond / 1e6
-            end_timestamp     = time.mktime(initial_information.end_time.timetuple()) + initial_information.end_time.microsecond / 1e6
+    def put(self, item):
+        self.queue.put_nowait(item)
 
-            request_info  = initial_information.request_info
-            from_ip       = request_info.pop('from_ip','<address not found>')
+    def stop(self):
+        self.keep_running = False
+        self.queue.put_nowait(None)
 
+    def run(self):
+        while self.keep_running:
             try:
-                username      = request_info.pop('username')
+                self.iterate()
             except:
-                log.log( TemporalInformationRetriever, log.level.Critical, "Provided information did not contain some required fields (such as username or role). This usually means that the reservation has previously been expired. Provided request_info: %r; provided data: %r" % (request_info, initial_information), max_size = 10000)
-                log.log_exc( TemporalInformationRetriever, log.level.Critical )
-                return
+                if self.retriever.PRINT_ERRORS:
+                    import traceback
+                    traceback.print_exc()
+                log.log( UsageWriter, log.level.Critical, "Exception iterating in UsageWriter!!!")
+                log.log_exc( UsageWriter, log.level.Critical )
 
-            usage = ExperimentUsage()
-            usage.start_date     = initial_timestamp
-            usage.from_ip        = from_ip
-            usage.experiment_id  = initial_information.experiment_id
-            usage.reservation_id = initial_information.reservation_id
-            usage.coord_address  = initial_information.exp_coordaddr
-            usage.request_info   = initial_information.request_info
+    def iterate(self):
+        timeout = self.retriever.retry_period if self.pending else None
+        try:
+            item = self.queue.get(True, timeout)
+        except Queue.Empty:
+            item = None
+
+        items = [] if item is None else [ item ]
+        while len(items) < self.retriever.batch_size:
+            try:
+                item = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not None:
+                items.append(item)
+
+        if not items and not self.pending:
+            return
+
+        # The older ones first
+        retried = self.pending
+        try:
+            self.pending = self.flush(retried + items)
+        finally:
+            for _ in items:
+                self.retriever.queue.task_done()
+
+        now = time.time()
+        pending_ids = set( id(entry) for entry in self.pending )
+        self.retriever._register_flush([ now - entry[2] for entry in retried + items if id(entry) not in pending_ids ])
+
+    def flush(self, items):
+        """ Stores the items, and returns those which must be retried """
+        items_by_kind = {
+            INITIAL   : [],
+            FINISHED  : [],
+            COMMAND   : [],
+            COMPLETED : [],
+        }
+        for item in items:
+            items_by_kind[item[0]].append(item)
+
+        usages    = []
+        callbacks = []
+        for _, information, _ in items_by_kind[INITIAL]:
+            username_and_usage = self._create_initial_usage(information)
+            if username_and_usage is not None:
+                usages.append(username_and_usage)
+                callbacks.append(None)
+
+        for _, (username, usage, callback), _ in items_by_kind[COMPLETED]:
+            usages.append((username, usage))
+            callbacks.append(callback)
+
+        # The usages are stored first, since the rest of the information refers to them
+        if usages:
+            self._store_usages(usages, callbacks)
+
+        # If the database fails, nothing of that kind was stored, so it is retried later
+        pending = []
+        for kind, store in ((COMMAND, self._store_commands), (FINISHED, self._store_finished)):
+            if not items_by_kind[kind]:
+                continue
+            try:
+                pending.extend(store(items_by_kind[kind]))
+            except:
+                if self.retriever.PRINT_ERRORS:
+                    import traceback
+                    traceback.print_exc()
+                log.log( UsageWriter, log.level.Critical, "Error storing %s entries of kind %s; retrying them later" % (len(items_by_kind[kind]), kind))
+                log.log_exc( UsageWriter, log.level.Critical )
+                pending.extend(items_by_kind[kind])
+        return pending
+
+    def _create_initial_usage(self, initial_information):
+        initial_timestamp = _timestamp(initial_information.initial_time)
+        end_timestamp     = _timestamp(initial_information.end_time)
+
+        # A copy, so it is still complete if it must be retried
+        request_info  = dict(initial_information.request_info)
+        from_ip       = request_info.pop('from_ip','<address not found>')
+
+        try:
+            username      = request_info.pop('username')
+        except:
+            log.log( UsageWriter, log.level.Critical, "Provided information did not contain some required fields (such as username or role). This usually means that the reservation has previously been expired. Provided request_info: %r; provided data: %r" % (request_info, initial_information), max_size = 10000)
+            log.log_exc( UsageWriter, log.level.Critical )
+            return None
+
+        usage = ExperimentUsage()
+        usage.start_date     = initial_timestamp
+        usage.from_ip        = from_ip
+        usage.experiment_id  = initial_information.experiment_id
+        usage.reservation_id = initial_information.reservation_id
+        usage.coord_address  = initial_information.exp_coordaddr
+        usage.request_info   = request_info
+
+        command_request = CommandSent(
+                Command.Command("@@@initial::request@@@"), initial_timestamp,
+                Command.Command(str(initial_information.client_initial_data)), end_timestamp)
+
+        command_response = CommandSent(
+                Command.Command("@@@initial::response@@@"), initial_timestamp,
+                Command.Command(str(initial_information.initial_configuration)), end_timestamp)
+
+        usage.append_command(command_request)
+        usage.append_command(command_response)
+        return username, usage
+
+    def _store_usages(self, usages, callbacks):
+        try:
+            self.db_manager.store_experiment_usages(usages)
+            stored = [ True ] * len(usages)
+        except:
+            # Some of them could not be stored (and therefore none of them was
+            # stored): store them one by one, so only those are lost
+            log.log( UsageWriter, log.level.Warning, "Error storing %s usages at once; storing them one by one" % len(usages))
+            log.log_exc( UsageWriter, log.level.Info )
+            stored = []
+            for username, usage in usages:
+                try:
+                    self.db_manager.store_experiment_usage(username, usage)
+                except:
+                    if self.retriever.PRINT_ERRORS:
+                        import traceback
+                        traceback.print_exc()
+                    log.log( UsageWriter, log.level.Critical, "Error storing usage of reservation %s" % usage.reservation_id)
+                    log.log_exc( UsageWriter, log.level.Critical )
+                    stored.append(False)
+                else:
+                    stored.append(True)
 
-            command_request = CommandSent(
-                    Command.Command("@@@initial::request@@@"), initial_timestamp,
-                    Command.Command(str(initial_information.client_initial_data)), end_timestamp)
+        for callback, usage_stored in zip(callbacks, stored):
+            if callback is not None and usage_stored:
+                callback()
 
-            command_response = CommandSent(
-                    Command.Command("@@@initial::response@@@"), initial_timestamp,
-                    Command.Command(str(initial_information.initial_configuration)), end_timestamp)
+    def _store_finished(self, items):
+        finished_usages = []
+        for _, (reservation_id, obj, initial_time, end_time), _ in items:
+            initial_timestamp = _timestamp(initial_time)
+            end_timestamp     = _timestamp(end_time)
 
-            usage.append_command(command_request)
-            usage.append_command(command_response)
+            command = CommandSent(
+                    Command.Command("@@@finish@@@"), initial_timestamp,
+                    Command.Command(str(obj)), end_timestamp)
 
-            self.db_manager.store_experiment_usage(username, usage)
+            finished_usages.append((reservation_id, initial_timestamp, command))
 
-    def iterate_completed(self):
-        completed_information = self.completed_store.get(timeout=self.timeout)
-        if completed_information is not None:
-            username, usage, callback = completed_information
-            self.db_manager.store_experiment_usage(username, usage)
-            callback()
+        not_found = set(self.db_manager.finish_experiment_usages(finished_usages))
+        # If they could not be finished because the usage did not exist
+        # yet, they are retried later
+        return [ item for item in items if item[1][0] in not_found ]
 
+    def _store_commands(self, items):
+        items_by_information = dict( (id(item[1]), item) for item in items )
+        retries = []
 
-    def iterate_finish(self):
-        information = self.finished_store.get(timeout=self.timeout)            
-        if information is not None:
-            reservation_id, obj, initial_time, end_time = information
+        command_pairs     = []
+        command_responses = []
+        command_requests  = {}
 
-            if not self.commands_store.empty() or not self.completed_store.empty():
-                # They have higher priority
-                self.finished_store.put(reservation_id, obj, initial_time, end_time)
-                return
+        file_pairs        = []
+        file_responses    = []
+        file_requests     = {}
 
-            initial_timestamp = time.mktime(initial_time.timetuple()) + initial_time.microsecond / 1e6
-            end_timestamp     = time.mktime(end_time.timetuple()) + end_time.microsecond / 1e6
+        backup_information           = {}
+        backup_information_responses = {}
 
-            command = CommandSent(
-                    Command.Command("@@@finish@@@"), initial_timestamp,
-                    Command.Command(str(obj)), end_timestamp)
+        # entry_id : command_id of the requests already stored, restored if the responses can not be stored
+        found_command_ids = {}
 
-            if not self.db_manager.finish_experiment_usage(reservation_id, initial_timestamp, command):
-                # If it could not be added because the experiment id
-                # did not exist, put it again in the queue
-                self.finished_store.put(reservation_id, obj, initial_time, end_time)
-                time.sleep(0.01)
-
-    def iterate_command(self):
-        information = self.commands_store.get(timeout=self.timeout)
-        if information is not None:
-            all_information = [ information ]
-            
-            # Retrieve all the remaining information to ensure that it it finally empty,
-            # with a maximum of 1000 registries per request
-            max_registries = 1000
-            counter = 0
-            while not self.commands_store.empty() and counter < max_registries:
-                counter += 1
-                information = self.commands_store.get(timeout=0)
-                if information is not None:
-                    all_information.append(information)
-
-            command_pairs     = []
-            command_responses = []
-            command_requests  = {}
-
-            file_pairs        = []
-            file_responses    = []
-            file_requests     = {}
-
-            backup_information           = {}
-            backup_information_responses = {}
-
-            # Process
-            for information in all_information:
-                if information.is_command:
-                    if information.is_before:
-                        backup_information[information.entry_id] = information
-                        command_requests[information.entry_id] = (information.reservation_id, CommandSent( information.payload, information.timestamp))
+        # Process
+        for _, information, _ in items:
+            if information.is_command:
+                if information.is_before:
+                    backup_information[information.entry_id] = information
+                    command_requests[information.entry_id] = (information.reservation_id, CommandSent( information.payload, information.timestamp))
+                else:
+                    backup_information_responses[information.entry_id] = information
+                    command_request = command_requests.pop(information.entry_id, None)
+                    if command_request is not None:
+                        reservation_id, command_sent = command_request
+                        complete_command = CommandSent(
+                                                command_sent.command, command_sent.timestamp_before,
+                                                information.payload, information.timestamp)
+                        command_pairs.append((reservation_id, information.entry_id, complete_command))
                     else:
-                        backup_information_responses[information.entry_id] = information
-                        command_request = command_requests.pop(information.entry_id, None)
-                        if command_request is not None:
-                            reservation_id, command_sent = command_request
-                            complete_command = CommandSent(
-                                                    command_sent.command, command_sent.timestamp_before,
-                                                    information.payload, information.timestamp)
-                            command_pairs.append((reservation_id, information.entry_id, complete_command))
+                        with self.retriever.entry_id2command_id_lock:
+                            command_id = self.retriever.entry_id2command_id.pop(information.entry_id, None)
+                        if command_id is None:
+                            retries.append(information)
                         else:
-                            with self.entry_id2command_id_lock:
-                                command_id = self.entry_id2command_id.pop(information.entry_id, None)
-                            if command_id is None:
-                                self.commands_store.put(information)
-                            else:
-                                command_responses.append((information.entry_id, command_id, information.payload, information.timestamp))
+                            found_command_ids[information.entry_id] = command_id
+                            command_responses.append((information.entry_id, command_id, information.payload, information.timestamp))
+            else:
+                if information.is_before:
+                    backup_information[information.entry_id] = information
+                    file_requests[information.entry_id] = (information.reservation_id, information.payload)
                 else:
-                    if information.is_before:
-                        backup_information[information.entry_id] = information
-                        file_requests[information.entry_id] = (information.reservation_id, information.payload)
-                    else:
-                        backup_information_responses[information.entry_id] = information
-                        file_request = file_requests.pop(information.entry_id, None)
-                        if file_request is not None:
-                            reservation_id, file_sent = file_request
-                            if file_sent.is_loaded():
-                                storer = file_storer.FileStorer(self.cfg_manager, reservation_id)
-                                stored = storer.store_file(self, file_sent.file_content, file_sent.file_info)
-                                file_path = stored.file_path
-                                file_hash = stored.file_hash
-                            else:
-                                file_path = file_sent.file_path
-                                file_hash = file_sent.file_hash
-
-                            complete_file = FileSent(file_path, file_hash, file_sent.timestamp_before,
-                                                    information.payload, information.timestamp)
-                            file_pairs.append((reservation_id, information.entry_id, complete_file))
+                    backup_information_responses[information.entry_id] = information
+                    file_request = file_requests.pop(information.entry_id, None)
+                    if file_request is not None:
+                        reservation_id, file_sent = file_request
+                        if file_sent.is_loaded():
+                            storer = file_storer.FileStorer(self.cfg_manager, reservation_id)
+                            stored = storer.store_file(file_sent.file_content, file_sent.file_info)
+                            file_path = stored.file_path
+                            file_hash = stored.file_hash
                         else:
-                            with self.entry_id2command_id_lock:
-                                command_id = self.entry_id2command_id.pop(information.entry_id, None)
-                            if command_id is None:
-                                self.commands_store.put(information)
-                            else:
-                                file_responses.append((information.entry_id, command_id, information.payload, information.timestamp))
-
-            # At this point, we have all the information processed and 
-            # ready to be passed to the database in a single commit
-            mappings = self.db_manager.store_commands(command_pairs, command_requests, command_responses, file_pairs, file_requests, file_responses)
+                            file_path = file_sent.file_path
+                            file_hash = file_sent.file_hash
 
-            elements_to_backup = []
-            with self.entry_id2command_id_lock:
-                for entry_id in mappings:
-                    command_id = mappings[entry_id]
-                    if command_id is not None and command_id is not False:
-                        self.entry_id2command_id[entry_id] = mappings[entry_id]
+                        complete_file = FileSent(file_path, file_hash, file_sent.timestamp_before,
+                                                information.payload, information.timestamp)
+                        file_pairs.append((reservation_id, information.entry_id, complete_file))
                     else:
-                        elements_to_backup.append(entry_id)
+                        with self.retriever.entry_id2command_id_lock:
+                            command_id = self.retriever.entry_id2command_id.pop(information.entry_id, None)
+                        if command_id is None:
+                            retries.append(information)
+                        else:
+                            found_command_ids[information.entry_id] = command_id
+                            file_responses.append((information.entry_id, command_id, information.payload, information.timestamp))
 
-            for entry_id in elements_to_backup:
-                if entry_id in backup_information:
-                    self.commands_store.put(backup_information[entry_id])
-                if entry_id in backup_information_responses:
-                    self.commands_store.put(backup_information_responses[entry_id])
+        # At this point, we have all the information processed and
+        # ready to be passed to the database in a single commit
+        try:
+            mappings = self.db_manager.store_commands(command_pairs, command_requests, command_responses, file_pairs, file_requests, file_responses)
+        except:
+            with self.retriever.entry_id2command_id_lock:
+                self.retriever.entry_id2command_id.update(found_command_ids)
+            raise
+
+        with self.retriever.entry_id2command_id_lock:
+            for entry_id in mappings:
+                command_id = mappings[entry_id]
+                if command_id is not None and command_id is not False:
+                    self.retriever.entry_id2command_id[entry_id] = mappings[entry_id]
+                else:
+                    if entry_id in backup_information:
+                        retries.append(backup_information[entry_id])
+                    if entry_id in backup_information_responses:
+                        retries.append(backup_information_responses[entry_id])
 
+        return [ items_by_information[id(information)] for information in retries ]
@@ -16,14 +16,19 @@
 
 import numbers
 
+from sqlalchemy.sql.expression import bindparam
+from sqlalchemy.orm import joinedload, contains_eager
 from sqlalchemy.orm.exc import NoResultFound
 
 import voodoo.log as log
 from voodoo.log import logged
+from voodoo.cache import CacheEngine
 from voodoo.typechecker import typecheck
 
 from weblab.db import db
 import weblab.db.model as model
+from weblab.db.rollups import UsageRollupDelta
+from weblab.db.file_hashes import FileHashIndexDelta
 
 from weblab.data import ValidDatabaseSessionId
 from weblab.data.command import Command
@@ -35,6 +40,35 @@ import weblab.permissions as permissions
 
 DEFAULT_VALUE = object()
 
+# Maximum number of reservation_ids in a single IN clause
+MAX_RESERVATIONS_PER_QUERY = 500
+
+# The permissions of each user are resolved once and kept in memory for
+# PERMISSIONS_CACHE_TTL seconds (so changes performed by other processes
+# are eventually seen), for at most PERMISSIONS_CACHE_SIZE users.
+PERMISSIONS_CACHE_SIZE         = 'core_permissions_cache_size'
+DEFAULT_PERMISSIONS_CACHE_SIZE = 1000
+PERMISSIONS_CACHE_TTL          = 'core_permissions_cache_ttl'
+DEFAULT_PERMISSIONS_CACHE_TTL  = 60
+
+# Changes in any of these models may change the resolved permissions
+PERMISSIONS_MODELS = (
+    model.DbUser, model.DbRole, model.DbGroup,
+    model.DbUserPermission,  model.DbUserPermissionParameter,
+    model.DbGroupPermission, model.DbGroupPermissionParameter,
+    model.DbRolePermission,  model.DbRolePermissionParameter,
+    model.DbExperiment, model.DbExperimentCategory, model.DbExperimentClientParameter,
+)
+
+class ResolvedPermissions(object):
+    """ Everything a user is granted, as required by the core server """
+    def __init__(self, role_name):
+        self.role_name         = role_name
+        self.permission_types  = frozenset()
+        self.permissions       = [] # Permission DTOs
+        self.experiments       = () # ExperimentAllowed
+        self.experiments_error = None
+
 class DatabaseGateway(object):
 
     forbidden_access = 'forbidden_access'
@@ -43,6 +77,10 @@ class DatabaseGateway(object):
         super(DatabaseGateway, self).__init__()
         self.cfg_manager = cfg_manager
         self.Session, self.engine = db.initialize(cfg_manager)
+        self._permissions_cache = CacheEngine(
+                    max_size = cfg_manager.get_value(PERMISSIONS_CACHE_SIZE, DEFAULT_PERMISSIONS_CACHE_SIZE),
+                    ttl      = cfg_manager.get_value(PERMISSIONS_CACHE_TTL,  DEFAULT_PERMISSIONS_CACHE_TTL)
+                )
 
     @typecheck(basestring)
     @logged()
@@ -69,174 +107,256 @@ class DatabaseGateway(object):
     # @typecheck(basestring, (basestring, None), (basestring, None))
     @logged()
     def list_experiments(self, user_login, exp_name = None, cat_name = None):
-        session = self.Session()
-        try:
-            user = self._get_user(session, user_login)
-            user_permissions = self._gather_permissions(session, user, 'experiment_allowed')
-
-            grouped_experiments = {}
-            for permission in user_permissions:
-                p_permanent_id                 = self._get_parameter_from_permission(session, permission, 'experiment_permanent_id')
-                p_category_id                  = self._get_parameter_from_permission(session, permission, 'experiment_category_id')
-                p_time_allowed                 = self._get_float_parameter_from_permission(session, permission, 'time_allowed')
-                p_priority                     = self._get_int_parameter_from_permission(session, permission, 'priority', ExperimentAllowed.DEFAULT_PRIORITY)
-                p_initialization_in_accounting = self._get_bool_parameter_from_permission(session, permission, 'initialization_in_accounting', ExperimentAllowed.DEFAULT_INITIALIZATION_IN_ACCOUNTING)
-                
-                # If a filter is passed, ignore those permissions on other experiments
-                if cat_name is not None and exp_name is not None:
-                    if p_category_id != cat_name or p_permanent_id != exp_name:
-                        continue
-                experiments = [ exp for exp in session.query(model.DbExperiment).filter_by(name=p_permanent_id).all() if exp.category.name == p_category_id ]
-                if len(experiments) == 0:
-                    continue
+        resolved = self._get_resolved_permissions(user_login)
+        if resolved.experiments_error is not None:
+            raise resolved.experiments_error
 
-                experiment = experiments[0]
-
-                if isinstance(permission, model.DbUserPermission):
-                    permission_scope = 'user'
-                elif isinstance(permission, model.DbGroupPermission):
-                    permission_scope = 'group'
-                elif isinstance(permission, model.DbRolePermission):
-                    permission_scope = 'role'
-                else:
-                    permission_scope = 'unknown'
-                experiment_allowed = ExperimentAllowed.ExperimentAllowed(experiment.to_business(), p_time_allowed, p_priority, p_initialization_in_accounting, permission.permanent_id, permission.id, permission_scope)
-
-                experiment_unique_id = p_permanent_id+"@"+p_category_id
-                if experiment_unique_id in grouped_experiments:
-                    grouped_experiments[experiment_unique_id].append(experiment_allowed)
-                else:
-                    grouped_experiments[experiment_unique_id] = [experiment_allowed]
-
-            # If any experiment is duplicated, only the less restrictive one is given
-            experiments = []
-            for experiment_unique_id in grouped_experiments:
-                less_restrictive_experiment_allowed = grouped_experiments[experiment_unique_id][0]
-                for experiment_allowed in grouped_experiments[experiment_unique_id]:
-                    if experiment_allowed.time_allowed > less_restrictive_experiment_allowed.time_allowed:
-                        less_restrictive_experiment_allowed = experiment_allowed
-                experiments.append(less_restrictive_experiment_allowed)
-
-            experiments.sort(lambda x,y: cmp(x.experiment.category.name, y.experiment.category.name))
-            return tuple(experiments)
-        finally:
-            session.close()
+        # If a filter is passed, ignore those permissions on other experiments
+        if cat_name is not None and exp_name is not None:
+            return tuple( experiment_allowed for experiment_allowed in resolved.experiments
+                            if experiment_allowed.experiment.name == exp_name and experiment_allowed.experiment.category.name == cat_name )
+        return resolved.experiments
 
     @typecheck(basestring)
     @logged()
     def is_access_forward(self, user_login):
-        session = self.Session()
-        try:
-            user = self._get_user(session, user_login)
-            user_permissions = self._gather_permissions(session, user, 'access_forward')
-            return len(user_permissions) > 0
-        finally:
-            session.close()
+        return 'access_forward' in self._get_resolved_permissions(user_login).permission_types
 
     @typecheck(basestring)
     @logged()
     def is_admin(self, user_login):
-        session = self.Session()
-        try:
-            user = self._get_user(session, user_login)
-            user_permissions = self._gather_permissions(session, user, 'admin_panel_access')
-            return len(user_permissions) > 0
-        finally:
-            session.close()
+        return 'admin_panel_access' in self._get_resolved_permissions(user_login).permission_types
 
     @typecheck(basestring)
     @logged()
     def is_instructor(self, user_login):
+        resolved = self._get_resolved_permissions(user_login)
+        return resolved.role_name == 'instructor' or 'admin_panel_access' in resolved.permission_types or 'instructor_of_group' in resolved.permission_types
+
+    def invalidate_permissions(self, user_login = None):
+        """ Forgets the permissions resolved for user_login (or for every user if None). It
+        must be called whenever users, groups, roles, permissions or experiments change. """
+        if user_login is None:
+            self._permissions_cache.clear()
+        else:
+            self._permissions_cache.invalidate(user_login)
+
+    def _get_resolved_permissions(self, user_login):
+        return self._permissions_cache.get_or_compute(user_login, self._resolve_permissions, user_login)
+
+    def _resolve_permissions(self, user_login):
+        """ Retrieves everything the user is granted with a few queries, instead of walking
+        the role, groups and permissions lazily for each permission type """
         session = self.Session()
         try:
-            user = self._get_user(session, user_login)
-            admin_permissions = self._gather_permissions(session, user, 'admin_panel_access')
-            instructor_permissions = self._gather_permissions(session, user, 'instructor_of_group')
-            return user.role.name == 'instructor' or len(admin_permissions) > 0 or len(instructor_permissions) > 0
+            try:
+                user = session.query(model.DbUser).options(joinedload('role'), joinedload('groups')).filter_by(login=user_login).one()
+            except NoResultFound:
+                raise DbErrors.DbProvidedUserNotFoundError("Unable to find a User with the provided login: '%s'" % user_login)
+
+            # Same order as _gather_permissions: role, groups (and their parents) and user
+            group_parents = dict(session.query(model.DbGroup.id, model.DbGroup.parent_id))
+            group_ids = []
+            for group in user.groups:
+                group_id = group.id
+                while group_id is not None and group_id not in group_ids:
+                    group_ids.append(group_id)
+                    group_id = group_parents.get(group_id)
+
+            user_permissions = []
+            if user.role is not None:
+                user_permissions.extend(session.query(model.DbRolePermission).options(joinedload('parameters'))
+                                            .filter_by(role_id = user.role.id).order_by(model.DbRolePermission.id).all())
+            if group_ids:
+                group_positions = dict( (group_id, position) for position, group_id in enumerate(group_ids) )
+                group_permissions = session.query(model.DbGroupPermission).options(joinedload('parameters')) \
+                                            .filter(model.DbGroupPermission.group_id.in_(group_ids)).order_by(model.DbGroupPermission.id).all()
+                user_permissions.extend(sorted(group_permissions, key = lambda permission : group_positions[permission.group_id]))
+            user_permissions.extend(session.query(model.DbUserPermission).options(joinedload('parameters'))
+                                            .filter_by(user_id = user.id).order_by(model.DbUserPermission.id).all())
+
+            resolved = ResolvedPermissions(user.role.name if user.role is not None else None)
+            for pt in permissions.permission_types:
+                resolved.permissions.extend( permission.to_dto() for permission in user_permissions if permission.get_permission_type() == pt )
+            resolved.permissions = tuple(resolved.permissions)
+            resolved.permission_types = frozenset( permission.get_permission_type() for permission in user_permissions )
+
+            try:
+                resolved.experiments = self._resolve_experiments(session, [ permission for permission in user_permissions if permission.get_permission_type() == 'experiment_allowed' ])
+            except (DbErrors.DbIllegalStatusError, DbErrors.InvalidPermissionParameterFormatError) as e:
+                # Only list_experiments fails, as it used to
+                resolved.experiments_error = e
+            return resolved
         finally:
             session.close()
 
+    def _resolve_experiments(self, session, experiment_permissions):
+        grants = []
+        for permission in experiment_permissions:
+            parameters = self._get_parameters_from_permission(permission)
+            p_permanent_id                 = self._get_parameter_from_permission(session, permission, 'experiment_permanent_id', parameters = parameters)
+            p_category_id                  = self._get_parameter_from_permission(session, permission, 'experiment_category_id', parameters = parameters)
+            p_time_allowed                 = self._get_float_parameter_from_permission(session, permission, 'time_allowed', parameters = parameters)
+            p_priority                     = self._get_int_parameter_from_permission(session, permission, 'priority', ExperimentAllowed.DEFAULT_PRIORITY, parameters = parameters)
+            p_initialization_in_accounting = self._get_bool_parameter_from_permission(session, permission, 'initialization_in_accounting', ExperimentAllowed.DEFAULT_INITIALIZATION_IN_ACCOUNTING, parameters = parameters)
+            grants.append((permission, p_permanent_id, p_category_id, p_time_allowed, p_priority, p_initialization_in_accounting))
+
+        db_experiments = {
+            # (exp_name, cat_name) : experiment
+        }
+        experiment_names = list(set( p_permanent_id for _, p_permanent_id, _, _, _, _ in grants ))
+        if experiment_names:
+            query = session.query(model.DbExperiment).join(model.DbExperiment.category) \
+                            .options(contains_eager(model.DbExperiment.category), joinedload(model.DbExperiment.client_parameters)) \
+                            .filter(model.DbExperiment.name.in_(experiment_names)).order_by(model.DbExperiment.id)
+            for db_experiment in query:
+                db_experiments.setdefault((db_experiment.name, db_experiment.category.name), db_experiment.to_business())
+
+        grouped_experiments = {}
+        for permission, p_permanent_id, p_category_id, p_time_allowed, p_priority, p_initialization_in_accounting in grants:
+            experiment = db_experiments.get((p_permanent_id, p_category_id))
+            if experiment is None:
+                continue
+
+            if isinstance(permission, model.DbUserPermission):
+                permission_scope = 'user'
+            elif isinstance(permission, model.DbGroupPermission):
+                permission_scope = 'group'
+            elif isinstance(permission, model.DbRolePermission):
+                permission_scope = 'role'
+            else:
+                permission_scope = 'unknown'
+            experiment_allowed = ExperimentAllowed.ExperimentAllowed(experiment, p_time_allowed, p_priority, p_initialization_in_accounting, permission.permanent_id, permission.id, permission_scope)
+
+            experiment_unique_id = p_permanent_id+"@"+p_category_id
+            if experiment_unique_id in grouped_experiments:
+                grouped_experiments[experiment_unique_id].append(experiment_allowed)
+            else:
+                grouped_experiments[experiment_unique_id] = [experiment_allowed]
+
+        # If any experiment is duplicated, only the less restrictive one is given
+        experiments = []
+        for experiment_unique_id in grouped_experiments:
+            less_restrictive_experiment_allowed = grouped_experiments[experiment_unique_id][0]
+            for experiment_allowed in grouped_experiments[experiment_unique_id]:
+                if experiment_allowed.time_allowed > less_restrictive_experiment_allowed.time_allowed:
+                    less_restrictive_experiment_allowed = experiment_allowed
+            experiments.append(less_restrictive_experiment_allowed)
+
+        experiments.sort(lambda x,y: cmp(x.experiment.category.name, y.experiment.category.name))
+        return tuple(experiments)
+
 
     @typecheck(basestring, ExperimentUsage)
     @logged()
     def store_experiment_usage(self, user_login, experiment_usage):
         session = self.Session()
         try:
-            use = model.DbUserUsedExperiment(
-                        self._get_user(session, user_login),
-                        self._get_experiment(session, experiment_usage.experiment_id.exp_name, experiment_usage.experiment_id.cat_name),
-                        experiment_usage.start_date,
-                        experiment_usage.from_ip,
-                        experiment_usage.coord_address.address,
-                        experiment_usage.reservation_id,
-                        experiment_usage.end_date,
-                )
-            session.add(use)
-            # TODO: The c.response of an standard command is an object with
-            # a commandstring, whereas the response to an async command is
-            # a simple string to identify the request. The way in which the logger
-            # currently handles these cases is somewhat shady.
-            for c in experiment_usage.commands:
-                # If we have a response, the c.response will be an object and not
-                # a string. Generally, we will, unless the command was asynchronous
-                # and it didn't finish executing.
-                if type(c.response) != type(""):
-                    session.add(model.DbUserCommand(
-                                    use,
-                                    c.command.commandstring,
-                                    c.timestamp_before,
-                                    c.response.commandstring,
-                                    c.timestamp_after
-                                ))
-                else:
-                    # In this other case, the response is a string, which means
-                    # that we have not updated it with the real response. Probably,
-                    # it was an asynchronous command which did not finish executing
-                    # by the time the experiment ended.
-                    session.add(model.DbUserCommand(
-                                    use,
-                                    c.command.commandstring,
-                                    c.timestamp_before,
-                                    "[RESPONSE NOT AVAILABLE]",
-                                    c.timestamp_after
-                                ))
-            for f in experiment_usage.sent_files:
-                if f.is_loaded():
-                    saved = f.save(self.cfg_manager, experiment_usage.reservation_id)
-                else:
-                    saved = f
-                session.add(model.DbUserFile(
-                                use,
-                                saved.file_path,
-                                saved.file_hash,
-                                saved.timestamp_before,
-                                saved.file_info,
-                                saved.response.commandstring,
-                                saved.timestamp_after
-                            ))
-            
-            permission_scope = experiment_usage.request_info.pop('permission_scope')
-            permission_id = experiment_usage.request_info.pop('permission_id')
-            if permission_scope == 'group':
-                use.group_permission_id = permission_id
-            elif permission_scope == 'user':
-                use.user_permission_id = permission_id
-            elif permission_scope == 'role':
-                use.role_permission_id = permission_id
-
-            for reservation_info_key in experiment_usage.request_info:
-                db_key = session.query(model.DbUserUsedExperimentProperty).filter_by(name = reservation_info_key).first()
-                if db_key is None:
-                    db_key = model.DbUserUsedExperimentProperty(reservation_info_key)
-                    session.add(db_key)
-
-                value = experiment_usage.request_info[reservation_info_key]
-                session.add(model.DbUserUsedExperimentPropertyValue( unicode(value), db_key, use ))
+            rollups = UsageRollupDelta()
+            file_hashes = FileHashIndexDelta()
+            self._store_experiment_usage(session, user_login, experiment_usage, rollups, file_hashes)
+            rollups.apply(session)
+            file_hashes.apply(session)
+            session.commit()
+        finally:
+            session.close()
+        # As in previous versions, the permission is not part of the request_info once stored
+        experiment_usage.request_info.pop('permission_scope', None)
+        experiment_usage.request_info.pop('permission_id', None)
 
+    @logged()
+    def store_experiment_usages(self, usages):
+        """ Stores many usages [ (user_login, experiment_usage) ] in a single transaction.
+        If any of them can not be stored, none of them is stored. """
+        session = self.Session()
+        try:
+            rollups = UsageRollupDelta()
+            file_hashes = FileHashIndexDelta()
+            for user_login, experiment_usage in usages:
+                self._store_experiment_usage(session, user_login, experiment_usage, rollups, file_hashes)
+            rollups.apply(session)
+            file_hashes.apply(session)
             session.commit()
         finally:
             session.close()
 
+    def _store_experiment_usage(self, session, user_login, experiment_usage, rollups, file_hashes):
+        use = model.DbUserUsedExperiment(
+                    self._get_user(session, user_login),
+                    self._get_experiment(session, experiment_usage.experiment_id.exp_name, experiment_usage.experiment_id.cat_name),
+                    experiment_usage.start_date,
+                    experiment_usage.from_ip,
+                    experiment_usage.coord_address.address,
+                    experiment_usage.reservation_id,
+                    experiment_usage.end_date,
+            )
+        session.add(use)
+        # TODO: The c.response of an standard command is an object with
+        # a commandstring, whereas the response to an async command is
+        # a simple string to identify the request. The way in which the logger
+        # currently handles these cases is somewhat shady.
+        for c in experiment_usage.commands:
+            # If we have a response, the c.response will be an object and not
+            # a string. Generally, we will, unless the command was asynchronous
+            # and it didn't finish executing.
+            if type(c.response) != type(""):
+                session.add(model.DbUserCommand(
+                                use,
+                                c.command.commandstring,
+                                c.timestamp_before,
+                                c.response.commandstring,
+                                c.timestamp_after
+                            ))
+            else:
+                # In this other case, the response is a string, which means
+                # that we have not updated it with the real response. Probably,
+                # it was an asynchronous command which did not finish executing
+                # by the time the experiment ended.
+                session.add(model.DbUserCommand(
+                                use,
+                                c.command.commandstring,
+                                c.timestamp_before,
+                                "[RESPONSE NOT AVAILABLE]",
+                                c.timestamp_after
+                            ))
+        for f in experiment_usage.sent_files:
+            if f.is_loaded():
+                saved = f.save(self.cfg_manager, experiment_usage.reservation_id)
+            else:
+                saved = f
+            session.add(model.DbUserFile(
+                            use,
+                            saved.file_path,
+                            saved.file_hash,
+                            saved.timestamp_before,
+                            saved.file_info,
+                            saved.response.commandstring,
+                            saved.timestamp_after
+                        ))
+            file_hashes.add(use, saved.file_hash)
+        
+        # Not modified, in case it must be stored again
+        request_info = experiment_usage.request_info.copy()
+        permission_scope = request_info.pop('permission_scope')
+        permission_id = request_info.pop('permission_id')
+        if permission_scope == 'group':
+            use.group_permission_id = permission_id
+        elif permission_scope == 'user':
+            use.user_permission_id = permission_id
+        elif permission_scope == 'role':
+            use.role_permission_id = permission_id
+
+        for reservation_info_key in request_info:
+            db_key = session.query(model.DbUserUsedExperimentProperty).filter_by(name = reservation_info_key).first()
+            if db_key is None:
+                db_key = model.DbUserUsedExperimentProperty(reservation_info_key)
+                session.add(db_key)
+
+            value = request_info[reservation_info_key]
+            session.add(model.DbUserUsedExperimentPropertyValue( unicode(value), db_key, use ))
+
+        rollups.add(use)
+
     @typecheck(basestring, float, CommandSent)
     @logged()
     def finish_experiment_usage(self, reservation_id, end_date, last_command ):
@@ -246,7 +366,11 @@ class DatabaseGateway(object):
             if user_used_experiment is None:
                 return False
 
+            rollups = UsageRollupDelta()
+            rollups.remove(user_used_experiment)
             user_used_experiment.set_end_date(end_date)
+            rollups.add(user_used_experiment)
+            rollups.apply(session)
             session.add(user_used_experiment)
             session.add(model.DbUserCommand(
                             user_used_experiment,
@@ -260,59 +384,199 @@ class DatabaseGateway(object):
         finally:
             session.close()
 
+    @logged()
+    def finish_experiment_usages(self, finished_usages):
+        """ Finishes many usages [ (reservation_id, end_date, last_command) ] in a single
+        transaction. Returns the reservation_ids which were not found (and therefore not finished). """
+        session = self.Session()
+        try:
+            reservation_ids = list(set( reservation_id for reservation_id, _, _ in finished_usages ))
+            uses = {}
+            for pos in xrange(0, len(reservation_ids), MAX_RESERVATIONS_PER_QUERY):
+                current_reservation_ids = reservation_ids[pos:pos + MAX_RESERVATIONS_PER_QUERY]
+                for use in session.query(model.DbUserUsedExperiment).filter(model.DbUserUsedExperiment.reservation_id.in_(current_reservation_ids)).all():
+                    uses[use.reservation_id] = use
+
+            not_found = []
+            rollups = UsageRollupDelta()
+            for reservation_id, end_date, last_command in finished_usages:
+                user_used_experiment = uses.get(reservation_id)
+                if user_used_experiment is None:
+                    not_found.append(reservation_id)
+                    continue
+
+                rollups.remove(user_used_experiment)
+                user_used_experiment.set_end_date(end_date)
+                rollups.add(user_used_experiment)
+                session.add(model.DbUserCommand(
+                                user_used_experiment,
+                                last_command.command.commandstring,
+                                last_command.timestamp_before,
+                                last_command.response.commandstring,
+                                last_command.timestamp_after
+                            ))
+            rollups.apply(session)
+            session.commit()
+            return not_found
+        finally:
+            session.close()
+
     @logged()
     def store_commands(self, complete_commands, command_requests, command_responses, complete_files, file_requests, file_responses):
-        """ Stores all the commands in a single transaction; retrieving the ids of the file and command requests """
+        """ Stores all the commands in a single transaction; retrieving the ids of the file and command requests.
+
+        All the experiment uses involved are retrieved in a single query, the complete commands and files
+        are inserted at once (executemany) and the responses are applied with bulk UPDATEs. Only the
+        requests are inserted one by one, since their ids must be returned. """
         request_mappings = {
             # entry_id : command_id
         }
         session = self.Session()
         try:
-            db_commands_and_files = []
-
+            reservation_ids = set()
+            for reservation_id, _, _ in complete_commands:
+                reservation_ids.add(reservation_id)
+            for reservation_id, _, _ in complete_files:
+                reservation_ids.add(reservation_id)
+            for reservation_id, _ in command_requests.values():
+                reservation_ids.add(reservation_id)
+            for reservation_id, _ in file_requests.values():
+                reservation_ids.add(reservation_id)
+
+            use_ids = self._get_use_ids(session, reservation_ids)
+
+            commands_table = model.DbUserCommand.__table__
+            files_table    = model.DbUserFile.__table__
+
+            command_rows = []
             for reservation_id, entry_id, command in complete_commands:
-                db_command = self._append_command(session, reservation_id, command)
-                if db_command == False:
+                if reservation_id in use_ids:
+                    command_rows.append(self._command_row(use_ids[reservation_id], command))
+                else:
                     request_mappings[entry_id] = False
 
-            for reservation_id, entry_id, command in complete_files:
-                db_file = self._append_file(session, reservation_id, command)
-                if db_file == False:
+            file_rows = []
+            for reservation_id, entry_id, file_sent in complete_files:
+                if reservation_id in use_ids:
+                    file_rows.append(self._file_row(use_ids[reservation_id], file_sent))
+                else:
                     request_mappings[entry_id] = False
 
+            if command_rows:
+                session.execute(commands_table.insert(), command_rows)
+            if file_rows:
+                session.execute(files_table.insert(), file_rows)
+
+            file_hashes = FileHashIndexDelta()
+            for file_row in file_rows:
+                file_hashes.add(file_row['experiment_use_id'], file_row['file_hash'])
+
+            db_ids = []
             for entry_id in command_requests:
                 reservation_id, command = command_requests[entry_id]
-                db_command = self._append_command(session, reservation_id, command)
-                if db_command == False:
-                    request_mappings[entry_id] = False
+                if reservation_id in use_ids:
+                    result = session.execute(commands_table.insert(), self._command_row(use_ids[reservation_id], command))
+                    db_ids.append((entry_id, result.inserted_primary_key[0]))
                 else:
-                    db_commands_and_files.append((entry_id, db_command))
+                    request_mappings[entry_id] = False
 
             for entry_id in file_requests:
-                reservation_id, file = file_requests[entry_id]
-                db_file = self._append_file(session, reservation_id, file)
-                if db_file == False:
-                    request_mappings[entry_id] = False
+                reservation_id, file_sent = file_requests[entry_id]
+                if reservation_id in use_ids:
+                    result = session.execute(files_table.insert(), self._file_row(use_ids[reservation_id], file_sent))
+                    db_ids.append((entry_id, result.inserted_primary_key[0]))
+                    file_hashes.add(use_ids[reservation_id], file_sent.file_hash)
                 else:
-                    db_commands_and_files.append((entry_id, db_file))
-
-            for entry_id, command_id, response, timestamp in command_responses:
-                if not self._update_command(session, command_id, response, timestamp):
                     request_mappings[entry_id] = False
 
-            for entry_id, file_id, response, timestamp in file_responses:
-                if not self._update_file(session, file_id, response, timestamp):
-                    request_mappings[entry_id] = False
+            self._update_responses(session, model.DbUserCommand, command_responses, request_mappings)
+            self._update_responses(session, model.DbUserFile, file_responses, request_mappings)
+            file_hashes.apply(session)
 
             session.commit()
-            for entry_id, db_command in db_commands_and_files:
-                request_mappings[entry_id] = db_command.id
+            for entry_id, db_id in db_ids:
+                request_mappings[entry_id] = db_id
 
         finally:
             session.close()
        
         return request_mappings
 
+    def _get_use_ids(self, session, reservation_ids):
+        """ Returns { reservation_id : experiment_use_id } for those reservation_ids stored """
+        reservation_ids = list(reservation_ids)
+        use_ids = {}
+        for pos in xrange(0, len(reservation_ids), MAX_RESERVATIONS_PER_QUERY):
+            current_reservation_ids = reservation_ids[pos:pos + MAX_RESERVATIONS_PER_QUERY]
+            query = session.query(model.DbUserUsedExperiment.id, model.DbUserUsedExperiment.reservation_id)
+            for use_id, reservation_id in query.filter(model.DbUserUsedExperiment.reservation_id.in_(current_reservation_ids)):
+                use_ids[reservation_id] = use_id
+        return use_ids
+
+    def _command_row(self, use_id, command):
+        timestamp_before, timestamp_before_micro = model._timestamp_to_splitted_utc_datetime(command.timestamp_before)
+        timestamp_after,  timestamp_after_micro  = model._timestamp_to_splitted_utc_datetime(command.timestamp_after)
+        return {
+            'experiment_use_id'      : use_id,
+            'command'                : command.command.commandstring,
+            'response'               : command.response.commandstring if command.response is not None else None,
+            'timestamp_before'       : timestamp_before,
+            'timestamp_before_micro' : timestamp_before_micro,
+            'timestamp_after'        : timestamp_after,
+            'timestamp_after_micro'  : timestamp_after_micro,
+        }
+
+    def _file_row(self, use_id, file_sent):
+        timestamp_before, timestamp_before_micro = model._timestamp_to_splitted_utc_datetime(file_sent.timestamp_before)
+        timestamp_after,  timestamp_after_micro  = model._timestamp_to_splitted_utc_datetime(file_sent.timestamp_after)
+        return {
+            'experiment_use_id'      : use_id,
+            'file_sent'              : file_sent.file_path,
+            'file_hash'              : file_sent.file_hash,
+            'file_info'              : file_sent.file_info,
+            'response'               : file_sent.response.commandstring if file_sent.response is not None else None,
+            'timestamp_before'       : timestamp_before,
+            'timestamp_before_micro' : timestamp_before_micro,
+            'timestamp_after'        : timestamp_after,
+            'timestamp_after_micro'  : timestamp_after_micro,
+        }
+
+    def _update_responses(self, session, klass, responses, request_mappings):
+        """ Applies the responses [ (entry_id, db_id, response, timestamp) ] to the commands or
+        files (depending on klass) with a single UPDATE. Those not found are marked as False
+        in request_mappings. """
+        if not responses:
+            return
+
+        db_ids = list(set( db_id for _, db_id, _, _ in responses ))
+        existing_ids = set()
+        for pos in xrange(0, len(db_ids), MAX_RESERVATIONS_PER_QUERY):
+            current_db_ids = db_ids[pos:pos + MAX_RESERVATIONS_PER_QUERY]
+            for (db_id,) in session.query(klass.id).filter(klass.id.in_(current_db_ids)):
+                existing_ids.add(db_id)
+
+        rows = []
+        for entry_id, db_id, response, timestamp in responses:
+            if db_id not in existing_ids:
+                request_mappings[entry_id] = False
+                continue
+            timestamp_after, timestamp_after_micro = model._timestamp_to_splitted_utc_datetime(timestamp)
+            rows.append({
+                'db_id'                    : db_id,
+                'db_response'              : response.commandstring if response is not None else None,
+                'db_timestamp_after'       : timestamp_after,
+                'db_timestamp_after_micro' : timestamp_after_micro,
+            })
+
+        if rows:
+            table = klass.__table__
+            statement = table.update().where(table.c.id == bindparam('db_id')).values(
+                            response              = bindparam('db_response'),
+                            timestamp_after       = bindparam('db_timestamp_after'),
+                            timestamp_after_micro = bindparam('db_timestamp_after_micro'),
+                        )
+            session.execute(statement, rows)
+
     @typecheck(basestring, CommandSent)
     @logged()
     def append_command(self, reservation_id, command ):
@@ -386,6 +650,9 @@ class DatabaseGateway(object):
                         file_sent.timestamp_after
                     )
         session.add(db_file_sent)
+        file_hashes = FileHashIndexDelta()
+        file_hashes.add(user_used_experiment, file_sent.file_hash)
+        file_hashes.apply(session)
         return db_file_sent
 
     @typecheck(numbers.Integral, Command, float)
@@ -457,16 +724,7 @@ class DatabaseGateway(object):
 
     @logged()
     def get_user_permissions(self, user_login):
-        session = self.Session()
-        try:
-            user = self._get_user(session, user_login)
-            user_permissions = []
-            for pt in permissions.permission_types:
-                user_permissions.extend(self._gather_permissions(session, user, pt))
-            dto_permissions = [ permission.to_dto() for permission in user_permissions ]
-            return tuple(dto_permissions)
-        finally:
-            session.close()
+        return self._get_resolved_permissions(user_login).permissions
 
     def _get_user(self, session, user_login):
         try:
@@ -511,20 +769,23 @@ class DatabaseGateway(object):
     def _get_permissions(self, session, user_or_role_or_group_or_ee, permission_type_name):
         return [ pi for pi in user_or_role_or_group_or_ee.permissions if pi.get_permission_type() == permission_type_name ]
 
-    def _get_parameter_from_permission(self, session, permission, parameter_name, default_value = DEFAULT_VALUE):
-        try:
-            param = [ p for p in permission.parameters if p.get_name() == parameter_name ][0]
-        except IndexError:
+    def _get_parameters_from_permission(self, permission):
+        return dict( (p.get_name(), p.value) for p in permission.parameters )
+
+    def _get_parameter_from_permission(self, session, permission, parameter_name, default_value = DEFAULT_VALUE, parameters = None):
+        if parameters is None:
+            parameters = self._get_parameters_from_permission(permission)
+        if parameter_name not in parameters:
             if default_value == DEFAULT_VALUE:
                 raise DbErrors.DbIllegalStatusError(
                     permission.get_permission_type() + " permission without " + parameter_name
                 )
             else:
                 return default_value
-        return param.value
+        return parameters[parameter_name]
 
-    def _get_float_parameter_from_permission(self, session, permission, parameter_name, default_value = DEFAULT_VALUE):
-        value = self._get_parameter_from_permission(session, permission, parameter_name, default_value)
+    def _get_float_parameter_from_permission(self, session, permission, parameter_name, default_value = DEFAULT_VALUE, parameters = None):
+        value = self._get_parameter_from_permission(session, permission, parameter_name, default_value, parameters)
         try:
             return float(value)
         except ValueError:
@@ -536,8 +797,8 @@ class DatabaseGateway(object):
                 )
             )
 
-    def _get_int_parameter_from_permission(self, session, permission, parameter_name, default_value = DEFAULT_VALUE):
-        value = self._get_parameter_from_permission(session, permission, parameter_name, default_value)
+    def _get_int_parameter_from_permission(self, session, permission, parameter_name, default_value = DEFAULT_VALUE, parameters = None):
+        value = self._get_parameter_from_permission(session, permission, parameter_name, default_value, parameters)
         try:
             return int(value)
         except ValueError:
@@ -549,8 +810,8 @@ class DatabaseGateway(object):
                 )
             )
 
-    def _get_bool_parameter_from_permission(self, session, permission, parameter_name, default_value = DEFAULT_VALUE):
-        return self._get_parameter_from_permission(session, permission, parameter_name, default_value)
+    def _get_bool_parameter_from_permission(self, session, permission, parameter_name, default_value = DEFAULT_VALUE, parameters = None):
+        return self._get_parameter_from_permission(session, permission, parameter_name, default_value, parameters)
 
     def _delete_all_uses(self):
         """ IMPORTANT: SHOULD NEVER BE USED IN PRODUCTION, IT'S HERE ONLY FOR TESTS """
@@ -559,6 +820,9 @@ class DatabaseGateway(object):
             uu = session.query(model.DbUserUsedExperiment).all()
             for i in uu:
                 session.delete(i)
+            session.execute(model.DbUsageRollup.__table__.delete())
+            session.execute(model.DbUsageDurationRollup.__table__.delete())
+            session.execute(model.DbFileHashIndex.__table__.delete())
             session.commit()
         finally:
             session.close()
@@ -1,9 +1,15 @@
+import os
 import time
+import hashlib
+import threading
 import traceback
 
 import voodoo.log as log
 
+from voodoo.threaded import run_concurrently
+
 from weblab.core.login.web import EXTERNAL_MANAGERS
+import weblab.core.login.simple.ldap_auth as ldap_auth
 
 from weblab.core.wl import weblab_api
 import weblab.core.login.exc as LoginErrors
@@ -16,11 +22,76 @@ DEFAULT_GROUPS     = 'login_default_groups_for_external_users'
 CREATING_EXTERNAL_USERS = 'login_creating_external_users'
 LINKING_EXTERNAL_USERS  = 'login_linking_external_users'
 
+USER_AUTHS_CACHE_TIME   = 'login_user_auths_cache_time'
+# While cached, a password changed or a user (or authentication method)
+# removed still authenticates with the cached authentication methods
+DEFAULT_USER_AUTHS_CACHE_TIME = 0 # seconds; 0 disables the cache
+
+CREDENTIALS_CACHE_TIME  = 'login_credentials_cache_time'
+DEFAULT_CREDENTIALS_CACHE_TIME = 0 # seconds; 0 disables the cache
+
+# Expired entries are only purged when the caches grow over this size
+CACHE_PURGE_SIZE = 10000
+
+class _ExpiringCache(object):
+    """ A thread-safe dictionary whose entries expire after ttl seconds """
+
+    def __init__(self, ttl, time_func = time.time):
+        self.ttl   = ttl
+        self._time = time_func
+        self._lock = threading.Lock()
+        self._data = {} # { key : (expiration time, value) }
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            expiration, value = entry
+            if expiration < self._time():
+                self._data.pop(key, None)
+                return None
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            now = self._time()
+            if len(self._data) >= CACHE_PURGE_SIZE:
+                for expired_key in [ k for k, (expiration, _) in self._data.iteritems() if expiration < now ]:
+                    self._data.pop(expired_key)
+            self._data[key] = (now + self.ttl, value)
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
 
 class LoginManager(object):
-    def __init__(self, db, core_server):
+    def __init__(self, db, core_server, cfg_manager):
         self._db = db
         self._core_server = core_server
+        self._cfg_manager = cfg_manager
+
+        # Role and user auths of each username, so logging in does not
+        # require querying the database each time
+        self._user_auths_cache = _ExpiringCache(cfg_manager.get_value(USER_AUTHS_CACHE_TIME, DEFAULT_USER_AUTHS_CACHE_TIME))
+
+        # Successful verifications, stored by a salted hash of the login and
+        # the password (so the passwords are not kept in memory), so logging
+        # in again does not require contacting the LDAP server
+        self._credentials_cache = _ExpiringCache(cfg_manager.get_value(CREDENTIALS_CACHE_TIME, DEFAULT_CREDENTIALS_CACHE_TIME))
+        self._credentials_salt  = os.urandom(16)
+
+        ldap_auth.configure(cfg_manager)
 
     def login(self, username, password):
         """ do_login(username, password) -> SessionId
@@ -45,36 +116,37 @@ class LoginManager(object):
         username and credentials (e.g., password, IP address, etc.). This
         method will only check the SimpleAuthn instances.
         """
+        credentials_key = None
+        if self._credentials_cache.ttl > 0:
+            credentials_key = self._hash_credentials(username, credentials)
+            role_name = self._credentials_cache.get(credentials_key)
+            if role_name is not None:
+                log.log( LoginManager, log.level.Debug, "Username: %s: SUCCESS (cached)" % username )
+                return ValidDatabaseSessionId( username, role_name )
+
         try:
-            role_name, user_auths  = self._db.retrieve_role_and_user_auths(username)
+            cached, role_name, user_auths = self._retrieve_role_and_user_auths(username)
         except DbUserNotFoundError:
             return self._process_invalid()
 
-        errors = False
+        authenticated_by, errors = self._check_user_auths(username, credentials, user_auths)
+
+        if authenticated_by is None and cached:
+            # The password or the user auths might have been changed meanwhile:
+            # check again if they are different in the database
+            try:
+                _, role_name, new_user_auths = self._retrieve_role_and_user_auths(username, use_cache = False)
+            except DbUserNotFoundError:
+                return self._process_invalid()
+
+            if map(repr, new_user_auths) != map(repr, user_auths):
+                authenticated_by, errors = self._check_user_auths(username, credentials, new_user_auths)
+
+        if authenticated_by is not None:
+            if credentials_key is not None and authenticated_by.credentials_only:
+                self._credentials_cache.set(credentials_key, role_name)
+            return ValidDatabaseSessionId( username, role_name )
 
-        for user_auth in user_auths:
-            # Take only those auth types that use a simple interface
-            if user_auth.is_simple_authn():
-                # With each user auth, try to authenticate the user.
-                try:
-                    authenticated = user_auth.authenticate(username, credentials)
-                except:
-                    # If there is an error, the user could not be authenticated.
-                    log.log( LoginManager, log.level.Warning, "Username: %s with user_auth %s: ERROR" % (username, user_auth) )
-                    log.log_exc( LoginManager, log.level.Warning)
-                    errors = True
-                    traceback.print_exc()
-                    continue
-                
-                if authenticated:
-                    # If authenticated, return that it was correctly authenticated.
-                    log.log( LoginManager, log.level.Debug, "Username: %s with user_auth %s: SUCCESS" % (username, user_auth) )
-                    return ValidDatabaseSessionId( username, role_name )
-
-                else:
-                    # If not authenticated, log it and continue with the next user_auth.
-                    log.log( LoginManager, log.level.Warning, "Username: %s with user_auth %s: FAIL" % (username, user_auth) )
-        
         if errors:
             # Raise error: there was a server problem and this might be the reason for not 
             # authenticating the user. Examples: LDAP server is down, there is an error in the
@@ -83,6 +155,88 @@ class LoginManager(object):
 
         return self._process_invalid()
 
+    def _retrieve_role_and_user_auths(self, username, use_cache = True):
+        """ Returns (cached, role_name, user_auths) """
+        if self._user_auths_cache.ttl > 0:
+            if use_cache:
+                cached_value = self._user_auths_cache.get(username)
+                if cached_value is not None:
+                    role_name, user_auths = cached_value
+                    return True, role_name, user_auths
+
+            try:
+                role_name, user_auths = self._db.retrieve_role_and_user_auths(username)
+            except DbUserNotFoundError:
+                self._user_auths_cache.pop(username)
+                raise
+            self._user_auths_cache.set(username, (role_name, user_auths))
+            return False, role_name, user_auths
+
+        role_name, user_auths = self._db.retrieve_role_and_user_auths(username)
+        return False, role_name, user_auths
+
+    def _hash_credentials(self, username, credentials):
+        if isinstance(username, unicode):
+            username = username.encode('utf8')
+        if isinstance(credentials, unicode):
+            credentials = credentials.encode('utf8')
+        return hashlib.sha256('%s%s\0%s' % (self._credentials_salt, username, credentials)).digest()
+
+    def _check_user_auths(self, username, credentials, user_auths):
+        """ Returns (the user auth which authenticated the user or None, were there errors) """
+        # Take only those auth types that use a simple interface
+        simple_user_auths = [ user_auth for user_auth in user_auths if user_auth.is_simple_authn() ]
+
+        # Whoever authenticates the user, the result is the same, so the local
+        # user auths (which are cheap to check) are checked before the remote
+        # ones, which are checked concurrently if there are many of them
+        local_user_auths  = [ user_auth for user_auth in simple_user_auths if not user_auth.remote ]
+        remote_user_auths = [ user_auth for user_auth in simple_user_auths if user_auth.remote ]
+
+        errors = False
+        for user_auth in local_user_auths:
+            authenticated = self._authenticate(user_auth, username, credentials)
+            if authenticated is None:
+                errors = True
+            elif authenticated:
+                return user_auth, errors
+
+        if len(remote_user_auths) == 1:
+            user_auth = remote_user_auths[0]
+            results = [ (user_auth, self._authenticate(user_auth, username, credentials)) ]
+        else:
+            tasks = [ (user_auth, self._authenticate, (user_auth, username, credentials)) for user_auth in remote_user_auths ]
+            results = ( (user_auth, result) for user_auth, _, result in run_concurrently(tasks, workers = len(tasks)) )
+
+        for user_auth, authenticated in results:
+            if authenticated is None:
+                errors = True
+            elif authenticated:
+                return user_auth, errors
+
+        return None, errors
+
+    def _authenticate(self, user_auth, username, credentials):
+        """ Returns True if authenticated, False if not, and None if there was an error """
+        # With each user auth, try to authenticate the user.
+        try:
+            authenticated = user_auth.authenticate(username, credentials)
+        except:
+            # If there is an error, the user could not be authenticated.
+            log.log( LoginManager, log.level.Warning, "Username: %s with user_auth %s: ERROR" % (username, user_auth) )
+            log.log_exc( LoginManager, log.level.Warning)
+            traceback.print_exc()
+            return None
+
+        if authenticated:
+            # If authenticated, return that it was correctly authenticated.
+            log.log( LoginManager, log.level.Debug, "Username: %s with user_auth %s: SUCCESS" % (username, user_auth) )
+            return True
+
+        # If not authenticated, log it and continue with the next user_auth.
+        log.log( LoginManager, log.level.Warning, "Username: %s with user_auth %s: FAIL" % (username, user_auth) )
+        return False
+
     def _reserve_session(self, db_session_id):
         session_id, server_route = self._core_server.do_reserve_session(db_session_id)
         if hasattr(session_id, 'id'):
@@ -28,6 +28,14 @@ class UserAuth(object):
 
 class SimpleAuthnUserAuth(UserAuth):
 
+    # Does authenticate contact an external server (e.g., LDAP)? If so, it
+    # is run concurrently with the other remote user auths of the user
+    remote = False
+
+    # Does the result of authenticate only depend on the login and the
+    # password? If so, a successful verification can be cached
+    credentials_only = True
+
     def is_simple_authn(self):
         return True
     
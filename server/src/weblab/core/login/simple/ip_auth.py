@@ -26,6 +26,9 @@ class TrustedIpAddressesUserAuth(SimpleAuthnUserAuth):
 
     NAME = 'TRUSTED-IP-ADDRESSES'
 
+    # It depends on the IP address of the request
+    credentials_only = False
+
     def __init__(self, auth_configuration, user_auth_configuration):
         self.addresses = []
         if auth_configuration:
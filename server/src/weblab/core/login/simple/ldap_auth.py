@@ -15,10 +15,13 @@
 
 import sys
 import re
+import time
+import threading
 try:
     import ldap
 except ImportError:
     LDAP_AVAILABLE = False
+    ldap = None
 else:
     LDAP_AVAILABLE = True
 
@@ -28,24 +31,126 @@ import weblab.core.login.exc as LoginErrors
 
 from weblab.core.login.simple import SimpleAuthnUserAuth
 
-#######################################################################
-# 
-#        LDAP
-# 
+LDAP_POOL_SIZE     = 'login_ldap_pool_size'
+DEFAULT_LDAP_POOL_SIZE = 10 # idle connections kept per LDAP server; 0 disables the pool
 
-# TODO: no test actually test the real ldap module. The problem is
-# requiring a LDAP server in the integration machine (in our integration
-# machine it's not a problem, but running those test in "any computer"
-# might be a bigger problem)
+LDAP_POOL_MAX_IDLE = 'login_ldap_pool_max_idle'
+DEFAULT_LDAP_POOL_MAX_IDLE = 60 # seconds
 
-if LDAP_AVAILABLE:
-    class _LdapProvider(object):
-        def __init__(self):
-            self.ldap_module = ldap
-        def get_module(self):
-            return self.ldap_module
+class _LdapProvider(object):
+    def __init__(self):
+        self.ldap_module = ldap
+    def get_module(self):
+        return self.ldap_module
 
-    _ldap_provider = _LdapProvider()
+_ldap_provider = _LdapProvider()
+
+class LdapConnectionPool(object):
+    """
+    Keeps the connections to a LDAP server open among logins, so each login
+    only costs a bind instead of a new (usually TLS) connection plus a bind.
+    A failed bind (invalid credentials) leaves the connection usable, and the
+    next bind on a connection replaces the identity of the previous one, so
+    the connections are only used for checking credentials.
+    """
+
+    def __init__(self, ldap_uri, size = DEFAULT_LDAP_POOL_SIZE, max_idle = DEFAULT_LDAP_POOL_MAX_IDLE, time_func = time.time):
+        self.ldap_uri = ldap_uri
+        self.size     = size
+        self.max_idle = max_idle
+        self._time    = time_func
+
+        self._lock    = threading.Lock()
+        self._idle    = [] # [ (connection, last use) ], the most recently used at the end
+        self._created = 0
+        self._reused  = 0
+
+    def acquire(self, reuse = True):
+        """ Returns (connection, reused). If reuse is False, a new connection is always created. """
+        expired = []
+        connection = None
+        with self._lock:
+            now = self._time()
+            while reuse and self._idle and connection is None:
+                candidate, last_use = self._idle.pop()
+                if now - last_use > self.max_idle:
+                    expired.append(candidate)
+                else:
+                    connection = candidate
+            if connection is None:
+                self._created += 1
+            else:
+                self._reused += 1
+
+        for expired_connection in expired:
+            self._close(expired_connection)
+
+        if connection is not None:
+            return connection, True
+
+        try:
+            return _ldap_provider.get_module().initialize(self.ldap_uri), False
+        except Exception as e:
+            raise LoginErrors.LdapInitializingError(
+                "Exception initializing the LDAP module: %s" % e
+            )
+
+    def release(self, connection, reusable = True):
+        if reusable:
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append((connection, self._time()))
+                    return
+        self._close(connection)
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for connection, _ in idle:
+            self._close(connection)
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'size'    : self.size,
+                'idle'    : len(self._idle),
+                'created' : self._created,
+                'reused'  : self._reused,
+            }
+
+    def _close(self, connection):
+        try:
+            connection.unbind_s()
+        except Exception:
+            pass
+
+_pools      = {} # { ldap_uri : pool }
+_pools_lock = threading.Lock()
+_pool_size  = DEFAULT_LDAP_POOL_SIZE
+_max_idle   = DEFAULT_LDAP_POOL_MAX_IDLE
+
+def configure(cfg_manager):
+    """ Sets the size and the idle time of the pools created from now on """
+    global _pool_size, _max_idle
+    with _pools_lock:
+        _pool_size = cfg_manager.get_value(LDAP_POOL_SIZE,     DEFAULT_LDAP_POOL_SIZE)
+        _max_idle  = cfg_manager.get_value(LDAP_POOL_MAX_IDLE, DEFAULT_LDAP_POOL_MAX_IDLE)
+
+def get_pool(ldap_uri):
+    with _pools_lock:
+        pool = _pools.get(ldap_uri)
+        if pool is None:
+            pool = LdapConnectionPool(ldap_uri, size = _pool_size, max_idle = _max_idle)
+            _pools[ldap_uri] = pool
+        return pool
+
+def close_all():
+    with _pools_lock:
+        pools = _pools.values()
+        _pools.clear()
+    for pool in pools:
+        pool.close()
 
 
 class LdapUserAuth(SimpleAuthnUserAuth):
@@ -53,6 +158,9 @@ class LdapUserAuth(SimpleAuthnUserAuth):
     NAME = 'LDAP'
     REGEX = 'ldap_uri=(ldaps?://[a-zA-Z0-9\./_-]+);domain=([a-zA-Z0-9\._-]+);base=([a-zA-Z0-9=\,_-]+)'
 
+    # It contacts the LDAP server
+    remote = True
+
     def __init__(self, auth_configuration, user_auth_configuration):
         mo = re.match(LdapUserAuth.REGEX, auth_configuration)
         if mo is None:
@@ -74,30 +182,31 @@ class LdapUserAuth(SimpleAuthnUserAuth):
             return False
 
         password = str(password)
-        ldap_module = _ldap_provider.get_module()
-        try:
-            ldapobj = ldap_module.initialize(
-                self.ldap_uri
-            )
-        except Exception as e:
-            raise LoginErrors.LdapInitializingError(
-                "Exception initializing the LDAP module: %s" % e
-            )
+        pool = get_pool(self.ldap_uri)
 
         dn = "%s@%s" % (login, self.domain)
         pw = password
 
-        try:
-            ldapobj.simple_bind_s(dn, pw)
-        except ldap.INVALID_CREDENTIALS as e:
-            return False
-        except Exception as e:
-            raise LoginErrors.LdapBindingError(
-                "Exception binding to the server: %s" % e
-            )
-        else:
-            ldapobj.unbind_s()
-            return True
+        reuse = True
+        while True:
+            ldapobj, reused = pool.acquire(reuse)
+            try:
+                ldapobj.simple_bind_s(dn, pw)
+            except ldap.INVALID_CREDENTIALS as e:
+                pool.release(ldapobj)
+                return False
+            except Exception as e:
+                pool.release(ldapobj, reusable = False)
+                if reused:
+                    # The server might have closed the idle connection: retry once with a new one
+                    reuse = False
+                    continue
+                raise LoginErrors.LdapBindingError(
+                    "Exception binding to the server: %s" % e
+                )
+            else:
+                pool.release(ldapobj)
+                return True
 
     def __str__(self):
         return "LdapUserAuth(domain=%r, ldap_uri=%r, base=%r)" % (self.domain, self.ldap_uri, self.base)
@@ -105,4 +214,3 @@ class LdapUserAuth(SimpleAuthnUserAuth):
     def __repr__(self):
         return "LdapUserAuth(configuration=%r)" % (self.auth_configuration)
 
-
@@ -10,9 +10,14 @@ from collections import OrderedDict
 
 from flask import request, Response
 
-from voodoo.log import log, level, log_exc, logged
+from voodoo.log import log, level, log_exc, logged, set_trace_context
 import weblab.core.codes as ErrorCodes
 import weblab.configuration_doc as configuration_doc
+from voodoo.sessions.session_id import SessionId
+from weblab.data.command import Command, NullCommand
+from weblab.data.dto.experiments import ExperimentAllowed, Experiment, ExperimentCategory, ExperimentClient
+import weblab.core.reservations as Reservation
+import weblab.core.coordinator.status as WSS
 
 # TODO: clean these imports
 import weblab.core.login.exc as LoginErrors
@@ -20,6 +25,94 @@ import weblab.core.exc as coreExc
 import weblab.exc as WebLabErrors
 import voodoo.gen.exceptions.exceptions as VoodooErrors
 
+#######################################################################
+#
+# simplify_response finds in _encoders the function which simplifies the
+# objects of each class. The first time a class is found, the encoder is
+# created and stored. Explicit encoders can be registered for those
+# classes which are returned in most requests.
+#
+
+# class : encoder(obj, limit, counter)
+_encoders = {}
+
+def register_encoder(klass, encoder):
+    """ encoder(obj, limit, counter) must return the simplified obj, calling simplify_response(value, limit, counter + 1) for the contained values """
+    _encoders[klass] = encoder
+
+def register_attributes(klass, *attributes):
+    """ Instances of klass are simplified as a dictionary with these attributes, which all the instances must have """
+    def attributes_encoder(obj, limit, counter):
+        ret = {}
+        for attr in attributes:
+            ret[attr] = simplify_response(getattr(obj, attr), limit, counter + 1)
+        return ret
+    register_encoder(klass, attributes_encoder)
+
+def _encode_basic(obj, limit, counter):
+    return obj
+
+def _encode_sequence(obj, limit, counter):
+    return [ simplify_response(i, limit, counter + 1) for i in obj ]
+
+def _encode_dict(obj, limit, counter):
+    new_response = {}
+    for i in obj:
+        new_response[i] = simplify_response(obj[i], limit, counter + 1)
+    return new_response
+
+def _encode_date(obj, limit, counter):
+    return obj.isoformat()
+
+def _encode_dir(obj, limit, counter):
+    ret = {}
+    for attr in [ a for a in dir(obj) if not a.startswith('_') ]:
+        if not hasattr(obj.__class__, attr):
+            attr_value = getattr(obj, attr)
+            if not isinstance(attr_value, types.FunctionType) and not isinstance(attr_value, types.MethodType):
+                ret[attr] = simplify_response(attr_value, limit, counter + 1)
+    return ret
+
+def _create_object_encoder(klass):
+    # Same as _encode_dir for objects which have their attributes in
+    # __dict__, but checking only once per class and attribute whether
+    # the class has it (which happens in the attributes of the instance
+    # that override a method or a property)
+    class_attributes = {
+        # attr : hasattr(klass, attr)
+    }
+
+    def object_encoder(obj, limit, counter):
+        ret = {}
+        for attr, attr_value in obj.__dict__.items():
+            if attr.startswith('_'):
+                continue
+
+            in_class = class_attributes.get(attr)
+            if in_class is None:
+                in_class = class_attributes[attr] = hasattr(klass, attr)
+
+            if not in_class and not isinstance(attr_value, (types.FunctionType, types.MethodType)):
+                ret[attr] = simplify_response(attr_value, limit, counter + 1)
+        return ret
+    return object_encoder
+
+def _create_encoder(klass):
+    if issubclass(klass, (basestring, int, long, float, bool)):
+        return _encode_basic
+    if issubclass(klass, (list, tuple)):
+        return _encode_sequence
+    if issubclass(klass, dict):
+        return _encode_dict
+    if issubclass(klass, (datetime.datetime, datetime.date, datetime.time)):
+        return _encode_date
+    # Instances of classes which define __dir__ or __slots__ (or of builtin
+    # types, without __dict__) are not represented by their __dict__. Old
+    # style instances always have it.
+    if hasattr(klass, '__dir__') or hasattr(klass, '__slots__') or getattr(klass, '__dictoffset__', None) == 0:
+        return _encode_dir
+    return _create_object_encoder(klass)
+
 def simplify_response(response, limit = 15, counter = 0):
     """
     Recursively serializes the response into a JSON dictionary. Because the response object could actually
@@ -27,27 +120,41 @@ def simplify_response(response, limit = 15, counter = 0):
     """
     if counter == limit:
         return None
-    if isinstance(response, (basestring, int, long, float, bool)):
-        return response
-    if isinstance(response, (list, tuple)):
-        new_response = []
-        for i in response:
-            new_response.append(simplify_response(i, limit, counter + 1,))
-        return new_response
-    if isinstance(response, dict):
-        new_response = {}
-        for i in response:
-            new_response[i] = simplify_response(response[i], limit, counter + 1)
-        return new_response
-    if isinstance(response, (datetime.datetime, datetime.date, datetime.time)):
-        return response.isoformat()
-    ret = {}
-    for attr in [ a for a in dir(response) if not a.startswith('_') ]:
-        if not hasattr(response.__class__, attr):
-            attr_value = getattr(response, attr)
-            if not isinstance(attr_value, types.FunctionType) and not isinstance(attr_value, types.MethodType):
-                ret[attr] = simplify_response(attr_value, limit, counter + 1)
-    return ret
+
+    klass = type(response)
+    if klass is types.InstanceType:
+        klass = response.__class__
+
+    encoder = _encoders.get(klass)
+    if encoder is None:
+        encoder = _encoders[klass] = _create_encoder(klass)
+    return encoder(response, limit, counter)
+
+# Objects returned in most of the requests (reserve, get_reservation_status, poll,
+# list_experiments, send_command...)
+register_attributes(SessionId, 'id')
+register_attributes(Command, 'commandstring')
+register_attributes(NullCommand, 'commandstring')
+
+register_attributes(Reservation.WaitingReservation,             'status', 'reservation_id', 'position')
+register_attributes(Reservation.WaitingInstances,               'status', 'reservation_id', 'position')
+register_attributes(Reservation.NullReservation,                'status', 'reservation_id', 'position')
+register_attributes(Reservation.WaitingConfirmationReservation, 'status', 'reservation_id', 'url')
+register_attributes(Reservation.ConfirmedReservation,           'status', 'reservation_id', 'time', 'initial_configuration', 'url', 'remote_reservation_id')
+register_attributes(Reservation.PostReservationReservation,     'status', 'reservation_id', 'finished', 'initial_data', 'end_data')
+
+register_attributes(WSS.WaitingQueueStatus,             'status', 'reservation_id', 'position')
+register_attributes(WSS.WaitingInstancesQueueStatus,    'status', 'reservation_id', 'position')
+register_attributes(WSS.WaitingConfirmationQueueStatus, 'status', 'reservation_id', 'url')
+register_attributes(WSS.RemoteReservedStatus,           'status', 'reservation_id', 'remaining_time', 'initial_configuration', 'url', 'remote_reservation_id')
+register_attributes(WSS.PostReservationStatus,          'status', 'reservation_id', 'finished', 'initial_data', 'end_data')
+register_attributes(WSS.LocalReservedStatus,            'status', 'reservation_id', 'coord_address', 'lab_session_id', 'exp_info', 'time', 'initial_configuration',
+                                                        'timestamp_before', 'timestamp_after', 'initialization_in_accounting', 'remaining_time', 'url')
+
+register_attributes(ExperimentAllowed,  'experiment', 'time_allowed', 'priority', 'initialization_in_accounting', 'permanent_id', 'permission_id', 'permission_scope')
+register_attributes(Experiment,         'name', 'category', 'start_date', 'end_date', 'client', 'id')
+register_attributes(ExperimentCategory, 'name')
+register_attributes(ExperimentClient,   'client_id', 'configuration')
 
 EXCEPTIONS = (
         #
@@ -221,9 +328,12 @@ class WebLabAPI(object):
                     session_id = request.args.get('session_id')
 
             self.context.session_id = session_id
+
+        # The calls traced in this request which do not receive the reservation_id
+        set_trace_context(self.context.reservation_id)
     
     def __exit__(self, *args, **kwargs):
-        pass
+        set_trace_context(None)
 
     @property
     def user_agent(self):
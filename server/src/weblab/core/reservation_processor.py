@@ -52,6 +52,10 @@ class ReservationProcessor(object):
 
     EXPIRATION_TIME_NOT_SET=-1234
 
+    # Fields of the reservation session required to check whether the
+    # reservation is expired and to poll (see get_polling_fields)
+    POLLING_FIELDS = ('reservation_id', 'session_polling', 'latest_timestamp', 'federated', 'manages_polling')
+
     def __init__(self, cfg_manager, reservation_id, reservation_session, coordinator, locator, commands_store):
         self._cfg_manager            = cfg_manager
         self._reservation_session_id = reservation_id
@@ -211,6 +215,10 @@ class ReservationProcessor(object):
                 expiration_time
             )
 
+    def get_polling_fields(self):
+        """ The fields modified by poll and update_latest_timestamp """
+        return dict( (field, self._reservation_session[field]) for field in ('session_polling', 'latest_timestamp') if field in self._reservation_session )
+
     def is_expired(self):
 
         """Did this reservation's user stay out for a long time without polling?"""
@@ -389,7 +397,7 @@ class ReservationProcessor(object):
                 )
 
 
-    def check_async_command_status(self, request_identifiers):
+    def check_async_command_status(self, request_identifiers, wait = 0):
         """
         Checks the status of several asynchronous commands. The request will be
         internally forwarded to the lab server. Standard async commands
@@ -400,6 +408,8 @@ class ReservationProcessor(object):
         logging purposes.
 
         @param request_identifiers: List of the identifiers to check
+        @param wait: If none of them has finished, seconds that the laboratory
+        server will wait for any of them to finish before returning
         @return: Dictionary by request-id of tuples: (status, content)
         """
 
@@ -412,7 +422,11 @@ class ReservationProcessor(object):
         laboratory_server = self._locator.get_server_from_coordaddr( lab_coordaddr, ServerType.Laboratory )
 
         try:
-            response = laboratory_server.check_async_command_status( lab_session_id, request_identifiers)
+            if wait:
+                response = laboratory_server.check_async_command_status( lab_session_id, request_identifiers, wait)
+            else:
+                # Laboratory servers of previous versions do not support waiting
+                response = laboratory_server.check_async_command_status( lab_session_id, request_identifiers)
 
             # Within the response map, we might now have the real response to one
             # (or more) async commands. We will update the usage object of the
@@ -451,6 +465,30 @@ class ReservationProcessor(object):
                     "Failed to send command: %s" % ftspe
                 )
 
+    def wait_async_command_status(self, request_identifiers, wait):
+        """
+        Waits in the laboratory server up to wait seconds for any of the
+        asynchronous commands to finish. Unlike check_async_command_status,
+        it does not modify the reservation, so it can be called without
+        locking it.
+
+        @param request_identifiers: List of the identifiers to check
+        @param wait: Seconds to wait
+        @return: Dictionary by request-id of tuples: (status, content), or None
+        if the laboratory failed (check_async_command_status handles it)
+        """
+        lab_session_id = self._reservation_session.get('lab_session_id')
+        lab_coordaddr  = self._reservation_session.get('lab_coordaddr')
+
+        if lab_session_id is None or lab_coordaddr is None:
+            return None
+
+        laboratory_server = self._locator.get_server_from_coordaddr( lab_coordaddr, ServerType.Laboratory )
+        try:
+            return laboratory_server.check_async_command_status( lab_session_id, request_identifiers, wait )
+        except (LaboratoryErrors.SessionNotFoundInLaboratoryServerError, LaboratoryErrors.FailedToInteractError):
+            return None
+
 
     def send_async_command(self, command):
         """
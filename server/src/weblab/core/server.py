@@ -47,6 +47,7 @@ from weblab.core.coordinator.gateway import create as coordinator_create
 import weblab.core.coordinator.store as TemporalInformationStore
 from weblab.core.db import DatabaseGateway
 import weblab.core.coordinator.status as WebLabSchedulingStatus
+from weblab.lab.async_request import STATUS_RUNNING
 
 import weblab.core.exc as coreExc
 import weblab.core.web as web
@@ -349,21 +350,46 @@ def send_async_file(file_content, file_info):
 
 # TODO: This method should now be finished. Will need to be verified, though.
 @weblab_api.route_api('/reservation/file/async/status')
-@load_reservation_processor
-def check_async_command_status(request_identifiers):
+def check_async_command_status(request_identifiers, wait = 0):
     """
-    check_async_command_status(session_id, request_identifiers)
+    check_async_command_status(session_id, request_identifiers[, wait])
     Checks the status of several asynchronous commands.
 
     @param session: Session id
     @param request_identifiers: A list of the request identifiers of the
     requests to check.
+    @param wait: If none of them has finished, seconds to wait for any of them
+    to finish before returning (so the client does not need to poll continuously).
     @return: Dictionary by request-id of the tuples: (status, content)
     """
+    response = _check_async_command_status(request_identifiers)
+    if not wait or not response or any( status != STATUS_RUNNING for status, _ in response.values() ):
+        return response
+
+    # The reservation is not locked while the laboratory waits, since
+    # meanwhile the client may keep using it (send_command, poll...)
+    response = _wait_async_command_status(request_identifiers, wait)
+    if response is None:
+        # The laboratory failed: check it again, locking the reservation,
+        # so the failure is handled as usual (finishing the reservation)
+        response = _check_async_command_status(request_identifiers)
+    return response
+
+@load_reservation_processor
+def _check_async_command_status(request_identifiers):
     reservation_processor = weblab_api.ctx.reservation_processor
     weblab_api.ctx.server_instance._check_reservation_not_expired_and_poll( reservation_processor )
     return reservation_processor.check_async_command_status( request_identifiers )
 
+def _wait_async_command_status(request_identifiers, wait):
+    server = weblab_api.ctx.server_instance
+    reservation_id = SessionId(weblab_api.ctx.reservation_id.split(';')[0])
+    try:
+        session = server._reservations_session_manager.get_session(reservation_id)
+    except SessionNotFoundError:
+        raise coreExc.SessionNotFoundError("Core Reservations session not found")
+    return server._load_reservation(session).wait_async_command_status( request_identifiers, wait )
+
 @weblab_api.route_api('/reservation/command/async/', methods = ['POST'])
 @load_reservation_processor
 def send_async_command(command):
@@ -385,8 +411,14 @@ def get_reservation_info():
 
 
 @weblab_api.route_api('/reservation/poll/')
-@load_reservation_processor
 def poll():
+    server = weblab_api.ctx.server_instance
+    reservation_id = SessionId(weblab_api.ctx.reservation_id.split(';')[0])
+    if not server._poll_without_locking(reservation_id):
+        _poll_locking()
+
+@load_reservation_processor
+def _poll_locking():
     reservation_processor = weblab_api.ctx.reservation_processor
     return weblab_api.ctx.server_instance._check_reservation_not_expired_and_poll( reservation_processor )
 
@@ -528,7 +560,7 @@ class UserProcessingServer(object):
                 self._locator, self._cfg_manager, session_type, self._reservations_session_manager, self._coordinator, self._commands_store, self._coordinator.finished_reservations_store)
 
         # Login Manager
-        self._login_manager  = LoginManager(self._db_manager, self)
+        self._login_manager  = LoginManager(self._db_manager, self, cfg_manager)
 
         #
         # Initialize facade (comm) servers
@@ -596,6 +628,31 @@ class UserProcessingServer(object):
                 reservation_processor.get_session()
             )
 
+    def _poll_without_locking(self, reservation_id):
+        """ Polls retrieving and storing only the fields of the reservation
+        session required, if the session manager does it without locking the
+        session. Returns False if it could not poll this way (e.g. because the
+        reservation expired and it must be finished), so the whole session
+        must be used. """
+        if not self._reservations_session_manager.atomic_field_updates:
+            return False
+
+        try:
+            fields = self._reservations_session_manager.get_session_fields(reservation_id, ReservationProcessor.POLLING_FIELDS)
+            if 'reservation_id' not in fields:
+                return False
+
+            reservation_processor = self._load_reservation(fields)
+            if reservation_processor.is_expired():
+                return False
+
+            reservation_processor.poll()
+            reservation_processor.update_latest_timestamp()
+            self._reservations_session_manager.update_session_fields(reservation_id, reservation_processor.get_polling_fields())
+        except SessionNotFoundError:
+            raise coreExc.SessionNotFoundError("Core Reservations session not found")
+        return True
+
     @threaded(_resource_manager)
     def _purge_expired_users(self, expired_users):
         for expired_reservation in expired_users:
@@ -1,8 +1,13 @@
 import sys
+import time
+import errno
+import select
+import socket
 import threading
 import wsgiref.simple_server
 import urlparse
 import SocketServer
+import Queue
 
 import voodoo.log as log
 import voodoo.counter as counter
@@ -11,6 +16,19 @@ from voodoo.resources_manager import CancelAndJoinResourceManager
 
 _resource_manager = CancelAndJoinResourceManager("RemoteFacadeServer")
 
+THREADED_MODE = 'threaded'
+POOL_MODE     = 'pool'
+SERVER_MODES  = (THREADED_MODE, POOL_MODE)
+
+# Python 2 does not provide the constant. This is the value in Linux.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+
+# If a request body was not read by the application, at most this amount of
+# bytes are discarded to keep the connection alive. Otherwise, it is closed.
+MAX_DISCARDED_BODY = 64 * 1024
+
+SERVICE_UNAVAILABLE_RESPONSE = 'HTTP/1.1 503 Service Unavailable\r\nContent-Type: text/plain\r\nContent-Length: 20\r\nRetry-After: 1\r\nConnection: close\r\n\r\nServer is too busy\r\n'
+
 class WsgiApp(object):
     def __init__(self):
         pass
@@ -21,6 +39,8 @@ class WsgiApp(object):
 
 class WrappedWSGIRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
 
+    access_log = True
+
     def get_environ(self):
         env = wsgiref.simple_server.WSGIRequestHandler.get_environ(self)
         script_name = self.server.script_name
@@ -28,6 +48,10 @@ class WrappedWSGIRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
             env['PATH_INFO'] = env['PATH_INFO'].split(script_name,1)[1]
         return env
 
+    def log_request(self, code = '-', size = '-'):
+        if self.access_log:
+            wsgiref.simple_server.WSGIRequestHandler.log_request(self, code, size)
+
     def log_message(self, format, *args):
         #args: ('POST /weblab/json/ HTTP/1.1', '200', '-')
         log.log(
@@ -36,13 +60,187 @@ class WrappedWSGIRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
             "Request: %s" %  (format % args)
         )
 
-class WsgiHttpServer(SocketServer.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
-    daemon_threads      = True
-    request_queue_size  = 50 #TODO: parameter!
+class _RequestInput(object):
+    """wsgi.input of a request in a kept-alive connection. It does not read
+    beyond the body of the request, since the next request comes after it."""
+
+    def __init__(self, rfile, length):
+        self._rfile    = rfile
+        self.remaining = length
+
+    def read(self, size = -1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._rfile.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size = -1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self._rfile.readline(size)
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint = -1):
+        return list(self)
+
+    def __iter__(self):
+        line = self.readline()
+        while line:
+            yield line
+            line = self.readline()
+
+class KeepAliveServerHandler(wsgiref.simple_server.ServerHandler):
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        wsgiref.simple_server.ServerHandler.cleanup_headers(self)
+        request_handler = self.request_handler
+        # Without Content-Length, the client only knows that the response
+        # finished when the connection is closed
+        if 'Content-Length' not in self.headers and self.status[:3] not in ('204', '304'):
+            request_handler.close_connection = 1
+
+        if request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+        elif request_handler.request_version == 'HTTP/1.0':
+            self.headers['Connection'] = 'keep-alive'
+
+    def handle_error(self):
+        self.request_handler.close_connection = 1
+        wsgiref.simple_server.ServerHandler.handle_error(self)
+
+class KeepAliveWSGIRequestHandler(WrappedWSGIRequestHandler):
+    """Handles a single request of a _Connection, which is kept open by the
+    WsgiPoolHttpServer if close_connection is not set after it."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.connection = self.request.socket
+        self.rfile      = self.request.rfile
+        self.wfile      = self.request.wfile
+        self.handled    = False
+
+    def finish(self):
+        # The connection is closed or kept by the server
+        pass
+
+    def handle(self):
+        self.close_connection = 1
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.error:
+            return
+
+        if not self.raw_requestline:
+            return
+
+        if len(self.raw_requestline) > 65536:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            return
+
+        if not self.parse_request(): # An error code has been sent, just exit
+            return
+
+        self.handled = True
+
+        if self.headers.get('Transfer-Encoding', '').lower() not in ('', 'identity'):
+            self.close_connection = 1
+
+        try:
+            content_length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            content_length = 0
+            self.close_connection = 1
+
+        request_input = _RequestInput(self.rfile, content_length)
+
+        handler = KeepAliveServerHandler(
+            request_input, self.wfile, self.get_stderr(), self.get_environ()
+        )
+        handler.request_handler = self      # backpointer for logging
+        handler.run(self.server.get_app())
+
+        if not self.close_connection and request_input.remaining > 0:
+            if request_input.remaining > MAX_DISCARDED_BODY:
+                self.close_connection = 1
+            else:
+                request_input.read()
+
+class _Connection(object):
+    """An accepted connection. The same rfile is used in all the requests, so
+    the data already buffered from the socket is not lost between them."""
+
+    def __init__(self, sock, client_address):
+        self.socket         = sock
+        self.client_address = client_address
+        self.rfile          = sock.makefile('rb', -1)
+        self.wfile          = sock.makefile('wb', 0)
+        self.enqueued_time  = time.time()
+        self.last_activity  = self.enqueued_time
+        # No request has been processed yet (so it can be rejected if the server is too busy)
+        self.new            = True
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def has_buffered_data(self):
+        # The next request (pipelining) might have been read already by rfile
+        return self.rfile._rbuf.tell() > 0
+
+    def close(self):
+        try:
+            self.wfile.close()
+            self.rfile.close()
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+
+def _socketpair():
+    """Connected pair of sockets, used for waking up a thread waiting in select."""
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+
+    # Windows: there is no socketpair in Python 2
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect(listener.getsockname())
+        server, _ = listener.accept()
+        return server, client
+    finally:
+        listener.close()
+
+class _ServerBindMixIn:
+    request_queue_size  = 50
     allow_reuse_address = True
+    reuse_port          = False
+
+    def server_bind(self):
+        if self.reuse_port:
+            if SO_REUSEPORT is None:
+                raise ValueError("%s is not supported in this platform" % configuration_doc.CORE_FACADE_REUSE_PORT)
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        wsgiref.simple_server.WSGIServer.server_bind(self)
+
+class WsgiHttpServer(SocketServer.ThreadingMixIn, _ServerBindMixIn, wsgiref.simple_server.WSGIServer):
+    """One new thread per connection, which is closed after the request."""
 
-    def __init__(self, script_name, server_address, handler_class, application):
+    daemon_threads      = True
+
+    def __init__(self, script_name, server_address, handler_class, application, backlog = None, reuse_port = False):
         self.script_name = script_name
+        if backlog is not None:
+            self.request_queue_size = backlog
+        self.reuse_port = reuse_port
         wsgiref.simple_server.WSGIServer.__init__(self, server_address, handler_class)
         self.set_app(application)
 
@@ -55,6 +253,282 @@ class WsgiHttpServer(SocketServer.ThreadingMixIn, wsgiref.simple_server.WSGIServ
         sock.settimeout(None)
         return sock, addr
 
+    def get_stats(self):
+        return {
+            'mode' : THREADED_MODE,
+            'threads' : threading.activeCount(),
+        }
+
+class _PoolWorker(threading.Thread):
+    def __init__(self, server):
+        threading.Thread.__init__(self)
+        self.setName(counter.next_name("RemoteFacadeWorker"))
+        self.setDaemon(True)
+        self._server = server
+
+    def run(self):
+        self._server._run_worker()
+
+class _IdleConnectionsPoller(threading.Thread):
+    def __init__(self, server):
+        threading.Thread.__init__(self)
+        self.setName(counter.next_name("RemoteFacadeKeepAlive"))
+        self.setDaemon(True)
+        self._server = server
+
+    def run(self):
+        self._server._run_poller()
+
+class WsgiPoolHttpServer(_ServerBindMixIn, wsgiref.simple_server.WSGIServer):
+    """
+    HTTP/1.1 server with a fixed pool of workers. The connections wait in a
+    poller thread (not in a worker) until a request arrives or
+    keep_alive_timeout seconds pass, both when they are accepted and when
+    they are kept alive after each request. Then they are put in a queue,
+    processed by the workers. If the queue is full when the first request
+    of a connection arrives, the client receives a 503 straight away.
+
+    Every stats_period seconds, the state of the pool is logged.
+    """
+
+    def __init__(self, script_name, server_address, handler_class, application, workers = 20, queue_size = 200, backlog = None, keep_alive_timeout = 15, reuse_port = False, stats_period = 60):
+        self.script_name = script_name
+        if backlog is not None:
+            self.request_queue_size = backlog
+        self.reuse_port         = reuse_port
+        self.keep_alive_timeout = keep_alive_timeout
+        self.stats_period       = stats_period
+
+        self._stopping    = False
+        self._queue       = Queue.Queue()
+        self._queue_size  = queue_size
+
+        self._idle        = {
+            # fileno : connection
+        }
+        self._new_idle    = []
+        self._idle_lock   = threading.Lock()
+        self._wake_read, self._wake_write = _socketpair()
+
+        self._stats_lock    = threading.Lock()
+        self._busy          = 0
+        self._requests      = 0
+        self._rejected      = 0
+        self._request_time  = 0.0
+        self._max_request_time = 0.0
+        self._wait_time     = 0.0
+
+        # If binding fails, server_close is called before raising
+        self._workers = []
+        self._poller  = None
+
+        wsgiref.simple_server.WSGIServer.__init__(self, server_address, handler_class)
+        self.set_app(application)
+
+        self._workers = [ _PoolWorker(self) for _ in xrange(workers) ]
+        self._poller  = _IdleConnectionsPoller(self)
+        for thread in self._workers + [self._poller]:
+            thread.start()
+
+    def setup_environ(self):
+        wsgiref.simple_server.WSGIServer.setup_environ(self)
+        self.base_environ['SCRIPT_NAME'] = self.script_name
+        self.base_environ['wsgi.multithread'] = True
+
+    def get_request(self):
+        sock, addr = wsgiref.simple_server.WSGIServer.get_request(self)
+        sock.settimeout(self.keep_alive_timeout)
+        return sock, addr
+
+    def process_request(self, request, client_address):
+        connection = _Connection(request, client_address)
+        if self._queue.qsize() >= self._queue_size:
+            self._reject(connection)
+        else:
+            # Slow clients (or browsers opening connections in advance) must
+            # not take a worker until they send the request
+            self._wait_for_request(connection)
+
+    def _reject(self, connection):
+        with self._stats_lock:
+            self._rejected += 1
+        try:
+            connection.wfile.write(SERVICE_UNAVAILABLE_RESPONSE)
+        except socket.error:
+            pass
+        connection.close()
+
+    def _wait_for_request(self, connection):
+        connection.last_activity = time.time()
+        with self._idle_lock:
+            self._new_idle.append(connection)
+        self._wake_up_poller()
+
+    def _enqueue(self, connection):
+        connection.enqueued_time = time.time()
+        self._queue.put(connection)
+
+    def _run_worker(self):
+        while True:
+            connection = self._queue.get()
+            if connection is None:
+                break
+
+            with self._stats_lock:
+                self._busy += 1
+            try:
+                self._process_connection(connection)
+            finally:
+                with self._stats_lock:
+                    self._busy -= 1
+
+    def _process_connection(self, connection):
+        connection.new = False
+        start_time = time.time()
+        try:
+            handler = self.RequestHandlerClass(connection, connection.client_address, self)
+        except Exception:
+            log.log(WsgiPoolHttpServer, log.level.Warning, "Error processing a request of %s" % (connection.client_address,))
+            log.log_exc(WsgiPoolHttpServer, log.level.Info)
+            connection.close()
+            return
+
+        end_time = time.time()
+        if handler.handled:
+            with self._stats_lock:
+                elapsed = end_time - connection.enqueued_time
+                self._requests     += 1
+                self._request_time += elapsed
+                self._wait_time    += start_time - connection.enqueued_time
+                if elapsed > self._max_request_time:
+                    self._max_request_time = elapsed
+
+        if handler.close_connection or self._stopping:
+            connection.close()
+        elif connection.has_buffered_data():
+            self._enqueue(connection)
+        else:
+            self._wait_for_request(connection)
+
+    def _wake_up_poller(self):
+        try:
+            self._wake_write.send('x')
+        except socket.error:
+            pass
+
+    def _run_poller(self):
+        wake_fileno = self._wake_read.fileno()
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(wake_fileno, select.POLLIN)
+        else:
+            poller = None
+
+        next_stats = time.time() + self.stats_period
+
+        while not self._stopping:
+            with self._idle_lock:
+                new_idle = self._new_idle
+                self._new_idle = []
+
+            for connection in new_idle:
+                self._idle[connection.fileno()] = connection
+                if poller is not None:
+                    poller.register(connection.fileno(), select.POLLIN)
+
+            try:
+                if poller is not None:
+                    ready = [ fileno for fileno, _ in poller.poll(1000) ]
+                else:
+                    ready, _, _ = select.select([wake_fileno] + self._idle.keys(), [], [], 1)
+            except (select.error, IOError), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fileno in ready:
+                if fileno == wake_fileno:
+                    self._wake_read.recv(4096)
+                    continue
+                connection = self._idle.pop(fileno)
+                if poller is not None:
+                    poller.unregister(fileno)
+                # Only new connections are rejected; those kept alive were already accepted.
+                # They are checked here (and not only when accepted) since they might
+                # have been accepted when the queue was empty, all at once.
+                if connection.new and self._queue.qsize() >= self._queue_size:
+                    self._reject(connection)
+                else:
+                    # Either a new request or the client closed it; a worker finds out
+                    self._enqueue(connection)
+
+            now = time.time()
+            if self.stats_period and now >= next_stats:
+                next_stats = now + self.stats_period
+                self._log_stats()
+
+            for fileno, connection in self._idle.items():
+                if now - connection.last_activity > self.keep_alive_timeout:
+                    del self._idle[fileno]
+                    if poller is not None:
+                        poller.unregister(fileno)
+                    connection.close()
+
+        for connection in self._idle.values():
+            connection.close()
+        self._idle.clear()
+
+    def get_stats(self):
+        """ Returns the state of the pool and the latency of the requests (since
+        they are accepted, or since they arrive in a kept-alive connection, until
+        the response is sent) """
+        with self._idle_lock:
+            idle_connections = len(self._idle) + len(self._new_idle)
+        with self._stats_lock:
+            return {
+                'mode'                 : POOL_MODE,
+                'workers'              : len(self._workers),
+                'busy_workers'         : self._busy,
+                'queued'               : self._queue.qsize(),
+                'queue_size'           : self._queue_size,
+                'idle_connections'     : idle_connections,
+                'requests'             : self._requests,
+                'rejected'             : self._rejected,
+                'average_request_time' : self._request_time / self._requests if self._requests else 0.0,
+                'max_request_time'     : self._max_request_time,
+                'average_wait_time'    : self._wait_time / self._requests if self._requests else 0.0,
+            }
+
+    def _log_stats(self):
+        log.log(WsgiPoolHttpServer, log.level.Info,
+            "Pool state: %(busy_workers)s/%(workers)s busy workers; %(queued)s/%(queue_size)s queued and %(idle_connections)s idle connections; "
+            "%(requests)s requests (%(rejected)s rejected); average request time: %(average_request_time).3f s (max: %(max_request_time).3f s; average wait: %(average_wait_time).3f s)" % self.get_stats())
+
+    def server_close(self):
+        wsgiref.simple_server.WSGIServer.server_close(self)
+
+        self._stopping = True
+        self._wake_up_poller()
+        if self._poller is not None:
+            self._poller.join()
+
+        # Connections waiting for a worker are discarded
+        while True:
+            try:
+                connection = self._queue.get_nowait()
+            except Queue.Empty:
+                break
+            if connection is not None:
+                connection.close()
+
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+        self._wake_read.close()
+        self._wake_write.close()
+
 class ServerThread(threading.Thread):
     """server_foreve is a blocking method. This class runs it in a daemon thread."""
     def __init__(self, server, timeout):
@@ -82,9 +556,19 @@ class WebLabWsgiServer(object):
         else:
             the_location = '/weblab'
 
-        class NewWsgiHttpHandler(WrappedWSGIRequestHandler):
+        server_mode = cfg_manager.get_doc_value(configuration_doc.CORE_FACADE_SERVER_MODE)
+        if server_mode not in SERVER_MODES:
+            raise ValueError("Invalid %s: %r. Expected one of %r" % (configuration_doc.CORE_FACADE_SERVER_MODE, server_mode, SERVER_MODES))
+
+        if server_mode == POOL_MODE:
+            BaseHandler = KeepAliveWSGIRequestHandler
+        else:
+            BaseHandler = WrappedWSGIRequestHandler
+
+        class NewWsgiHttpHandler(BaseHandler):
             server_route   = the_server_route
             location       = the_location
+            access_log     = cfg_manager.get_doc_value(configuration_doc.CORE_FACADE_ACCESS_LOG)
 
         script_name = core_server_url_parsed.path.split('/weblab')[0]
         timeout = cfg_manager.get_doc_value(configuration_doc.FACADE_TIMEOUT)
@@ -92,12 +576,24 @@ class WebLabWsgiServer(object):
         listen  = cfg_manager.get_doc_value(configuration_doc.CORE_FACADE_BIND)
         port    = cfg_manager.get_doc_value(configuration_doc.CORE_FACADE_PORT)
 
+        backlog    = cfg_manager.get_doc_value(configuration_doc.CORE_FACADE_BACKLOG)
+        reuse_port = cfg_manager.get_doc_value(configuration_doc.CORE_FACADE_REUSE_PORT)
+
         if cfg_manager.get_value('flask_debug', False):
             print >> sys.stderr, "Using a different server (relying on Flask rather than on Python's WsgiHttpServer)"
             core_server = None
             core_server_thread = threading.Thread(target = application.run, kwargs = { 'port' : port, 'debug' : True, 'use_reloader' : False })
         else:
-            core_server = WsgiHttpServer(script_name, (listen, port), NewWsgiHttpHandler, application)
+            if server_mode == POOL_MODE:
+                core_server = WsgiPoolHttpServer(script_name, (listen, port), NewWsgiHttpHandler, application,
+                                workers            = cfg_manager.get_doc_value(configuration_doc.CORE_FACADE_WORKERS),
+                                queue_size         = cfg_manager.get_doc_value(configuration_doc.CORE_FACADE_QUEUE_SIZE),
+                                backlog            = backlog,
+                                keep_alive_timeout = cfg_manager.get_doc_value(configuration_doc.CORE_FACADE_KEEP_ALIVE_TIMEOUT),
+                                reuse_port         = reuse_port,
+                                stats_period       = cfg_manager.get_doc_value(configuration_doc.CORE_FACADE_STATS_PERIOD))
+            else:
+                core_server = WsgiHttpServer(script_name, (listen, port), NewWsgiHttpHandler, application, backlog = backlog, reuse_port = reuse_port)
             core_server.socket.settimeout(timeout)
             core_server_thread = ServerThread(core_server, timeout)
 
@@ -112,12 +608,14 @@ class WebLabWsgiServer(object):
     def cancel(self):
         self.stop()
 
+    def get_stats(self):
+        return [ server.get_stats() for server in self._servers if server is not None ]
+
     def stop(self):
         for server in self._servers:
             if server is not None:
                 server.shutdown()
-                server.socket.close()
+                server.server_close()
 
         for server_thread in self._server_threads:
             server_thread.join()
-
@@ -23,6 +23,7 @@ from voodoo.override import Override
 from voodoo.gen.coordinator.CoordAddress import CoordAddress
 from voodoo.representable import AbstractRepresentable, Representable
 from voodoo.typechecker import typecheck
+from voodoo.sessions.serializer import register_type
 
 from weblab.core.file_storer import FileStorer
 
@@ -59,6 +60,8 @@ class ExperimentId(object):
         category_name   = weblab_str[pos + 1 :]
         return ExperimentId(experiment_name, category_name)
 
+register_type(ExperimentId, 'ExperimentId', lambda experiment_id : [ experiment_id.exp_name, experiment_id.cat_name ], lambda value : ExperimentId(*value))
+
 class ExperimentInstanceId(object):
 
     __metaclass__ = Representable
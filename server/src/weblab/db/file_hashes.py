@@ -0,0 +1,204 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+"""
+The plagiarism detection of the administration panel looks for files
+submitted by more than one user. Instead of grouping every UserFile by
+hash, it relies on the file hash index (model.DbFileHashIndex), which
+stores the first use in which each hash was submitted and whether other
+users submitted it later. The core server keeps it updated whenever it
+stores files (see FileHashIndexDelta), and it can be rebuilt or checked
+against the files with rebuild_file_hash_index and check_file_hash_index.
+"""
+
+from collections import defaultdict
+
+from sqlalchemy import sql, func
+
+import weblab.db.model as model
+from voodoo.dbutil import try_insert
+
+# Hashes of files which are not relevant for plagiarism (empty, not stored...)
+EMPTY_HASHES = (
+    '',
+    '{sha}f96cea198ad1dd5617ac084a3d92c6107708c0ef', # '{sha}' + hashlib.new("sha", "").hexdigest()
+    '{sha}da39a3ee5e6b4b0d3255bfef95601890afd80709', # '{sha}' + sha.new("").hexdigest()
+    '<file not yet stored>',
+)
+
+# Ids per IN query
+MAX_IDS_PER_QUERY = 500
+
+# Rows per INSERT when rebuilding
+REBUILD_CHUNK = 1000
+
+class FileHashIndexDelta(object):
+    """
+    Collects the files stored in a transaction, so the index is updated
+    with a few queries when applied (instead of once per file).
+    """
+    def __init__(self):
+        self.files = [] # [ (use or use_id, file_hash) ]
+
+    def add(self, use, file_hash):
+        """ use can be a DbUserUsedExperiment (even if it was not flushed) or its id """
+        if file_hash not in EMPTY_HASHES:
+            self.files.append((use, file_hash))
+
+    def apply(self, session):
+        """ Updates the index in the session transaction """
+        if not self.files:
+            return
+
+        # Uses added in this transaction do not have an id until flushed
+        session.flush()
+        use_ids = set()
+        files = []
+        for use, file_hash in self.files:
+            use_id = use if isinstance(use, (int, long)) else use.id
+            use_ids.add(use_id)
+            files.append((use_id, file_hash))
+        self.files = []
+
+        uue = model.DbUserUsedExperiment
+        uses = {}
+        use_ids = list(use_ids)
+        for pos in xrange(0, len(use_ids), MAX_IDS_PER_QUERY):
+            query = sql.select([uue.id, uue.user_id, uue.start_date, uue.start_date_micro], uue.id.in_(use_ids[pos:pos + MAX_IDS_PER_QUERY]))
+            for use_id, user_id, start_date, start_date_micro in session.execute(query):
+                uses[use_id] = (start_date, start_date_micro, use_id, user_id)
+
+        submissions = defaultdict(list)
+        for use_id, file_hash in files:
+            if use_id in uses:
+                submissions[file_hash].append(uses[use_id])
+
+        _merge(session, submissions)
+
+def _merge(session, submissions):
+    """ Merges { file_hash : [ (start_date, start_date_micro, use_id, user_id) ] } in the index """
+    table = model.DbFileHashIndex.__table__
+
+    existing = _read_index(session, list(submissions))
+
+    new_rows = []
+    for file_hash in sorted(submissions):
+        if file_hash in existing:
+            _update_index(session, file_hash, submissions[file_hash], existing[file_hash])
+        else:
+            new_rows.append(_new_index_row(file_hash, submissions[file_hash]))
+
+    if not new_rows or try_insert(session, table, new_rows):
+        return
+
+    # Another transaction inserted some of them meanwhile (e.g. the same file
+    # submitted at the same time): insert the rest, and update those
+    inserted_meanwhile = []
+    for row in new_rows:
+        if not try_insert(session, table, row):
+            inserted_meanwhile.append(row['file_hash'])
+
+    # Locking them, so the rows committed by the other transaction are read
+    existing = _read_index(session, inserted_meanwhile, for_update = True)
+    for file_hash in inserted_meanwhile:
+        _update_index(session, file_hash, submissions[file_hash], existing[file_hash])
+
+def _read_index(session, file_hashes, for_update = False):
+    """ Returns { file_hash : ((start_date, start_date_micro, use_id, user_id), shared) } """
+    table = model.DbFileHashIndex.__table__
+
+    existing = {}
+    for pos in xrange(0, len(file_hashes), MAX_IDS_PER_QUERY):
+        query = sql.select([table.c.file_hash, table.c.first_start_date, table.c.first_start_date_micro, table.c.first_use_id, table.c.first_user_id, table.c.shared],
+                            table.c.file_hash.in_(file_hashes[pos:pos + MAX_IDS_PER_QUERY]), for_update = for_update)
+        for file_hash, start_date, start_date_micro, use_id, user_id, shared in session.execute(query):
+            existing[file_hash] = ((start_date, start_date_micro, use_id, user_id), shared)
+    return existing
+
+def _update_index(session, file_hash, current_submissions, (previous_first, previous_shared)):
+    table = model.DbFileHashIndex.__table__
+
+    user_ids = set( user_id for _, _, _, user_id in current_submissions )
+    user_ids.add(previous_first[3])
+    first = min(min(current_submissions), previous_first)
+    shared = previous_shared or len(user_ids) > 1
+    if (first, shared) != (previous_first, previous_shared):
+        session.execute(table.update().where(table.c.file_hash == file_hash).values(**_index_row(first, shared)))
+
+def _new_index_row(file_hash, current_submissions):
+    user_ids = set( user_id for _, _, _, user_id in current_submissions )
+    row = _index_row(min(current_submissions), len(user_ids) > 1)
+    row['file_hash'] = file_hash
+    return row
+
+def _index_row((start_date, start_date_micro, use_id, user_id), shared):
+    return dict(first_start_date = start_date, first_start_date_micro = start_date_micro, first_use_id = use_id, first_user_id = user_id, shared = shared)
+
+def calculate_file_hash_index(session):
+    """ Calculates the index from every file. Returns { file_hash : (first_use_id, first_user_id, shared) } """
+    uue  = model.DbUserUsedExperiment
+    ufile = model.DbUserFile
+    query = sql.select([ufile.file_hash, uue.start_date, uue.start_date_micro, uue.id, uue.user_id],
+                        sql.and_(ufile.experiment_use_id == uue.id, sql.not_(ufile.file_hash.in_(EMPTY_HASHES))))
+
+    firsts   = {}
+    user_ids = defaultdict(set)
+    for file_hash, start_date, start_date_micro, use_id, user_id in session.execute(query):
+        submission = (start_date, start_date_micro, use_id, user_id)
+        if file_hash not in firsts or submission < firsts[file_hash]:
+            firsts[file_hash] = submission
+        user_ids[file_hash].add(user_id)
+
+    return dict( (file_hash, (first, len(user_ids[file_hash]) > 1)) for file_hash, first in firsts.iteritems() )
+
+def rebuild_file_hash_index(session):
+    """ Replaces the index by the one calculated from every file, in the session
+    transaction. Returns the number of hashes indexed. """
+    index = calculate_file_hash_index(session)
+
+    table = model.DbFileHashIndex.__table__
+    session.execute(table.delete())
+
+    rows = []
+    for file_hash, (first, shared) in index.iteritems():
+        row = _index_row(first, shared)
+        row['file_hash'] = file_hash
+        rows.append(row)
+
+    for pos in xrange(0, len(rows), REBUILD_CHUNK):
+        session.execute(table.insert(), rows[pos:pos + REBUILD_CHUNK])
+
+    return len(rows)
+
+def check_file_hash_index(session):
+    """ Compares the index with the one calculated from every file. Returns a list of
+    differences: (file_hash, expected (first_use_id, shared), stored (first_use_id, shared)) """
+    expected = dict( (file_hash, (first[2], shared)) for file_hash, (first, shared) in calculate_file_hash_index(session).iteritems() )
+
+    table = model.DbFileHashIndex.__table__
+    stored = {}
+    for file_hash, first_use_id, shared in session.execute(sql.select([table.c.file_hash, table.c.first_use_id, table.c.shared])):
+        stored[file_hash] = (first_use_id, bool(shared))
+
+    differences = []
+    for file_hash in sorted(set(expected).union(stored)):
+        if expected.get(file_hash) != stored.get(file_hash):
+            differences.append((file_hash, expected.get(file_hash), stored.get(file_hash)))
+    return differences
+
+def get_file_hash_version(session):
+    """ Changes whenever new files are stored, so results derived from the index can be cached """
+    return session.execute(sql.select([func.max(model.DbUserFile.id)])).scalar()
+
@@ -560,17 +560,17 @@ class DbUserUsedExperiment(Base):
         self.role_permission = role_permission
         if end_date is not None:
             self.session_time_micro = (self.end_date - self.start_date).seconds * 1e6 + (self.end_date - self.start_date).microseconds
-            self.session_time_seconds = self.session_time_micro / 1000000
+            self.session_time_seconds = int(self.session_time_micro / 1000000)
         else:
             self.session_time_micro = session_time_micro
             if self.session_time_micro:
-                self.session_time_seconds = self.session_time_micro / 1000000
+                self.session_time_seconds = int(self.session_time_micro / 1000000)
 
     def set_end_date(self, end_date):
         self.end_date, self.end_date_micro = _timestamp_to_splitted_utc_datetime(end_date)
         if end_date:
             self.session_time_micro = (self.end_date - self.start_date).seconds * 1e6 + (self.end_date - self.start_date).microseconds
-            self.session_time_seconds = self.session_time_micro / 1000000
+            self.session_time_seconds = int(self.session_time_micro / 1000000)
 
     def __repr__(self):
         return "DbUserUsedExperiment(id = %r, user = %r, experiment = %r, start_date = %r, start_date_micro = %r, end_date = %r, end_date_micro = %r, origin = %r, coord_address = %r, reservation_id = %r)" % (
@@ -665,6 +665,113 @@ class DbUserUsedExperimentPropertyValue(Base):
             self.experiment_use_id
         )
 
+##############################################################################
+# USAGE ROLLUPS
+#
+# Aggregations of UserUsedExperiment, maintained while the uses are stored
+# (see weblab.db.rollups), so statistics do not need to scan every use.
+# The permission ids are 0 (not NULL) if the use was not granted by that
+# kind of permission, so the unique constraints are honored.
+#
+
+class DbUsageRollup(Base):
+    __tablename__  = 'UsageRollup'
+    __table_args__ = (UniqueConstraint('start_date_date', 'start_date_hour', 'experiment_id', 'user_id', 'group_permission_id', 'user_permission_id', 'role_permission_id'),
+                      Index('idx_UsageRollup_timetable', 'start_date_weekday', 'start_date_hour'),
+                      TABLE_KWARGS)
+
+    id                  = Column(Integer, primary_key = True)
+
+    start_date_date     = Column(Date, nullable = False, index = True)
+    start_date_weekday  = Column(Integer, nullable = False) # 0..6, as in datetime.datetime.weekday()
+    start_date_hour     = Column(Integer, nullable = False) # 0..23
+    experiment_id       = Column(Integer, ForeignKey("Experiment.id"), nullable = False, index = True)
+    user_id             = Column(Integer, ForeignKey("User.id"), nullable = False, index = True)
+    group_permission_id = Column(Integer, nullable = False, default = 0, index = True)
+    user_permission_id  = Column(Integer, nullable = False, default = 0, index = True)
+    role_permission_id  = Column(Integer, nullable = False, default = 0, index = True)
+
+    uses                = Column(Integer, nullable = False, default = 0)
+    timed_uses          = Column(Integer, nullable = False, default = 0) # uses with session_time_micro
+    session_time_micro  = Column(BigInteger, nullable = False, default = 0)
+
+    def __repr__(self):
+        return "DbUsageRollup(id = %r, start_date_date = %r, start_date_hour = %r, experiment_id = %r, user_id = %r, group_permission_id = %r, user_permission_id = %r, role_permission_id = %r, uses = %r, timed_uses = %r, session_time_micro = %r)" % (
+            self.id,
+            self.start_date_date,
+            self.start_date_hour,
+            self.experiment_id,
+            self.user_id,
+            self.group_permission_id,
+            self.user_permission_id,
+            self.role_permission_id,
+            self.uses,
+            self.timed_uses,
+            self.session_time_micro
+        )
+
+class DbUsageDurationRollup(Base):
+    __tablename__  = 'UsageDurationRollup'
+    __table_args__ = (UniqueConstraint('session_time_seconds', 'experiment_id', 'user_id', 'group_permission_id', 'user_permission_id', 'role_permission_id'),
+                      TABLE_KWARGS)
+
+    id                   = Column(Integer, primary_key = True)
+
+    session_time_seconds = Column(Integer, nullable = False, index = True)
+    experiment_id        = Column(Integer, ForeignKey("Experiment.id"), nullable = False, index = True)
+    user_id              = Column(Integer, ForeignKey("User.id"), nullable = False, index = True)
+    group_permission_id  = Column(Integer, nullable = False, default = 0, index = True)
+    user_permission_id   = Column(Integer, nullable = False, default = 0, index = True)
+    role_permission_id   = Column(Integer, nullable = False, default = 0, index = True)
+
+    uses                 = Column(Integer, nullable = False, default = 0)
+
+    def __repr__(self):
+        return "DbUsageDurationRollup(id = %r, session_time_seconds = %r, experiment_id = %r, user_id = %r, group_permission_id = %r, user_permission_id = %r, role_permission_id = %r, uses = %r)" % (
+            self.id,
+            self.session_time_seconds,
+            self.experiment_id,
+            self.user_id,
+            self.group_permission_id,
+            self.user_permission_id,
+            self.role_permission_id,
+            self.uses
+        )
+
+##############################################################################
+# FILE HASH INDEX
+#
+# The first use in which each file hash was submitted, and whether other
+# users submitted it later. Maintained while the files are stored (see
+# weblab.db.file_hashes), so the plagiarism detection only needs to look at
+# the files submitted by more than one user.
+#
+
+class DbFileHashIndex(Base):
+    __tablename__  = 'FileHashIndex'
+    __table_args__ = (TABLE_KWARGS)
+
+    id                     = Column(Integer, primary_key = True)
+    file_hash              = Column(String(255), nullable = False, unique = True)
+    first_use_id           = Column(Integer, nullable = False)
+    first_user_id          = Column(Integer, ForeignKey("User.id"), nullable = False, index = True)
+    first_start_date       = Column(DateTime, nullable = False)
+    first_start_date_micro = Column(Integer, nullable = False)
+    shared                 = Column(Boolean, nullable = False, default = False, index = True) # submitted by more than one user
+
+    first_user = relation("DbUser")
+
+    def __repr__(self):
+        return "DbFileHashIndex(id = %r, file_hash = %r, first_use_id = %r, first_user_id = %r, first_start_date = %r, first_start_date_micro = %r, shared = %r)" % (
+            self.id,
+            self.file_hash,
+            self.first_use_id,
+            self.first_user_id,
+            self.first_start_date,
+            self.first_start_date_micro,
+            self.shared
+        )
+
 class DbUserFile(Base):
     __tablename__  = 'UserFile'
     __table_args__ = (Index('idx_UserFile_experiment_use_id_file_hash', 'experiment_use_id', 'file_hash'), TABLE_KWARGS)
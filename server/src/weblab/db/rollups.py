@@ -0,0 +1,180 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2005 onwards University of Deusto
+# All rights reserved.
+#
+# This software is licensed as described in the file COPYING, which
+# you should have received as part of this distribution.
+#
+# This software consists of contributions made by many individuals,
+# listed below:
+#
+# Author: Pablo Orduña <pablo@ordunya.com>
+#
+
+"""
+The statistics of the administration panel are calculated on the usage
+rollups (model.DbUsageRollup and model.DbUsageDurationRollup) rather than
+on every UserUsedExperiment. The rollups are kept updated by the core
+server whenever it stores or finishes a use (see UsageRollupDelta), and
+they can be rebuilt or checked against the uses with rebuild_rollups and
+check_rollups (which is what 'weblab-admin rollups' does).
+"""
+
+from collections import defaultdict
+
+from sqlalchemy import sql, func
+
+import weblab.db.model as model
+from voodoo.dbutil import try_insert
+
+PERMISSION_COLUMNS = ('group_permission_id', 'user_permission_id', 'role_permission_id')
+ROLLUP_KEY         = ('start_date_date', 'start_date_hour', 'experiment_id', 'user_id') + PERMISSION_COLUMNS
+DURATION_KEY       = ('session_time_seconds', 'experiment_id', 'user_id') + PERMISSION_COLUMNS
+
+# Rows per INSERT when rebuilding
+REBUILD_CHUNK = 1000
+
+class UsageRollupDelta(object):
+    """
+    Collects how the rollups must change as uses are stored (add) or
+    modified (remove the use as it was, modify it, add it again), so they
+    are updated once per key when applied.
+    """
+    def __init__(self):
+        self.rollups   = defaultdict(lambda : [0, 0, 0]) # ROLLUP_KEY   : [ uses, timed_uses, session_time_micro ]
+        self.durations = defaultdict(int)                # DURATION_KEY : uses
+
+    def add(self, use, sign = 1):
+        # The use might not have been flushed yet
+        user_id       = use.user_id       if use.user_id       is not None else use.user.id
+        experiment_id = use.experiment_id if use.experiment_id is not None else use.experiment.id
+        permission_ids = (use.group_permission_id or 0, use.user_permission_id or 0, use.role_permission_id or 0)
+
+        rollup = self.rollups[(use.start_date_date, use.start_date_hour, experiment_id, user_id) + permission_ids]
+        rollup[0] += sign
+        if use.session_time_micro is not None:
+            rollup[1] += sign
+            rollup[2] += sign * int(use.session_time_micro)
+
+        if use.session_time_seconds is not None:
+            self.durations[(int(use.session_time_seconds), experiment_id, user_id) + permission_ids] += sign
+
+    def remove(self, use):
+        self.add(use, -1)
+
+    def apply(self, session):
+        """ Updates the rollups in the session transaction. Keys are updated in
+        order, so concurrent transactions do not deadlock locking the same rows. """
+        for key, (uses, timed_uses, session_time_micro) in sorted(self.rollups.iteritems()):
+            if uses or timed_uses or session_time_micro:
+                _increment(session, model.DbUsageRollup.__table__, ROLLUP_KEY, key,
+                            dict(uses = uses, timed_uses = timed_uses, session_time_micro = session_time_micro),
+                            dict(start_date_weekday = key[0].weekday()))
+
+        for key, uses in sorted(self.durations.iteritems()):
+            if uses:
+                _increment(session, model.DbUsageDurationRollup.__table__, DURATION_KEY, key, dict(uses = uses), {})
+
+        self.rollups.clear()
+        self.durations.clear()
+
+def _increment(session, table, key_columns, key, increments, extra_columns):
+    condition = sql.and_(*[ table.c[column] == value for column, value in zip(key_columns, key) ])
+    values    = dict( (column, table.c[column] + value) for column, value in increments.iteritems() )
+    result    = session.execute(table.update().where(condition).values(**values))
+    if result.rowcount == 0:
+        row = dict(zip(key_columns, key))
+        row.update(increments)
+        row.update(extra_columns)
+        if not try_insert(session, table, row):
+            # Another core server (or usage writer) inserted it meanwhile
+            session.execute(table.update().where(condition).values(**values))
+
+def _permission_ids(group_permission_id, user_permission_id, role_permission_id):
+    return (group_permission_id or 0, user_permission_id or 0, role_permission_id or 0)
+
+def calculate_rollups(session):
+    """ Aggregates every use as the rollups would. Returns ({ ROLLUP_KEY : (uses, timed_uses, session_time_micro) }, { DURATION_KEY : uses }) """
+    uue = model.DbUserUsedExperiment
+
+    rollups = defaultdict(lambda : [0, 0, 0])
+    key_columns = [ uue.start_date_date, uue.start_date_hour, uue.experiment_id, uue.user_id, uue.group_permission_id, uue.user_permission_id, uue.role_permission_id ]
+    query = sql.select(key_columns + [ func.count(uue.id), func.count(uue.session_time_micro), func.sum(uue.session_time_micro) ],
+                        uue.start_date_date != None).group_by(*key_columns)
+    for start_date_date, start_date_hour, experiment_id, user_id, group_permission_id, user_permission_id, role_permission_id, uses, timed_uses, session_time_micro in session.execute(query):
+        rollup = rollups[(start_date_date, start_date_hour, experiment_id, user_id) + _permission_ids(group_permission_id, user_permission_id, role_permission_id)]
+        rollup[0] += uses
+        rollup[1] += timed_uses
+        rollup[2] += int(session_time_micro or 0)
+
+    durations = defaultdict(int)
+    key_columns = [ uue.session_time_seconds, uue.experiment_id, uue.user_id, uue.group_permission_id, uue.user_permission_id, uue.role_permission_id ]
+    query = sql.select(key_columns + [ func.count(uue.id) ],
+                        sql.and_(uue.start_date_date != None, uue.session_time_seconds != None)).group_by(*key_columns)
+    for session_time_seconds, experiment_id, user_id, group_permission_id, user_permission_id, role_permission_id, uses in session.execute(query):
+        durations[(int(session_time_seconds), experiment_id, user_id) + _permission_ids(group_permission_id, user_permission_id, role_permission_id)] += uses
+
+    return dict( (key, tuple(value)) for key, value in rollups.iteritems() ), dict(durations)
+
+def rebuild_rollups(session):
+    """ Replaces the rollups by the aggregation of every use, in the session
+    transaction (so it should be run while the core servers are stopped).
+    Returns the number of rows of each rollup table. """
+    rollups, durations = calculate_rollups(session)
+
+    rollups_table   = model.DbUsageRollup.__table__
+    durations_table = model.DbUsageDurationRollup.__table__
+    session.execute(rollups_table.delete())
+    session.execute(durations_table.delete())
+
+    rows = []
+    for key, (uses, timed_uses, session_time_micro) in rollups.iteritems():
+        row = dict(zip(ROLLUP_KEY, key))
+        row.update(start_date_weekday = key[0].weekday(), uses = uses, timed_uses = timed_uses, session_time_micro = session_time_micro)
+        rows.append(row)
+    _insert_chunks(session, rollups_table, rows)
+
+    rows = []
+    for key, uses in durations.iteritems():
+        row = dict(zip(DURATION_KEY, key))
+        row.update(uses = uses)
+        rows.append(row)
+    _insert_chunks(session, durations_table, rows)
+
+    return len(rollups), len(durations)
+
+def _insert_chunks(session, table, rows):
+    for pos in xrange(0, len(rows), REBUILD_CHUNK):
+        session.execute(table.insert(), rows[pos:pos + REBUILD_CHUNK])
+
+def check_rollups(session):
+    """ Compares the rollups with the aggregation of every use. Returns a list of
+    differences: (table name, key (dict), expected values, stored values). """
+    expected_rollups, expected_durations = calculate_rollups(session)
+
+    stored_rollups = {}
+    rollup = model.DbUsageRollup
+    for row in session.execute(sql.select([ getattr(rollup, column) for column in ROLLUP_KEY ] + [ rollup.uses, rollup.timed_uses, rollup.session_time_micro ])):
+        key = tuple(row[:len(ROLLUP_KEY)])
+        stored_rollups[key] = tuple( int(value) for value in row[len(ROLLUP_KEY):] )
+
+    stored_durations = {}
+    duration = model.DbUsageDurationRollup
+    for row in session.execute(sql.select([ getattr(duration, column) for column in DURATION_KEY ] + [ duration.uses ])):
+        stored_durations[tuple(row[:len(DURATION_KEY)])] = int(row[len(DURATION_KEY)])
+
+    differences = []
+    differences.extend(_compare(rollup.__tablename__,   ROLLUP_KEY,   expected_rollups,   stored_rollups,   (0, 0, 0)))
+    differences.extend(_compare(duration.__tablename__, DURATION_KEY, expected_durations, stored_durations, 0))
+    return differences
+
+def _compare(table_name, key_columns, expected, stored, empty):
+    differences = []
+    for key in sorted(set(expected).union(stored)):
+        expected_value = expected.get(key, empty)
+        stored_value   = stored.get(key, empty)
+        if expected_value != stored_value:
+            differences.append((table_name, dict(zip(key_columns, key)), expected_value, stored_value))
+    return differences
@@ -0,0 +1,71 @@
+"""Add usage rollup tables
+
+Revision ID: 2f5e1b2c6a1d
+Revises: 3fab9480c190
+Create Date: 2014-03-03 11:20:41.530218
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2f5e1b2c6a1d'
+down_revision = '3fab9480c190'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # The rollups are filled by 'weblab-admin upgrade' (or 'weblab-admin rollups DIR --rebuild')
+    op.create_table('UsageRollup',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('start_date_date', sa.Date(), nullable=False),
+    sa.Column('start_date_weekday', sa.Integer(), nullable=False),
+    sa.Column('start_date_hour', sa.Integer(), nullable=False),
+    sa.Column('experiment_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('group_permission_id', sa.Integer(), nullable=False),
+    sa.Column('user_permission_id', sa.Integer(), nullable=False),
+    sa.Column('role_permission_id', sa.Integer(), nullable=False),
+    sa.Column('uses', sa.Integer(), nullable=False),
+    sa.Column('timed_uses', sa.Integer(), nullable=False),
+    sa.Column('session_time_micro', sa.BigInteger(), nullable=False),
+    sa.ForeignKeyConstraint(['experiment_id'], ['Experiment.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['User.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('start_date_date', 'start_date_hour', 'experiment_id', 'user_id', 'group_permission_id', 'user_permission_id', 'role_permission_id'),
+    mysql_engine='InnoDB'
+    )
+    op.create_index('ix_UsageRollup_start_date_date', 'UsageRollup', ['start_date_date'])
+    op.create_index('ix_UsageRollup_experiment_id', 'UsageRollup', ['experiment_id'])
+    op.create_index('ix_UsageRollup_user_id', 'UsageRollup', ['user_id'])
+    op.create_index('ix_UsageRollup_group_permission_id', 'UsageRollup', ['group_permission_id'])
+    op.create_index('ix_UsageRollup_user_permission_id', 'UsageRollup', ['user_permission_id'])
+    op.create_index('ix_UsageRollup_role_permission_id', 'UsageRollup', ['role_permission_id'])
+    op.create_index('idx_UsageRollup_timetable', 'UsageRollup', ['start_date_weekday', 'start_date_hour'])
+
+    op.create_table('UsageDurationRollup',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('session_time_seconds', sa.Integer(), nullable=False),
+    sa.Column('experiment_id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('group_permission_id', sa.Integer(), nullable=False),
+    sa.Column('user_permission_id', sa.Integer(), nullable=False),
+    sa.Column('role_permission_id', sa.Integer(), nullable=False),
+    sa.Column('uses', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['experiment_id'], ['Experiment.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['User.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('session_time_seconds', 'experiment_id', 'user_id', 'group_permission_id', 'user_permission_id', 'role_permission_id'),
+    mysql_engine='InnoDB'
+    )
+    op.create_index('ix_UsageDurationRollup_session_time_seconds', 'UsageDurationRollup', ['session_time_seconds'])
+    op.create_index('ix_UsageDurationRollup_experiment_id', 'UsageDurationRollup', ['experiment_id'])
+    op.create_index('ix_UsageDurationRollup_user_id', 'UsageDurationRollup', ['user_id'])
+    op.create_index('ix_UsageDurationRollup_group_permission_id', 'UsageDurationRollup', ['group_permission_id'])
+    op.create_index('ix_UsageDurationRollup_user_permission_id', 'UsageDurationRollup', ['user_permission_id'])
+    op.create_index('ix_UsageDurationRollup_role_permission_id', 'UsageDurationRollup', ['role_permission_id'])
+
+
+def downgrade():
+    op.drop_table('UsageDurationRollup')
+    op.drop_table('UsageRollup')
@@ -0,0 +1,37 @@
+"""Add file hash index
+
+Revision ID: 4c1f3a7e9b2d
+Revises: 2f5e1b2c6a1d
+Create Date: 2014-03-10 16:42:08.120937
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c1f3a7e9b2d'
+down_revision = '2f5e1b2c6a1d'
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # The index is filled by 'weblab-admin upgrade' (or 'weblab-admin rollups DIR --rebuild')
+    op.create_table('FileHashIndex',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('file_hash', sa.String(length=255), nullable=False),
+    sa.Column('first_use_id', sa.Integer(), nullable=False),
+    sa.Column('first_user_id', sa.Integer(), nullable=False),
+    sa.Column('first_start_date', sa.DateTime(), nullable=False),
+    sa.Column('first_start_date_micro', sa.Integer(), nullable=False),
+    sa.Column('shared', sa.Boolean(), nullable=False),
+    sa.ForeignKeyConstraint(['first_user_id'], ['User.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('file_hash'),
+    mysql_engine='InnoDB'
+    )
+    op.create_index('ix_FileHashIndex_first_user_id', 'FileHashIndex', ['first_user_id'])
+    op.create_index('ix_FileHashIndex_shared', 'FileHashIndex', ['shared'])
+
+
+def downgrade():
+    op.drop_table('FileHashIndex')
@@ -0,0 +1,23 @@
+"""Add waiting queue index
+
+Revision ID: 3b8d0a6f5c21
+Revises: 2ecc7c4ec0c5
+Create Date: 2014-03-24 11:05:37.284615
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3b8d0a6f5c21'
+down_revision = '2ecc7c4ec0c5'
+
+from alembic import op
+
+import weblab.core.coordinator.sql.priority_queue_scheduler_model as pq_model
+
+def upgrade():
+    # Used to count the reservations ahead of a reservation in the queue
+    op.create_index('ix_pq_waiting_queue', pq_model.WaitingReservation.__tablename__, ['resource_type_id', 'priority', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_pq_waiting_queue', pq_model.WaitingReservation.__tablename__)
@@ -11,50 +11,239 @@
 # listed below:
 #
 # Author: Luis Rodriguez <luis.rodriguez@opendeusto.es>
+#         Pablo Orduña <pablo@ordunya.com>
 #
 
+import time
+import threading
+from collections import deque
+
+import voodoo.log as log
+import voodoo.counter as counter
+from voodoo.sessions import generator as SessionGenerator
+
+import weblab.lab.exc as LaboratoryErrors
+
 STATUS_RUNNING  = "running"
 STATUS_OK       = "ok"
 STATUS_ERROR    = "error"
 
-# TODO: The following class seems to actually be not necessary. Consider removing
-# this whole file.
-#
-#class AsyncRequest(object):
-#    """
-#    Contains information about the state and result of an asynchronous request.
-#    """
-#
-#    def __init__(self, request_id, threadobj = None):
-#        """
-#        Creates a new AsyncRequest object, which will be identified
-#        through its request_id.
-#        """
-#        self._request_id = request_id
-#        self._status = STATUS_RUNNING
-#        self._command = None
-#        self._contents = None
-#        self._thread = threadobj
-#
-#    def get_contents(self):
-#        """
-#        Retrieves the contents field of the async request. If the content has finished
-#        successfully, that will be the response text. If it has failed, it will be
-#        the error message.
-#        """
-#        return self._command
-#
-#    def get_request_id(self):
-#        """ Retrieves the request's identifier. """
-#        return self._request_id
-#
-#    def get_status(self):
-#        """ Retrieves the request's status. """
-#        return self._status
-#
-#    def get_thread(self):
-#        """
-#        Retrieves the thread object that is running the request.
-#        May return None.
-#        """
-#        return self._thread
\ No newline at end of file
+DEFAULT_WORKERS                 = 10
+DEFAULT_MAX_PENDING_PER_SESSION = 50
+DEFAULT_RESULT_TTL              = 600 # seconds
+# A waiting get_status holds one of the pooled connections of the core server
+# to this laboratory (see rpc_client_pool_size), so it must be short
+DEFAULT_MAX_WAIT                = 5   # seconds
+
+# Idle workers finish after this time, so an idle laboratory does not keep threads
+WORKER_IDLE_TIMEOUT = 30 # seconds
+
+class AsyncRequest(object):
+    """
+    Contains information about the state and result of an asynchronous request.
+    """
+
+    def __init__(self, request_id, session_id, func, args, kwargs):
+        self.request_id = request_id
+        self.session_id = session_id
+        self.func       = func
+        self.args       = args
+        self.kwargs     = kwargs
+
+        self.finished   = False
+        self.result     = None
+        self.raised_exc = None
+
+    def get_status(self):
+        """ Returns (status, contents), as returned by check_async_command_status """
+        if not self.finished:
+            return STATUS_RUNNING, None
+        if self.raised_exc is not None:
+            return STATUS_ERROR, str(self.raised_exc)
+        return STATUS_OK, self.result.get_command_string()
+
+class AsyncRequestEngine(object):
+    """
+    Runs the asynchronous requests of the laboratory server in a bounded
+    pool of workers. Each session has its own queue, and the workers take
+    the requests of the sessions in turns, so a session sending many
+    requests does not delay the rest. The results are kept until they are
+    retrieved through get_status, the session is freed or they expire.
+    """
+
+    def __init__(self, workers = DEFAULT_WORKERS, max_pending_per_session = DEFAULT_MAX_PENDING_PER_SESSION,
+                        result_ttl = DEFAULT_RESULT_TTL, max_wait = DEFAULT_MAX_WAIT, time_func = time.time):
+        self._max_workers             = workers
+        self._max_pending_per_session = max_pending_per_session
+        self._result_ttl              = result_ttl
+        self._max_wait                = max_wait
+        self._time                    = time_func
+
+        self._lock        = threading.Lock()
+        self._work        = threading.Condition(self._lock) # new requests queued
+        self._finished    = threading.Condition(self._lock) # requests finished
+
+        self._queues      = {}      # { session_id : deque([ request ]) } of not started requests
+        self._ready       = deque() # session_ids with queued requests, in turns
+        self._requests    = {}      # { session_id : { request_id : request } } not yet retrieved
+        self._pending     = {}      # { session_id : number of requests not finished }
+        self._expirations = deque() # [ (expiration time, session_id, request_id) ] of finished requests
+
+        self._workers      = []
+        self._idle_workers = 0
+        self._stopped      = False
+
+    def submit(self, session_id, func, *args, **kwargs):
+        """ Queues func(*args, **kwargs) for the session. Returns the request identifier.
+        Raises TooManyAsyncRequestsError if the session has too many unfinished requests. """
+        request_id = SessionGenerator.SessionGenerator().generate_id(16)
+        request = AsyncRequest(request_id, session_id, func, args, kwargs)
+
+        with self._lock:
+            self._purge_expired()
+            pending = self._pending.get(session_id, 0)
+            if pending >= self._max_pending_per_session:
+                raise LaboratoryErrors.TooManyAsyncRequestsError("Too many pending asynchronous requests (%s) in this session" % pending)
+
+            self._pending[session_id] = pending + 1
+            self._requests.setdefault(session_id, {})[request_id] = request
+            if session_id not in self._queues:
+                self._queues[session_id] = deque()
+                self._ready.append(session_id)
+            self._queues[session_id].append(request)
+
+            if self._idle_workers == 0 and len(self._workers) < self._max_workers:
+                self._start_worker()
+            else:
+                self._work.notify()
+
+        return request_id
+
+    def get_status(self, session_id, request_identifiers, wait = 0):
+        """
+        Returns { request_id : (status, contents) } for the requests of the session.
+        The requests reported as finished are removed, and those not found are ignored.
+        If wait is provided (in seconds), and none of the requests has finished, it
+        waits until one of them finishes or the time passes, so clients do not need
+        to poll continuously.
+        """
+        wait = min(wait or 0, self._max_wait)
+        deadline = self._time() + wait
+
+        with self._lock:
+            self._purge_expired()
+            requests = self._requests.get(session_id, {})
+            current_requests = [ requests[request_id] for request_id in request_identifiers if request_id in requests ]
+            while current_requests and not any([ request.finished for request in current_requests ]):
+                remaining = deadline - self._time()
+                if remaining <= 0 or self._stopped:
+                    break
+                self._finished.wait(remaining)
+                # It might have been freed meanwhile
+                requests = self._requests.get(session_id, {})
+                current_requests = [ request for request in current_requests if request.request_id in requests ]
+
+            response = {}
+            for request in current_requests:
+                response[request.request_id] = request.get_status()
+                if request.finished:
+                    requests.pop(request.request_id, None)
+            if not requests:
+                self._requests.pop(session_id, None)
+            return response
+
+    def free_session(self, session_id):
+        """ Discards the queued requests and the results of the session. The running
+        requests will finish, but their results will be discarded. """
+        with self._lock:
+            queue = self._queues.pop(session_id, None)
+            if queue is not None:
+                self._ready.remove(session_id)
+            self._requests.pop(session_id, None)
+            self._pending.pop(session_id, None)
+            self._finished.notify_all()
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            workers = self._workers[:]
+            self._work.notify_all()
+            self._finished.notify_all()
+
+        for worker in workers:
+            worker.join()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'workers' : len(self._workers),
+                'idle_workers' : self._idle_workers,
+                'queued' : sum([ len(queue) for queue in self._queues.values() ]),
+                'pending' : sum(self._pending.values()),
+                'results' : sum([ len(requests) for requests in self._requests.values() ]),
+            }
+
+    def _purge_expired(self):
+        now = self._time()
+        while self._expirations and self._expirations[0][0] <= now:
+            _, session_id, request_id = self._expirations.popleft()
+            requests = self._requests.get(session_id)
+            if requests is not None:
+                requests.pop(request_id, None)
+                if not requests:
+                    self._requests.pop(session_id, None)
+
+    def _start_worker(self):
+        worker = threading.Thread(target = self._run_worker, name = counter.next_name("AsyncRequestWorker"))
+        worker.setDaemon(True)
+        self._workers.append(worker)
+        worker.start()
+
+    def _next_request(self, worker):
+        """ Waits for the next request in turns. Returns None if the worker must finish. """
+        with self._lock:
+            while not self._ready:
+                if self._stopped:
+                    self._workers.remove(worker)
+                    return None
+
+                self._idle_workers += 1
+                try:
+                    self._work.wait(WORKER_IDLE_TIMEOUT)
+                finally:
+                    self._idle_workers -= 1
+
+                if not self._ready and not self._stopped:
+                    self._workers.remove(worker)
+                    return None
+
+            session_id = self._ready.popleft()
+            queue = self._queues[session_id]
+            request = queue.popleft()
+            if queue:
+                self._ready.append(session_id)
+            else:
+                del self._queues[session_id]
+            return request
+
+    def _run_worker(self):
+        worker = threading.currentThread()
+        while True:
+            request = self._next_request(worker)
+            if request is None:
+                return
+
+            try:
+                request.result = request.func(*request.args, **request.kwargs)
+            except Exception as e:
+                request.raised_exc = e
+                log.log( AsyncRequestEngine, log.level.Warning, "Exception running async request: %s" % e )
+                log.log_exc( AsyncRequestEngine, log.level.Info )
+
+            with self._lock:
+                request.finished = True
+                if request.session_id in self._pending:
+                    self._pending[request.session_id] -= 1
+                    self._expirations.append((self._time() + self._result_ttl, request.session_id, request.request_id))
+                self._finished.notify_all()
+
@@ -38,6 +38,9 @@ class FailedToSendFileError(FailedToInteractError):
 class FailedToSendCommandError(FailedToInteractError):
     pass
 
+class TooManyAsyncRequestsError(FailedToInteractError):
+    pass
+
 class SessionNotFoundInLaboratoryServerError(LaboratoryError):
     pass
 
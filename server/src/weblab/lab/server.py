@@ -16,6 +16,7 @@
 #
 
 import re
+import time
 
 import voodoo.log as log
 from voodoo.log import logged
@@ -24,7 +25,7 @@ import voodoo.sessions.session_type as SessionType
 import voodoo.gen.coordinator.CoordAddress as CoordAddress
 import voodoo.gen.exceptions.exceptions as GeneratorErrors
 
-from voodoo.threaded import threaded
+from voodoo.threaded import run_concurrently
 import weblab.lab.async_request as AsyncRequest
 
 import weblab.lab.exc as LaboratoryErrors
@@ -43,7 +44,7 @@ import weblab.lab.status_handler as IsUpAndRunningHandler
 import weblab.experiment.level as ExperimentApiLevel
 
 import voodoo.sessions.manager as SessionManager
-from voodoo.sessions import generator as SessionGenerator
+import voodoo.sessions.session_id as SessionId
 import json
 
 check_session_params = (
@@ -59,6 +60,16 @@ DEFAULT_WEBLAB_LABORATORY_SERVER_SESSION_POOL_ID = "LaboratoryServer"
 WEBLAB_LABORATORY_SERVER_ASSIGNED_EXPERIMENTS    = "laboratory_assigned_experiments"
 WEBLAB_LABORATORY_EXCLUDE_CHECKING               = "laboratory_exclude_checking"
 DEFAULT_WEBLAB_LABORATORY_EXCLUDE_CHECKING       = []
+WEBLAB_LABORATORY_ASYNC_WORKERS                  = "laboratory_async_workers"
+WEBLAB_LABORATORY_ASYNC_MAX_PENDING              = "laboratory_async_max_pending_per_session"
+WEBLAB_LABORATORY_ASYNC_RESULT_TTL               = "laboratory_async_result_ttl"
+WEBLAB_LABORATORY_ASYNC_MAX_WAIT                 = "laboratory_async_max_wait"
+WEBLAB_LABORATORY_CHECKS_WORKERS                 = "laboratory_checks_workers"
+DEFAULT_WEBLAB_LABORATORY_CHECKS_WORKERS         = 10
+WEBLAB_LABORATORY_CHECKS_TIMEOUT                 = "laboratory_checks_timeout"
+DEFAULT_WEBLAB_LABORATORY_CHECKS_TIMEOUT         = 30 # seconds
+WEBLAB_LABORATORY_CHECKS_HEALTHY_CACHE_TIME      = "laboratory_checks_healthy_cache_time"
+DEFAULT_WEBLAB_LABORATORY_CHECKS_HEALTHY_CACHE_TIME = 0 # seconds
 
 DEBUG = False
 
@@ -91,10 +102,17 @@ class LaboratoryServer(object):
         self._locator               = locator
         self._cfg_manager           = cfg_manager
 
-        # This dictionary will be used to store the ongoing and not-yet-queried
-        # async requests. They will be stored by session.
-        # TODO: Consider refactoring this.
-        self._async_requests = {}
+        # The async requests run in a bounded pool of workers, and their
+        # results are kept (by session) until they are queried.
+        self._async_requests = AsyncRequest.AsyncRequestEngine(
+                workers                 = cfg_manager.get_value(WEBLAB_LABORATORY_ASYNC_WORKERS, AsyncRequest.DEFAULT_WORKERS),
+                max_pending_per_session = cfg_manager.get_value(WEBLAB_LABORATORY_ASYNC_MAX_PENDING, AsyncRequest.DEFAULT_MAX_PENDING_PER_SESSION),
+                result_ttl              = cfg_manager.get_value(WEBLAB_LABORATORY_ASYNC_RESULT_TTL, AsyncRequest.DEFAULT_RESULT_TTL),
+                max_wait                = cfg_manager.get_value(WEBLAB_LABORATORY_ASYNC_MAX_WAIT, AsyncRequest.DEFAULT_MAX_WAIT),
+            )
+
+        # Last result of each handler: { handler_repr : (time, messages) }
+        self._handler_results = {}
 
         self._load_assigned_experiments()
 
@@ -292,11 +310,8 @@ class LaboratoryServer(object):
         experiment_response = None
         try:
             # Remove the async requests whose results we have not retrieved.
-            # It seems that they might still be running when free gets called.
-            # TODO: Consider possible issues.
-            session_id = session['session_id']
-            if session_id in self._async_requests:
-                del self._async_requests[session_id]
+            # Those still running will finish, but their results are discarded.
+            self._async_requests.free_session(session['session_id'])
 
             experiment_instance_id = session['experiment_instance_id']
             try:
@@ -402,6 +417,7 @@ class LaboratoryServer(object):
         all_handlers = {
             # checker_repr : ( checker, [ experiment_instance_id1, experiment_instance_id2, ... ])
         }
+        experiment_instance_ids_to_check = []
 
         for experiment_instance_id in experiment_instance_ids:
             if experiment_instance_id.to_weblab_str() in exclude_checking:
@@ -420,19 +436,49 @@ class LaboratoryServer(object):
                 else:
                     all_handlers[handler_repr] = (handlers[handler_repr], [ experiment_instance_id ])
 
-            # Try to call the WebLab service
-            experiment_coord_address = self._assigned_experiments.get_coord_address(experiment_instance_id)
-            try:
-                self._locator.check_server_at_coordaddr(experiment_coord_address, ServerType.Experiment)
-            except Exception as e:
-                failing_experiment_instance_ids[experiment_instance_id] = str(e)
-                self.log_error(experiment_instance_id, str(e))
+            experiment_instance_ids_to_check.append(experiment_instance_id)
 
         # In VISIR, for instance, there might be 60 or 80 handlers pointing to the same server. There
         # is no need to contact that server so many times. So we collect all the checkers and run only
-        # once each unique checker.
-        for checker, experiment_instance_ids in all_handlers.values():
-            handler_messages = checker.run_times()
+        # once each unique checker. Those which were working a moment ago are not checked again.
+        healthy_cache_time = self._cfg_manager.get_value(WEBLAB_LABORATORY_CHECKS_HEALTHY_CACHE_TIME, DEFAULT_WEBLAB_LABORATORY_CHECKS_HEALTHY_CACHE_TIME)
+        now = time.time()
+        for handler_repr in all_handlers.keys():
+            last_time, last_messages = self._handler_results.get(handler_repr, (None, None))
+            if last_time is not None and not last_messages and now - last_time < healthy_cache_time:
+                all_handlers.pop(handler_repr)
+
+        # All the checks (calling each WebLab service and running each handler) are run concurrently,
+        # so a resource which does not reply does not delay the rest
+        tasks = []
+        for experiment_instance_id in experiment_instance_ids_to_check:
+            experiment_coord_address = self._assigned_experiments.get_coord_address(experiment_instance_id)
+            tasks.append((('experiment', experiment_instance_id), self._locator.check_server_at_coordaddr, (experiment_coord_address, ServerType.Experiment)))
+        for handler_repr, (checker, _) in all_handlers.iteritems():
+            tasks.append((('handler', handler_repr), checker.run_times, ()))
+
+        workers = self._cfg_manager.get_value(WEBLAB_LABORATORY_CHECKS_WORKERS, DEFAULT_WEBLAB_LABORATORY_CHECKS_WORKERS)
+        timeout = self._cfg_manager.get_value(WEBLAB_LABORATORY_CHECKS_TIMEOUT, DEFAULT_WEBLAB_LABORATORY_CHECKS_TIMEOUT)
+
+        handler_results = {
+            # checker_repr : messages
+        }
+        for (kind, key), finished_ok, result in run_concurrently(tasks, workers, timeout):
+            if kind == 'experiment':
+                # Try to call the WebLab service
+                if not finished_ok:
+                    failing_experiment_instance_ids[key] = str(result)
+                    self.log_error(key, str(result))
+            else:
+                if finished_ok:
+                    handler_messages = result
+                else:
+                    handler_messages = [ "%s: %s" % (type(result).__name__, str(result)) ]
+                self._handler_results[key] = (time.time(), handler_messages)
+                handler_results[key] = handler_messages
+
+        for handler_repr, (checker, experiment_instance_ids) in all_handlers.iteritems():
+            handler_messages = handler_results[handler_repr]
 
             if len(handler_messages) > 0:
                 error_message = '; '.join(handler_messages)
@@ -554,11 +600,10 @@ class LaboratoryServer(object):
 
 
     @logged(log.level.Info)
-    @threaded()
     def _send_async_file_t(self, session, file_content, file_info):
         """
         This method is used for asynchronously calling the experiment server's
-        send_file_to_device, and for that purpose runs on its own thread.
+        send_file_to_device, and for that purpose runs in the async requests workers.
         This implies that its response will arrive asynchronously to the client.
         """
         
@@ -587,95 +632,57 @@ class LaboratoryServer(object):
     @caller_check(ServerType.UserProcessing)
     def do_send_async_file(self, session, file_content, file_info):
         """
-        Runs the experiment server's send_file_to_device asynchronously, by running the
-        call on its own thread and storing the result, to be returned through the
-        check_async_command_status request.
+        Runs the experiment server's send_file_to_device asynchronously, by queuing the
+        call in the async requests workers and storing the result, to be returned through
+        the check_async_command_status request.
 
         @param session: Session
-        @param request_identifiers: List of request identifiers whose status to check.
-        @return A dictionary with each request identifier as key and a (status, contents) tuple as values.
-        The status can either be "ok", if the request is done, "error", if it failed, and "running", if it
-        has not finished yet. In the first two cases, contents will return the response.
+        @param file_content: Content of the file to send
+        @param file_info: Information about the file
+        @return The identifier of the request
         """
-
-        # Call the async method which will run on its own thread. Store the object
-        # it returns, so that we can know whether it has finished.
-        threadobj = self._send_async_file_t(session, file_content, file_info)
-
-        # Create a new identifier for the new request
-        # TODO: Consider refactoring this
-        gen = SessionGenerator.SessionGenerator()
-        request_id = gen.generate_id(16)
-
-        # Store the new request in our dictionary
-        session_id = session['session_id']
-        if(session_id not in self._async_requests):
-            self._async_requests[session_id] = {}
-        self._async_requests[session_id][request_id] = threadobj
-
-        return request_id
+        try:
+            return self._async_requests.submit(session['session_id'], self._send_async_file_t, session, file_content, file_info)
+        except LaboratoryErrors.TooManyAsyncRequestsError as e:
+            raise LaboratoryErrors.FailedToSendFileError("Couldn't send async file: %s" % str(e))
 
 
     @logged(log.level.Info)
-    @check_session(*check_session_params)
     @caller_check(ServerType.UserProcessing)
-    def do_check_async_command_status(self, session, request_identifiers):
+    def do_check_async_command_status(self, lab_session_id, request_identifiers, wait = 0):
         """
         Checks the status of several asynchronous commands.
         Note that at this respect there is no difference between a standard async command and an async send_file.
         This method will work for either, and request_identifiers of both types can be mixed freely.
         Requests reported as finished (either successfully or not) will be removed.
 
-        @param session: Session
+        @param lab_session_id: Laboratory session identifier
         @param request_identifiers: List of request identifiers whose status to check.
+        @param wait: If none of the requests has finished, seconds to wait for any of them to finish
+        (limited by laboratory_async_max_wait), instead of returning immediately.
         @return A dictionary with each request identifier as key and a (status, contents) tuple as values.
         The status can either be "ok", if the request is done, "error", if it failed, and "running", if it
         has not finished yet. In the first two cases, contents will return the response.
         """
 
-        session_id = session['session_id']
-        if(session_id not in self._async_requests):
-            self._async_requests[session_id] = {}
-
-        # Build and return a dictionary with information about the status of every
-        # specified async command.
-        response = {}
-        for req_id in request_identifiers:
-
-            # If one of the specified request ids does not seem to exist, we
-            # will simply ignore it and return nothing about it. We will handle
-            # the remaining request ids normally.
-            # TODO: Consider whether doing this is appropriate.
-            if( req_id not in self._async_requests[session_id] ):
-                continue
-
-            req = self._async_requests[session_id][req_id]
-
-            status = None
-            contents = None
-
-            if(req.raised_exc is not None):
-                status = AsyncRequest.STATUS_ERROR
-                contents = str(req.raised_exc)
-                del self._async_requests[session_id][req_id]
-            elif(req.finished_ok == True):
-                status = AsyncRequest.STATUS_OK
-                contents = req.result.get_command_string()
-                del self._async_requests[session_id][req_id]
-            else:
-                status = AsyncRequest.STATUS_RUNNING
+        # The session is not locked (as check_session would do), since this might wait
+        # for the requests to finish, and meanwhile other requests may use the session.
+        if isinstance(lab_session_id, basestring):
+            lab_session_id = SessionId.SessionId(lab_session_id)
 
+        if not self._session_manager.has_session(lab_session_id):
+            raise LaboratoryErrors.SessionNotFoundInLaboratoryServerError("Laboratory Server session not found")
 
-            response[req_id] = (status, contents)
-
-        return response
+        # If one of the specified request ids does not seem to exist, we
+        # will simply ignore it and return nothing about it. We will handle
+        # the remaining request ids normally.
+        return self._async_requests.get_status(lab_session_id, request_identifiers, wait)
 
     @logged(log.level.Info)
-    @threaded()
     def _send_async_command_t(self, session, command):
         """
         This method is used for asynchronously calling the experiment server's
-        send_command_to_device, and for that purpose runs on its own thread.
+        send_command_to_device, and for that purpose runs in the async requests workers.
         This implies that its response will arrive asynchronously to the client.
         """
         
@@ -703,27 +710,15 @@ class LaboratoryServer(object):
     @caller_check(ServerType.UserProcessing)
     def do_send_async_command(self, session, command):
         """
-        Runs the experiment server's send_command_to_device asynchronously, by running the
-        call on its own thread and storing the result, to be returned through the
-        check_async_command_status request.
+        Runs the experiment server's send_command_to_device asynchronously, by queuing the
+        call in the async requests workers and storing the result, to be returned through
+        the check_async_command_status request.
 
         @param session: Session
         @param command: Command to execute asynchronously
+        @return The identifier of the request
         """
-
-        # Call the async method which will run on its own thread. Store the object
-        # it returns, so that we can know whether it has finished.
-        threadobj = self._send_async_command_t(session, command)
-
-        # Create a new identifier for the new request
-        # TODO: Consider refactoring this
-        gen = SessionGenerator.SessionGenerator()
-        request_id = gen.generate_id(16)
-
-        # Store the new request in our dictionary
-        session_id = session['session_id']
-        if(session_id not in self._async_requests):
-            self._async_requests[session_id] = {}
-        self._async_requests[session_id][request_id] = threadobj
-
-        return request_id
+        try:
+            return self._async_requests.submit(session['session_id'], self._send_async_command_t, session, command)
+        except LaboratoryErrors.TooManyAsyncRequestsError as e:
+            raise LaboratoryErrors.FailedToSendCommandError("Couldn't send async command: %s" % str(e))
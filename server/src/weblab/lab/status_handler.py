@@ -37,16 +37,22 @@ VALID_IMAGE_FORMATS = ('image/jpg','image/png','image/jpeg')
 
 class AbstractLightweightIsUpAndRunningHandler(object):
 
-    DEFAULT_TIMES = 1
+    DEFAULT_TIMES   = 1
+    DEFAULT_TIMEOUT = 10 # seconds, per attempt
 
     __metaclass__ = ABCMeta
 
-    def __init__(self, times = None):
+    def __init__(self, times = None, timeout = None):
         if times is not None:
             self.times = times
         else:
             self.times = self.DEFAULT_TIMES
 
+        if timeout is not None:
+            self.timeout = timeout
+        else:
+            self.timeout = self.DEFAULT_TIMEOUT
+
     def run_times(self):
         messages = []
         for _ in xrange(self.times):
@@ -78,6 +84,7 @@ class HostIsUpAndRunningHandler(AbstractLightweightIsUpAndRunningHandler):
     @Override(AbstractLightweightIsUpAndRunningHandler)
     def run(self):
         s = self._socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(self.timeout)
         try:
             s.connect((self.hostname, self.port))
         except socket.error as e:
@@ -100,8 +107,8 @@ class WebcamIsUpAndRunningHandler(AbstractLightweightIsUpAndRunningHandler):
     @Override(AbstractLightweightIsUpAndRunningHandler)
     def run(self):
         try:
-            response = self._urllib2.urlopen(self.img_url)
-        except urllib2.URLError as e:
+            response = self._urllib2.urlopen(self.img_url, timeout = self.timeout)
+        except (urllib2.URLError, socket.error) as e:
             raise labExc.ImageURLDidNotRetrieveAResponseError(self.img_url, e)
         if response.headers['content-type'] not in VALID_IMAGE_FORMATS:
             raise labExc.InvalidContentTypeRetrievedFromImageURLError(self.img_url)